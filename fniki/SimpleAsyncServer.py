@@ -3,26 +3,41 @@
 # LICENSE: MIT
 # http://code.activestate.com/help/terms/
 # http://www.opensource.org/licenses/mit-license.php
+#
+# Modifications: Copyright (C) 2009 Darrell Karbott
 
 """A generic, multi-protocol asynchronous server
 
 Usage :
 - create a server on a specific host and port : server = Server(host,port)
-- call the loop() function, passing it the server and the class used to 
+- call the loop() function, passing it the server and the class used to
 manage the protocol (a subclass of ClientHandler) : loop(server,ProtocolClass)
 
 An example of protocol class is provided, LengthSepBody : the client sends
 the message length, the line feed character and the message body
+
+Sockets are watched with the selectors module, so each pass through the
+loop only costs something for the sockets which are ready. Handlers can
+ask for slow requests to be run on a small pool of worker threads so that
+one slow response doesn't hold up every other client. Connections stay
+open for more requests unless the handler sets close_when_done, and are
+closed after sitting idle for the loop timeout.
 """
 
-import io
+import collections
+import os
+import selectors
 import socket
-import select
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # the dictionary holding one client handler for each connected client
 # key = client socket, value = instance of (a subclass of) ClientHandler
 client_handlers = {}
 
+# Number of threads used to run slow requests.
+DEFAULT_WORKERS = 4
+
 # =======================================================================
 # The server class. Creating an instance starts a server on the specified
 # host and port
@@ -35,7 +50,63 @@ class Server:
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.setblocking(0)
         self.socket.bind((host,port))
-        self.socket.listen(5)
+        self.socket.listen(64)
+        # Set by loop().
+        self.selector = None
+        self.pool = None
+        # Wakes up the loop when a worker finishes.
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(0)
+        self.wake_send.setblocking(0)
+        # (handler, response, exception) tuples from the workers.
+        self.finished = collections.deque()
+
+    def set_events(self, client_socket, events):
+        """Watch client_socket for events. 0 stops watching it"""
+        if self.selector is None:
+            return # loop() isn't running
+        try:
+            key = self.selector.get_key(client_socket)
+        except KeyError:
+            key = None
+        if key is None:
+            if events:
+                self.selector.register(client_socket, events)
+        elif not events:
+            self.selector.unregister(client_socket)
+        elif key.events != events:
+            self.selector.modify(client_socket, events)
+
+    def run_in_worker(self, handler):
+        """Build the handler's response on a worker thread"""
+        def done(future):
+            # Runs on the worker thread.
+            exception = future.exception()
+            response = None
+            if exception is None:
+                response = future.result()
+            self.finished.append((handler, response, exception))
+            try:
+                self.wake_send.send(b'x')
+            except socket.error:
+                pass # Already has a wake up pending.
+        self.pool.submit(handler.make_response).add_done_callback(done)
+
+    def deliver_finished(self):
+        """Hand responses built by the workers back to their handlers"""
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self.finished:
+            handler, response, exception = self.finished.popleft()
+            if handler.closed:
+                continue
+            if not exception is None:
+                handler.handle_error()
+                continue
+            handler.set_response(response)
 
 # =====================================================================
 # Generic client handler. An instance of this class is created for each
@@ -44,83 +115,166 @@ class Server:
 class ClientHandler:
 
     blocksize = 2048
+    # Incoming data beyond this is refused. See handle_overflow().
+    max_incoming = 1 << 20
 
     def __init__(self, server, client_socket, client_address):
         self.server = server
         self.client_address = client_address
         self.client_socket = client_socket
         self.client_socket.setblocking(0)
-        self.host = socket.getfqdn(client_address[0])
-        self.incoming = '' # receives incoming data
+        # Not getfqdn(). A slow DNS lookup would stall every client.
+        self.host = client_address[0]
+        self.incoming = bytearray() # receives incoming data
+        # Bytes of self.incoming used by the current request. None means
+        # all of it.
+        self.request_length = None
+        self.response = None
         self.writable = False
+        self.busy = False # a worker is building the response
+        self.closed = False
         self.close_when_done = True
- 
+        # Offset into the file at the front of self.response.
+        self.file_offset = 0
+        self.last_active = time.time()
+
     def handle_error(self):
         self.close()
-        
+
     def handle_read(self):
         """Reads the data received"""
         try:
-            buff = self.client_socket.recv(1024)
-            if not buff:  # the connection is closed
-                self.close()
-            # buffer the data in self.incoming
-            self.incoming += buff #.write(buff)
-            self.process_incoming()
+            buff = self.client_socket.recv(65536)
+        except BlockingIOError:
+            return
         except socket.error:
             self.close()
+            return
+        if not buff:  # the connection is closed
+            self.close()
+            return
+        self.last_active = time.time()
+        # buffer the data in self.incoming
+        self.incoming += buff
+        if len(self.incoming) > self.max_incoming:
+            self.handle_overflow()
+            return
+        self.process_incoming()
+
+    def handle_overflow(self):
+        """Called when more than max_incoming bytes are buffered
+        Override this method in subclasses"""
+        self.close()
 
     def process_incoming(self):
         """Test if request is complete ; if so, build the response
         and set self.writable to True"""
+        if self.busy or self.writable or self.closed:
+            return
         if not self.request_complete():
             return
-        self.response = self.make_response()
+        if self.run_in_worker():
+            self.busy = True
+            # Don't read the next request until this one is answered.
+            self.server.set_events(self.client_socket, 0)
+            self.server.run_in_worker(self)
+            return
+        self.set_response(self.make_response())
+
+    def set_response(self, response):
+        """Start sending response"""
+        self.busy = False
+        self.response = response
+        self.file_offset = 0
         self.writable = True
+        self.server.set_events(self.client_socket, selectors.EVENT_WRITE)
 
     def request_complete(self):
         """Return True if the request is complete, False otherwise
         Override this method in subclasses"""
         return True
-    
+
+    def run_in_worker(self):
+        """Return True if make_response() should run on a worker thread
+        Override this method in subclasses"""
+        return False
+
     def make_response(self):
         """Return the list of strings or file objects whose content will
         be sent to the client
         Override this method in subclasses"""
-        return ["xxx"]
+        return [b"xxx"]
 
     def handle_write(self):
-        """Send (a part of) the response on the socket
+        """Send as much of the response as the socket will take
         Finish the request if the whole response has been sent
         self.response is a list of strings or file objects
         """
-        # get next piece of data from self.response
-        buff = ''
-        while self.response and not buff:
-            if isinstance(self.response[0],str):
-                buff = self.response.pop(0)
-            else:
-                buff = self.response[0].read(self.blocksize)
-                if not buff:
+        self.last_active = time.time()
+        try:
+            while self.response:
+                if isinstance(self.response[0], (bytes, memoryview)):
+                    sent = self.client_socket.send(self.response[0])
+                    if sent < len(self.response[0]):
+                        self.response[0] = memoryview(self.response[0])[sent:]
+                        return
                     self.response.pop(0)
-        if buff:
-            try:
-                self.client_socket.sendall(buff)
-            except socket.error:
-                self.close()
-            if self.response:
-                return
+                elif not self.send_file(self.response[0]):
+                    self.response.pop(0).close()
+                    self.file_offset = 0
+        except BlockingIOError:
+            return
+        except socket.error:
+            self.close()
+            return
         # nothing left in self.response
         if self.close_when_done:
             self.close() # close socket
+            return
+        # reset for next request
+        self.writable = False
+        self.response = None
+        if self.request_length is None:
+            del self.incoming[:]
         else:
-            # reset for next request
-            self.writable = False
-            self.incoming = ''
-    
+            del self.incoming[:self.request_length]
+        self.request_length = None
+        self.server.set_events(self.client_socket, selectors.EVENT_READ)
+        if self.incoming:
+            # The client sent the next request without waiting.
+            self.process_incoming()
+
+    def send_file(self, in_file):
+        """Send the next part of a file. Returns False at the end"""
+        if hasattr(os, 'sendfile'):
+            try:
+                sent = os.sendfile(self.client_socket.fileno(),
+                                   in_file.fileno(), self.file_offset,
+                                   1 << 20)
+                self.file_offset += sent
+                return sent > 0
+            except (OSError, AttributeError) as err:
+                if isinstance(err, BlockingIOError):
+                    raise
+                # Not a regular file, or no zero copy for it.
+        in_file.seek(self.file_offset)
+        buff = in_file.read(self.blocksize)
+        if not buff:
+            return False
+        self.file_offset += self.client_socket.send(buff)
+        return True
+
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.set_events(self.client_socket, 0)
         del client_handlers[self.client_socket]
         self.client_socket.close()
+        for item in self.response or ():
+            if not isinstance(item, (bytes, memoryview)):
+                item.close()
+        self.response = None
 
 # ==============================================================
 # A protocol with message length + line feed (\n) + message body
@@ -131,7 +285,7 @@ class LengthSepBody(ClientHandler):
     def request_complete(self):
         """The request is complete if the separator is present and the
         number of bytes received equals the specified message length"""
-        recv = self.incoming.split('\n',1)
+        recv = bytes(self.incoming).split(b'\n',1)
         if len(recv)==1 or len(recv[1]) != int(recv[0]):
             return False
         self.msg_body = recv[1]
@@ -142,36 +296,51 @@ class LengthSepBody(ClientHandler):
         return [self.msg_body]
 
 # ============================================================================
-# Main loop, calling the select() function on the sockets to see if new 
-# clients are trying to connect, if some clients have sent data and if those
-# for which the response is complete are ready to receive it
-# For each event, call the appropriate method of the server or of the instance
-# of ClientHandler managing the dialog with the client : handle_read() or 
-# handle_write()
+# Main loop. The selector reports new clients trying to connect, clients
+# which have sent data and clients which are ready to receive more of their
+# response. For each event, call the appropriate method of the server or of
+# the instance of ClientHandler managing the dialog with the client :
+# handle_read() or handle_write()
+#
+# Connections with nothing to do for more than timeout seconds are closed.
 # ============================================================================
-def loop(server,handler,timeout=30):
-    while True:
-        k = list(client_handlers.keys())
-        # w = sockets to which there is something to send
-        # we must test if we can send data
-        w = [ cl for cl in client_handlers if client_handlers[cl].writable ]
-        # the heart of the program ! "r" will have the sockets that have sent
-        # data, and the server socket if a new client has tried to connect
-        r,w,e = select.select(k+[server.socket],w,k,timeout)
-        for e_socket in e:
-            client_handlers[e_socket].handle_error()
-        for r_socket in r:
-            if r_socket is server.socket:
-                # server socket readable means a new connection request
-                try:
-                    client_socket,client_address = server.socket.accept()
+def loop(server,handler,timeout=30,workers=DEFAULT_WORKERS):
+    server.selector = selectors.DefaultSelector()
+    server.selector.register(server.socket, selectors.EVENT_READ)
+    server.selector.register(server.wake_recv, selectors.EVENT_READ)
+    server.pool = ThreadPoolExecutor(workers)
+    last_sweep = time.time()
+    try:
+        while True:
+            for key, events in server.selector.select(timeout):
+                sock = key.fileobj
+                if sock is server.socket:
+                    # server socket readable means a new connection request
+                    try:
+                        client_socket,client_address = server.socket.accept()
+                    except socket.error:
+                        continue
                     client_handlers[client_socket] = handler(server,
                         client_socket,client_address)
-                except socket.error:
-                    pass
-            else:
-                # the client connected on r_socket has sent something
-                client_handlers[r_socket].handle_read()
-        w = set(w) & set(client_handlers.keys()) # remove deleted sockets
-        for w_socket in w:
-            client_handlers[w_socket].handle_write()
+                    server.set_events(client_socket, selectors.EVENT_READ)
+                elif sock is server.wake_recv:
+                    server.deliver_finished()
+                elif sock in client_handlers:
+                    if events & selectors.EVENT_READ:
+                        # the client connected on sock has sent something
+                        client_handlers[sock].handle_read()
+                    elif events & selectors.EVENT_WRITE:
+                        client_handlers[sock].handle_write()
+
+            now = time.time()
+            if now - last_sweep < 1.0:
+                continue
+            last_sweep = now
+            for client in list(client_handlers.values()):
+                if (not client.busy and
+                    now - client.last_active > timeout):
+                    client.close()
+    finally:
+        server.pool.shutdown(wait=False)
+        server.selector.close()
+        server.selector = None
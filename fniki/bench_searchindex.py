@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+""" Benchmark piki full text search with and without the index.
+
+    usage: python bench_searchindex.py [page count]
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import piki
+import searchindex
+
+PAGE_COUNT = 20000
+WORDS_PER_PAGE = 300
+VOCABULARY = 5000
+SEARCHES = 20
+
+def make_word(rand, index):
+    """ Return a made up word. """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return (''.join([rand.choice(letters) for dummy in range(rand.randint(3, 9))])
+            + str(index))
+
+def make_page_name(index):
+    """ Return a unique WikiWord for index. """
+    letters = ''
+    while True:
+        letters += chr(ord('a') + index % 26)
+        index //= 26
+        if index == 0:
+            break
+    return 'BenchPage' + letters
+
+def make_wiki(base_dir, page_count):
+    """ Write a wiki with page_count random pages. Returns a list of
+        words used in the pages. """
+    rand = random.Random(42)
+    words = [make_word(rand, index) for index in range(VOCABULARY)]
+    text_dir = os.path.join(base_dir, 'wikitext')
+    os.makedirs(text_dir)
+    os.makedirs(os.path.join(os.path.dirname(base_dir),
+                             'OVERLAY', 'wikitext'))
+    for index in range(page_count):
+        # Zipf-ish, like real text.
+        body = ' '.join([words[int(rand.paretovariate(1.0)) % VOCABULARY]
+                         for dummy in range(WORDS_PER_PAGE)])
+        out_file = open(os.path.join(text_dir, make_page_name(index)),
+                        'w')
+        try:
+            out_file.write(body + '\n')
+        finally:
+            out_file.close()
+    return words
+
+def timed(label, func, count=1):
+    """ Run func count times and print the mean time. """
+    start = time.time()
+    for dummy in range(count):
+        result = func()
+    secs = (time.time() - start) / count
+    print("%-40s %10.4f secs" % (label, secs))
+    return result
+
+def main():
+    """ Run the benchmark. """
+    page_count = PAGE_COUNT
+    if len(sys.argv) > 1:
+        page_count = int(sys.argv[1])
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_searchindex')
+    try:
+        wiki_root = os.path.join(tmp_dir, 'wiki_root')
+        print("Writing %i pages..." % page_count)
+        words = make_wiki(wiki_root, page_count)
+        piki.reset_root_dir(wiki_root, True)
+
+        rare = [words[-index] for index in range(1, SEARCHES + 1)]
+        common = [words[index] for index in range(SEARCHES)]
+
+        print("%i pages, %i words per page" % (page_count, WORDS_PER_PAGE))
+        timed("regex search, rare word", lambda :
+              [piki.regex_fullsearch(word) for word in rare], 1)
+        timed("index build (first search)", lambda :
+              piki.index_fullsearch(rare[0]))
+        timed("index search, rare word", lambda :
+              [piki.index_fullsearch(word) for word in rare], 1)
+        timed("index search, common word", lambda :
+              [piki.index_fullsearch(word) for word in common], 1)
+        for word in rare + common + [word[1:-1] for word in rare]:
+            assert (sorted(piki.index_fullsearch(word)[0])
+                    == sorted(piki.regex_fullsearch(word)[0]))
+
+        name = piki.page_list()[0]
+        full_path = os.path.join(piki.text_dir, name)
+        piki.filefuncs.write(full_path, 'edited %s\n' % rare[0], 'wb')
+        timed("update one page", lambda :
+              piki.update_search_index((name, )))
+        timed("search after editing one page", lambda :
+              piki.index_fullsearch(rare[1]))
+
+        print("Index size: %i bytes" % os.path.getsize(
+            searchindex.index_file_name(wiki_root)))
+        print("(Times for searches are for %i searches.)" % SEARCHES)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
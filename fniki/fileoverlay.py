@@ -20,8 +20,11 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 import codecs
+import errno
 import os
 import stat
+import threading
+import time
 
 # NOTE: There are hard coded references to utf8 in piki.py, submission.py
 #       and hgoverlay.py.  Look there before changing this value.
@@ -58,12 +61,117 @@ class IFileFunctions:
         """ Return True if the instance supports overlaying, False
             otherwise. """
         raise NotImplementedError
+    def fork_index(self, path):
+        """ Return a wiki name -> sorted list of fork versions dict
+            for the pages in path. """
+        return make_fork_index(self.list_pages(path))
+
+def make_fork_index(names):
+    """ Return a wiki name -> sorted list of fork versions dict for
+        a list of page names.
+
+        Forks are named <WikiName>_<40 digit hex version>. """
+    index = {}
+    for name in names:
+        fields = name.split('_')
+        if len(fields) < 2:
+            continue
+        if len(fields[1].strip()) != 40:
+            continue
+        # hmmmm... validate?
+        index.setdefault(fields[0].strip(), set()).add(fields[1].strip())
+
+    for name in index:
+        index[name] = sorted(index[name])
+    return index
+
+# Directory listings are cached in DirSnapshots, which are reused until
+# the directory's modtime changes. Adding, removing or renaming a file
+# changes it. Rewriting a file in place doesn't, so the cached sizes
+# can be stale for files which weren't written with write().
+#
+# A listing made less than RACY_SECS after the directory last changed
+# isn't reused, since a later change might not change the modtime
+# again. Much longer for file systems which only keep whole seconds.
+RACY_SECS = 0.05
+RACY_COARSE_SECS = 2.0
+
+class DirSnapshot:
+    """ The entries in a directory, read with a single scandir(). """
+    def __init__(self, dir_name, with_sizes):
+        self.with_sizes = with_sizes
+        # Regular files, not symlinks. i.e. pages.
+        self.pages = set([])
+        # Every name os.path.exists() is True for.
+        self.existing = set([])
+        # name -> size for the existing entries, if with_sizes.
+        self.sizes = {}
+        # Cached fork_index() result.
+        self.forks = None
+        # (st_mtime_ns, st_ino) of the directory, None if the snapshot
+        # can't be reused.
+        self.stamp = None
+        # When the stamp was last checked.
+        self.checked = time.time()
+        if not os.path.isdir(dir_name):
+            return
+        for entry in os.scandir(dir_name):
+            if entry.is_symlink() or with_sizes:
+                try:
+                    size = entry.stat().st_size # Follows links.
+                except OSError:
+                    continue # Broken link.
+                self.sizes[entry.name] = size
+            if entry.is_file(follow_symlinks=False):
+                self.pages.add(entry.name)
+            self.existing.add(entry.name)
+
+EMPTY_SNAPSHOT = DirSnapshot('', False)
 
 class DirectFiles(IFileFunctions):
     """ An IFileFunctions implementation which writes directly to
         the file system. """
     def __init__(self, base_path):
         IFileFunctions.__init__(self, base_path)
+        # dir name -> DirSnapshot
+        self.snapshots = {}
+        # Snapshots are used without checking the directory for this
+        # many seconds. Changes made through other instances or by other
+        # processes can go unseen for that long.
+        self.max_age = 0.0
+
+    def snapshot(self, dir_name, with_sizes=False):
+        """ INTERNAL: Return a DirSnapshot for dir_name, reusing the last
+            one if the directory hasn't changed since it was made. """
+        now = time.time()
+        snapshot = self.snapshots.get(dir_name)
+        if not snapshot is None and with_sizes and not snapshot.with_sizes:
+            snapshot = None
+        if not snapshot is None and now - snapshot.checked < self.max_age:
+            return snapshot
+        try:
+            info = os.stat(dir_name)
+        except OSError:
+            return EMPTY_SNAPSHOT
+        stamp = (info.st_mtime_ns, info.st_ino)
+        if not snapshot is None and snapshot.stamp == stamp:
+            snapshot.checked = now
+            return snapshot
+
+        snapshot = DirSnapshot(dir_name, with_sizes)
+        racy_secs = RACY_SECS
+        if info.st_mtime_ns % 1000000000 == 0:
+            racy_secs = RACY_COARSE_SECS
+        if now - info.st_mtime_ns / 1e9 > racy_secs:
+            snapshot.stamp = stamp
+        # Atomic, so it's ok for servepiki's worker threads to race here.
+        self.snapshots[dir_name] = snapshot
+        return snapshot
+
+    def invalidate(self, path):
+        """ INTERNAL: Forget the snapshot of the directory containing
+            path. """
+        self.snapshots.pop(os.path.dirname(path), None)
 
     def overlay_path(self, path):
         """ IFileFunctions implementation. """
@@ -75,7 +183,9 @@ class DirectFiles(IFileFunctions):
         # to handle nt refusing to rename to an existing
         # file name.  Not sure if it is a problem on
         # modern windows.
-        tmp_name = path + '.__%s__' % str(os.getpid())
+        # servepiki can save from several threads at once.
+        tmp_name = path + '.__%s_%s__' % (os.getpid(),
+                                          threading.get_ident())
         try:
             out_file = codecs.open(tmp_name, mode, WIKITEXT_ENCODING)
             try:
@@ -89,6 +199,7 @@ class DirectFiles(IFileFunctions):
 
             os.rename(tmp_name, path)
         finally:
+            self.invalidate(path)
             if os.path.exists(tmp_name):
                 os.remove(tmp_name)
 
@@ -103,7 +214,10 @@ class DirectFiles(IFileFunctions):
 
     def exists(self, path, dummy_non_overlayed=False):
         """ IFileFunctions implementation. """
-        return os.path.exists(path)
+        dir_name, name = os.path.split(path)
+        if not name:
+            return os.path.exists(path)
+        return name in self.snapshot(dir_name).existing
 
     def modtime(self, path, dummy_non_overlayed=False):
         """ IFileFunctions implementation. """
@@ -111,9 +225,10 @@ class DirectFiles(IFileFunctions):
 
     def list_pages(self, path, dummy_non_overlayed=False):
         """ IFileFunctions implementation. """
-        return [name for name in os.listdir(path)
-                if (os.path.isfile(os.path.join(path, name)) and
-                    not os.path.islink(os.path.join(path, name)))]
+        if not os.path.isdir(path):
+            # Same error as listdir().
+            raise OSError(errno.ENOENT, "No such directory", path)
+        return list(self.snapshot(path).pages)
 
     def has_overlay(self, dummy_path):
         """ IFileFunctions implementation. """
@@ -127,6 +242,13 @@ class DirectFiles(IFileFunctions):
         """ IFileFunctions implementation. """
         return False
 
+    def fork_index(self, path):
+        """ IFileFunctions implementation. """
+        snapshot = self.snapshot(path)
+        if snapshot.forks is None:
+            snapshot.forks = make_fork_index(snapshot.pages)
+        return snapshot.forks
+
 OVERLAY_DIR = 'OVERLAY'
 
 class OverlayedFiles(DirectFiles):
@@ -142,6 +264,16 @@ class OverlayedFiles(DirectFiles):
     """
     def __init__(self, base_path):
         DirectFiles.__init__(self, base_path)
+        # path -> ((base stamp, overlay stamp), fork index)
+        self.forks = {}
+
+    def overlay_size(self, path):
+        """ INTERNAL: Return the size of the overlayed file for path, or
+            None if there isn't one. """
+        dir_name, name = os.path.split(self.overlay_path(path))
+        if not name:
+            return None
+        return self.snapshot(dir_name, True).sizes.get(name)
 
     def overlay_path(self, path):
         """ Return the path that overlayed writes should be written to. """
@@ -167,9 +299,8 @@ class OverlayedFiles(DirectFiles):
         if non_overlayed:
             return DirectFiles.read(self, path, mode)
 
-        overlayed = self.overlay_path(path)
-        if os.path.exists(overlayed):
-            return DirectFiles.read(self, overlayed, mode)
+        if not self.overlay_size(path) is None:
+            return DirectFiles.read(self, self.overlay_path(path), mode)
 
         return DirectFiles.read(self, path, mode)
 
@@ -179,23 +310,19 @@ class OverlayedFiles(DirectFiles):
         if non_overlayed:
             return DirectFiles.exists(self, path)
 
-        overlay = self.overlay_path(path)
-        if os.path.exists(overlay):
-            if os.path.getsize(overlay) == 0:
-                return False
-            else:
-                return True
+        size = self.overlay_size(path)
+        if not size is None:
+            return size > 0
 
-        return os.path.exists(path)
+        return DirectFiles.exists(self, path)
 
     def modtime(self, path, non_overlayed=False):
         """ IFileFunctions implementation. """
         if non_overlayed:
             return DirectFiles.modtime(self, path)
 
-        overlay = self.overlay_path(path)
-        if os.path.exists(overlay) and os.path.getsize(overlay) > 0:
-            return DirectFiles.modtime(self, overlay)
+        if self.overlay_size(path):
+            return DirectFiles.modtime(self, self.overlay_path(path))
 
         return DirectFiles.modtime(self, path)
 
@@ -204,34 +331,39 @@ class OverlayedFiles(DirectFiles):
         if non_overlayed:
             return DirectFiles.list_pages(self, path)
 
-        overlay = self.overlay_path(path)
-        overlay_pages = set([])
-        if os.path.exists(overlay):
-            overlay_pages = set(DirectFiles.list_pages(self, overlay))
-
-        deleted = set([])
-        for name in overlay_pages:
-            if os.path.getsize(os.path.join(overlay, name)) == 0:
-                deleted.add(name)
+        overlay = self.snapshot(self.overlay_path(path), True)
+        deleted = set([name for name in overlay.pages
+                       if overlay.sizes.get(name) == 0])
 
-        return list(overlay_pages.union(
+        return list(overlay.pages.union(
             set(DirectFiles.list_pages(self, path)) - deleted))
 
     # Hmmmm... Returns True for zero length file. i.e. "mark to delete"
     def has_overlay(self, path):
         """ IFileFunctions implementation. """
-        return os.path.exists(self.overlay_path(path))
+        return not self.overlay_size(path) is None
 
     def remove_overlay(self, path):
         """ IFileFunctions implementation. """
         overlay = self.overlay_path(path)
         if os.path.exists(overlay):
             os.remove(overlay)
+            self.invalidate(overlay)
 
     def is_overlayed(self):
         """ IFileFunctions implementation. """
         return True
 
+    def fork_index(self, path):
+        """ IFileFunctions implementation. """
+        stamp = (self.snapshot(path).stamp,
+                 self.snapshot(self.overlay_path(path), True).stamp)
+        cached = self.forks.get(path)
+        if cached is None or cached[0] != stamp or None in stamp:
+            cached = (stamp, make_fork_index(self.list_pages(path)))
+            self.forks[path] = cached
+        return cached[1]
+
 def get_file_funcs(base_path, is_overlayed=False):
     """ Returns an overlayed IFileFunctions implementation if
         is_overlayed is True, and a direct implementation otherwise. """
@@ -240,6 +372,22 @@ def get_file_funcs(base_path, is_overlayed=False):
 
     return OverlayedFiles(base_path)
 
+def dirs_stamp(overlay, path):
+    """ Return a string which changes when files are added to or
+        removed from the directory at path, or its overlay.
+
+        Files rewritten in place don't change it. """
+    dirs = [path, ]
+    if overlay.is_overlayed():
+        dirs.append(overlay.overlay_path(path))
+    values = []
+    for dir_name in dirs:
+        if os.path.isdir(dir_name):
+            values.append(str(os.stat(dir_name).st_mtime_ns))
+        else:
+            values.append('-')
+    return ':'.join(values)
+
 def remove_redundant_files(overlay, wikitext_dir, out_func=lambda msg:None):
     """ Removes files which are identical in the overlayed and non-overlayed
         directories.
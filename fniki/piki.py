@@ -25,13 +25,27 @@
 __version__ = '$Revision: 1.62 $'[11:-2];
 
 import cgi, codecs, sys, string, os, re, errno, time
+import builtins, html, json, threading, traceback
 from os import path, environ
 from socket import gethostbyaddr
 from time import localtime, strftime
 # NOTE: cStringIO doesn't work for unicode.
 from io import StringIO
 import fileoverlay
+import rendercache
 filefuncs = None
+try:
+    import searchindex
+except ImportError:
+    # No sqlite3. Always use regex search.
+    searchindex = None
+
+# Set to False to always search with regular expressions.
+use_search_index = True
+
+# Seconds wiki directory listings are cached for without checking the
+# directories. Edits made outside piki show up after this long.
+SNAPSHOT_SECS = 1.0
 
 # File to redirect sys.stderr to.
 #STDERR_FILE = '/tmp/piki_err' # REDFLAG: Comment out this line
@@ -60,6 +74,52 @@ PIKI_REQUIRED_FILES = (PIKI_PNG, PIKI_CSS, ACTIVELINK)
 scrub_links = False
 LINKS_DISABLED_PAGE = "LinksDisabledWhileEditing"
 
+# Per request state -------------------------------------------------
+#
+# When piki runs as a CGI script the request comes from os.environ and
+# the global form, and output goes to sys.stdout. handle_request() and
+# dump() run requests in process instead. Each thread gets its own
+# RequestContext so several requests can run at once.
+
+form = {}
+
+class RequestContext:
+    def __init__(self, environ_, form_, out):
+        self.environ = environ_
+        self.form = form_
+        self.out = out
+
+_local = threading.local()
+
+def get_context():
+    return getattr(_local, 'context', None)
+
+def get_environ():
+    context = get_context()
+    if context is None:
+        return environ
+    return context.environ
+
+def get_form():
+    context = get_context()
+    if context is None:
+        return form
+    return context.form
+
+def form_value(form_, name):
+    value = form_[name].value
+    if isinstance(value, bytes):
+        value = value.decode('utf8')
+    return value
+
+# Shadows the builtin so all the print()s below write to the
+# current request.
+def print(*args, **kwargs):
+    context = get_context()
+    if not context is None and not 'file' in kwargs:
+        kwargs['file'] = context.out
+    builtins.print(*args, **kwargs)
+
 def scrub(link_text, ss_class=None, force=False):
     """ Cleanup href values so the work with Freenet. """
     if (not scrub_links) and (not force):
@@ -79,10 +139,6 @@ def scrub(link_text, ss_class=None, force=False):
     # hmmm... Do better?
     return link_text
 
-def emit_header():
-    print("Content-type: text/html; charset=utf-8")
-    print()
-
 # Regular expression defining a WikiWord (but this definition
 # is also assumed in other places.
 word_re_str = r"\b([A-Z][a-z]+){2,}\b"
@@ -91,11 +147,17 @@ versioned_page_re_str = (r"\b(?P<wikiword>([A-Z][a-z]+){2,})" +
                          r"(_(?P<version>([a-f0-9]{40,40})))?\b")
 versioned_page_re = re.compile('^' + versioned_page_re_str + '$')
 command_re_str = "(search|edit|fullsearch|titlesearch)\=(.*)"
+macro_re_str = (r"\[\[(TitleSearch|FullSearch|WordIndex"
+                + r"|TitleIndex|ActiveLink"
+                + r"|LocalChanges|RemoteChanges|BookMark|"
+                + r"FreesiteUri|GoTo)\]\]")
+macro_re = re.compile(macro_re_str)
+link_word_re = re.compile(r"\b(?:[A-Z][a-z]+){2,}\b")
 
 # Formatting stuff --------------------------------------------------
 
 def get_scriptname():
-    return environ.get('SCRIPT_NAME', '')
+    return get_environ().get('SCRIPT_NAME', '')
 
 def send_title(text, link=None, msg=None, is_forked=False):
     print("<head><title>%s</title>" % text)
@@ -132,17 +194,59 @@ def link_tag(params, text=None, ss_class=None):
 
 # Search ---------------------------------------------------
 
-def do_fullsearch(needle):
-    send_title('Full text search for "%s"' % (needle))
-
+def regex_search_pages(needle, page_names):
     needle_re = re.compile(needle, re.IGNORECASE)
     hits = []
-    all_pages = page_list()
-    for page_name in all_pages:
+    for page_name in page_names:
         body = Page(page_name).get_raw_body()
         count = len(needle_re.findall(body))
         if count:
             hits.append((count, page_name))
+    return hits
+
+def regex_fullsearch(needle):
+    all_pages = page_list()
+    return regex_search_pages(needle, all_pages), len(all_pages)
+
+# Same results as regex_fullsearch(), but only reads the pages the
+# index says can match. Returns None if the index can't be used.
+def index_fullsearch(needle):
+    if searchindex is None or not use_search_index:
+        return None
+    words = searchindex.query_terms(needle)
+    if words is None:
+        return None
+    try:
+        index = searchindex.SearchIndex(
+            searchindex.index_file_name(data_dir))
+        try:
+            all_pages = list(filter(word_anchored_re.match,
+                                    index.sync(filefuncs, text_dir)))
+            candidates = list(filter(word_anchored_re.match,
+                                     index.candidates(words)))
+        finally:
+            index.close()
+    except searchindex.sqlite3.Error:
+        return None
+    return regex_search_pages(needle, candidates), len(all_pages)
+
+def update_search_index(page_names):
+    if searchindex is None:
+        return
+    try:
+        searchindex.update_index(searchindex.index_file_name(data_dir),
+                                 filefuncs, text_dir, page_names)
+    except searchindex.sqlite3.Error:
+        pass # The next search resyncs.
+
+def do_fullsearch(needle):
+    send_title('Full text search for "%s"' % (needle))
+
+    result = index_fullsearch(needle)
+    if result is None:
+        # Not plain ASCII words, or no index.
+        result = regex_fullsearch(needle)
+    hits, searched = result
 
     # The default comparison for tuples compares elements in order,
     # so this sorts by number of hits
@@ -156,7 +260,7 @@ def do_fullsearch(needle):
         print(['match', 'matches'][count != 1])
     print("</UL>")
 
-    print_search_stats(len(hits), len(all_pages))
+    print_search_stats(len(hits), searched)
 
 
 def do_titlesearch(needle):
@@ -200,11 +304,12 @@ def do_viewunmodifiedsource(pagename):
         Page(pagename).send_editor(True, True)
 
 def do_savepage(pagename):
-    global form
+    form_ = get_form()
     pg = Page(pagename)
     text = ''
-    if 'savetext' in form:
-        text = form['savetext'].value
+    if 'savetext' in form_:
+        # Decode the utf8 text from the browser into unicode.
+        text = form_value(form_, 'savetext')
     if text.strip() == '':
         text = ''
         msg = """<b>Locally deleting blank page.</b>"""
@@ -212,11 +317,10 @@ def do_savepage(pagename):
         msg = """<b>Saved local changes. They won't be applied to the
               wiki in Freenet until you explictly <em>submit</em> them. </b>"""
 
-    # Decode the utf8 text from the browser into unicode.
-    text = text.decode('utf8')
-
     # Normalize to UNIX line terminators.
     pg.save_text(text.replace('\r\n', '\n'))
+    update_search_index((pagename, ))
+    invalidate_render_cache()
 
     pg.send_page(msg=msg)
 
@@ -227,6 +331,8 @@ def do_removepage(page_name):
         msg = """<b>Locally marked fork as resolved.</b>"""
     pg = Page(page_name)
     pg.save_text('')
+    update_search_index((page_name, ))
+    invalidate_render_cache()
     pg.send_page(msg=msg)
 
 def do_unmodified(pagename):
@@ -242,6 +348,8 @@ def do_unmodified(pagename):
 
 def do_deletelocal(pagename):
     filefuncs.remove_overlay(Page(pagename)._text_filename())
+    update_search_index((pagename, ))
+    invalidate_render_cache()
 
     send_title("Removed Local Edits", None,
                "Removed local edits to %s page." %
@@ -252,8 +360,9 @@ def do_deletelocal(pagename):
 
 def make_index_key():
     s = '<p><center>'
-    links = ['<a href="#%s">%s</a>' % (ch, ch) for ch in string.lowercase]
-    s = s + string.join(links, ' | ')
+    links = ['<a href="#%s">%s</a>' % (ch, ch)
+             for ch in string.ascii_lowercase]
+    s = s + ' | '.join(links)
     s = s + '</center><p>'
     return s
 
@@ -274,8 +383,9 @@ def _macro_FullSearch():
     return _macro_search("fullsearch")
 
 def _macro_search(type):
-    if 'value' in form:
-        default = form["value"].value.encode('utf8')
+    form_ = get_form()
+    if 'value' in form_:
+        default = html.escape(form_value(form_, 'value'))
     else:
         default = ''
     return """<form method=get accept-charset="UTF-8">
@@ -305,7 +415,7 @@ def _macro_WordIndex():
     all_words.sort()
     last_letter = None
     for word in all_words:
-        letter = string.lower(word[0])
+        letter = word[0].lower()
         if letter != last_letter:
             s = s + '<a name="%s"><h3>%s</h3></a>' % (letter, letter)
             last_letter = letter
@@ -330,7 +440,7 @@ def _macro_TitleIndex():
     pages.sort()
     current_letter = None
     for name in pages:
-        letter = string.lower(name[0])
+        letter = name[0].lower()
         if letter != current_letter:
             s = s + '<a name="%s"><h3>%s</h3></a>' % (letter, letter)
             current_letter = letter
@@ -346,26 +456,10 @@ def _macro_ActiveLink():
 
 def get_unmerged_versions(overlay, wikitext_dir, page_names):
     # name -> version list
+    index = overlay.fork_index(wikitext_dir)
     ret = {}
     for name in page_names:
-        ret[name] = set([]) # hmmm paranoia? list ok?
-
-    # REDFLAG: O(N) in total number of pages.  hmmmm...
-    for name in overlay.list_pages(wikitext_dir):
-        fields = name.split('_')
-        if len(fields) < 2:
-            continue
-        if not fields[0].strip() in page_names:
-            continue
-        if len(fields[1].strip()) != 40:
-            continue
-        # hmmmm... validate?
-        ret[fields[0].strip()].add(fields[1].strip())
-
-    for name in list(ret.keys())[:]: # hmmm copy required?
-        ret[name] = list(ret[name])
-        ret[name].sort()
-
+        ret[name] = list(index.get(name, ()))
     return ret
 
 def fork_link(overlay, text_dir_, name, version):
@@ -537,9 +631,55 @@ class PageFormatter:
     All formatting commands can be parsed one line at a time, though
     some state is carried over between lines.
     """
-    def __init__(self, raw, allow_images):
+    # For each line, we scan through looking for magic
+    # strings, outputting verbatim any intervening text
+    scan_re = re.compile(
+        r"(?:(?P<emph>'{2,3})"
+        + r"|(?P<br>\<br\>)"
+        + r"|(?P<ent>[<>&])"
+        + r"|(?P<anch>@@@([^@]+)@@@)"
+        + r"|(?P<anchl>@@@@([^@]+)@@@@)"
+        + r"|(?P<word>\b(?:[A-Z][a-z]+){2,}\b)"
+        + r"|(?P<rule>-{4,})"
+        + r"|(?P<img>\[\[\[(freenet\:[^\]]+)\]\]\])"
+        + r"|(?P<url>(freenet|http)\:[^\s'\"]+\S)"
+        + r"|(?P<li>^\s+\*)"
+
+        + r"|(?P<pre>(\{\{\{|\}\}\}))"
+        + r"|(?P<macro>" + macro_re_str + r")"
+        + r"|(?P<tablerow>^\|\|.*\|\|$)"
+        + r")")
+    blank_re = re.compile(r"^\s*$")
+    indent_re = re.compile(r"^\s*")
+    eol_re = re.compile(r'\r?\n')
+
+    table_re = re.compile(
+        r"(?:(?P<tableborder>\<tableborder:(?P<borderval>\d+(%|px)?)\>)"
+        + r"|(?P<tablebordercolor>\<tablebordercolor:(?P<bordercolorval>#[0-9A-Fa-f]{6})\>)"
+        + r"|(?P<tablewidth>\<tablewidth:(?P<widthval>\d+(%|px)?)\>)"
+        + r"|(?P<tableheight>\<tableheight:(?P<heightval>\d+(%|px)?)\>)"
+        + r"|(?P<collapse>\<collapse\>)"
+        + r"|(?P<stripe>\<stripe:(?P<stripecol1>#[0-9A-Fa-f]{6}),(?P<stripecol2>#[0-9A-Fa-f]{6})\>)"
+        + r")")
+    span_re = re.compile(
+        r"(?:(?P<colspan>\<-(?P<csval>\d+)\>)"
+        + r"|(?P<rowspan>\<\|(?P<rsval>\d+)\>)"
+        + r")")
+    td_re = re.compile(
+        r"(?:(?P<tdborder>\<border:(?P<borderval>\d+(%|px)?)\>)"
+        + r"|(?P<tdbordercolor>\<bordercolor:(?P<bordercolorval>#[0-9A-Fa-f]{6})\>)"
+        + r"|(?P<tdwidth>\<width:(?P<widthval>\d+(%|px)?)\>)"
+        + r"|(?P<tdheight>\<height:(?P<heightval>\d+(%|px)?)\>)"
+        + r"|(?P<tdbgcolor>\<bgcolor:(?P<bgcolorval>#[0-9A-Fa-f]{6})\>)"
+        + r"|(?P<tdalign>\<align:(?P<alignval>(left|center|right))\>)"
+        + r"|(?P<tdvalign>\<valign:(?P<valignval>(top|middle|bottom))\>)"
+        + r")")
+
+    def __init__(self, raw, allow_images, existing=None):
         self.raw = raw
         self.allow_images = allow_images
+        # Names of the pages which exist. None means look them up.
+        self.existing = existing
         self.is_em = self.is_b = 0
         self.list_indents = []
         self.in_pre = 0
@@ -565,7 +705,7 @@ class PageFormatter:
         return s
 
     def _word_repl(self, word):
-        return Page(word).link_to()
+        return Page(word).link_to(self.existing)
 
 
     def _url_repl(self, word):
@@ -670,15 +810,7 @@ class PageFormatter:
                 self.table_striped = 0
                 self.table_row_num = 0
                 rval = rval + '<table'
-
-                table_re = re.compile(
-                r"(?:(?P<tableborder>\<tableborder:(?P<borderval>\d+(%|px)?)\>)"
-                + r"|(?P<tablebordercolor>\<tablebordercolor:(?P<bordercolorval>#[0-9A-Fa-f]{6})\>)"
-                + r"|(?P<tablewidth>\<tablewidth:(?P<widthval>\d+(%|px)?)\>)"
-                + r"|(?P<tableheight>\<tableheight:(?P<heightval>\d+(%|px)?)\>)"
-                + r"|(?P<collapse>\<collapse\>)"
-                + r"|(?P<stripe>\<stripe:(?P<stripecol1>#[0-9A-Fa-f]{6}),(?P<stripecol2>#[0-9A-Fa-f]{6})\>)"
-                + r")")
+                table_re = self.table_re
 
                 stylestr = ''
 
@@ -707,10 +839,7 @@ class PageFormatter:
                 if line == '':
                     colspan = colspan + 1
                 else:
-                    span_re = re.compile(
-                    r"(?:(?P<colspan>\<-(?P<csval>\d+)\>)"
-                    + r"|(?P<rowspan>\<\|(?P<rsval>\d+)\>)"
-                    + r")")
+                    span_re = self.span_re
 
                     for match in span_re.finditer(line):
                         for type, hit in list(match.groupdict().items()):
@@ -729,15 +858,7 @@ class PageFormatter:
                     if rowspan > 1:
                         rval = rval + ' rowspan="' + str(rowspan) + '"'
 
-                    td_re = re.compile(
-                    r"(?:(?P<tdborder>\<border:(?P<borderval>\d+(%|px)?)\>)"
-                    + r"|(?P<tdbordercolor>\<bordercolor:(?P<bordercolorval>#[0-9A-Fa-f]{6})\>)"
-                    + r"|(?P<tdwidth>\<width:(?P<widthval>\d+(%|px)?)\>)"
-                    + r"|(?P<tdheight>\<height:(?P<heightval>\d+(%|px)?)\>)"
-                    + r"|(?P<tdbgcolor>\<bgcolor:(?P<bgcolorval>#[0-9A-Fa-f]{6})\>)"
-                    + r"|(?P<tdalign>\<align:(?P<alignval>(left|center|right))\>)"
-                    + r"|(?P<tdvalign>\<valign:(?P<valignval>(top|middle|bottom))\>)"
-                    + r")")
+                    td_re = self.td_re
 
                     stylestr = ''
 
@@ -754,7 +875,8 @@ class PageFormatter:
 
                     # recursive call to pageformatter to format any code within the table data
                     # is there a better way to do this??
-                    rval = rval + PageFormatter(line, self.allow_images).return_html() + '</td>'
+                    rval = rval + PageFormatter(line, self.allow_images,
+                                                self.existing).return_html() + '</td>'
                     colspan = 1
                     rowspan = 1
 
@@ -830,55 +952,88 @@ class PageFormatter:
             raise "Can't handle match " + repr(match)
 
     def return_html(self):
-        returnval = ''
-        # For each line, we scan through looking for magic
-        # strings, outputting verbatim any intervening text
-        scan_re = re.compile(
-            r"(?:(?P<emph>'{2,3})"
-            + r"|(?P<br>\<br\>)"
-            + r"|(?P<ent>[<>&])"
-            + r"|(?P<anch>@@@([^@]+)@@@)"
-            + r"|(?P<anchl>@@@@([^@]+)@@@@)"
-            + r"|(?P<word>\b(?:[A-Z][a-z]+){2,}\b)"
-            + r"|(?P<rule>-{4,})"
-            + r"|(?P<img>\[\[\[(freenet\:[^\]]+)\]\]\])"
-            + r"|(?P<url>(freenet|http)\:[^\s'\"]+\S)"
-            + r"|(?P<li>^\s+\*)"
-
-            + r"|(?P<pre>(\{\{\{|\}\}\}))"
-            + r"|(?P<macro>\[\[(TitleSearch|FullSearch|WordIndex"
-                            + r"|TitleIndex|ActiveLink"
-                            + r"|LocalChanges|RemoteChanges|BookMark|"
-                            + r"FreesiteUri|GoTo)\]\])"
-            + r"|(?P<tablerow>^\|\|.*\|\|$)"
-            + r")")
-        blank_re = re.compile("^\s*$")
-        bullet_re = re.compile("^\s+\*")
-        indent_re = re.compile("^\s*")
-        eol_re = re.compile(r'\r?\n')
-        raw = string.expandtabs(self.raw)
-        for line in eol_re.split(raw):
+        # Accumulate in a list. Repeated string concatenation is
+        # quadratic for big pages.
+        out = []
+        for line in self.eol_re.split(self.raw.expandtabs()):
             if not self.in_pre:
                 # XXX: Should we check these conditions in this order?
-                if blank_re.match(line):
+                if self.blank_re.match(line):
                     if self.in_table:
-                        returnval = returnval + self._tablerow_repl('')
-                    returnval = returnval + '<p>\n'
+                        out.append(self._tablerow_repl(''))
+                    out.append('<p>\n')
                     continue
-                indent = indent_re.match(line)
-                returnval = returnval + self._indent_to(len(indent.group(0)))
-            returnval = returnval + re.sub(scan_re, self.replace, line) + '\n'
-        if self.in_pre: returnval = returnval + '</pre>\n'
-        returnval = returnval + self._undent() + '\n'
-        return returnval
+                indent = self.indent_re.match(line)
+                out.append(self._indent_to(len(indent.group(0))))
+            out.append(self.scan_re.sub(self.replace, line))
+            out.append('\n')
+        if self.in_pre: out.append('</pre>\n')
+        out.append(self._undent())
+        out.append('\n')
+        return ''.join(out)
 
     def print_html(self):
         print(self.return_html())
 
+# Render cache ---------------------------------------------
+
+# Rendered page bodies. See render_wikitext().
+render_cache = rendercache.RenderCache()
+
+# (fileoverlay.dirs_stamp() value, frozenset of page names) or None.
+existing_pages_cache = None
+
+def existing_pages():
+    """ Return a frozenset of the names of all the pages that exist. """
+    global existing_pages_cache
+    stamp = fileoverlay.dirs_stamp(filefuncs, text_dir)
+    cached = existing_pages_cache
+    if not cached is None and cached[0] == stamp:
+        return cached[1]
+    names = frozenset(filefuncs.list_pages(text_dir))
+    existing_pages_cache = (stamp, names)
+    return names
+
+def invalidate_render_cache():
+    """ Call after creating or deleting pages.
+
+        Additions and removals are usually caught by the directory
+        modtimes, but they can be too coarse to see a change made
+        right after the last check. """
+    global existing_pages_cache
+    existing_pages_cache = None
+
+def link_targets(raw, existing):
+    """ Return the WikiWords in raw which name existing pages. """
+    words = set(link_word_re.findall(raw))
+    if raw.find('||') != -1:
+        # Table cell markup is stripped before formatting, which
+        # can join words.
+        words.update(link_word_re.findall(re.sub(r'<[^>]*>', '', raw)))
+    return [word for word in words if word in existing]
+
+def render_wikitext(raw, allow_images):
+    """ Return the html for raw wikitext, from the cache if possible. """
+    existing = existing_pages()
+    if macro_re.search(raw):
+        # Macro output can change when the page doesn't.
+        return PageFormatter(raw, allow_images, existing).return_html()
+
+    key = rendercache.make_key(raw, link_targets(raw, existing),
+                               allow_images, scrub_links, get_scriptname(),
+                               nonexist_qm)
+    html = render_cache.get(key)
+    if html is None:
+        html = PageFormatter(raw, allow_images, existing).return_html()
+        render_cache.put(key, html)
+    return html
+
 # ----------------------------------------------------------
 class Page:
     def __init__(self, page_name):
         self.page_name = page_name
+        # See FreenetPage.
+        self.fork_table = None
 
     def wiki_name(self):
         return self.page_name.split('_')[0]
@@ -907,9 +1062,13 @@ class Page:
     def exists(self):
         return filefuncs.exists(self._text_filename())
 
-    def link_to(self):
+    def link_to(self, existing=None):
         word = self.page_name
-        if self.exists():
+        if existing is None:
+            exists = self.exists()
+        else:
+            exists = word in existing
+        if exists:
             return link_tag(word)
         else:
             if nonexist_qm:
@@ -940,14 +1099,15 @@ class Page:
         send_title(self.split_title(), link, msg, bool(self.version()))
         allow_images = not is_no_image(data_dir, self.wiki_name())
         if unmodified:
-            PageFormatter(self.get_raw_body(unmodified), allow_images).print_html()
+            print(render_wikitext(self.get_raw_body(unmodified), allow_images))
         else:
             if removed:
                 print("<b>Already resolved.</b>")
             elif resolved:
                 print("<b>Locally marked resolved.</b>")
             else:
-                PageFormatter(self.get_raw_body(unmodified), allow_images).print_html()
+                print(render_wikitext(self.get_raw_body(unmodified),
+                                      allow_images))
 
         self.send_footer(True,
                          self._last_modified(),
@@ -1005,8 +1165,10 @@ class Page:
 
         if not page_path is None:
             name = os.path.split(page_path)[1]
-            fork_table = get_unmerged_versions(filefuncs, text_dir,
-                                               (name,))
+            fork_table = self.fork_table
+            if fork_table is None:
+                fork_table = get_unmerged_versions(filefuncs, text_dir,
+                                                   (name,))
             if len(fork_table[name]) > 0:
                 print(("<strong>This page has forks: %s!</strong><br>"  %
                        get_fork_html(filefuncs, text_dir, name, fork_table)))
@@ -1040,8 +1202,8 @@ class Page:
 
         link = get_scriptname() + '?fullsearch=' + self.wiki_name()
         send_title(self.split_title(), link, msg, bool(self.version()))
-        PageFormatter(self.get_raw_body(unmodified),
-                      not is_no_image(data_dir, self.wiki_name())).print_html()
+        print(render_wikitext(self.get_raw_body(unmodified),
+                              not is_no_image(data_dir, self.wiki_name())))
         self.send_footer(False, self._last_modified(),
                          self._text_filename(), unmodified)
 
@@ -1065,8 +1227,7 @@ class Page:
         print('<input type=hidden name="savepage" value="%s">' % \
               (self.page_name))
         # Encode outgoing raw wikitext into utf8
-        raw_body = string.replace(self.get_raw_body(unmodified),
-                                  '\r\n', '\n')
+        raw_body = self.get_raw_body(unmodified).replace('\r\n', '\n')
         print("""<textarea wrap="virtual" name="savetext" rows="17"
                  cols="120" %s >%s</textarea>""" % (
                  read_only_value, raw_body))
@@ -1084,7 +1245,7 @@ class Page:
 
     def save_text(self, newtext):
         self._write_file(newtext)
-        remote_name = environ.get('REMOTE_ADDR', '')
+        remote_name = get_environ().get('REMOTE_ADDR', '')
 
 # See set_data_dir_from_cfg(), reset_root_dir
 data_dir = None
@@ -1104,54 +1265,79 @@ show_hosts = 0                          # show hostnames?
 css_url = '/' + PIKI_CSS         # stylesheet link, or ''
 nonexist_qm = 0                         # show '?' for nonexistent?
 
-def serve_one_page():
-
-    emit_header()
+def dispatch():
+    form_ = get_form()
+    environ_ = get_environ()
+    handlers = { 'fullsearch':  do_fullsearch,
+                 'titlesearch': do_titlesearch,
+                 'edit':        do_edit,
+                 'viewsource':  do_viewsource,
+                 'viewunmodifiedsource':  do_viewunmodifiedsource,
+                 'savepage':    do_savepage,
+                 'unmodified':  do_unmodified,
+                 'deletelocal': do_deletelocal,
+                 'removepage':  do_removepage}
+
+    for cmd in list(handlers.keys()):
+        if cmd in form_:
+            handlers[cmd](*(form_value(form_, cmd),))
+            break
+    else:
+        path_info = environ_.get('PATH_INFO', '')
 
-    try:
-        global form
-        form = cgi.FieldStorage()
-
-        handlers = { 'fullsearch':  do_fullsearch,
-                     'titlesearch': do_titlesearch,
-                     'edit':        do_edit,
-                     'viewsource':  do_viewsource,
-                     'viewunmodifiedsource':  do_viewunmodifiedsource,
-                     'savepage':    do_savepage,
-                     'unmodified':  do_unmodified,
-                     'deletelocal': do_deletelocal,
-                     'removepage':  do_removepage}
-
-        for cmd in list(handlers.keys()):
-            if cmd in form:
-                handlers[cmd](*(form[cmd].value.decode('utf8'),))
-                break
+        if 'goto' in form_:
+            query = form_value(form_, 'goto')
+        elif len(path_info) and path_info[0] == '/':
+            query = path_info[1:] or 'FrontPage'
         else:
-            path_info = environ.get('PATH_INFO', '')
+            query = environ_.get('QUERY_STRING', '') or 'FrontPage'
+
+        #word_match = re.match(word_re_str, query)
+        word_match = re.match(versioned_page_re_str, query)
+        #sys.stderr.write("query: %s [%s]\n" % (repr(query),
+        #                                       repr(word_match)))
+        if word_match:
+            word = word_match.group('wikiword')
+            if not word_match.group('version') is None:
+                word = "%s_%s" % (word, word_match.group('version'))
+            Page(word).send_page()
+        else:
+            print("<p>Can't work out query \"<pre>" + query + "</pre>\"")
 
-            if 'goto' in form:
-                query = form['goto'].value.decode('utf8')
-            elif len(path_info) and path_info[0] == '/':
-                query = path_info[1:] or 'FrontPage'
-            else:
-                query = environ.get('QUERY_STRING', '') or 'FrontPage'
-
-            #word_match = re.match(word_re_str, query)
-            word_match = re.match(versioned_page_re_str, query)
-            #sys.stderr.write("query: %s [%s]\n" % (repr(query),
-            #                                       repr(word_match)))
-            if word_match:
-                word = word_match.group('wikiword')
-                if not word_match.group('version') is None:
-                    word = "%s_%s" % (word, word_match.group('version'))
-                Page(word).send_page()
-            else:
-                print("<p>Can't work out query \"<pre>" + query + "</pre>\"")
+CONTENT_TYPE = "text/html; charset=utf-8"
 
-    except:
-        cgi.print_exception()
+# Module state (data_dir, filefuncs, ...) must already be set up with
+# set_data_dir_from_cfg() or reset_root_dir().
+def render_request(environ_, in_stream):
+    """ Run one request in process and return the utf8 encoded html.
 
-    sys.stdout.flush()
+        environ_ has the CGI variables for the request and in_stream
+        is a binary file with the POST body, if any. """
+    out = StringIO()
+    _local.context = RequestContext(environ_, None, out)
+    try:
+        try:
+            _local.context.form = cgi.FieldStorage(fp=in_stream,
+                                                   environ=environ_)
+            dispatch()
+        except:
+            print("<pre>%s</pre>" % html.escape(traceback.format_exc()))
+    finally:
+        _local.context = None
+    return out.getvalue().encode('utf8')
+
+def handle_request(environ_, in_stream):
+    """ Like render_request() but returns the full CGI response,
+        headers included. """
+    return (("Content-type: %s\r\n\r\n" % CONTENT_TYPE).encode('ascii')
+            + render_request(environ_, in_stream))
+
+def application(environ_, start_response):
+    """ WSGI entry point. """
+    body = render_request(environ_, environ_['wsgi.input'])
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                              ('Content-Length', str(len(body)))])
+    return [body]
 
 
 ############################################################
@@ -1236,53 +1422,87 @@ def read_info():
     return usk, desc, link_name
 
 
+# Bytes read at a time by reversed_lines().
+REVERSE_BLOCK_SIZE = 8192
+
+def reversed_lines(in_file, block_size=REVERSE_BLOCK_SIZE):
+    """ Yield the lines of a file opened in binary mode, last line first.
+
+        Only reads as far back into the file as the caller iterates,
+        so getting the last few lines of a big log is cheap. The lines
+        are exactly as they are in the file, including line endings. """
+    in_file.seek(0, os.SEEK_END)
+    pos = in_file.tell()
+    # The first, possibly partial, line of the data read so far.
+    pending = b''
+    # True until the end of the last line has been yielded. The last
+    # line may not end with a newline.
+    at_end = True
+    while pos > 0:
+        step = min(block_size, pos)
+        pos -= step
+        in_file.seek(pos)
+        parts = (in_file.read(step) + pending).split(b'\n')
+        pending = parts[0]
+        for part in reversed(parts[1:]):
+            if not at_end:
+                part += b'\n'
+            at_end = False
+            if part:
+                yield part
+
+    if not at_end:
+        pending += b'\n'
+    if pending:
+        yield pending
+
+def read_log_lines(full_path):
+    """ INTERNAL: Yield the lines of a change log, newest first. """
+    if not os.path.exists(full_path):
+        return
+    in_file = open(full_path, 'rb')
+    try:
+        for line in reversed_lines(in_file):
+            yield line.decode('utf8', 'replace')
+    finally:
+        in_file.close()
+
 def read_log_file_entries(base_dir, max_entries):
     accepted = []
-    full_path = os.path.join(base_dir, 'accepted.txt')
-    if os.path.exists(full_path):
-        in_file = open(full_path, 'rb')
-        try:
+    changes = {}
+    for line in read_log_lines(os.path.join(base_dir, 'accepted.txt')):
+        if len(accepted) >= max_entries:
+            break
+        fields = line.split(':')
+        if fields[0] in ('C', 'M', 'R', 'F'):
+            for index in range(1, len(fields)):
+                fields[index] = fields[index].strip()
+            changes[fields[0]] = fields[1:]
+        else:
+            fields = fields[:4]
+            fields.append((changes.get('C', ()),
+                           changes.get('M', ()),
+                           changes.get('R', ()),
+                           make_fork_list(changes.get('F', ()))))
+            accepted.append(tuple(fields))
             changes = {}
-            # LATER: find/write reverse line iterator?
-            for line in reversed(in_file.readlines()):
-                if len(accepted) >= max_entries:
-                    break
-                fields = line.split(':')
-                if fields[0] in ('C', 'M', 'R', 'F'):
-                    for index in range(1, len(fields)):
-                        fields[index] = fields[index].strip()
-                    changes[fields[0]] = fields[1:]
-                else:
-                    fields = fields[:4]
-                    fields.append((changes.get('C', ()),
-                                   changes.get('M', ()),
-                                   changes.get('R', ()),
-                                   make_fork_list(changes.get('F', ()))))
-                    accepted.append(tuple(fields))
-                    changes = {}
-        finally:
-            in_file.close()
 
     rejected = []
-    full_path = os.path.join(base_dir, 'rejected.txt')
-    if os.path.exists(full_path):
-        in_file = open(full_path, 'rb')
-        try:
-            changes = {}
-            # LATER: find/write reverse line iterator?
-            for line in reversed(in_file.readlines()):
-                if len(rejected) >= max_entries:
-                    break
-                rejected.append(tuple(line.split(':')[:5]))
-        finally:
-            in_file.close()
+    for line in read_log_lines(os.path.join(base_dir, 'rejected.txt')):
+        if len(rejected) >= max_entries:
+            break
+        rejected.append(tuple(line.split(':')[:5]))
 
     return tuple(accepted), tuple(rejected)
 
 
 class FreenetPage(Page):
-    def __init__(self, page_name):
+    # fork_table is an optional get_unmerged_versions() result which
+    # includes this page, so dump() doesn't list the wikitext dir
+    # once for every page.
+    def __init__(self, page_name, fork_table=None):
         Page.__init__(self, page_name)
+        self.fork_table = fork_table
 
 
     def send_footer(self, versioned, dummy_mod_string=None,
@@ -1294,8 +1514,10 @@ class FreenetPage(Page):
                             link_tag('WordIndex', 'WordIndex')))
         if not page_path is None and not versioned:
             name = os.path.split(page_path)[1]
-            fork_table = get_unmerged_versions(filefuncs, text_dir,
-                                               (name,))
+            fork_table = self.fork_table
+            if fork_table is None:
+                fork_table = get_unmerged_versions(filefuncs, text_dir,
+                                                   (name,))
             if len(fork_table[name]) > 0:
                 print((("<hr><strong>This page has forks: %s! " %
                         get_fork_html(filefuncs, text_dir, name, fork_table))
@@ -1314,6 +1536,10 @@ def reset_root_dir(root_dir, overlayed=False):
 
     cgi.logfile = path.join(data_dir, 'cgi_log')
     filefuncs = fileoverlay.get_file_funcs(root_dir, overlayed)
+    # Serve the directory listings for a request from memory.
+    filefuncs.max_age = SNAPSHOT_SECS
+    invalidate_render_cache()
+    render_cache.clear()
     if overlayed:
         # Only overlay 'wikitext', not 'www'
         full_path = filefuncs.overlay_path(text_dir)
@@ -1354,51 +1580,172 @@ def create_default_wiki(base_path):
                                  'default_files'),
                     base_path)
 
-def dump(output_dir, wiki_root, overlayed=False):
-    global form, scrub_links
+# Incremental dumps ----------------------------------------
+#
+# An incremental dump keeps a page name -> key dict in the output
+# dir. The key hashes everything the dumped html for the page depends
+# on, including which of the pages it links to exist, so a page is only
+# rendered again when its text, its forks or its live links changed.
+# Pages with macros are always rendered, but files are only rewritten
+# when their contents change.
+
+DUMP_STATE_FILE = '.piki_dump_state'
+DUMP_STATE_VERSION = '1'
+
+def read_dump_state(output_dir):
+    full_path = os.path.join(output_dir, DUMP_STATE_FILE)
+    if not os.path.exists(full_path):
+        return {}
+    in_file = open(full_path, 'rb')
+    try:
+        try:
+            state = json.loads(in_file.read().decode('utf8'))
+        except ValueError:
+            return {} # Corrupt. Dump everything.
+    finally:
+        in_file.close()
+    if state.get('version') != DUMP_STATE_VERSION:
+        return {}
+    return state['pages']
+
+def write_dump_state(output_dir, keys):
+    full_path = os.path.join(output_dir, DUMP_STATE_FILE)
+    tmp_name = full_path + '.tmp'
+    out_file = open(tmp_name, 'wb')
+    try:
+        out_file.write(json.dumps({'version':DUMP_STATE_VERSION,
+                                   'pages':keys}).encode('utf8'))
+    finally:
+        out_file.close()
+    os.rename(tmp_name, full_path)
+
+def dump_key(name, raw, existing, fork_table):
+    if macro_re.search(raw):
+        return None
+    page = Page(name)
+    full_path = os.path.join(text_dir, name)
+    return rendercache.make_key(raw, link_targets(raw, existing), name,
+                                not is_no_image(data_dir, page.wiki_name()),
+                                fork_table.get(name, ()),
+                                filefuncs.exists(full_path, True),
+                                filefuncs.has_overlay(full_path),
+                                scrub_links, get_scriptname(), css_url,
+                                get_logo_string(), nonexist_qm)
+
+def write_if_changed(file_name, data):
+    """ Write data to file_name unless it already has exactly that
+        content. Returns True if the file was written. """
+    if (os.path.exists(file_name) and
+        os.path.getsize(file_name) == len(data)):
+        in_file = open(file_name, 'rb')
+        try:
+            if in_file.read() == data:
+                return False
+        finally:
+            in_file.close()
+    out = open(file_name, 'wb')
+    try:
+        out.write(data)
+    finally:
+        out.close()
+    return True
+
+def dump_page(name, fork_table=None):
+    out = StringIO()
+    old_context = get_context()
+    _local.context = RequestContext(environ, form, out)
+    try:
+        print('<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">')
+        FreenetPage(name, fork_table).send_page()
+    finally:
+        _local.context = old_context
+    return out.getvalue()
+
+def dump(output_dir, wiki_root, overlayed=False, cache_dir=None,
+         incremental=False):
+    """ Dump the wiki as html files in output_dir.
+
+        If cache_dir is set, rendered pages are kept there between dumps.
+
+        If incremental is True, only pages which could have changed
+        since the last incremental dump into output_dir are rendered,
+        and files are only written if their contents changed.
+
+        Returns the list of files which were written or removed. """
+    global form, scrub_links, render_cache
 
     form = {}
     scrub_links = True
     reset_root_dir(wiki_root, overlayed)
 
-    old_out = sys.stdout
+    old_keys = {}
+    if incremental:
+        old_keys = read_dump_state(output_dir)
+    keys = {}
+    changed = []
+
+    old_cache = render_cache
+    if not cache_dir is None:
+        render_cache = rendercache.RenderCache(cache_dir=cache_dir)
     try:
         pages = list(page_list(True))
+        fork_table = get_unmerged_versions(filefuncs, text_dir,
+                                           [name for name in pages
+                                            if not is_versioned(name)])
+        if incremental:
+            existing = existing_pages()
         for name in pages:
             file_name = os.path.join(output_dir, name)
-            out = codecs.open(file_name, "wb", 'utf8') # Write utf8
-            try:
-                page = FreenetPage(name)
-                sys.stdout = out
-                print('<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">')
-                page.send_page()
-                sys.stdout.flush()
-                out.close()
-                sys.stdout = old_out
-            finally:
-                out.close()
-                sys.stdout = old_out
+            if incremental:
+                key = dump_key(name, Page(name).get_raw_body(), existing,
+                               fork_table)
+                keys[name] = key
+                if (not key is None and old_keys.get(name) == key and
+                    os.path.exists(file_name)):
+                    continue
+            if write_if_changed(file_name,
+                                dump_page(name, fork_table).encode('utf8')):
+                changed.append(name)
+        if not cache_dir is None:
+            # Drop renders of pages which changed or went away.
+            render_cache.prune()
     finally:
-        sys.stdout = old_out
+        render_cache = old_cache
+
+    for name in old_keys:
+        if not name in keys and os.path.exists(os.path.join(output_dir,
+                                                            name)):
+            os.remove(os.path.join(output_dir, name))
+            changed.append(name)
 
     if not os.path.exists(os.path.join(data_dir, 'NotWrittenYet')):
-        out = open(os.path.join(output_dir, 'NotWrittenYet'), 'wb')
-        out.write("That page doesn't exist in the wiki yet!\n")
-        out.close()
+        if write_if_changed(os.path.join(output_dir, 'NotWrittenYet'),
+                            b"That page doesn't exist in the wiki yet!\n"):
+            changed.append('NotWrittenYet')
 
     if not os.path.exists(os.path.join(data_dir, 'AlreadyResolved')):
-        out = open(os.path.join(output_dir, 'AlreadyResolved'), 'wb')
-        out.write("That fork was already resolved.\n")
-        out.close()
+        if write_if_changed(os.path.join(output_dir, 'AlreadyResolved'),
+                            b"That fork was already resolved.\n"):
+            changed.append('AlreadyResolved')
 
     # .css, .png
     www_dir = os.path.join(data_dir, 'www')
     for name in PIKI_REQUIRED_FILES:
-        shutil.copyfile(os.path.join(www_dir, name),
-                        os.path.join(output_dir, name))
+        in_file = open(os.path.join(www_dir, name), 'rb')
+        try:
+            data = in_file.read()
+        finally:
+            in_file.close()
+        if write_if_changed(os.path.join(output_dir, name), data):
+            changed.append(name)
 
-# "builtin" when execfile()'d by servepiki.py
-if __name__ == "__main__" or __name__ == "__builtin__":
+    if incremental:
+        # Last, so an interrupted dump is redone next time.
+        write_dump_state(output_dir, keys)
+    return changed
+
+# Run as a CGI script. servepiki.py calls handle_request() directly.
+if __name__ == "__main__":
 
     if not STDERR_FILE is None:
         sys.stderr = open(STDERR_FILE, 'ab')
@@ -1406,15 +1753,7 @@ if __name__ == "__main__" or __name__ == "__builtin__":
         # Disable stderr. hmmm...
         sys.stderr = StringIO()
 
-    # Redirect "print" output into a StringIO so
-    # we can encode the html as UTF-8.
-    real_out = sys.stdout
-    buf = StringIO()
-    sys.stdout = buf
-    try:
-        set_data_dir_from_cfg()
-        serve_one_page()
-    finally:
-        sys.stdout = real_out
-        print(buf.getvalue().encode('utf8'))
+    set_data_dir_from_cfg()
+    sys.stdout.buffer.write(handle_request(environ, sys.stdin.buffer))
+    sys.stdout.flush()
 
@@ -0,0 +1,140 @@
+""" A cache for wikitext rendered to html.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# Keys are hashes of everything the html depends on, so entries never
+# have to be invalidated. A page that links to a page which was just
+# created just gets a new key. Stale entries fall out of the memory
+# LRU, and out of the cache dir when prune() is called.
+
+import codecs
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+# Bump this when PageFormatter output changes.
+FORMAT_VERSION = '1'
+
+DEFAULT_MAX_ENTRIES = 512
+
+def make_key(raw, link_targets, *flags):
+    """ Return the cache key for rendering wikitext.
+
+        link_targets is the set of WikiWords in raw which name pages
+        that exist. flags are any other values the html depends on. """
+    digest = sha1(FORMAT_VERSION.encode('utf8'))
+    digest.update(sha1(raw.encode('utf8')).digest())
+    for name in sorted(link_targets):
+        digest.update(b'\0' + name.encode('utf8'))
+    digest.update(b'\1' + repr(flags).encode('utf8'))
+    return digest.hexdigest()
+
+class RenderCache:
+    """ A thread safe LRU cache of rendered html, which can also
+        keep entries on disk in cache_dir. """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        # key -> html
+        self.entries = OrderedDict()
+        # Keys looked up or stored since the last prune().
+        self.used = set([])
+        self.hits = 0
+        self.misses = 0
+        if not cache_dir is None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        """ Return the cached html for key or None. """
+        with self.lock:
+            self.used.add(key)
+            html = self.entries.get(key)
+            if not html is None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return html
+        html = self.read_file(key)
+        with self.lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.add_entry(key, html)
+        return html
+
+    def put(self, key, html):
+        """ Cache the html for key. """
+        with self.lock:
+            self.used.add(key)
+            self.add_entry(key, html)
+        self.write_file(key, html)
+
+    def add_entry(self, key, html):
+        """ INTERNAL: Add an entry to the LRU. Caller holds the lock. """
+        self.entries[key] = html
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(False)
+
+    def clear(self):
+        """ Drop all the entries held in memory. """
+        with self.lock:
+            self.entries.clear()
+
+    def read_file(self, key):
+        """ INTERNAL: Return the html from the cache dir or None. """
+        if self.cache_dir is None:
+            return None
+        try:
+            in_file = codecs.open(os.path.join(self.cache_dir, key),
+                                  'rb', 'utf8')
+        except IOError:
+            return None
+        try:
+            return in_file.read()
+        finally:
+            in_file.close()
+
+    def write_file(self, key, html):
+        """ INTERNAL: Write the html into the cache dir. """
+        if self.cache_dir is None:
+            return
+        full_path = os.path.join(self.cache_dir, key)
+        tmp_name = full_path + '.tmp'
+        out_file = codecs.open(tmp_name, 'wb', 'utf8')
+        try:
+            out_file.write(html)
+        finally:
+            out_file.close()
+        os.rename(tmp_name, full_path)
+
+    def prune(self):
+        """ Delete the files in the cache dir which weren't used
+            since the last call. """
+        with self.lock:
+            used = self.used
+            self.used = set([])
+        if self.cache_dir is None:
+            return
+        for name in os.listdir(self.cache_dir):
+            if not name in used:
+                os.remove(os.path.join(self.cache_dir, name))
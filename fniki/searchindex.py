@@ -0,0 +1,279 @@
+""" A persistent inverted index for piki full text search.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# The index is an sqlite file with term -> page postings, plus a table
+# of all the terms.
+#
+# Each indexed page has a stamp made from the modtime and size of the
+# file it was read from (overlayed or not). sync() compares stamps
+# against two directory listings so that changes made behind piki's
+# back (hg update, fn-wiki --apply, editing files by hand) are picked
+# up without reading every page. The directory listings are skipped
+# if neither directory's modtime changed since the last full check,
+# unless it was more than SYNC_SECS ago. Files rewritten in place don't
+# change the directory modtime.
+#
+# Terms are lower cased words. The index only narrows down which pages
+# can match. Full text search is a case insensitive regex search, so
+# a needle word can match the middle of a word ('page' finds
+# 'FrontPage'), and piki runs the regex over the candidate pages to
+# get the real hits. Anything that isn't a plain list of ASCII words
+# has to be searched with the regex alone.
+
+import os
+import re
+import sqlite3
+import time
+
+from fileoverlay import get_file_funcs, dirs_stamp
+
+INDEX_FILE = 'search_index.db'
+
+# Bump this when the schema or the way terms are extracted changes.
+INDEX_VERSION = '2'
+
+# Maximum time between full checks of the page stamps.
+SYNC_SECS = 60
+
+TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+PLAIN_QUERY_REGEX = re.compile(r'^[\w\s]+$', re.ASCII)
+
+# Non-ASCII characters which re.IGNORECASE matches with ASCII ones,
+# but which str.lower() doesn't map to them.
+ASCII_FOLDS = str.maketrans({'\u0130':'i', '\u0131':'i', '\u017f':'s',
+                             '\u212a':'k'})
+
+TABLES = ('pages', 'postings', 'terms')
+META_SCHEMA = ("CREATE TABLE IF NOT EXISTS meta "
+               + "(key TEXT PRIMARY KEY, value TEXT)")
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS pages (name TEXT PRIMARY KEY, stamp TEXT)",
+    "CREATE TABLE IF NOT EXISTS postings (term TEXT, name TEXT, "
+    + "PRIMARY KEY (term, name)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS postings_by_name ON postings (name)",
+    "CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY) WITHOUT ROWID",
+)
+
+def get_terms(text):
+    """ Return the set of terms for the words in text. """
+    return set([word.translate(ASCII_FOLDS).lower() for word
+                in TERM_REGEX.findall(text)])
+
+def query_terms(needle):
+    """ Return a tuple of the unique words in needle, or None if
+        it can't be searched with the index. """
+    if not PLAIN_QUERY_REGEX.match(needle):
+        return None
+    terms = tuple(sorted(set([word.lower() for word
+                              in TERM_REGEX.findall(needle)])))
+    if len(terms) == 0:
+        return None
+    return terms
+
+def scan_dir(dir_name):
+    """ INTERNAL: Return a name -> (mtime_ns, size) dict for the
+        regular files in dir_name. """
+    ret = {}
+    if not os.path.isdir(dir_name):
+        return ret
+    for entry in os.scandir(dir_name):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        info = entry.stat(follow_symlinks=False)
+        ret[entry.name] = (info.st_mtime_ns, info.st_size)
+    return ret
+
+def current_stamps(filefuncs, text_dir):
+    """ Return a name -> stamp dict for every page which exists.
+
+        Same pages as filefuncs.list_pages(text_dir), without
+        reading any of them. """
+    stamps = dict([(name, 'b:%i:%i' % value) for name, value
+                   in scan_dir(text_dir).items()])
+    if filefuncs.is_overlayed():
+        for name, value in scan_dir(filefuncs.overlay_path(text_dir)).items():
+            if value[1] == 0:
+                # Zero length overlay means deleted.
+                stamps.pop(name, None)
+            else:
+                stamps[name] = 'o:%i:%i' % value
+    return stamps
+
+def page_stamp(filefuncs, full_path):
+    """ INTERNAL: Return the stamp for a single page, or None if it
+        doesn't exist. """
+    if filefuncs.is_overlayed():
+        overlay = filefuncs.overlay_path(full_path)
+        if os.path.exists(overlay):
+            info = os.stat(overlay)
+            if info.st_size == 0:
+                return None
+            return 'o:%i:%i' % (info.st_mtime_ns, info.st_size)
+    if not os.path.exists(full_path):
+        return None
+    info = os.stat(full_path)
+    return 'b:%i:%i' % (info.st_mtime_ns, info.st_size)
+
+class SearchIndex:
+    """ An inverted index of the wikitext pages in a directory. """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # Piki runs one request at a time, but the bot and hg fn-wiki
+        # can write while it's running.
+        self.conn = sqlite3.connect(file_name, timeout=30)
+        self.conn.execute(META_SCHEMA)
+        if self.get_meta('version') != INDEX_VERSION:
+            self.clear()
+        else:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+        self.conn.commit()
+
+    def close(self):
+        """ Close the underlying database. """
+        self.conn.close()
+
+    def clear(self):
+        """ Remove all entries from the index. """
+        # Dropped so that schema changes take effect.
+        for table in TABLES:
+            self.conn.execute("DROP TABLE IF EXISTS %s" % table)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.conn.execute("DELETE FROM meta")
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                          (INDEX_VERSION, ))
+
+    def stored_stamps(self):
+        """ Return a name -> stamp dict for every indexed page. """
+        return dict(self.conn.execute("SELECT name, stamp FROM pages"))
+
+    def get_meta(self, key):
+        """ INTERNAL: Return a value from the meta table or None. """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                (key, )).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def sync(self, filefuncs, text_dir, max_age=SYNC_SECS):
+        """ Reindex the pages which changed since they were indexed.
+
+            Returns the names of all the pages in text_dir. """
+        # Before the scan so changes made during it are seen next time.
+        dirs = dirs_stamp(filefuncs, text_dir)
+        synced = float(self.get_meta('synced') or 0)
+        if (dirs == self.get_meta('dirs') and
+            time.time() - synced < max_age):
+            return [row[0] for row in
+                    self.conn.execute("SELECT name FROM pages")]
+
+        now = time.time()
+        stamps = current_stamps(filefuncs, text_dir)
+        stored = self.stored_stamps()
+        changed = [name for name, stamp in stamps.items()
+                   if stored.get(name) != stamp]
+        changed += [name for name in stored if not name in stamps]
+        if len(changed) > 0:
+            self.update_pages(filefuncs, text_dir, changed, stamps)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                  (('dirs', dirs), ('synced', repr(now))))
+        return list(stamps.keys())
+
+    def update_pages(self, filefuncs, text_dir, names, stamps=None):
+        """ Reindex the named pages, removing the ones that no
+            longer exist. """
+        with self.conn: # Commits or rolls back.
+            for name in names:
+                full_path = os.path.join(text_dir, name)
+                if stamps is None:
+                    stamp = page_stamp(filefuncs, full_path)
+                else:
+                    stamp = stamps.get(name)
+                old_terms = set([row[0] for row in self.conn.execute(
+                    "SELECT term FROM postings WHERE name = ?", (name, ))])
+                self.conn.execute("DELETE FROM postings WHERE name = ?",
+                                  (name, ))
+                self.conn.execute("DELETE FROM pages WHERE name = ?",
+                                  (name, ))
+                terms = set([])
+                if not stamp is None:
+                    try:
+                        terms = self.add_page(filefuncs, full_path,
+                                              name, stamp)
+                    except IOError:
+                        pass # Removed after the stamp was made.
+                # Drop terms which are no longer on any page.
+                self.conn.executemany(
+                    "DELETE FROM terms WHERE term = ? AND NOT EXISTS "
+                    + "(SELECT 1 FROM postings WHERE term = ?)",
+                    [(term, term) for term in old_terms - terms])
+
+    def add_page(self, filefuncs, full_path, name, stamp):
+        """ INTERNAL: Index a single page. Returns its terms. """
+        terms = get_terms(filefuncs.read(full_path, 'rb'))
+        self.conn.execute("INSERT INTO pages VALUES (?, ?)",
+                          (name, stamp))
+        self.conn.executemany("INSERT INTO postings VALUES (?, ?)",
+                              [(term, name) for term in terms])
+        self.conn.executemany("INSERT OR IGNORE INTO terms VALUES (?)",
+                              [(term, ) for term in terms])
+        return terms
+
+    def candidates(self, words):
+        """ Return the names of the pages which have a term containing
+            each of the lower case words.
+
+            This is a superset of the pages a case insensitive regex
+            search for the words (separated by whitespace) matches. """
+        words = tuple(set(words))
+        if len(words) == 0:
+            return []
+        select = ("SELECT DISTINCT name FROM postings WHERE term IN "
+                  + "(SELECT term FROM terms WHERE instr(term, ?) > 0)")
+        return [row[0] for row in self.conn.execute(
+            ' INTERSECT '.join((select, ) * len(words)), words)]
+
+def index_file_name(base_path):
+    """ Return the index file for the wiki with its root at base_path. """
+    return os.path.join(base_path, INDEX_FILE)
+
+def update_index(file_name, filefuncs, text_dir, names):
+    """ Reindex the named pages if the index file exists.
+
+        Indices are only created by searching. Returns True if the
+        index was updated, False otherwise. """
+    if not os.path.exists(file_name):
+        return False
+    index = SearchIndex(file_name)
+    try:
+        index.update_pages(filefuncs, text_dir, names)
+    finally:
+        index.close()
+    return True
+
+def update_wiki_index(base_path, is_overlayed, names):
+    """ Reindex the named pages in the wiki with its root at base_path,
+        if it has an index. """
+    return update_index(index_file_name(base_path),
+                        get_file_funcs(base_path, is_overlayed),
+                        os.path.join(base_path, 'wikitext'), names)
@@ -21,23 +21,17 @@ import SimpleAsyncServer
 # =============================================================
 import sys
 import os
-import traceback
 import datetime
 import mimetypes
 import urllib.parse
 import urllib.request, urllib.parse, urllib.error
 import io
 import re
+import socket
 
 import piki
 from fileoverlay import remove_redundant_files
 
-# Absolute path to the cgi python script.
-SCRIPT_PATH = piki.__file__
-if SCRIPT_PATH[-3:] == 'pyc':
-    # We need the python source, *NOT* the compiled code.
-    SCRIPT_PATH = SCRIPT_PATH[:-1]
-
 # Name *without* any '/' chars
 SCRIPT_NAME = 'piki'
 
@@ -52,37 +46,54 @@ class HTTP(SimpleAsyncServer.ClientHandler):
     # cgi_directories = ['/cgi-bin']  # subdirectories for cgi scripts
 
     script_name = None
-    script_path = None
     script_regex = None
 
     logging = True      # print logging info for each request ?
     blocksize = 2 << 16 # size of blocks to read from files and send
 
+    # Requests with larger headers or bodies are refused.
+    max_header_length = 64 * 1024
+    max_body_length = 8 * 1024 * 1024
+    max_incoming = max_header_length + max_body_length
+
     def request_complete(self):
         """In the HTTP protocol, a request is complete if the "end of headers"
         sequence ('\r\n\r\n') has been received
-        If the request is POST, stores the request body in a StringIO before
+        If the request is POST, stores the request body in self.body before
         returning True"""
-        terminator = self.incoming.find('\r\n\r\n')
+        self.error = None
+        terminator = self.incoming.find(b'\r\n\r\n')
         if terminator == -1:
+            if len(self.incoming) > HTTP.max_header_length:
+                self.requestline = ''
+                self.protocol = 'HTTP/1.0'
+                self.error = (431, 'Request header fields too large')
+                return True
             return False
-        lines = self.incoming[:terminator].split('\r\n')
+        lines = self.incoming[:terminator].decode('iso-8859-1').split('\r\n')
         self.requestline = lines[0]
+        self.request_length = terminator + 4
         try:
             self.method,self.url,self.protocol = lines[0].strip().split()
         except:
             self.method = None # indicates bad request
+            self.protocol = 'HTTP/1.0'
             return True
         # put request headers in a dictionary
         self.headers = {}
         for line in lines[1:]:
+            if line.find(':') == -1:
+                self.method = None
+                return True
             k,v = line.split(':',1)
             self.headers[k.lower().strip()] = v.strip()
-        # persistent connection
-        close_conn = self.headers.get("connection","")
-        if (self.protocol == "HTTP/1.1"
-            and close_conn.lower() == "keep-alive"):
-            self.close_when_done = False
+        # persistent connection. The default for HTTP/1.1, only when asked
+        # for with HTTP/1.0.
+        conn_hdr = self.headers.get("connection","").lower()
+        if self.protocol == "HTTP/1.1":
+            self.close_when_done = conn_hdr == "close"
+        else:
+            self.close_when_done = conn_hdr != "keep-alive"
         # parse the url
         scheme,netloc,path,params,query,fragment = urllib.parse.urlparse(self.url)
         self.path,self.rest = path,(params,query,fragment)
@@ -90,19 +101,49 @@ class HTTP(SimpleAsyncServer.ClientHandler):
         if self.method == 'POST':
             # for POST requests, read the request body
             # its length must be specified in the content-length header
-            content_length = int(self.headers.get('content-length',0))
-            body = self.incoming[terminator+4:]
+            try:
+                content_length = int(self.headers.get('content-length',0))
+            except ValueError:
+                self.method = None
+                return True
+            if content_length > HTTP.max_body_length:
+                self.error = (413, 'Request entity too large')
+                return True
+            body = self.incoming[terminator+4:terminator+4+content_length]
             # request is incomplete if not all message body received
             if len(body)<content_length:
                 return False
-            f_body = io.StringIO(body)
-            f_body.seek(0)
-            sys.stdin = f_body # compatibility with CGI
+            self.body = bytes(body)
+            self.request_length += content_length
+        else:
+            self.body = b''
 
         return True
 
+    def handle_overflow(self):
+        """Refuse requests bigger than max_incoming"""
+        self.request_length = None
+        self.requestline = ''
+        self.protocol = 'HTTP/1.0'
+        self.error = (413, 'Request entity too large')
+        self.set_response(self.make_response())
+
+    def run_in_worker(self):
+        """Render piki pages on the worker threads, so one slow page (e.g.
+        a full text search) doesn't hold up everyone else"""
+        return (self.error is None and not self.method is None and
+                self.is_cgi())
+
+    def connection_header(self):
+        """Return the Connection header for the response"""
+        if self.close_when_done:
+            return "Connection: close\r\n"
+        return "Connection: keep-alive\r\n"
+
     def make_response(self):
         """Build the response : a list of strings or files"""
+        if not self.error is None:
+            return self.err_resp(*self.error)
         if self.method is None: # bad request
             return self.err_resp(400,'Bad request : %s' %self.requestline)
         resp_headers, resp_body, resp_file = '','',None
@@ -127,15 +168,20 @@ class HTTP(SimpleAsyncServer.ClientHandler):
                 size = os.stat(file_name).st_size
                 resp_headers = "Content-Type: %s\r\n" %c_type
                 resp_headers += "Content-Length: %s\r\n" %size
+                resp_headers += self.connection_header()
                 resp_headers += '\r\n'
+                resp_string = (resp_line + resp_headers).encode('ascii')
                 if self.method == "HEAD":
-                    resp_string = resp_line + resp_headers
+                    pass
                 elif size > HTTP.blocksize:
-                    resp_string = resp_line + resp_headers
+                    # Sent with sendfile() where possible.
                     resp_file = open(file_name,'rb')
                 else:
-                    resp_string = resp_line + resp_headers + \
-                        open(file_name,'rb').read()
+                    in_file = open(file_name,'rb')
+                    try:
+                        resp_string += in_file.read()
+                    finally:
+                        in_file.close()
                 response = [resp_string]
                 if resp_file:
                     response.append(resp_file)
@@ -161,44 +207,25 @@ class HTTP(SimpleAsyncServer.ClientHandler):
         return bool(HTTP.script_regex.match(self.path.strip()))
 
     def run_cgi(self):
-        # set CGI environment variables
-        self.make_cgi_env()
-        # redirect print statements to a cStringIO
+        """ Run piki in process.
 
-        save_stdout = sys.stdout
-        sys.stdout = io.StringIO()
-        # run the script
-        try:
-            # djk20091109 There was a bug here. You need the {} in order to run
-            # global functions.
-            #
-            #execfile(self.file_name)
-
-            # djk20091109 HACKED to run only piki script.
-            exec(compile(open(HTTP.script_path, "rb").read(), HTTP.script_path, 'exec'), {})
-        except:
-            sys.stdout = io.StringIO()
-            sys.stdout.write("Content-type:text/plain\r\n\r\n")
-            traceback.print_exc(file=sys.stdout)
-
-        response = sys.stdout.getvalue()
-        if self.method == "HEAD":
-            # for HEAD request, don't send message body even if the script
-            # returns one (RFC 3875)
-            head_lines = []
-            for line in response.split('\n'):
-                if not line:
-                    break
-                head_lines.append(line)
-            response = '\n'.join(head_lines)
-        sys.stdout = save_stdout # restore sys.stdout
-        # close connection in case there is no content-length header
-        self.close_when_done = True
+            piki's module state is set up once in serve_wiki() and
+            each request gets its own environment and output buffer,
+            so nothing global is swapped out here. """
+        body = piki.render_request(self.make_cgi_env(), io.BytesIO(self.body))
         resp_line = "%s 200 Ok\r\n" %self.protocol
-        return [resp_line + response]
+        resp_headers = "Content-Type: %s\r\n" % piki.CONTENT_TYPE
+        resp_headers += "Content-Length: %s\r\n" % len(body)
+        resp_headers += self.connection_header()
+        resp_headers += '\r\n'
+        response = (resp_line + resp_headers).encode('ascii')
+        if self.method != "HEAD":
+            # for HEAD request, don't send message body (RFC 3875)
+            response += body
+        return [response]
 
     def make_cgi_env(self):
-        """Set CGI environment variables"""
+        """Return the CGI environment variables for the request"""
         env = {}
         env['SERVER_SOFTWARE'] = "AsyncServer"
         env['SERVER_NAME'] = "AsyncServer"
@@ -218,22 +245,26 @@ class HTTP(SimpleAsyncServer.ClientHandler):
         #env['PATH_INFO'] = urlparse.urlunparse(("","","",self.rest[0],"",""))
         env['PATH_INFO'] = self.path[len("/" + HTTP.script_name):]
         env['QUERY_STRING'] = self.rest[1]
-        if not self.host == self.client_address[0]:
-            env['REMOTE_HOST'] = self.host
+        # Runs on a worker thread, so the lookup only holds up this request.
+        host = socket.getfqdn(self.client_address[0])
+        if not host == self.client_address[0]:
+            env['REMOTE_HOST'] = host
         env['REMOTE_ADDR'] = self.client_address[0]
         env['CONTENT_LENGTH'] = str(self.headers.get('content-length',''))
+        env['CONTENT_TYPE'] = str(self.headers.get('content-type',''))
         for k in ['USER_AGENT','COOKIE','ACCEPT','ACCEPT_CHARSET',
             'ACCEPT_ENCODING','ACCEPT_LANGUAGE','CONNECTION']:
             hdr = k.lower().replace("_","-")
             env['HTTP_%s' %k.upper()] = str(self.headers.get(hdr,''))
-        os.environ.update(env)
+        return env
 
     def err_resp(self,code,msg):
         """Return an error message"""
         resp_line = "%s %s %s\r\n" %(self.protocol,code,msg)
         self.close_when_done = True
         self.log(code)
-        return [resp_line]
+        return [(resp_line + self.connection_header()
+                 + '\r\n').encode('ascii')]
 
     def redirect_resp(self, url, msg):
         """Return a 301 redirect"""
@@ -241,7 +272,8 @@ class HTTP(SimpleAsyncServer.ClientHandler):
         resp_line += "Location: %s\r\n" % url
         self.close_when_done = True
         self.log(301)
-        return [resp_line]
+        return [(resp_line + self.connection_header()
+                 + '\r\n').encode('ascii')]
 
     def log(self,code):
         """Write a trace of the request on stderr"""
@@ -290,7 +322,6 @@ def serve_wiki(port=8081, bind_to='localhost', out_func=default_out_func):
 
     # Must set these.
     HTTP.script_name = SCRIPT_NAME
-    HTTP.script_path = SCRIPT_PATH
     HTTP.script_regex = SCRIPT_REGEX
     
     HTTP.logging = False
@@ -0,0 +1,174 @@
+""" Unit tests for the cached directory listings in fileoverlay.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fileoverlay import get_file_funcs, OVERLAY_DIR
+
+VERSION = '0123456789abcdef0123456789abcdef01234567'
+
+class OverlayCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_fileoverlay')
+        self.base_path = os.path.join(self.test_dir, 'wiki_root')
+        self.text_dir = os.path.join(self.base_path, 'wikitext')
+        self.overlay_dir = os.path.join(self.test_dir, OVERLAY_DIR,
+                                        'wikitext')
+        os.makedirs(self.text_dir)
+        os.makedirs(self.overlay_dir)
+        for name in ('FrontPage', 'OtherPage', 'FrontPage_' + VERSION):
+            self.write_file(self.text_dir, name, 'Some text.\n')
+        self.files = get_file_funcs(self.base_path, True)
+        self.make_old()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    @classmethod
+    def write_file(cls, dir_name, name, text):
+        """ Write a file the way other processes do, with a tmp file
+            and a rename. """
+        tmp_name = os.path.join(dir_name, '.tmp_' + name)
+        out_file = open(tmp_name, 'w')
+        try:
+            out_file.write(text)
+        finally:
+            out_file.close()
+        os.rename(tmp_name, os.path.join(dir_name, name))
+
+    @classmethod
+    def rewrite_in_place(cls, dir_name, name, text):
+        """ Rewrite a file without changing its directory's modtime. """
+        out_file = open(os.path.join(dir_name, name), 'w')
+        try:
+            out_file.write(text)
+        finally:
+            out_file.close()
+
+    def make_old(self):
+        """ Move the directory modtimes out of the racy window. """
+        then = int((time.time() - 10) * 1e9) + 123
+        for dir_name in (self.text_dir, self.overlay_dir):
+            os.utime(dir_name, ns=(then, then))
+
+    def page_path(self, name):
+        return os.path.join(self.text_dir, name)
+
+    def check(self, pages):
+        """ Check the cached listings against the expected set of
+            existing pages and against an instance with no cache. """
+        fresh = get_file_funcs(self.base_path, True)
+        listed = set(self.files.list_pages(self.text_dir))
+        self.assertEqual(listed, set(fresh.list_pages(self.text_dir)))
+        # Deleted pages are still listed.
+        self.assertTrue(pages.issubset(listed))
+        for name in ('FrontPage', 'OtherPage', 'NewPage',
+                     'FrontPage_' + VERSION):
+            self.assertEqual(self.files.exists(self.page_path(name)),
+                             name in pages, name)
+            self.assertEqual(self.files.has_overlay(self.page_path(name)),
+                             fresh.has_overlay(self.page_path(name)), name)
+        self.assertEqual(self.files.fork_index(self.text_dir),
+                         fresh.fork_index(self.text_dir))
+
+    def test_delete_by_overlay(self):
+        all_pages = set(['FrontPage', 'OtherPage', 'FrontPage_' + VERSION])
+        self.check(all_pages)
+        # Cached now.
+        self.assertTrue(self.files.snapshot(self.text_dir).stamp is not None)
+
+        # Zero length overlays delete the page and the fork.
+        self.write_file(self.overlay_dir, 'OtherPage', '')
+        self.write_file(self.overlay_dir, 'FrontPage_' + VERSION, '')
+        self.check(set(['FrontPage', ]))
+        self.make_old()
+        self.check(set(['FrontPage', ]))
+
+        # Through the IFileFunctions interface.
+        self.files.remove_overlay(self.page_path('OtherPage'))
+        self.check(set(['FrontPage', 'OtherPage']))
+        self.files.write(self.page_path('FrontPage'), '')
+        self.check(set(['OtherPage', ]))
+
+    def test_tmp_rename_write(self):
+        self.check(set(['FrontPage', 'OtherPage', 'FrontPage_' + VERSION]))
+        self.write_file(self.text_dir, 'NewPage', 'New.\n')
+        self.check(set(['FrontPage', 'OtherPage', 'NewPage',
+                        'FrontPage_' + VERSION]))
+        self.make_old()
+
+        # An overlay replaces the page, and the cached size is updated.
+        self.files.write(self.page_path('NewPage'), 'Changed.\n')
+        self.assertEqual(self.files.read(self.page_path('NewPage')),
+                         'Changed.\n')
+        self.assertEqual(os.listdir(self.overlay_dir), ['NewPage'])
+
+        # Removed behind the cache's back.
+        os.remove(os.path.join(self.text_dir, 'FrontPage_' + VERSION))
+        self.check(set(['FrontPage', 'OtherPage', 'NewPage']))
+        self.assertEqual(self.files.fork_index(self.text_dir), {})
+        self.make_old()
+
+        # A fork made by another process.
+        self.write_file(self.text_dir, 'NewPage_' + VERSION, 'Fork.\n')
+        self.assertEqual(self.files.fork_index(self.text_dir),
+                         {'NewPage':[VERSION, ]})
+
+    def test_remove_overlay_behind_back(self):
+        self.write_file(self.overlay_dir, 'OtherPage', '')
+        self.make_old()
+        self.check(set(['FrontPage', 'FrontPage_' + VERSION]))
+        os.remove(os.path.join(self.overlay_dir, 'OtherPage'))
+        self.check(set(['FrontPage', 'OtherPage', 'FrontPage_' + VERSION]))
+
+    def test_racy_rewrite(self):
+        # Made just now, so the listing isn't cached.
+        self.write_file(self.overlay_dir, 'OtherPage', '')
+        self.check(set(['FrontPage', 'FrontPage_' + VERSION]))
+        self.assertTrue(self.files.snapshot(self.overlay_dir, True).stamp
+                        is None)
+
+        # Doesn't change the overlay dir's modtime.
+        self.rewrite_in_place(self.overlay_dir, 'OtherPage', 'Back.\n')
+        self.check(set(['FrontPage', 'OtherPage', 'FrontPage_' + VERSION]))
+        self.assertEqual(self.files.read(self.page_path('OtherPage')),
+                         'Back.\n')
+
+    def test_racy_coarse_modtime(self):
+        # A file system which only keeps whole seconds.
+        self.write_file(self.overlay_dir, 'OtherPage', '')
+        then = (int(time.time()) - 1) * 1000000000
+        os.utime(self.overlay_dir, ns=(then, then))
+        self.check(set(['FrontPage', 'FrontPage_' + VERSION]))
+        self.rewrite_in_place(self.overlay_dir, 'OtherPage', 'Back.\n')
+        self.check(set(['FrontPage', 'OtherPage', 'FrontPage_' + VERSION]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+""" Unit tests for the piki full text search index.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import piki
+import searchindex
+
+PAGES = {
+    'FrontPage':'The quick brown fox.\nSee OtherPage and PagePage.\n',
+    'OtherPage':'brown, quick and QUICK_BROWN foxes 123\n',
+    'FoldPage':'Meſſage at 3 Kelvin. İnk.\n',
+    'PlainPage':'nothing to see here\n',
+}
+
+NEEDLES = ('page', 'PAGE', 'ontpa', 'quick brown', 'brown quick', 'quick',
+           'quick_brown', 'fox', 'foxes', '123', '23', 'message', 'kelvin',
+           'ink', 'the  quick', 'nowhere', ' see ')
+
+class IndexSearchTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_searchindex')
+        self.wiki_root = os.path.join(self.test_dir, 'wiki_root')
+        os.makedirs(os.path.join(self.wiki_root, 'wikitext'))
+        for name, text in PAGES.items():
+            self.write_page(name, text)
+        piki.reset_root_dir(self.wiki_root, True)
+        piki.filefuncs.max_age = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_page(self, name, text):
+        out_file = open(os.path.join(self.wiki_root, 'wikitext', name), 'wb')
+        try:
+            out_file.write(text.encode('utf8'))
+        finally:
+            out_file.close()
+
+    def check_same(self, needles=NEEDLES):
+        for needle in needles:
+            result = piki.index_fullsearch(needle)
+            self.assertFalse(result is None)
+            self.assertEqual(sorted(result[0]),
+                             sorted(piki.regex_fullsearch(needle)[0]),
+                             needle)
+            self.assertEqual(result[1], len(PAGES))
+
+    def test_same_as_regex(self):
+        self.check_same()
+        self.assertEqual(sorted(piki.index_fullsearch('page')[0]),
+                         [(3, 'FrontPage')])
+        self.assertEqual(piki.index_fullsearch('message')[0],
+                         [(1, 'FoldPage')])
+
+    def test_not_plain(self):
+        for needle in ('fo+', 'qu.ck', 'ſ', ''):
+            self.assertTrue(piki.index_fullsearch(needle) is None)
+
+    def test_edits(self):
+        self.check_same()
+        # Overlayed edit through piki.
+        full_path = os.path.join(piki.text_dir, 'PlainPage')
+        piki.filefuncs.write(full_path, 'a page about foxes\n', 'wb')
+        piki.update_search_index(('PlainPage', ))
+        self.check_same()
+        self.assertEqual(sorted(piki.index_fullsearch('foxes')[0]),
+                         [(1, 'OtherPage'), (1, 'PlainPage')])
+
+        # Overlayed delete.
+        piki.filefuncs.write(full_path, '', 'wb')
+        piki.update_search_index(('PlainPage', ))
+        self.assertEqual(piki.index_fullsearch('about')[0], [])
+
+    def test_terms_pruned(self):
+        index = searchindex.SearchIndex(
+            searchindex.index_file_name(self.wiki_root))
+        try:
+            index.sync(piki.filefuncs, piki.text_dir)
+            self.assertEqual(index.candidates(('nothing', )), ['PlainPage'])
+            os.remove(os.path.join(piki.text_dir, 'PlainPage'))
+            index.update_pages(piki.filefuncs, piki.text_dir, ('PlainPage', ))
+            self.assertEqual(index.candidates(('nothing', )), [])
+            terms = set([row[0] for row in
+                         index.conn.execute("SELECT term FROM terms")])
+            self.assertFalse('nothing' in terms)
+            # Still on FrontPage.
+            self.assertTrue('see' in terms)
+        finally:
+            index.close()
+
+    def test_old_version(self):
+        file_name = searchindex.index_file_name(self.wiki_root)
+        conn = sqlite3.connect(file_name)
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT INTO meta VALUES ('version', '1')")
+        conn.execute("CREATE TABLE postings (term TEXT, name TEXT, "
+                     + "count INTEGER, PRIMARY KEY (term, name)) "
+                     + "WITHOUT ROWID")
+        conn.commit()
+        conn.close()
+        self.check_same()
+
+if __name__ == '__main__':
+    unittest.main()
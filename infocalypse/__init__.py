@@ -123,6 +123,24 @@ key for the repository. For other levels, the
 top key insert is skipped if you don't have
 the private key.
 
+PULLING AND PUSHING MANY REPOS AT ONCE:
+
+hg fn-batch --file ~/mirrors.txt
+
+pulls or pushes every repository listed in the file
+over a single FCP connection. Each line is:
+
+<pull|push> <repository directory> [uri]
+
+If the uri is left out, the one stored in the config
+file for the directory is used, just like fn-pull and
+fn-push do. You can also use --pull <dir> and --push <dir>,
+more than once.
+
+--repos sets how many repositories are worked on at once.
+The total number of FCP requests is still limited by the
+N_CONCURRENT default.
+
 WARNING:
 DO NOT use fn-reinsert if you're concerned about
 correlation attacks. The risk is on the order
@@ -554,6 +572,18 @@ cmdtable = {
                    + NOSEARCH_OPT
                    + AGGRESSIVE_OPT,
                    b"[options]"),
+
+    b"fn-batch": (fncommands.infocalypse_batch,
+                 [(b'', b'pull', [], b'repository directory to pull into'),
+                  (b'', b'push', [], b'repository directory to push from'),
+                  (b'', b'file', b'', b'file with one '
+                   + b'"<pull|push> <dir> [uri]" line per repository'),
+                  (b'', b'repos', 8, b'maximum number of repositories to '
+                   + b'work on at once'),
+                 ]
+                 + FCP_OPTS
+                 + NOSEARCH_OPT,
+                 b"[options]"),
 }
 
 
@@ -565,6 +595,7 @@ try:
     commands.norepo += ' fn-setupwot'
     commands.norepo += ' fn-setupfreemail'
     commands.norepo += ' fn-updaterepolist'
+    commands.norepo += ' fn-batch'
 except AttributeError as e: # Mercurial 3.8 API change
     for i in cmdtable:
         cmdtable[i][0].norepo = False
@@ -578,6 +609,7 @@ except AttributeError as e: # Mercurial 3.8 API change
     fncommands.infocalypse_genkey.norepo = True
     fncommands.infocalypse_archive.norepo = True
     fncommands.infocalypse_update_repo_list.norepo = True
+    fncommands.infocalypse_batch.norepo = True
 
 
 ## Wrap core commands for use with freenet keys.
@@ -24,7 +24,8 @@ from mercurial import util
 from .fcpclient import get_version, get_usk_for_usk_version, is_usk_file, is_usk
 
 from . import config
-from .infcmds import setup, do_key_setup, is_redundant, run_until_quiescent
+from .infcmds import setup, do_key_setup, is_redundant, run_until_quiescent, \
+     cleanup_runner
 from .updatesm import QUIESCENT, FINISHING
 from .archivesm import create_dirs, ArchiveUpdateContext, \
      start_inserting_blocks, start_requesting_blocks, cleanup_dirs, \
@@ -51,11 +52,12 @@ def arc_cleanup(update_sm, top_key_state=None):
         cleanup_dirs(ctx.ui_,
                      ctx['ARCHIVE_CACHE_DIR'],
                      ctx['REQUEST_URI'],
-                     top_key)
+                     top_key,
+                     ctx.get('CHK_STORE_MAX_BYTES'))
 
     # Previous cleanup code.
     if not update_sm.runner is None:
-        update_sm.runner.connection.close()
+        cleanup_runner(update_sm.runner)
 
     if not update_sm.ctx.bundle_cache is None:
         update_sm.ctx.bundle_cache.remove_files() # Unreachable???
@@ -136,6 +138,7 @@ def execute_arc_create(ui_, params, stored_cfg):
         ctx.update({'REQUEST_URI':request_uri,
                     'INSERT_URI':params['INSERT_URI'],
                     'ARCHIVE_CACHE_DIR':params['ARCHIVE_CACHE_DIR'],
+                    'CHK_STORE_MAX_BYTES':params['CHK_STORE_MAX_BYTES'],
                     'PROVISIONAL_TOP_KEY':top_key,
                     'ARCHIVE_BLOCK_FILES':files})
 
@@ -183,7 +186,8 @@ def execute_arc_pull(ui_, params, stored_cfg):
         # Pull changes into the local block cache.
         ctx = ArchiveUpdateContext(update_sm, ui_)
         ctx.update({'REQUEST_URI':params['REQUEST_URI'],
-                    'ARCHIVE_CACHE_DIR':params['ARCHIVE_CACHE_DIR']})
+                    'ARCHIVE_CACHE_DIR':params['ARCHIVE_CACHE_DIR'],
+                    'CHK_STORE_MAX_BYTES':params['CHK_STORE_MAX_BYTES']})
         start_requesting_blocks(update_sm, ctx)
         run_until_quiescent(update_sm, params['POLL_SECS'])
 
@@ -243,6 +247,7 @@ def execute_arc_push(ui_, params, stored_cfg):
         ctx.update({'REQUEST_URI':request_uri,
                     'INSERT_URI':params['INSERT_URI'],
                     'ARCHIVE_CACHE_DIR':params['ARCHIVE_CACHE_DIR'],
+                    'CHK_STORE_MAX_BYTES':params['CHK_STORE_MAX_BYTES'],
                     'PROVISIONAL_TOP_KEY':top_key,
                     'ARCHIVE_BLOCK_FILES':files})
 
@@ -290,6 +295,7 @@ def execute_arc_reinsert(ui_, params, stored_cfg):
         ctx.update({'REQUEST_URI':request_uri,
                     'INSERT_URI':params['INSERT_URI'],
                     'ARCHIVE_CACHE_DIR':params['ARCHIVE_CACHE_DIR'],
+                    'CHK_STORE_MAX_BYTES':params['CHK_STORE_MAX_BYTES'],
                     'PROVISIONAL_TOP_KEY':top_key,
                     'ARCHIVE_BLOCK_FILES':files,
                     'REINSERT':params['REINSERT_LEVEL']})
@@ -25,19 +25,21 @@ import shutil
 
 from . import archivetop
 
-from .fcpconnection import make_id, SUCCESS_MSGS, sha1_hexdigest
+from .fcpconnection import make_id, SUCCESS_MSGS
 from .fcpclient import get_version, get_usk_hash, get_usk_for_usk_version, \
      is_usk
 from .fcpmessage import GET_DEF, PUT_FILE_DEF
 
 from .statemachine import StateMachine, State, DecisionState, \
-     RetryingRequestList, CandidateRequest
+     RetryingRequestList, CandidateRequest, HedgingPolicy
 from .updatesm import UpdateStateMachine, QUIESCENT, FAILING, FINISHING, \
      RequestingUri, InsertingUri, UpdateContextBase, PAD_BYTE
 
 from .archivetop import top_key_tuple_to_bytes, default_out
 
 from .chk import clear_control_bytes
+from .chkstore import ChkStore, CHK_STORE_DIR, CHK_NAME_PREFIX, \
+     DEFAULT_MAX_STORE_BYTES, chk_file_name
 from .graph import FREENET_BLOCK_LEN, MAX_METADATA_HACK_LEN
 
 TMP_DIR = "__TMP__"
@@ -50,8 +52,10 @@ ARC_METADATA_MARKER = ARC_MIME_TYPE + ';'
 # Careful when changing. There is code that depends on '_' chars.
 TOP_KEY_NAME_PREFIX = "_top_"
 TOP_KEY_NAME_FMT = TOP_KEY_NAME_PREFIX + "%i_.bin"
-CHK_NAME_PREFIX = "_chk_"
-CHK_NAME_FMT = CHK_NAME_PREFIX + "%s.bin"
+
+# Default time to wait before racing a slow block request against
+# a request for the redundant block.
+BLOCK_HEDGE_DELAY_SECS = 90
 
 ARC_REQUESTING_URI = 'ARC_REQUESTING_URI'
 ARC_CACHING_TOPKEY = 'ARC_CACHING_TOPKEY'
@@ -62,14 +66,6 @@ ARC_FIXING_UP_TOP_KEY = 'ARC_FIXING_UP_TOP_KEY'
 ARC_INSERTING_URI = 'ARC_INSERTING_URI'
 ARC_CACHING_INSERTED_TOPKEY = 'ARC_CACHING_INSERTED_TOPKEY'
 
-# File name that 0) is tagged for deletion and
-# 1) doesn't have weird chars in it. e.g. '~'
-# Hmmm... it would be more studly to extract the (SHA256?)
-# hash from the CHK and use that
-def chk_file_name(chk):
-    """ Return a file name for the CHK. """
-    return CHK_NAME_FMT % sha1_hexdigest(chk)
-
 class ArchiveUpdateContext(UpdateContextBase):
     """ An UpdateContextBase for running incremental archive commands. """
     def __init__(self, parent=None, ui_=None):
@@ -92,36 +88,37 @@ class ArchiveUpdateContext(UpdateContextBase):
         dest =  os.path.join(self.arch_cache_dir(),
                              chk_file_name(chk))
 
+        store = self.arch_chk_store()
         if os.path.exists(dest):
+            store.touch(chk)
             return
 
-        if not os.path.exists(file_name):
-            print("DOESN'T EXIST: ", file_name)
-            return
-
-        if not length is None:
-            #print length, os.path.getsize(file_name)
-            assert length <= os.path.getsize(file_name)
-            if length < os.path.getsize(file_name):
-                out_file = open(file_name, 'ab')
-                try:
-                    out_file.truncate(length)
-                finally:
-                    out_file.close()
-            assert length == os.path.getsize(file_name)
+        if store.lookup(chk) is None:
+            if not os.path.exists(file_name):
+                print("DOESN'T EXIST: ", file_name)
+                return
+            store.add(chk, file_name, length)
 
-        os.rename(file_name, dest)
+        # Hard link so the data is only stored once.
+        store.link_out(chk, dest, length)
 
     def required_blocks(self, top_key_tuple):
         """ Return ((block_len, (chk0, ..), ...) for
             non-locally-cached blocks. """
+        store = self.arch_chk_store()
         ret = []
         for block in top_key_tuple[0]:
             required_chks = []
             cached = 0
             for chk in block[1]:
-                if not os.path.exists(os.path.join(self.arch_cache_dir(),
-                                                   chk_file_name(chk))):
+                full_path = os.path.join(self.arch_cache_dir(),
+                                         chk_file_name(chk))
+                if (not os.path.exists(full_path) and
+                    not store.lookup(chk) is None):
+                    # Already fetched for another archive.
+                    store.link_out(chk, full_path)
+
+                if not os.path.exists(full_path):
                     #print "NEEDS: ", chk
                     required_chks.append(chk)
                 else:
@@ -137,6 +134,12 @@ class ArchiveUpdateContext(UpdateContextBase):
         return os.path.join(self['ARCHIVE_CACHE_DIR'],
                             get_usk_hash(self['REQUEST_URI']))
 
+    def arch_chk_store(self):
+        """ Return the CHK store shared by all archives in the cache. """
+        max_bytes = self.get('CHK_STORE_MAX_BYTES')
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_STORE_BYTES
+        return ChkStore(chk_store_dir(self['ARCHIVE_CACHE_DIR']), max_bytes)
 
 class RequestingArchiveUri(RequestingUri):
     """ A state to request the top level URI for an archive. """
@@ -595,6 +598,7 @@ class RequestingRedundantBlocks(RetryingRequestList):
         self.failure_state = failure_state
         self.blocks = ()
         self.history = RequestHistory()
+        self.hedging = HedgingPolicy(BLOCK_HEDGE_DELAY_SECS)
 
     def enter(self, from_state):
         """ State implementation. """
@@ -626,6 +630,11 @@ class RequestingRedundantBlocks(RetryingRequestList):
             chk_ordinals = list(range(0, len(block[1])))
             # DESIGN INTENT: Don't favor primary over redundant.
             random.shuffle(chk_ordinals)
+            # ... unless one of them usually wins hedged races.
+            preferred = self.hedging.preferred_ordinal(chk_ordinals)
+            if not preferred is None:
+                chk_ordinals.remove(preferred)
+                chk_ordinals.append(preferred)
             ordinal = chk_ordinals.pop()
             # Randomly enqueue one full request.
             self.current_candidates.append((block_ordinal, ordinal, False))
@@ -739,6 +748,40 @@ class RequestingRedundantBlocks(RetryingRequestList):
         self.current_candidates.insert(0, alternate) # FIFO
         return True
 
+    def hedge_candidate(self, candidate):
+        """ RetryingRequestList implementation. """
+        if candidate[2] or len(self.blocks[candidate[0]][1]) < 2:
+            return None
+
+        alternate = (candidate[0], int(not candidate[1]), False)
+        if self.history.is_running(alternate) or self.history.tried(alternate):
+            return None
+
+        # Upgrade a queued top block only request to a full one.
+        alternate_partial = (candidate[0], alternate[1], True)
+        if alternate_partial in self.current_candidates:
+            self.current_candidates.remove(alternate_partial)
+        if alternate in self.current_candidates:
+            self.current_candidates.remove(alternate)
+
+        self.parent.ctx.ui_.status("Hedging slow request %s with %s.\n" %
+                                   (str(candidate), str(alternate)))
+        return alternate
+
+    def hedge_group(self, candidate):
+        """ RetryingRequestList implementation. """
+        if candidate[2]:
+            return None # Top block only requests don't race.
+        return candidate[0]
+
+    def hedge_ordinal(self, candidate):
+        """ RetryingRequestList implementation. """
+        return candidate[1]
+
+    def hedge_lost(self, candidate):
+        """ RetryingRequestList implementation. """
+        self.history.finished_request(candidate, False)
+
     def candidate_done(self, client, msg, candidate):
         """ RetryingRequestList implementation. """
         #print "CANDIDATE_DONE: ", msg[0], candidate
@@ -858,6 +901,36 @@ class ArchiveStateMachine(UpdateStateMachine):
 
 
 
+def chk_store_dir(cache_dir):
+    """ Return the directory of the CHK store shared by all the archives
+        cached in cache_dir. """
+    return os.path.join(cache_dir, CHK_STORE_DIR)
+
+def referenced_chks(cache_dir):
+    """ Return the set of all CHKs referenced by the top keys cached
+        for any archive in cache_dir. """
+    ret = set([])
+    for dir_name in os.listdir(cache_dir):
+        archive_dir = os.path.join(cache_dir, dir_name)
+        if (dir_name in (TMP_DIR, BLOCK_DIR, CHK_STORE_DIR) or
+            not os.path.isdir(archive_dir)):
+            continue
+        for name in os.listdir(archive_dir):
+            if not name.startswith(TOP_KEY_NAME_PREFIX):
+                continue
+            in_file = open(os.path.join(archive_dir, name), 'rb')
+            try:
+                try:
+                    top_key = archivetop.bytes_to_top_key_tuple(
+                        in_file.read())[0]
+                except ValueError:
+                    continue # Corrupt. Don't let it keep blocks alive.
+            finally:
+                in_file.close()
+            for block in top_key[0]:
+                ret.update(block[1])
+    return ret
+
 def create_dirs(ui_, cache_dir, uri):
     """ Create cache and temp directories for an archive. """
     full_path = os.path.join(cache_dir, get_usk_hash(uri))
@@ -870,8 +943,18 @@ def create_dirs(ui_, cache_dir, uri):
         ui_.status("Creating temp dir:\n%s\n" % tmp_dir)
         os.makedirs(tmp_dir)
 
-def cleanup_dirs(ui_, cache_dir, uri, top_key=None):
-    """ Remove unneeded files from the archive cache dir. """
+    store_dir = chk_store_dir(cache_dir)
+    if not os.path.exists(store_dir):
+        ui_.status("Creating block store dir:\n%s\n" % store_dir)
+        os.makedirs(store_dir)
+
+def cleanup_dirs(ui_, cache_dir, uri, top_key=None, max_bytes=None):
+    """ Remove unneeded files from the archive cache dir.
+
+        Blocks in the shared CHK store which aren't referenced by any
+        cached top key are removed, least recently used first, until
+        the store is smaller than max_bytes. None means
+        DEFAULT_MAX_STORE_BYTES. """
 
     # Remove temp dir
     tmp_dir = os.path.join(cache_dir, TMP_DIR)
@@ -912,6 +995,15 @@ def cleanup_dirs(ui_, cache_dir, uri, top_key=None):
             choose_word(len(survivors) == 1, '','s'),
             archive_dir))
 
+    # Only now, after stale top keys are gone.
+    store = ChkStore(chk_store_dir(cache_dir))
+    removed = store.collect_garbage(referenced_chks(cache_dir), max_bytes)
+    if len(removed) > 0:
+        ui_.status("Removed %i unreferenced block%s from: %s\n" % (
+            len(removed),
+            choose_word(len(removed) == 1, '', 's'),
+            store.base_dir))
+
 # LATER: Add "START_STATE" to context, get rid of
 #        most start_* members on UpdateStateMachine
 #        and replace them with a generic start(ctx) function.
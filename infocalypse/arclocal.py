@@ -26,9 +26,11 @@ import random
 
 from . import archivetop
 from .fcpclient import get_version, get_usk_hash
+from .fcpconnection import sha1_hexdigest
 from .graph import MAX_METADATA_HACK_LEN
-from .archivesm import choose_word, chk_file_name, BLOCK_DIR, TMP_DIR, \
-     TOP_KEY_NAME_FMT
+from .archivesm import choose_word, chk_file_name, chk_store_dir, \
+     BLOCK_DIR, TMP_DIR, TOP_KEY_NAME_FMT
+from .chkstore import ChkStore, link_or_copy
 
 # Archive stuff
 from .pathhacks import add_parallel_sys_path
@@ -36,7 +38,8 @@ add_parallel_sys_path('wormarc')
 from blocks import BlockStorage, ITempFileManager
 from archive import WORMBlockArchive, UpToDateException
 from deltacoder import DeltaCoder
-from filemanifest import FileManifest, entries_from_dir, manifest_to_dir
+from filemanifest import FileManifest, entries_from_dir, manifest_to_dir, \
+     StatCache
 
 BLOCK_NAME = "block"
 
@@ -48,6 +51,9 @@ KIND_MANIFEST = 1 # 32 bit unsigned id value.
 # MUST match blocknames.BLOCK_SUFFIX
 BLOCK_NAME_FMT = BLOCK_NAME +"_%i.bin"
 
+# One per directory synched from the archive.
+STAT_CACHE_FMT = "_stat_%s.txt"
+
 class HandleTemps(ITempFileManager):
     """ Delegate to handle temp file creation and deletion. """
     def __init__(self, base_dir):
@@ -78,9 +84,15 @@ def cache_dir_name(cache_dir, uri):
 
 def cached_block(cache_dir, uri, block):
     """ Return the file name of a cached block. """
+    store = ChkStore(chk_store_dir(cache_dir))
     for chk in block[1]:
         full_path = os.path.join(cache_dir_name(cache_dir, uri),
                                  chk_file_name(chk))
+        if (not os.path.exists(full_path) and
+            not store.lookup(chk) is None):
+            # Cached for another archive.
+            store.link_out(chk, full_path)
+
         if os.path.exists(full_path):
             if os.path.getsize(full_path) != block[0]:
                 raise IOError("Wrong size: %s, expected: %i, got: %i" %
@@ -93,6 +105,13 @@ def cached_block(cache_dir, uri, block):
 
     raise IOError("Not cached: %s" % str(block))
 
+def stat_cache_file(cache_dir, uri, to_dir):
+    """ Return the file name of the stat cache for a directory synched
+        from the archive. """
+    dir_hash = sha1_hexdigest(os.path.abspath(to_dir).encode('utf8'))
+    return os.path.join(cache_dir_name(cache_dir, uri),
+                        STAT_CACHE_FMT % dir_hash.decode('utf8'))
+
 def load_cached_top_key(cache_dir, uri):
     """ Return a top key tuple from a cached top key. """
     full_path = os.path.join(cache_dir_name(cache_dir, uri),
@@ -121,18 +140,23 @@ def verify_fully_cached(cache_dir, uri, top_key):
 def setup_block_dir(cache_dir, uri, top_key=None, copy_blocks=False,
                     pad_to=4):
     """ Create a temporary block directory for reading and writing
-        archive blocks. """
+        archive blocks.
+
+        If copy_blocks is True, the block files are hard links (or
+        reflinks, or copies) of the cached blocks. """
     block_dir = os.path.join(cache_dir, BLOCK_DIR)
     if os.path.exists(block_dir):
         shutil.rmtree(block_dir) # Hmmmm...
     os.makedirs(block_dir)
 
     if copy_blocks:
+        # Hard link instead of copying. The archive code never writes
+        # into an existing block file, it only renames and removes them.
         for index, block in enumerate(top_key[0]):
             src = cached_block(cache_dir, uri, block)
             dest = os.path.join(block_dir,
                                 BLOCK_NAME_FMT % index)
-            shutil.copyfile(src, dest)
+            link_or_copy(src, dest)
         # 'pad' with empty block files.
         for index in range(len(top_key[0]), pad_to):
             dest = os.path.join(block_dir,
@@ -161,7 +185,7 @@ def load_cached_archive(cache_dir, uri):
 
     verify_fully_cached(cache_dir, uri, top_key)
 
-    # Clear previous block dir and copy cached blocks into it.
+    # Clear previous block dir and link cached blocks into it.
     block_dir = setup_block_dir(cache_dir, uri, top_key, True)
 
     tmps = HandleTemps(os.path.join(cache_dir, TMP_DIR))
@@ -276,6 +300,8 @@ def local_create(cache_dir, uri, from_dir):
 def local_synch(ui_, cache_dir, uri, to_dir):
     """ Update to_dir from the archive in cache_dir.
 
+        Only files which don't match the archive are rewritten.
+
         CAUTION: May delete files and directories.
     """
 
@@ -284,8 +310,15 @@ def local_synch(ui_, cache_dir, uri, to_dir):
         # Load the old file manifest and use it to extract.
         manifest = FileManifest.from_archive(archive, top_key[1][0][0])
 
-        result = manifest_to_dir(archive, manifest,
-                                 to_dir, make_skip_regex(cache_dir))
+        stat_cache = StatCache.from_file(stat_cache_file(cache_dir, uri,
+                                                         to_dir))
+        try:
+            result = manifest_to_dir(archive, manifest,
+                                     to_dir, make_skip_regex(cache_dir),
+                                     False, stat_cache)
+        finally:
+            # Save even on failure so finished files aren't redone.
+            stat_cache.save()
         ui_.status(("Created: %i, Modified: %i, Removed: %i\n") %
                    (len(result[0]), len(result[1]), len(result[2])))
 
@@ -0,0 +1,299 @@
+""" Implementation of commands to pull or push many Infocalypse
+    repositories at once over a single FCP connection.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# Each repository gets its own UpdateStateMachine, which is just
+# another RequestQueue on the shared RequestRunner. The runner round
+# robins between them, so N_CONCURRENT bounds the FCP requests for
+# the whole batch, not per repository.
+
+import os
+import socket
+import time
+
+from mercurial import hg, error
+
+from .infcmds import UICallbacks, make_runner, cleanup_runner, \
+     do_key_setup, handle_updating_config, update_request_index, \
+     check_uri, set_debug_vars, track_request_uri
+from .updatesm import UpdateStateMachine, UpdateContext, QUIESCENT, \
+     FINISHING, INSERTING_URI, REQUESTING_URI
+from .bundlecache import BundleCache, is_writable
+from .usktracker import USKTracker
+from .keys import parse_repo_path
+
+PULL = b'pull'
+PUSH = b'push'
+
+# Maximum number of repositories to work on at the same time.
+DEFAULT_MAX_ACTIVE = 8
+
+class RepoUI:
+    """ A ui wrapper which prefixes output with a repository name so
+        output from concurrent jobs can be told apart. """
+    def __init__(self, ui_, name):
+        self.ui_ = ui_
+        self.prefix = b'[' + name + b'] '
+
+    def fix(self, msg):
+        """ INTERNAL: Return the prefixed message as bytes. """
+        if isinstance(msg, str):
+            msg = msg.encode('utf8')
+        return self.prefix + msg
+
+    def status(self, msg):
+        """ Same as ui.status. """
+        self.ui_.status(self.fix(msg))
+
+    def warn(self, msg):
+        """ Same as ui.warn. """
+        self.ui_.warn(self.fix(msg))
+
+    def debug(self, msg):
+        """ Same as ui.debug. """
+        self.ui_.debug(self.fix(msg))
+
+    def __getattr__(self, name):
+        return getattr(self.ui_, name)
+
+class BatchJob:
+    """ A pull or push of one repository in a batch.
+
+        repo_dir is a bytes path, like hg uses. """
+    def __init__(self, command, repo_dir, uri=None):
+        assert command in (PULL, PUSH)
+        self.command = command
+        self.repo_dir = repo_dir
+        self.uri = uri
+        self.params = None
+        self.repo = None
+        self.update_sm = None
+        self.start_time = None
+        self.end_time = None
+        self.succeeded = False
+        # Request URIs on success.
+        self.result_uris = ()
+        self.error = None
+
+    def name(self):
+        """ Return a short name for the job, for ui output. """
+        return os.path.basename(os.path.normpath(self.repo_dir))
+
+    def is_done(self):
+        """ Return True if the job has finished, successfully or not. """
+        return not self.end_time is None
+
+    def fail(self, msg):
+        """ Finish the job with an error message. """
+        self.error = msg
+        self.succeeded = False
+        self.end_time = time.time()
+
+def read_batch_file(file_name):
+    """ Read BatchJobs from a text file with one
+        '<pull|push> <repo dir> [uri]' line per repository.
+
+        Blank lines and lines starting with '#' are ignored. """
+    jobs = []
+    in_file = open(file_name, 'rb')
+    try:
+        for line in in_file.readlines():
+            fields = line.strip().split()
+            if len(fields) == 0 or fields[0].startswith(b'#'):
+                continue
+            if not fields[0] in (PULL, PUSH) or not len(fields) in (2, 3):
+                raise error.Abort(b"Bad line in batch file: %s\n"
+                                  % line.strip())
+            uri = None
+            if len(fields) == 3:
+                uri = parse_repo_path(fields[2])
+            jobs.append(BatchJob(fields[0],
+                                 os.path.expanduser(fields[1]), uri))
+    finally:
+        in_file.close()
+    return jobs
+
+def start_job(ui_, job, runner, shared, params, stored_cfg):
+    """ INTERNAL: Start a pull or push for a job on the shared runner.
+
+        Fails the job instead of raising for per repository problems. """
+    job.start_time = time.time()
+    job_ui = RepoUI(ui_, job.name())
+    try:
+        job.repo = hg.repository(ui_, job.repo_dir)
+    except error.RepoError as err:
+        job.fail(bytes(err))
+        return
+
+    job.params = params.copy()
+    if job.command == PULL:
+        uri = job.uri or stored_cfg.get_request_uri(job.repo.root)
+        if not uri:
+            job.fail(b"No stored request URI. Use fn-pull --uri once.")
+            return
+        job.params['REQUEST_URI'] = uri
+        update_request_index(job_ui, job.params, stored_cfg)
+        check_uri(job_ui, job.params['REQUEST_URI'])
+        track_request_uri(shared, job.params)
+    else:
+        uri = job.uri or stored_cfg.get_dir_insert_uri(job.repo.root)
+        if not uri:
+            job.fail(b"No stored insert URI. Use fn-push --uri once.")
+            return
+        job.params['INSERT_URI'] = uri
+        check_uri(job_ui, job.params['INSERT_URI'])
+
+    ctx = UpdateContext(None)
+    ctx.repo = job.repo
+    ctx.ui_ = job_ui
+    ctx.bundle_cache = BundleCache(job.repo, job_ui, params['TMP_DIR'])
+    ctx.usk_tracker = shared
+    ctx.latency_model = runner.latency_model
+    update_sm = UpdateStateMachine(runner, ctx)
+
+    callbacks = UICallbacks(job_ui)
+    callbacks.verbosity = params.get('VERBOSITY', 1)
+    callbacks.metrics = runner.metrics
+    update_sm.params = job.params.copy()
+    update_sm.transition_callback = callbacks.transition_callback
+    update_sm.monitor_callback = callbacks.monitor_callback
+    update_sm.params[b'FREENET_BUILD'] = (
+        runner.connection.node_hello[1][b'Build'])
+    job.update_sm = update_sm
+
+    if job.command == PULL:
+        job_ui.status(b"Pulling from:\n%s\n" % job.params['REQUEST_URI'])
+        update_sm.start_pulling(job.params['REQUEST_URI'])
+        return
+
+    # Runs the other jobs while it waits for the key to be inverted.
+    request_uri, is_keypair = do_key_setup(job_ui, update_sm, job.params,
+                                           stored_cfg)
+    # do_key_setup() can update the params.
+    update_sm.params.update(job.params)
+    job_ui.status(b"Pushing to:\n%s\n" % job.params['INSERT_URI'])
+    update_sm.start_pushing(job.params['INSERT_URI'],
+                            job.params.get('TO_VERSIONS', (b'tip',)),
+                            request_uri, # None is allowed
+                            is_keypair)
+
+def finish_job(job, runner, stored_cfg):
+    """ INTERNAL: Record the result of a job whose state machine
+        has stopped, and take it off the runner. """
+    update_sm = job.update_sm
+    job.end_time = time.time()
+    job.succeeded = update_sm.get_state(QUIESCENT).arrived_from(
+        ((FINISHING,)))
+    if job.succeeded:
+        if job.command == PULL:
+            job.result_uris = (update_sm.get_state(REQUESTING_URI).
+                               get_latest_uri(), )
+        else:
+            job.result_uris = tuple(update_sm.get_state(INSERTING_URI).
+                                    get_request_uris())
+    elif update_sm.ctx.get(b'UP_TO_DATE', False):
+        job.error = b"Local changes already in Freenet."
+    handle_updating_config(job.repo, update_sm, job.params, stored_cfg,
+                           job.command == PULL)
+    runner.remove_queue(update_sm)
+    job.update_sm = None
+
+def show_results(ui_, jobs):
+    """ INTERNAL: Print a line per job. """
+    ui_.status(b"\nBatch results:\n")
+    for job in jobs:
+        secs = 0
+        if not job.start_time is None and not job.end_time is None:
+            secs = job.end_time - job.start_time
+        ui_.status(b"%s %s %s (%is)\n" % ((b'OK    ' if job.succeeded
+                                            else b'FAILED'),
+                                           job.command,
+                                           job.repo_dir,
+                                           secs))
+        for uri in job.result_uris:
+            ui_.status(b"   %s\n" % uri)
+        if not job.error is None:
+            ui_.status(b"   %s\n" % job.error)
+
+def execute_batch(ui_, jobs, params, stored_cfg):
+    """ Run a list of BatchJobs, several at a time, over a single
+        FCP connection.
+
+        Returns the number of jobs that failed. """
+    if len(jobs) == 0:
+        ui_.warn(b"Nothing to do.\n")
+        return 0
+
+    if not is_writable(os.path.expanduser(stored_cfg.defaults['TMP_DIR'])):
+        raise error.Abort(b"Can't write to temp dir: %s\n"
+                         % stored_cfg.defaults['TMP_DIR'])
+
+    set_debug_vars(params.get('VERBOSITY', 1), params)
+    callbacks = UICallbacks(ui_)
+    callbacks.verbosity = params.get('VERBOSITY', 1)
+    runner = make_runner(ui_, params, stored_cfg, callbacks)
+    shared = USKTracker(runner.connection, stored_cfg)
+    max_active = max(1, params.get('MAX_ACTIVE_REPOS', DEFAULT_MAX_ACTIVE))
+
+    waiting = list(jobs)
+    active = []
+    try:
+        while len(waiting) > 0 or len(active) > 0:
+            while len(waiting) > 0 and len(active) < max_active:
+                job = waiting.pop(0)
+                try:
+                    start_job(ui_, job, runner, shared, params, stored_cfg)
+                except error.Abort as err:
+                    # Bad URI, failed key inversion, etc.
+                    job.fail(err.message)
+                    if not job.update_sm is None:
+                        runner.remove_queue(job.update_sm)
+                        job.update_sm = None
+                if not job.is_done():
+                    active.append(job)
+
+            for job in active[:]:
+                if job.update_sm.current_state.name == QUIESCENT:
+                    finish_job(job, runner, stored_cfg)
+                    active.remove(job)
+            if len(active) == 0:
+                continue
+
+            if not runner.connection.socket.poll():
+                raise IOError("FCP socket closed.")
+            runner.kick()
+            time.sleep(params['POLL_SECS'])
+    except (socket.error, IOError):
+        ui_.warn(b"Exiting because of an error on the FCP socket.\n")
+        for job in active + waiting:
+            if not job.is_done():
+                job.fail(b"Not finished.")
+        raise
+    finally:
+        cleanup_runner(runner, shared)
+        for job in jobs:
+            if not job.repo is None:
+                # They all share TMP_DIR.
+                BundleCache(job.repo, ui_, params['TMP_DIR']).remove_files()
+                break
+        show_results(ui_, jobs)
+
+    return len([job for job in jobs if not job.succeeded])
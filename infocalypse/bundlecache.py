@@ -21,12 +21,12 @@
 """
 
 import os
-import shutil
 import random
 
 from mercurial import commands
 
 from .fcpconnection import sha1_hexdigest
+from .chkstore import link_or_copy
 
 from .graph import FIRST_INDEX, FREENET_BLOCK_LEN, MAX_REDUNDANT_LENGTH
 from .graphutil import get_rollup_bounds
@@ -100,7 +100,7 @@ class BundleCache:
 
             raised = True
             try:
-                shutil.copyfile(full_path, out_file)
+                link_or_copy(full_path, out_file)
                 raised = False
             finally:
                 if raised and os.path.exists(out_file):
@@ -114,7 +114,7 @@ class BundleCache:
 
         raised = True
         try:
-            shutil.copyfile(out_file, self.get_bundle_path(index_pair))
+            link_or_copy(out_file, self.get_bundle_path(index_pair))
             raised = False
         finally:
             if raised and os.path.exists(out_file):
@@ -0,0 +1,271 @@
+""" A content addressed local store for CHK block data.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# One file per CHK, named by the hash of the CHK, shared by every
+# archive cached under the same directory. Everything else
+# (per USK cache dirs, block dirs, bundle caches) hard links to
+# the files in the store, so the data is only on disk once.
+#
+# IMPORTANT: Files in the store are never modified in place.
+#            Anything that links to them must replace files by
+#            renaming or removing them, never by truncating or
+#            appending to them. See truncate_to() and append_to().
+
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Not on Windows.
+
+from .fcpconnection import sha1_hexdigest
+
+CHK_STORE_DIR = "__CHK_STORE__"
+
+# Careful when changing. There is code that depends on '_' chars.
+CHK_NAME_PREFIX = "_chk_"
+CHK_NAME_FMT = CHK_NAME_PREFIX + "%s.bin"
+
+# Unreferenced blocks are only removed when the store is larger than this.
+DEFAULT_MAX_STORE_BYTES = 256 * 1024 * 1024
+
+# From linux/fs.h. Shares data blocks on btrfs, xfs, etc.
+FICLONE = 0x40049409
+
+# File name that 0) is tagged for deletion and
+# 1) doesn't have weird chars in it. e.g. '~'
+# Hmmm... it would be more studly to extract the (SHA256?)
+# hash from the CHK and use that
+def chk_file_name(chk):
+    """ Return a file name for the CHK. """
+    return CHK_NAME_FMT % sha1_hexdigest(chk)
+
+def reflink(src, dest):
+    """ Make dest a copy on write clone of src.
+
+        Raises an OSError if the file system can't do it. """
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        raise OSError("Reflinks not supported.")
+
+    in_file = open(src, 'rb')
+    try:
+        out_file = open(dest, 'wb')
+        raised = True
+        try:
+            fcntl.ioctl(out_file.fileno(), FICLONE, in_file.fileno())
+            raised = False
+        finally:
+            out_file.close()
+            if raised:
+                os.remove(dest)
+    finally:
+        in_file.close()
+
+def link_or_copy(src, dest):
+    """ Make dest a hard link to src, or a reflink or copy if that's
+        not possible.
+
+        Returns 'link', 'reflink' or 'copy'. """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return 'link'
+    except (OSError, AttributeError):
+        pass # Different file system, FAT, etc.
+    try:
+        reflink(src, dest)
+        return 'reflink'
+    except (OSError, IOError):
+        pass
+
+    raised = True
+    try:
+        shutil.copyfile(src, dest)
+        raised = False
+    finally:
+        if raised and os.path.exists(dest):
+            os.remove(dest)
+    return 'copy'
+
+def truncate_to(file_name, length):
+    """ INTERNAL: Truncate file_name to length bytes without touching
+        data shared with other links to the same file. """
+    size = os.path.getsize(file_name)
+    assert length <= size
+    if length == size:
+        return
+
+    if os.stat(file_name).st_nlink == 1:
+        out_file = open(file_name, 'ab')
+        try:
+            out_file.truncate(length)
+        finally:
+            out_file.close()
+        return
+
+    # Copy the prefix to a new file instead.
+    tmp_name = file_name + '.tmp'
+    in_file = open(file_name, 'rb')
+    try:
+        out_file = open(tmp_name, 'wb')
+        try:
+            out_file.write(in_file.read(length))
+        finally:
+            out_file.close()
+    finally:
+        in_file.close()
+    os.remove(file_name)
+    os.rename(tmp_name, file_name)
+
+def append_to(file_name, data):
+    """ Append data to file_name without touching data shared with
+        other links to the same file. """
+    if os.stat(file_name).st_nlink > 1:
+        # Break the link with a private copy first.
+        tmp_name = os.fsencode(file_name) + b'.tmp'
+        shutil.copyfile(file_name, tmp_name)
+        os.rename(tmp_name, os.fsencode(file_name))
+
+    out_file = open(file_name, 'ab')
+    try:
+        out_file.write(data)
+    finally:
+        out_file.close()
+
+class ChkStore:
+    """ A directory of CHK data files shared by all the archives
+        in a cache directory. """
+    def __init__(self, base_dir, max_bytes=DEFAULT_MAX_STORE_BYTES):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+
+    def create_dir(self):
+        """ Create the store directory if it doesn't already exist. """
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+
+    def full_path(self, chk):
+        """ Return the full path of the store file for a CHK. """
+        return os.path.join(self.base_dir, chk_file_name(chk))
+
+    def lookup(self, chk, length=None):
+        """ Return the full path of the data for chk or None if it
+            isn't stored.
+
+            Raises an IOError if the stored data isn't length bytes long.
+        """
+        full_path = self.full_path(chk)
+        if not os.path.exists(full_path):
+            return None
+        if not length is None and os.path.getsize(full_path) != length:
+            raise IOError("Wrong size: %s, expected: %i, got: %i" %
+                          (full_path, length, os.path.getsize(full_path)))
+        return full_path
+
+    def add(self, chk, file_name, length=None):
+        """ Move file_name into the store as the data for chk.
+
+            If length is not None, trailing padding past length
+            is truncated. Returns the full path of the stored file. """
+        self.create_dir()
+        dest = self.full_path(chk)
+        if os.path.exists(dest):
+            self.touch(chk)
+            return dest
+
+        if not length is None:
+            truncate_to(file_name, length)
+
+        try:
+            os.rename(file_name, dest)
+        except OSError:
+            # Across file systems.
+            link_or_copy(file_name, dest)
+            os.remove(file_name)
+        return dest
+
+    def link_out(self, chk, dest, length=None):
+        """ Make dest a link to (or copy of) the data for chk.
+
+            Raises an IOError if chk isn't stored. """
+        src = self.lookup(chk, length)
+        if src is None:
+            raise IOError("Not stored: %s" % str(chk))
+        self.touch(chk)
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return
+        link_or_copy(src, dest)
+
+    def entries(self):
+        """ Return a list of (mtime, size, name) tuples for all the
+            files in the store. """
+        ret = []
+        if not os.path.exists(self.base_dir):
+            return ret
+        for name in os.listdir(self.base_dir):
+            if not name.startswith(CHK_NAME_PREFIX):
+                continue
+            stat = os.stat(os.path.join(self.base_dir, name))
+            ret.append((stat.st_mtime, stat.st_size, name))
+        return ret
+
+    def total_bytes(self):
+        """ Return the number of bytes of data in the store. """
+        return sum([entry[1] for entry in self.entries()])
+
+    # Files in the store are never modified, so the modtime is the
+    # last time they were used.
+    def touch(self, chk):
+        """ Mark the data for chk as recently used. """
+        full_path = self.full_path(chk)
+        if os.path.exists(full_path):
+            os.utime(full_path, None)
+
+    def collect_garbage(self, referenced_chks, max_bytes=None):
+        """ Remove the least recently used unreferenced files until
+            the store fits in max_bytes.
+
+            Files for CHKs in referenced_chks are never removed, even
+            if that leaves the store over budget.
+
+            Returns a list of the removed file names. """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        entries = self.entries()
+        total = sum([entry[1] for entry in entries])
+        if total <= max_bytes:
+            return []
+
+        keep = set([chk_file_name(chk) for chk in referenced_chks])
+        entries.sort()
+        removed = []
+        for dummy, size, name in entries:
+            if total <= max_bytes:
+                break
+            if name in keep:
+                continue
+            os.remove(os.path.join(self.base_dir, name))
+            removed.append(name)
+            total -= size
+        return removed
@@ -20,6 +20,7 @@ from .sitecmds import execute_putsite, execute_genkey
 from .wikicmds import execute_wiki, execute_wiki_apply
 from .arccmds import execute_arc_create, execute_arc_pull, execute_arc_push, \
     execute_arc_reinsert
+from .batchcmds import BatchJob, PULL, PUSH, read_batch_file, execute_batch
 
 from . import config
 
@@ -732,9 +733,29 @@ def infocalypse_archive(ui_, **opts):
 
     params, stored_cfg = get_config_info(ui_, opts)
     params['ARCHIVE_CACHE_DIR'] = os.path.join(os.getcwd(), ARCHIVE_CACHE_DIR)
+    params['CHK_STORE_MAX_BYTES'] = stored_cfg.defaults['CHK_STORE_MAX_BYTES']
 
     if not subcmd in ARCHIVE_SUBCMDS:
         raise error.Abort(("Unhandled subcommand: " + subcmd).encode("utf-8"))
 
     # 2 qt?
     ARCHIVE_SUBCMDS[subcmd](ui_, opts, params, stored_cfg)
+
+
+def infocalypse_batch(ui_, **opts):
+    """ Pull or push many repositories over a single FCP connection. """
+    jobs = ([BatchJob(PULL, os.path.expanduser(repo_dir))
+             for repo_dir in opts['pull']]
+            + [BatchJob(PUSH, os.path.expanduser(repo_dir))
+               for repo_dir in opts['push']])
+    if opts['file']:
+        jobs += read_batch_file(os.path.expanduser(opts['file']))
+    if len(jobs) == 0:
+        raise error.Abort(b"Nothing to do. Use --pull, --push or --file.")
+
+    params, stored_cfg = get_config_info(ui_, opts)
+    params['MAX_ACTIVE_REPOS'] = int(opts['repos'])
+    failed = execute_batch(ui_, jobs, params, stored_cfg)
+    if failed > 0:
+        raise error.Abort(b"%i of %i repositories failed."
+                          % (failed, len(jobs)))
@@ -167,6 +167,9 @@ class Config:
 
         self.defaults['FORMAT_VERSION'] = 'Unknown' # Read from file.
 
+        # Size budget for the archive CHK store. None means the default.
+        self.defaults['CHK_STORE_MAX_BYTES'] = None
+
     def get_index(self, usk_or_id):
         """ Returns the highest known USK version for a USK or None. """
         return self.version_table.get(normalize(usk_or_id))
@@ -373,6 +376,9 @@ class Config:
         if parser.has_option('primary', 'default_truster'):
             cfg.defaults['DEFAULT_TRUSTER'] = parser.get('primary',
                                                          'default_truster').encode('utf-8')
+        if parser.has_option('primary', 'chk_store_max_bytes'):
+            cfg.defaults['CHK_STORE_MAX_BYTES'] = parser.getint(
+                'primary', 'chk_store_max_bytes')
 
 
     # Hmmm... would be better to detect_and_fix_default_bug()
@@ -483,6 +489,9 @@ class Config:
         parser.set('primary', 'fmsread_groups', b'|'.join(cfg.fmsread_groups).decode('utf-8'))
         parser.set('primary', 'default_truster',
                    cfg.defaults['DEFAULT_TRUSTER'].decode('utf-8'))
+        if not cfg.defaults['CHK_STORE_MAX_BYTES'] is None:
+            parser.set('primary', 'chk_store_max_bytes',
+                       str(cfg.defaults['CHK_STORE_MAX_BYTES']))
         parser.add_section('index_values')
         for repo_id in cfg.version_table:
             parser.set('index_values', repo_id.decode("utf-8"), str(cfg.version_table[repo_id]))
@@ -23,7 +23,7 @@
 import mimetypes, os, re
 
 from .fcpconnection import FCPConnection, IDataSource, READ_BLOCK, \
-     MinimalClient, PolledSocket, FCPError, sha1_hexdigest
+     MinimalClient, PolledSocket, sha1_hexdigest
 
 from .fcpmessage import GETNODE_DEF, GENERATE_SSK_DEF, \
      GET_REQUEST_URI_DEF, GET_DEF, \
@@ -58,32 +58,27 @@ def get_file_infos(directory, forced_mime_type=None, accept_regex = None):
         (name, length, mime_type, full_path)
     """
 
-    def walk_visitor(file_info, dirname, names):
-        """ Function scope visitor implementation passed to os.path.walk.
-        """
-
+    if directory[-1] != os.path.sep:
+        # Force trailing path separator.
+        directory += os.path.sep
+    ret = []
+    for dirname, dummy, names in os.walk(directory):
         for name in names:
             full_name = os.path.join(dirname, name)
             if os.path.isfile(full_name):
-                base = file_info[0]
-                local_path = full_name.replace(base, '')
+                local_path = full_name[len(directory):]
                 # REDFLAG: More principled way to do this?
                 # Fix slashes on windows.
-                local_path = local_path.replace('\\', '/') 
-                if file_info[2] and not file_info[2].match(local_path):
+                local_path = local_path.replace('\\', '/')
+                if accept_regex and not accept_regex.match(local_path):
                     # Skip files rejected by the regex
                     continue
 
-                file_info[1].append((local_path,
-                                     os.path.getsize(full_name),
-                                     forced_mime_type,
-                                     full_name))
-    if directory[-1] != os.path.sep:
-        # Force trailing path separator.
-        directory += os.path.sep
-    file_info = (directory, [], accept_regex) #REDFLAG: bad variable name
-    os.path.walk(directory, walk_visitor, file_info)
-    return file_info[1]
+                ret.append((local_path,
+                            os.path.getsize(full_name),
+                            forced_mime_type,
+                            full_name))
+    return ret
 
 def total_length(file_infos):
     """ Returns the sum of the file lengths in file_info list. """
@@ -159,7 +154,7 @@ class FileInfoDataSource(IDataSource):
                 finally:
                     # Note: Wacky control flow because you can't yield
                     #       from a finally block
-                    if raised or data is None:
+                    if raised or not data:
                         #print "FileInfoDataSource.GEN -- closing", info[3]
                         self.input_file.close()
                         self.input_file = None
@@ -193,7 +188,7 @@ class FileInfoDataSource(IDataSource):
         #print "FileInfoDataSource.release -- called"
         if not self.chunks is None:
             self.chunks = None
-        if not self.input_file:
+        if self.input_file:
             self.input_file.close()
             self.input_file = None
 
@@ -339,55 +334,53 @@ def get_negative_usk(usk_uri):
 
     return get_usk_for_usk_version(usk_uri, version, True)
 
-def prefetch_usk(client, usk_uri, allowed_redirects = 3,
-                 message_callback = None):
+# Hmmmm... a node search round can take a long time for USKs nobody
+# has inserted in a while.
+USK_SEARCH_TIMEOUT_SECS = 5 * 60
+
+def prefetch_usk(client, usk_uri, message_callback = None,
+                 timeout_secs = USK_SEARCH_TIMEOUT_SECS):
     """ Force the FCP server to explicitly search for updates
         to the USK.
 
         Returns the latest version as an integer or None if
         no version could be determined.
 
-        This works by sending a negative index value for the USK.
+        This works by subscribing to the USK and waiting until the
+        node has finished one search round.
 
         Note that this can return a version LESS THAN the version
         in usk_uri.
     """
+    # Here to avoid a circular import.
+    from .usktracker import USKTracker
 
     if client.in_params._async:
         raise ValueError("This function only works synchronously.")
 
-    usk_uri = get_negative_usk(usk_uri)
-    client.reset()
-    callback = client.message_callback
-    return_type = client.in_params.default_fcp_params.get('ReturnType')
-    version = None
+    tracker = USKTracker(client.conn)
+    if message_callback:
+        tracker.listeners.append(lambda usk, edition:
+                                 message_callback(client,
+                                                  (b'SubscribedUSKUpdate',
+                                                   {b'URI':usk,
+                                                    b'Edition':edition})))
     try:
-        if message_callback:
-            # Install a custom message callback
-            client.message_callback = message_callback
-        client.in_params.default_fcp_params['ReturnType'] = 'none'
-        try:
-            # BUG: HANGS
-            version = get_version(client.get(usk_uri,
-                                             allowed_redirects)[1]['URI'])
-        except FCPError:
-            version = None
+        subscription = tracker.subscribe(get_usk_for_usk_version(usk_uri, 0))
+        tracker.wait_until_current((usk_uri, ), timeout_secs)
+        return subscription.edition
     finally:
-        client.message_callback = callback
-        if return_type:
-            client.in_params.default_fcp_params['ReturnType'] = return_type
-
-    return version
+        tracker.close()
 
 def latest_usk_index(client, usk_uri, allowed_redirects = 1,
-                     message_callback = None):
+                     message_callback = None,
+                     timeout_secs = USK_SEARCH_TIMEOUT_SECS):
     """ Determines the version index of a USK key.
 
         Returns a (version, data_found) tuple where version
         is the integer version and data_found is the data_found
         message for the latest index.
 
-        
         NOTE:
         This fetches the key and discards the data.
         It may take a very long time if you call it for
@@ -397,6 +390,10 @@ def latest_usk_index(client, usk_uri, allowed_redirects = 1,
     if client.in_params._async:
         raise ValueError("This function only works synchronously.")
 
+    version = prefetch_usk(client, usk_uri, message_callback, timeout_secs)
+    if version is None or version < get_version(usk_uri):
+        version = get_version(usk_uri)
+
     client.reset()
     callback = client.message_callback
     #print "PARAMS:", client.in_params.default_fcp_params
@@ -406,19 +403,16 @@ def latest_usk_index(client, usk_uri, allowed_redirects = 1,
             # Install a custom message callback
             client.message_callback = message_callback
         client.in_params.default_fcp_params['ReturnType'] = 'none'
-        prev = None
-        while True:
-            # Hmmmm... Make sure that the USK has 'settled'
-            next = client.get(usk_uri, allowed_redirects)
-            if prev and next[1]['URI'] == prev[1]['URI']:
-                break
-            prev = next
+        # One request for the exact edition. No need to wait for the
+        # URI to 'settle'.
+        found = client.get(get_usk_for_usk_version(usk_uri, version),
+                           allowed_redirects)
     finally:
         client.message_callback = callback
         if return_type:
             client.in_params.default_fcp_params['ReturnType'] = return_type
 
-    return (get_version(prev[1]['URI']), prev)
+    return (get_version(found[1][b'URI']), found)
 
 def get_insert_chk_filename(uri):
     """ Returns the file name part of CHK@/file_part.ext style
@@ -677,7 +671,7 @@ class FCPClient(MinimalClient):
         return self.conn.start_request(self)
 
     def put_complex_dir(self, uri, file_infos,
-                        default_mime_type = 'text/plain'):
+                        default_mime_type = 'text/plain', redirects=None):
         """ Insert a collection of files into a Freenet Container.
 
             file_infos must be a list of
@@ -685,6 +679,10 @@ class FCPClient(MinimalClient):
 
             file_infos[0] is inserted as the default document.
 
+            redirects is an optional name -> target URI dict. Files
+            named in it are inserted as redirects to the target URI
+            instead of uploading their data.
+
             mime types:
             If the mime_type value in the file_infos tuple for the
             file is not None, it is used.  Otherwise the mime type
@@ -697,30 +695,46 @@ class FCPClient(MinimalClient):
 
         self.reset()
         self.in_params.definition = PUT_COMPLEX_DIR_DEF
-        self.in_params.fcp_params = {'URI': uri}
+        self.in_params.fcp_params = {b'URI': uri}
 
         # IMPORTANT: Don't set the data length.
         return self.conn.start_request(self,
                                        dir_data_source(file_infos,
                                                        self.in_params,
-                                                       default_mime_type),
+                                                       default_mime_type,
+                                                       redirects),
                                        False)
 
 
+def ensure_bytes(value):
+    """ INTERNAL: Return a str or bytes value as utf8 bytes. """
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf8')
+
 # Break out implementation helper so I can use it elsewhere.
-def dir_data_source(file_infos, in_params, default_mime_type):
+def dir_data_source(file_infos, in_params, default_mime_type,
+                    redirects=None):
     """ Return an IDataSource for a list of file_infos.
 
+        Files named in the optional redirects dict are inserted as
+        redirects to the URI they map to, and their data isn't sent.
+        file_infos[0] can't be a redirect.
+
         NOTE: Also sets up Files.* fields in in_params as a
               side effect. """
 
     for field in in_params.default_fcp_params:
-        if field.startswith("Files"):
+        if ensure_bytes(field).startswith(b"Files"):
             raise ValueError("You can't set file entries via "
                              + " default_fcp_params.")
-    if 'DefaultName' in in_params.default_fcp_params:
+    if (b'DefaultName' in in_params.default_fcp_params or
+        'DefaultName' in in_params.default_fcp_params):
         raise ValueError("You can't set 'DefaultName' via "
                          + "default_fcp_params.")
+    if redirects is None:
+        redirects = {}
+    assert not file_infos[0][0] in redirects
 
     # IMPORTANT: Sort the file infos so that the same set of
     #            file_infos always yields the same inserted data blob.
@@ -740,20 +754,28 @@ def dir_data_source(file_infos, in_params, default_mime_type):
             # Fall back to the default.
             mime_type = default_mime_type
 
-        files['Files.%i.Name' % index] = info[0]
-        files['Files.%i.UploadFrom' % index] = 'direct'
-        files['Files.%i.DataLength' % index] = info[1]
-        files['Files.%i.Metadata.ContentType' % index] = mime_type
+        prefix = b'Files.%i.' % index
+        files[prefix + b'Name'] = ensure_bytes(info[0])
+        if info[0] in redirects:
+            files[prefix + b'UploadFrom'] = b'redirect'
+            files[prefix + b'TargetURI'] = ensure_bytes(redirects[info[0]])
+        else:
+            files[prefix + b'UploadFrom'] = b'direct'
+            files[prefix + b'DataLength'] = b'%i' % info[1]
+        files[prefix + b'Metadata.ContentType'] = ensure_bytes(mime_type)
 
         index += 1
 
-    in_params.fcp_params['Files'] = files
-    in_params.fcp_params['DefaultName'] = file_infos[0][0]
+    in_params.fcp_params[b'Files'] = files
+    in_params.fcp_params[b'DefaultName'] = ensure_bytes(file_infos[0][0])
 
     #REDFLAG: Fix
     in_params.send_data = True
 
-    return FileInfoDataSource(file_infos)
+    # The data for the direct files, in the same order as the Files.*
+    # entries.
+    return FileInfoDataSource([info for info in file_infos
+                               if not info[0] in redirects])
 
 ############################################################
 # Helper function for hg changeset bundle handling.
@@ -67,7 +67,8 @@ except ImportError:
         """ Return the SHA1 hexdigest of bytes using the sha module. """
         return sha.new(bytes).hexdigest().encode("utf-8")
 
-from .fcpmessage import make_request, FCPParser, HELLO_DEF, REMOVE_REQUEST_DEF
+from .fcpmessage import make_request, FCPParser, HELLO_DEF, REMOVE_REQUEST_DEF, \
+     UNSUBSCRIBE_USK_DEF
 
 FCP_VERSION = b'2.0' # Expected version value sent in ClientHello
 
@@ -459,7 +460,7 @@ class FCPConnection:
             self.state_callback = state_callback
         else:
             self.state_callback = lambda x, y: None
-        self.socket.recv_callback = self.parser.parse_bytes
+        self.socket.recv_callback = self.recv_handler
         self.socket.closed_callback = self.closed_handler
 
         self.node_hello = None
@@ -467,13 +468,17 @@ class FCPConnection:
         # Only used for uploads.
         self.data_source = None
 
+        # Running totals, for requestmetrics.
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
         # Tell the client code that we are trying to connect.
         self.state_callback(self, CONNECTING)
 
         # Send a ClientHello
         params = {b'Name':b'FCPConnection[%s]' % make_id(),
                   b'ExpectedVersion': FCP_VERSION}
-        self.socket.write_bytes(make_request(HELLO_DEF, params))
+        self.write_bytes(make_request(HELLO_DEF, params))
         if wait_for_connect:
             # Wait for the reply
             while not self.is_connected():
@@ -501,6 +506,17 @@ class FCPConnection:
         if self.socket:
             self.socket.close()
 
+    def write_bytes(self, data):
+        """ INTERNAL: Write to the socket, counting bytes. """
+        self.bytes_sent += len(data)
+        self.socket.write_bytes(data)
+
+    def recv_handler(self, data):
+        """ INTERNAL: Callback called by the IAsyncSocket delegate with
+            data read from the socket. """
+        self.bytes_received += len(data)
+        self.parser.parse_bytes(data)
+
     def convert_params_keys_to_bytes(self, params):
         """ Convert the keys in the given params to bytes before they are
             handed to fcpmesage.make_request."""
@@ -559,12 +575,12 @@ class FCPConnection:
                                                                 send_data)
                 write_string = True
         # print(client.in_params.__dict__)
-        self.socket.write_bytes(make_request(client.in_params.definition,
+        self.write_bytes(make_request(client.in_params.definition,
                                              client.in_params.fcp_params,
                                              client.in_params.default_fcp_params))
 
         if write_string:
-            self.socket.write_bytes(client.in_params.send_data)
+            self.write_bytes(client.in_params.send_data)
 
         assert not client.context
         client.context = RequestContext(client.in_params.allowed_redirects,
@@ -598,7 +614,23 @@ class FCPConnection:
                   identifier)
         params = {b'Identifier': identifier,
                   b'Global': (b"true" if is_global else b"false")}
-        self.socket.write_bytes(make_request(REMOVE_REQUEST_DEF, params))
+        self.write_bytes(make_request(REMOVE_REQUEST_DEF, params))
+
+    def unsubscribe_usk(self, client):
+        """ Stop a running SubscribeUSK request.
+
+            The node never sends a terminal message for subscriptions,
+            so this also forgets the client. """
+        if not client.is_running():
+            return
+        identifier = client.context.initiating_id
+        if self.is_connected():
+            self.write_bytes(make_request(UNSUBSCRIBE_USK_DEF,
+                                                 {b'Identifier':identifier}))
+        if identifier in self.running_clients:
+            del self.running_clients[identifier]
+        client.context.release()
+        client.context = None
 
     def wait_for_terminal(self, client):
         """ Wait until the request running on client finishes. """
@@ -645,7 +677,7 @@ class FCPConnection:
                 params[b'Identifier'] = client.context.running_id
 
                 # Send new request.
-                self.socket.write_bytes(make_request(client.in_params.
+                self.write_bytes(make_request(client.in_params.
                                                      definition, params))
 
                 #print "MAPPED(1) [%s]->[%s]" % (client.context.running_id,
@@ -807,7 +839,7 @@ class FCPConnection:
             if self.is_connected():
                 self.state_callback(self, CONNECTED)
             return
-        self.socket.write_bytes(data)
+        self.write_bytes(data)
 
 # Writes to file if file_name is set, raw_data otherwise
 class DataSink:
@@ -166,6 +166,11 @@ def put_file_constraint(dummy, params):
     else:
         raise ValueError("Unknown value, b'UploadFrom' == %s" % upload_from)
 
+def is_chk_only(params):
+    """ Return True if ClientPut params only ask the node to compute
+        the CHK, without inserting anything. """
+    value = params.get(b'GetCHKOnly', params.get('GetCHKOnly', False))
+    return value in (True, b'true', 'true')
 
 HELLO_DEF = (b'ClientHello', (b'Name', b'ExpectedVersion'), None, None)
 
@@ -220,6 +225,16 @@ PUT_COMPLEX_DIR_DEF = (b'ClientPutComplexDir',
 
 REMOVE_REQUEST_DEF = (b'RemoveRequest', (b'Identifier', b'Global'), None, None)
 
+# Long running. The node sends SubscribedUSK, then a SubscribedUSKUpdate
+# every time it finds a later edition, until the client unsubscribes.
+SUBSCRIBE_USK_DEF = (b'SubscribeUSK',
+                     (b'URI', b'Identifier', b'DontPoll', b'PriorityClass',
+                      b'PriorityClassProgress', b'RealTimeFlag',
+                      b'SparsePoll', b'IgnoreUSKDatehints'),
+                     (b'URI', b'Identifier'),
+                     None)
+UNSUBSCRIBE_USK_DEF = (b'UnsubscribeUSK', (b'Identifier',), None, None)
+
 # REDFLAG: Shouldn't assert on bad data! raise instead.
 # Hmmmm... I hacked this together by unwinding a "pull" parser
 # to make a "push" parser.  Feels like there's too much code here.
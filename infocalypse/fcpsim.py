@@ -0,0 +1,1118 @@
+""" A local stand-in for the FCP 2.0 interface of a Freenet node.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# INTENT: Exercise everything above FCPConnection without a real node.
+#
+# Supported: ClientHello, GenerateSSK, ClientGet, ClientPut (direct,
+# disk and redirect), ClientPutComplexDir, SubscribeUSK,
+# UnsubscribeUSK and RemoveRequest. Requests get SimpleProgress
+# messages along the way.
+#
+# There's no crypto. Keys are made by hashing the data, so inserting
+# the same data always yields the same CHK. Latency, bandwidth and
+# failures come from a seeded random.Random, so a run with the same
+# requests in the same order fails the same way every time.
+#
+# Use it in process:
+#   node = SimulatedNode(params)
+#   connection = FCPConnection(SimSocket(node), True)
+#
+# or over TCP, e.g. to run hg fn-push / fn-pull against it:
+#   python -m infocalypse.fcpsim [port [store_dir]]
+
+import heapq
+import os
+import random
+import select
+import socket
+import sys
+import time
+from hashlib import sha256
+
+from .chk import freenet_base64_encode, freenet_base64_decode
+from .fcpconnection import IAsyncSocket, FCPConnection, sha1_hexdigest, \
+     MAX_SOCKET_READ, FCP_VERSION, RECV_BLOCK
+
+DEFAULT_SIM_PARAMS = {
+    # Fixed delay before every request finishes.
+    'LATENCY_SECS':0.5,
+    # Uniformly distributed extra delay in [0, JITTER_SECS).
+    'JITTER_SECS':0.25,
+    # Shared by all requests on a connection. None means no limit.
+    'BYTES_PER_SEC':None,
+    # Probability that a request fails for no good reason.
+    'GET_FAILURE_RATE':0.0,
+    'PUT_FAILURE_RATE':0.0,
+    # Seed for the random.Random that makes all the decisions above.
+    'SEED':0,
+    # Directory for the key store. None keeps keys in memory.
+    'STORE_DIR':None,
+    # Don't send more SimpleProgress messages than this per request.
+    'MAX_PROGRESS_MSGS':8,
+}
+
+DEFAULT_SIM_PORT = 19481
+
+SIM_NODE_BUILD = 1465
+SIM_NODE_VERSION = b'Fred,0.7,1.0,%i' % SIM_NODE_BUILD
+
+# Same as graph.FREENET_BLOCK_LEN.
+SIM_BLOCK_LEN = 32 * 1024
+
+# Give up following metadata after this many hops.
+MAX_METADATA_HOPS = 8
+
+# Data larger than a block is stored as a metadata block pointing
+# to the raw data. Redirects and container default documents use
+# the same format.
+SIM_METADATA_MARKER = b'FCPSIM-METADATA\n'
+
+# Metadata targets which aren't URIs.
+TARGET_KEY = b'key:' # A store key.
+TARGET_DOC = b'doc:' # A file in the same container.
+
+# Control bytes for the keys the simulator makes. Same as the node.
+CHK_EXTRA = b'AAMC--8'
+SSK_REQUEST_EXTRA = b'AQACAAE'
+SSK_INSERT_EXTRA = b'AQECAAE'
+
+# FetchException codes.
+GET_DATA_NOT_FOUND = 13
+GET_INVALID_URI = 20
+GET_TOO_BIG = 21
+GET_CANCELLED = 25
+GET_PERMANENT_REDIRECT = 27
+GET_ALL_DATA_NOT_FOUND = 28
+
+# InsertException codes.
+PUT_INVALID_URI = 1
+PUT_ROUTE_NOT_FOUND = 5
+PUT_COLLISION = 9
+PUT_CANCELLED = 10
+
+CODE_DESCRIPTIONS = {
+    (b'GetFailed', GET_DATA_NOT_FOUND):b'Data not found',
+    (b'GetFailed', GET_INVALID_URI):b'Invalid URI',
+    (b'GetFailed', GET_TOO_BIG):b'Too big',
+    (b'GetFailed', GET_CANCELLED):b'Cancelled',
+    (b'GetFailed', GET_PERMANENT_REDIRECT):b'New URI',
+    (b'GetFailed', GET_ALL_DATA_NOT_FOUND):b'All data not found',
+    (b'PutFailed', PUT_INVALID_URI):b'Invalid URI',
+    (b'PutFailed', PUT_ROUTE_NOT_FOUND):b'Route not found',
+    (b'PutFailed', PUT_COLLISION):b'Collision',
+    (b'PutFailed', PUT_CANCELLED):b'Cancelled',
+}
+
+FATAL_CODES = frozenset([(b'GetFailed', GET_INVALID_URI),
+                         (b'GetFailed', GET_TOO_BIG),
+                         (b'GetFailed', GET_CANCELLED),
+                         (b'GetFailed', GET_PERMANENT_REDIRECT),
+                         (b'PutFailed', PUT_INVALID_URI),
+                         (b'PutFailed', PUT_COLLISION),
+                         (b'PutFailed', PUT_CANCELLED)])
+
+#-----------------------------------------------------------#
+# Keys
+#-----------------------------------------------------------#
+
+def key_field(raw):
+    """ INTERNAL: Return the Freenet base64 key field for raw bytes. """
+    return freenet_base64_encode(raw).rstrip(b'=')
+
+def hash_key(value):
+    """ INTERNAL: Return a 43 char Freenet base64 key field. """
+    return key_field(sha256(value).digest())
+
+def make_chk(data, mime_type):
+    """ Return the CHK the simulator uses for data. """
+    digest = sha256(mime_type + b'\0' + data).digest()
+    return (b'CHK@' + key_field(digest) + b','
+            + hash_key(b'crypto' + digest) + b',' + CHK_EXTRA)
+
+def public_ssk_fields(private_key, crypto_key):
+    """ Return the (public key hash, crypto key, extra) fields of the
+        request SSK for an insert SSK. """
+    return (hash_key(b'public' + freenet_base64_decode(private_key)),
+            crypto_key, SSK_REQUEST_EXTRA)
+
+def is_insert_extra(extra):
+    """ Return True if the extra field of an SSK is for an insert key. """
+    try:
+        raw = freenet_base64_decode(extra)
+    except (ValueError, TypeError):
+        return False
+    return len(raw) > 1 and raw[1] == 1
+
+def is_raw_extra(extra):
+    """ Return True if the extra field of a CHK has its control bytes
+        cleared. i.e. the caller wants the raw metadata. """
+    try:
+        raw = freenet_base64_decode(extra)
+    except (ValueError, TypeError):
+        return False
+    return len(raw) > 2 and raw[2] == 0
+
+class SimUri:
+    """ The parts of a Freenet URI that the simulator cares about. """
+    def __init__(self, uri):
+        if uri.startswith(b'freenet:'):
+            uri = uri[len(b'freenet:'):]
+        fields = uri.split(b'/')
+        pos = fields[0].find(b'@')
+        if pos == -1:
+            raise ValueError("No key type: %s" % uri)
+        self.key_type = fields[0][:pos]
+        if not self.key_type in (b'CHK', b'SSK', b'USK', b'KSK'):
+            raise ValueError("Unsupported key type: %s" % uri)
+        self.key_fields = fields[0][pos + 1:].split(b',')
+        self.path = [field for field in fields[1:] if field]
+
+        if self.key_type == b'KSK':
+            # KSK@name -> treated like an SSK everyone can insert to.
+            self.path = [fields[0][pos + 1:]] + self.path
+            self.key_fields = [b'', b'', b'']
+        elif self.key_fields != [b''] and len(self.key_fields) != 3:
+            raise ValueError("Bad key fields: %s" % uri)
+
+    def is_insert(self):
+        """ Return True if the URI is an insert URI. """
+        if self.key_type == b'CHK' or self.key_type == b'KSK':
+            return True
+        return is_insert_extra(self.key_fields[-1])
+
+    def public_fields(self):
+        """ Return the key fields of the request URI. """
+        if self.key_type in (b'CHK', b'KSK') or not self.is_insert():
+            return self.key_fields
+        return public_ssk_fields(self.key_fields[0], self.key_fields[1])
+
+    def usk_name(self):
+        """ Return the (base store key, edition, remaining path) of a
+            USK. """
+        assert self.key_type == b'USK'
+        if len(self.path) < 2:
+            raise ValueError("No edition in USK.")
+        fields = self.public_fields()
+        return (b'USK@' + fields[0] + b',' + fields[1] + b'/' + self.path[0],
+                int(self.path[1]), self.path[2:])
+
+    def request_uri(self, path=None):
+        """ Return the public URI with path, or with self.path if
+            path is None. """
+        if path is None:
+            path = self.path
+        if self.key_type == b'KSK':
+            return b'/'.join([b'KSK@' + path[0], ] + path[1:])
+        return b'/'.join([self.key_type + b'@'
+                          + b','.join(self.public_fields()), ] + path)
+
+def store_key(key_type, fields, path):
+    """ INTERNAL: Return the key data is stored under.
+
+        The extra field is left out so that fetches with the control
+        bytes cleared find the same data. """
+    if key_type == b'KSK':
+        return b'/'.join([b'KSK@', ] + path)
+    return b'/'.join([key_type + b'@' + fields[0] + b',' + fields[1], ]
+                     + path)
+
+def usk_slot(usk_base, edition):
+    """ INTERNAL: Return the store key for an edition of a USK.
+
+        Just like the node, USK editions are stored as SSKs. """
+    assert usk_base.startswith(b'USK@')
+    return b'SSK@' + usk_base[4:] + b'-%i' % edition
+
+def make_metadata(mime_type, target_uri):
+    """ INTERNAL: Return a simulator metadata block. """
+    return SIM_METADATA_MARKER + mime_type + b'\n' + target_uri
+
+def parse_metadata(data):
+    """ INTERNAL: Return (mime_type, target_uri) for a metadata block or
+        None if data isn't one. """
+    if not data.startswith(SIM_METADATA_MARKER):
+        return None
+    fields = data[len(SIM_METADATA_MARKER):].split(b'\n', 1)
+    if len(fields) != 2:
+        return None
+    return fields[0], fields[1]
+
+def stored_form(data, mime_type):
+    """ INTERNAL: Return a (stored data, raw data key) tuple for data.
+
+        Data that doesn't fit in a block is stored as metadata pointing
+        to the raw data, like a splitfile. raw data key is None for
+        data that fits. """
+    if len(data) <= SIM_BLOCK_LEN or not parse_metadata(data) is None:
+        return data, None
+    data_key = store_key(b'CHK', make_chk(data, b'')[4:].split(b','), [])
+    return make_metadata(mime_type, TARGET_KEY + data_key), data_key
+
+#-----------------------------------------------------------#
+# Key store
+#-----------------------------------------------------------#
+
+class SimKeyStore:
+    """ A map from keys to (data, mime_type) tuples, kept in memory or
+        in files under a directory. """
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir
+        self.entries = {}
+        if not base_dir is None and not os.path.exists(base_dir):
+            os.makedirs(base_dir)
+
+    def full_path(self, key):
+        """ INTERNAL: Return the file name for the data for key. """
+        return os.path.join(self.base_dir,
+                            sha1_hexdigest(key).decode('utf8') + '.blk')
+
+    def get(self, key):
+        """ Return the (data, mime_type) tuple for key or None. """
+        if self.base_dir is None:
+            return self.entries.get(key)
+        full_path = self.full_path(key)
+        if not os.path.exists(full_path):
+            return None
+        in_file = open(full_path, 'rb')
+        try:
+            raw = in_file.read()
+        finally:
+            in_file.close()
+        mime_type, data = raw.split(b'\n', 1)
+        return data, mime_type
+
+    def put(self, key, data, mime_type):
+        """ Store data and mime_type under key. """
+        if self.base_dir is None:
+            self.entries[key] = (data, mime_type)
+            return
+        full_path = self.full_path(key)
+        out_file = open(full_path + '.tmp', 'wb')
+        try:
+            out_file.write(mime_type + b'\n' + data)
+        finally:
+            out_file.close()
+        os.rename(full_path + '.tmp', full_path)
+
+    def latest_edition(self, usk_base):
+        """ Return the latest inserted edition of a USK or None. """
+        entry = self.get(b'EDITION:' + usk_base)
+        if entry is None:
+            return None
+        return int(entry[0])
+
+    def update_edition(self, usk_base, edition):
+        """ Record that edition of a USK was inserted. """
+        latest = self.latest_edition(usk_base)
+        if latest is None or edition > latest:
+            self.put(b'EDITION:' + usk_base, b'%i' % edition, b'text/plain')
+
+#-----------------------------------------------------------#
+# Protocol handling.
+#-----------------------------------------------------------#
+
+def make_msg(name, fields, data=None):
+    """ INTERNAL: Return the wire bytes for a node to client message. """
+    lines = [name, ]
+    for field in fields:
+        value = fields[field]
+        if isinstance(value, bool):
+            value = value and b'true' or b'false'
+        elif isinstance(value, int):
+            value = b'%i' % value
+        lines.append(field + b'=' + value)
+    if data is None:
+        lines.append(b'EndMessage')
+        return b'\n'.join(lines) + b'\n'
+    lines.append(b'Data')
+    return b'\n'.join(lines) + b'\n' + data
+
+def trailing_data_length(msg):
+    """ INTERNAL: Return the number of data bytes that follow a client
+        message. """
+    name, fields = msg
+    if name == b'ClientPut':
+        if fields.get(b'UploadFrom', b'direct') == b'direct':
+            return int(fields.get(b'DataLength', b'0'))
+    elif name == b'ClientPutComplexDir':
+        total = 0
+        for index in dir_file_indices(fields):
+            prefix = b'Files.%i.' % index
+            if fields.get(prefix + b'UploadFrom', b'direct') == b'direct':
+                total += int(fields.get(prefix + b'DataLength', b'0'))
+        return total
+    return 0
+
+def dir_file_indices(fields):
+    """ INTERNAL: Return the sorted indices of the Files.N.Name entries
+        in a ClientPutComplexDir message. """
+    ret = []
+    for field in fields:
+        parts = field.split(b'.')
+        if len(parts) == 3 and parts[0] == b'Files' and parts[2] == b'Name':
+            ret.append(int(parts[1]))
+    ret.sort()
+    return ret
+
+class SimParser:
+    """ Parse the byte stream from a client into
+        (msg_name, fields, trailing_data) tuples. """
+    def __init__(self, msg_callback):
+        self.msg_callback = msg_callback
+        self.buffer = b''
+        self.msg = None
+        self.data_length = 0
+
+    def parse_bytes(self, data):
+        """ Push bytes from the client into the parser. """
+        self.buffer += data
+        while self.buffer:
+            if self.data_length > 0:
+                if len(self.buffer) < self.data_length:
+                    return
+                msg = (self.msg[0], self.msg[1],
+                       self.buffer[:self.data_length])
+                self.buffer = self.buffer[self.data_length:]
+                self.msg = None
+                self.data_length = 0
+                self.msg_callback(msg)
+                continue
+
+            pos = self.buffer.find(b'\n')
+            if pos == -1:
+                return
+            line = self.buffer[:pos].strip()
+            self.buffer = self.buffer[pos + 1:]
+            if not line:
+                continue
+            if self.msg is None:
+                self.msg = (line, {})
+                continue
+            pos = line.find(b'=')
+            if pos != -1:
+                self.msg[1][line[:pos].strip()] = line[pos + 1:].strip()
+                continue
+
+            # End of message.
+            self.data_length = trailing_data_length(self.msg)
+            if self.data_length == 0:
+                msg = (self.msg[0], self.msg[1], b'')
+                self.msg = None
+                self.msg_callback(msg)
+
+class SimSession:
+    """ The node side of a single client connection. """
+    def __init__(self, node):
+        self.node = node
+        self.parser = SimParser(self.handle_msg)
+        self.out = b''
+        self.hello = None
+        # (due_time, sequence, identifier, function)
+        self.events = []
+        self.sequence = 0
+        # Simulated network link. Transfers happen one at a time.
+        self.link_free_time = 0.0
+        # identifier -> USK base
+        self.subscriptions = {}
+        # identifier -> message name for running requests.
+        self.running = {}
+
+    def receive(self, data):
+        """ Handle bytes sent by the client. """
+        self.parser.parse_bytes(data)
+
+    def send(self, name, fields, data=None):
+        """ Queue a message for the client. """
+        self.out += make_msg(name, fields, data)
+
+    def schedule(self, due_time, identifier, function):
+        """ Call function at due_time unless identifier is cancelled
+            first. """
+        self.sequence += 1
+        heapq.heappush(self.events, (due_time, self.sequence,
+                                     identifier, function))
+
+    def next_due_time(self):
+        """ Return the time the next event is due or None. """
+        if not self.events:
+            return None
+        return self.events[0][0]
+
+    def poll(self):
+        """ Run events which are due and return the bytes to send to
+            the client. """
+        now = self.node.clock()
+        while self.events and self.events[0][0] <= now:
+            function = heapq.heappop(self.events)[3]
+            function()
+        ret = self.out
+        self.out = b''
+        return ret
+
+    def cancel(self, identifier):
+        """ Drop all scheduled events for identifier. """
+        self.events = [event for event in self.events
+                       if event[2] != identifier]
+        heapq.heapify(self.events)
+
+    def transfer_time(self, length):
+        """ INTERNAL: Reserve the link for length bytes and return the
+            time the transfer finishes, including latency. """
+        now = self.node.clock()
+        start = max(now, self.link_free_time)
+        bytes_per_sec = self.node.params['BYTES_PER_SEC']
+        if bytes_per_sec:
+            self.link_free_time = start + float(length) / bytes_per_sec
+        else:
+            self.link_free_time = start
+        return self.link_free_time + self.node.latency()
+
+    def handle_msg(self, msg):
+        """ INTERNAL: Dispatch a message from the client. """
+        if self.hello is None and msg[0] != b'ClientHello':
+            self.send(b'ProtocolError',
+                      {b'Code':1, b'CodeDescription':
+                       b'ClientHello must be first message',
+                       b'Fatal':True, b'Global':False})
+            return
+        handler = self.node.HANDLERS.get(msg[0])
+        if handler is None:
+            self.send(b'ProtocolError',
+                      {b'Code':7, b'CodeDescription':b'Message not supported',
+                       b'Identifier':msg[1].get(b'Identifier', b''),
+                       b'Fatal':False, b'Global':False})
+            return
+        handler(self.node, self, msg)
+
+    def schedule_progress(self, identifier, length, due_time):
+        """ INTERNAL: Schedule SimpleProgress messages for a transfer
+            of length bytes finishing at due_time. """
+        total = max(1, (length + SIM_BLOCK_LEN - 1) // SIM_BLOCK_LEN)
+        count = min(total, self.node.params['MAX_PROGRESS_MSGS'])
+        now = self.node.clock()
+        for index in range(0, count):
+            succeeded = (total * index) // count
+
+            def progress(succeeded=succeeded):
+                """ INTERNAL: Send a SimpleProgress message. """
+                self.send(b'SimpleProgress',
+                          {b'Identifier':identifier, b'Total':total,
+                           b'Required':total, b'Failed':0,
+                           b'FatallyFailed':0, b'Succeeded':succeeded,
+                           b'FinalizedTotal':True, b'Global':False})
+            self.schedule(now + (due_time - now) * index / count,
+                          identifier, progress)
+
+    def send_failure(self, name, identifier, code, extra=None):
+        """ INTERNAL: Send a GetFailed or PutFailed message. """
+        description = CODE_DESCRIPTIONS[(name, code)]
+        fields = {b'Identifier':identifier, b'Code':code,
+                  b'CodeDescription':description,
+                  b'ShortCodeDescription':description,
+                  b'Fatal':(name, code) in FATAL_CODES,
+                  b'Global':False}
+        if extra:
+            fields.update(extra)
+        self.running.pop(identifier, None)
+        self.send(name, fields)
+
+class SimulatedNode:
+    """ A fake Freenet node which speaks enough FCP 2.0 for
+        infocalypse. """
+    def __init__(self, params=None, store=None, clock=time.time):
+        self.params = DEFAULT_SIM_PARAMS.copy()
+        if params:
+            self.params.update(params)
+        if store is None:
+            store = SimKeyStore(self.params['STORE_DIR'])
+        self.store = store
+        self.clock = clock
+        self.random = random.Random(self.params['SEED'])
+        self.sessions = []
+
+    def connect(self):
+        """ Return a new SimSession. """
+        session = SimSession(self)
+        self.sessions.append(session)
+        return session
+
+    def disconnect(self, session):
+        """ Forget a SimSession. """
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def latency(self):
+        """ INTERNAL: Return a random request latency. """
+        return (self.params['LATENCY_SECS']
+                + self.random.random() * self.params['JITTER_SECS'])
+
+    def fails(self, rate_name):
+        """ INTERNAL: Return True if the next request should fail. """
+        rate = self.params[rate_name]
+        return rate > 0 and self.random.random() < rate
+
+    #-----------------------------------------------------------#
+    # Fetching
+    #-----------------------------------------------------------#
+    def lookup(self, uri, hops=0):
+        """ Return a (code, data, mime_type, redirect_uri) tuple for a
+            URI, following metadata.
+
+            code is None on success. """
+        try:
+            parsed = SimUri(uri)
+        except ValueError:
+            return (GET_INVALID_URI, None, None, None)
+        if parsed.key_type != b'KSK' and len(parsed.key_fields) != 3:
+            return (GET_INVALID_URI, None, None, None)
+
+        raw = False
+        path = parsed.path
+        if parsed.key_type == b'USK':
+            try:
+                usk_base, edition, rest = parsed.usk_name()
+            except ValueError:
+                return (GET_INVALID_URI, None, None, None)
+            latest = self.store.latest_edition(usk_base)
+            if latest is None or latest < abs(edition):
+                return (GET_DATA_NOT_FOUND, None, None, None)
+            if latest != edition:
+                # The node redirects to the latest edition it knows of.
+                return (GET_PERMANENT_REDIRECT, None, None,
+                        parsed.request_uri(parsed.path[:1]
+                                           + [b'%i' % latest, ] + rest))
+            key = b'/'.join([usk_slot(usk_base, edition), ] + rest)
+        else:
+            if parsed.key_type == b'CHK':
+                raw = is_raw_extra(parsed.key_fields[-1])
+            elif not path:
+                return (GET_INVALID_URI, None, None, None)
+            key = store_key(parsed.key_type, parsed.public_fields(), path)
+
+        return self.lookup_key(key, raw, hops)
+
+    def lookup_key(self, key, raw, hops):
+        """ INTERNAL: Like lookup() but for a store key. """
+        entry = self.store.get(key)
+        if entry is None:
+            return (GET_DATA_NOT_FOUND, None, None, None)
+        data, mime_type = entry
+        metadata = parse_metadata(data)
+        if raw or metadata is None:
+            return (None, data, mime_type, None)
+
+        if hops >= MAX_METADATA_HOPS:
+            return (GET_DATA_NOT_FOUND, None, None, None)
+        target = metadata[1]
+        if target.startswith(TARGET_KEY):
+            ret = self.lookup_key(target[len(TARGET_KEY):], False, hops + 1)
+        elif target.startswith(TARGET_DOC):
+            ret = self.lookup_key(key + b'/' + target[len(TARGET_DOC):],
+                                  False, hops + 1)
+        else:
+            ret = self.lookup(target, hops + 1)
+        if ret[0] is None:
+            return (None, ret[1], metadata[0], None)
+        return ret
+
+    def handle_get(self, session, msg):
+        """ INTERNAL: Handle ClientGet. """
+        fields = msg[1]
+        identifier = fields[b'Identifier']
+        uri = fields.get(b'URI', b'')
+        session.running[identifier] = msg[0]
+        code, data, dummy, dummy = self.lookup(uri)
+        length = 0
+        if code is None:
+            length = len(data)
+        failed = self.fails('GET_FAILURE_RATE')
+        due_time = session.transfer_time(length)
+        session.schedule_progress(identifier, length, due_time)
+        session.schedule(due_time, identifier,
+                         lambda: self.finish_get(session, fields, failed))
+
+    def finish_get(self, session, fields, failed):
+        """ INTERNAL: Send the result of a ClientGet. """
+        identifier = fields[b'Identifier']
+        code, data, mime_type, redirect_uri = self.lookup(fields[b'URI'])
+        if code is None and failed:
+            code = GET_DATA_NOT_FOUND
+            if len(data) > SIM_BLOCK_LEN:
+                code = GET_ALL_DATA_NOT_FOUND
+        if code == GET_PERMANENT_REDIRECT:
+            session.send_failure(b'GetFailed', identifier, code,
+                                 {b'RedirectURI':redirect_uri})
+            return
+        if not code is None:
+            session.send_failure(b'GetFailed', identifier, code)
+            return
+
+        max_size = fields.get(b'MaxSize')
+        if not max_size is None and len(data) > int(max_size):
+            session.send_failure(b'GetFailed', identifier, GET_TOO_BIG,
+                                 {b'ExpectedDataLength':len(data),
+                                  b'ExpectedMetadata.ContentType':mime_type})
+            return
+
+        del session.running[identifier]
+        found = {b'Identifier':identifier, b'DataLength':len(data),
+                 b'Metadata.ContentType':mime_type, b'Global':False}
+        return_type = fields.get(b'ReturnType', b'direct')
+        if return_type == b'direct':
+            session.send(b'DataFound', found)
+            session.send(b'AllData', {b'Identifier':identifier,
+                                      b'DataLength':len(data),
+                                      b'Global':False}, data)
+            return
+        if return_type == b'disk':
+            out_file = open(fields[b'FileName'], 'wb')
+            try:
+                out_file.write(data)
+            finally:
+                out_file.close()
+        session.send(b'DataFound', found)
+
+    #-----------------------------------------------------------#
+    # Inserting
+    #-----------------------------------------------------------#
+    def put_entry(self, key, data, mime_type):
+        """ INTERNAL: Store data under key. """
+        stored, data_key = stored_form(data, mime_type)
+        if not data_key is None:
+            self.store.put(data_key, data, b'')
+        self.store.put(key, stored, mime_type)
+
+    def insert_at(self, uri, entries, dry_run):
+        """ INTERNAL: Insert a list of (path, data, mime_type) entries
+            under uri. A path of None is the key itself.
+
+            Returns (code, final URI). code is None on success. """
+        try:
+            parsed = SimUri(uri)
+        except ValueError:
+            return (PUT_INVALID_URI, None)
+        if not parsed.is_insert():
+            return (PUT_INVALID_URI, None)
+
+        if parsed.key_type == b'CHK':
+            if len(entries) == 1:
+                # Key it by what's stored, so that the CHK of
+                # a big file points to its metadata.
+                mime_type = entries[0][2]
+                chk = make_chk(stored_form(entries[0][1], mime_type)[0],
+                               mime_type)
+            else:
+                # Container. Key it by its contents.
+                chk = make_chk(b''.join([b'%s\0%s\0%s\0' %
+                                         (entry[0], entry[2],
+                                          sha256(entry[1]).digest())
+                                         for entry in entries[1:]]),
+                               b'container')
+            base_key = store_key(b'CHK', chk[4:].split(b','), [])
+            final_uri = chk
+            if len(entries) > 1:
+                final_uri += b'/'
+        elif parsed.key_type == b'USK':
+            try:
+                usk_base, edition, rest = parsed.usk_name()
+            except ValueError:
+                return (PUT_INVALID_URI, None)
+            if rest or edition < 0:
+                return (PUT_INVALID_URI, None)
+            # Like the node, move on to the next free slot.
+            while self.slot_taken(usk_slot(usk_base, edition), entries):
+                edition += 1
+            base_key = usk_slot(usk_base, edition)
+            final_uri = parsed.request_uri(parsed.path[:1]
+                                           + [b'%i' % edition, ])
+        else:
+            if not parsed.path:
+                return (PUT_INVALID_URI, None)
+            base_key = store_key(parsed.key_type, parsed.public_fields(),
+                                 parsed.path)
+            if self.slot_taken(base_key, entries):
+                return (PUT_COLLISION, None)
+            final_uri = parsed.request_uri()
+
+        if dry_run:
+            return (None, final_uri)
+
+        for path, data, mime_type in entries:
+            if path is None:
+                self.put_entry(base_key, data, mime_type)
+            else:
+                self.put_entry(base_key + b'/' + path, data, mime_type)
+        if parsed.key_type == b'USK':
+            self.store.update_edition(usk_base, edition)
+            self.notify_subscribers(usk_base, edition)
+        return (None, final_uri)
+
+    def slot_taken(self, base_key, entries):
+        """ INTERNAL: Return True if base_key already holds different
+            data. """
+        if self.store.get(base_key) is None:
+            return False
+        for path, data, mime_type in entries:
+            key = base_key
+            if not path is None:
+                key += b'/' + path
+            entry = self.store.get(key)
+            if entry is None or entry[0] != stored_form(data, mime_type)[0]:
+                return True
+        return False
+
+    def handle_put(self, session, msg):
+        """ INTERNAL: Handle ClientPut. """
+        fields = msg[1]
+        identifier = fields[b'Identifier']
+        session.running[identifier] = msg[0]
+        mime_type = fields.get(b'Metadata.ContentType',
+                               b'application/octet-stream')
+        upload_from = fields.get(b'UploadFrom', b'direct')
+        if upload_from == b'disk':
+            in_file = open(fields[b'Filename'], 'rb')
+            try:
+                data = in_file.read()
+            finally:
+                in_file.close()
+        elif upload_from == b'redirect':
+            data = make_metadata(mime_type, fields[b'TargetURI'])
+        else:
+            data = msg[2]
+        self.start_insert(session, msg, [(None, data, mime_type), ])
+
+    def handle_put_dir(self, session, msg):
+        """ INTERNAL: Handle ClientPutComplexDir. """
+        fields = msg[1]
+        identifier = fields[b'Identifier']
+        session.running[identifier] = msg[0]
+        entries = []
+        offset = 0
+        for index in dir_file_indices(fields):
+            prefix = b'Files.%i.' % index
+            name = fields[prefix + b'Name']
+            mime_type = fields.get(prefix + b'Metadata.ContentType',
+                                   b'application/octet-stream')
+            upload_from = fields.get(prefix + b'UploadFrom', b'direct')
+            if upload_from == b'disk':
+                in_file = open(fields[prefix + b'Filename'], 'rb')
+                try:
+                    data = in_file.read()
+                finally:
+                    in_file.close()
+            elif upload_from == b'redirect':
+                data = make_metadata(mime_type, fields[prefix + b'TargetURI'])
+            else:
+                length = int(fields[prefix + b'DataLength'])
+                data = msg[2][offset:offset + length]
+                offset += length
+            entries.append((name, data, mime_type))
+
+        if not entries:
+            session.send(b'ProtocolError',
+                         {b'Code':5, b'CodeDescription':b'No files',
+                          b'Identifier':identifier, b'Fatal':False,
+                          b'Global':False})
+            del session.running[identifier]
+            return
+
+        # Fetching the container itself gets the default document.
+        entries.insert(0, (None, make_metadata(b'text/html', TARGET_DOC
+                                               + fields.get(b'DefaultName',
+                                                            entries[0][0])),
+                           b'text/html'))
+        self.start_insert(session, msg, entries)
+
+    def start_insert(self, session, msg, entries):
+        """ INTERNAL: Schedule the messages for an insert. """
+        fields = msg[1]
+        identifier = fields[b'Identifier']
+        uri = fields.get(b'URI', b'CHK@')
+        chk_only = fields.get(b'GetCHKOnly', b'false').lower() == b'true'
+
+        code, final_uri = self.insert_at(uri, entries, True)
+        if not code is None:
+            session.send_failure(b'PutFailed', identifier, code)
+            return
+
+        session.send(b'URIGenerated', {b'Identifier':identifier,
+                                       b'URI':final_uri, b'Global':False})
+        length = sum([len(entry[1]) for entry in entries])
+        if chk_only:
+            length = 0
+        failed = self.fails('PUT_FAILURE_RATE') and not chk_only
+        due_time = session.transfer_time(length)
+        session.schedule_progress(identifier, length, due_time)
+
+        def finish():
+            """ INTERNAL: Send the result of the insert. """
+            if failed:
+                session.send_failure(b'PutFailed', identifier,
+                                     PUT_ROUTE_NOT_FOUND)
+                return
+            code, final_uri = self.insert_at(uri, entries, chk_only)
+            if not code is None:
+                session.send_failure(b'PutFailed', identifier, code)
+                return
+            del session.running[identifier]
+            session.send(b'PutFetchable', {b'Identifier':identifier,
+                                           b'URI':final_uri,
+                                           b'Global':False})
+            session.send(b'PutSuccessful', {b'Identifier':identifier,
+                                            b'URI':final_uri,
+                                            b'Global':False})
+        session.schedule(due_time, identifier, finish)
+
+    #-----------------------------------------------------------#
+    # Everything else
+    #-----------------------------------------------------------#
+    def handle_hello(self, session, msg):
+        """ INTERNAL: Handle ClientHello. """
+        session.hello = msg
+        session.send(b'NodeHello', {b'FCPVersion':FCP_VERSION,
+                                    b'Node':b'Fred',
+                                    b'Version':SIM_NODE_VERSION,
+                                    b'Build':SIM_NODE_BUILD,
+                                    b'Revision':b'fcpsim',
+                                    b'Testnet':False,
+                                    b'CompressionCodecs':0,
+                                    b'ConnectionIdentifier':
+                                    sha1_hexdigest(b'%i' % id(session))})
+
+    def handle_generate_ssk(self, session, msg):
+        """ INTERNAL: Handle GenerateSSK. """
+        private_key = key_field(
+            bytes([self.random.randrange(256) for dummy in range(32)]))
+        crypto_key = key_field(
+            bytes([self.random.randrange(256) for dummy in range(32)]))
+        public = public_ssk_fields(private_key, crypto_key)
+        session.send(b'SSKKeypair',
+                     {b'Identifier':msg[1][b'Identifier'],
+                      b'InsertURI':b'SSK@%s,%s,%s/' % (private_key,
+                                                       crypto_key,
+                                                       SSK_INSERT_EXTRA),
+                      b'RequestURI':b'SSK@%s,%s,%s/' % public})
+
+    def handle_subscribe_usk(self, session, msg):
+        """ INTERNAL: Handle SubscribeUSK. """
+        identifier = msg[1][b'Identifier']
+        try:
+            usk_base, edition, dummy = SimUri(msg[1][b'URI']).usk_name()
+        except (ValueError, KeyError):
+            session.send(b'ProtocolError',
+                         {b'Code':4, b'CodeDescription':b'Invalid URI',
+                          b'Identifier':identifier, b'Fatal':False,
+                          b'Global':False})
+            return
+        session.subscriptions[identifier] = usk_base
+        session.send(b'SubscribedUSK', {b'Identifier':identifier,
+                                        b'URI':msg[1][b'URI'],
+                                        b'DontPoll':False})
+
+        def search_round():
+            """ INTERNAL: Report what the first search found. """
+            latest = self.store.latest_edition(usk_base)
+            if not latest is None and latest >= abs(edition):
+                self.send_usk_update(session, identifier, usk_base, latest)
+            session.send(b'SubscribedUSKRoundFinished',
+                         {b'Identifier':identifier})
+        session.schedule(self.clock() + self.latency(), identifier,
+                         search_round)
+
+    def send_usk_update(self, session, identifier, usk_base, edition):
+        """ INTERNAL: Send a SubscribedUSKUpdate. """
+        if not identifier in session.subscriptions:
+            return
+        fields = usk_base[4:].split(b'/')
+        session.send(b'SubscribedUSKUpdate',
+                     {b'Identifier':identifier, b'Edition':edition,
+                      b'URI':b'USK@%s,%s/%s/%i' % (fields[0],
+                                                   SSK_REQUEST_EXTRA,
+                                                   fields[1], edition),
+                      b'NewKnownGood':True, b'NewSlotToo':True})
+
+    def notify_subscribers(self, usk_base, edition):
+        """ INTERNAL: Tell subscribers about a new edition. """
+        for session in self.sessions:
+            for identifier in list(session.subscriptions):
+                if session.subscriptions[identifier] != usk_base:
+                    continue
+
+                def update(session=session, identifier=identifier):
+                    """ INTERNAL: Send the update. """
+                    self.send_usk_update(session, identifier,
+                                         usk_base, edition)
+                session.schedule(self.clock() + self.latency(),
+                                 identifier, update)
+
+    def handle_unsubscribe_usk(self, session, msg):
+        """ INTERNAL: Handle UnsubscribeUSK. """
+        identifier = msg[1][b'Identifier']
+        session.subscriptions.pop(identifier, None)
+        session.cancel(identifier)
+
+    def handle_remove_request(self, session, msg):
+        """ INTERNAL: Handle RemoveRequest. """
+        identifier = msg[1][b'Identifier']
+        session.cancel(identifier)
+        name = session.running.get(identifier)
+        if name == b'ClientGet':
+            session.send_failure(b'GetFailed', identifier, GET_CANCELLED)
+        elif not name is None:
+            session.send_failure(b'PutFailed', identifier, PUT_CANCELLED)
+        session.send(b'PersistentRequestRemoved',
+                     {b'Identifier':identifier, b'Global':False})
+
+    HANDLERS = {
+        b'ClientHello':handle_hello,
+        b'GenerateSSK':handle_generate_ssk,
+        b'ClientGet':handle_get,
+        b'ClientPut':handle_put,
+        b'ClientPutComplexDir':handle_put_dir,
+        b'SubscribeUSK':handle_subscribe_usk,
+        b'UnsubscribeUSK':handle_unsubscribe_usk,
+        b'RemoveRequest':handle_remove_request,
+    }
+
+#-----------------------------------------------------------#
+# Transports
+#-----------------------------------------------------------#
+
+class SimSocket(IAsyncSocket):
+    """ IAsyncSocket implementation which talks directly to a
+        SimulatedNode in the same process. """
+    def __init__(self, node):
+        IAsyncSocket.__init__(self)
+        self.session = node.connect()
+        self.bytes_written = 0
+
+    def write_bytes(self, bytes):
+        """ IAsyncSocket implementation. """
+        assert bytes
+        self.bytes_written += len(bytes)
+        self.session.receive(bytes)
+
+    def close(self):
+        """ IAsyncSocket implementation. """
+        if self.session:
+            self.session.node.disconnect(self.session)
+            self.session = None
+            self.closed_callback()
+
+    def poll(self):
+        """ IAsyncSocket implementation. """
+        if not self.session:
+            raise IOError("The socket is closed")
+        # Pull upload data from the FCPConnection.
+        limit = self.bytes_written + MAX_SOCKET_READ
+        while self.writable_callback and self.bytes_written < limit:
+            self.writable_callback()
+
+        data = self.session.poll()
+        if data:
+            self.recv_callback(data)
+        return True
+
+def make_sim_connection(node):
+    """ Return a connected FCPConnection to a SimulatedNode. """
+    return FCPConnection(SimSocket(node), True)
+
+class SimServer:
+    """ Serve a SimulatedNode over TCP so that unmodified clients
+        (e.g. hg fn-push --fcpport) can use it. """
+    def __init__(self, node, host='127.0.0.1', port=DEFAULT_SIM_PORT):
+        self.node = node
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(5)
+        self.listener.setblocking(0)
+        # socket -> [SimSession, unsent bytes]
+        self.clients = {}
+
+    def drop(self, sock):
+        """ INTERNAL: Close a client socket. """
+        session = self.clients.pop(sock)[0]
+        self.node.disconnect(session)
+        sock.close()
+
+    def serve_once(self, max_wait_secs=0.25):
+        """ Handle socket activity and due events once. """
+        now = self.node.clock()
+        wait = max_wait_secs
+        for session, dummy in self.clients.values():
+            due_time = session.next_due_time()
+            if not due_time is None:
+                wait = max(0.0, min(wait, due_time - now))
+
+        writable = [sock for sock in self.clients if self.clients[sock][1]]
+        readable, writable, dummy = select.select(
+            [self.listener, ] + list(self.clients), writable, [], wait)
+
+        for sock in readable:
+            if sock is self.listener:
+                client, dummy = self.listener.accept()
+                client.setblocking(0)
+                self.clients[client] = [self.node.connect(), b'']
+                continue
+            try:
+                data = sock.recv(RECV_BLOCK)
+            except socket.error:
+                data = None
+            if not data:
+                self.drop(sock)
+                continue
+            self.clients[sock][0].receive(data)
+
+        for sock, entry in list(self.clients.items()):
+            entry[1] += entry[0].poll()
+            if not entry[1] or not sock in writable:
+                continue
+            try:
+                sent = sock.send(entry[1])
+            except socket.error:
+                self.drop(sock)
+                continue
+            entry[1] = entry[1][sent:]
+
+    def serve_forever(self):
+        """ Serve until interrupted. """
+        try:
+            while True:
+                self.serve_once()
+        finally:
+            for sock in list(self.clients):
+                self.drop(sock)
+            self.listener.close()
+
+def main():
+    """ CLI entry point: fcpsim [port [store_dir]] """
+    port = DEFAULT_SIM_PORT
+    params = {}
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        params['STORE_DIR'] = sys.argv[2]
+    print("Simulated FCP node listening on port: %i" % port)
+    SimServer(SimulatedNode(params), port=port).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -22,74 +22,106 @@
 
 
 import os
-from mercurial import cmdutil
+from collections import OrderedDict
 
 from .pathhacks import add_parallel_sys_path
 add_parallel_sys_path('fniki')
-from fileoverlay import OverlayedFiles, DirectFiles, WIKITEXT_ENCODING
+from fileoverlay import OverlayedFiles, DirectFiles, make_fork_index, \
+     WIKITEXT_ENCODING
+
+# Number of file revisions an HgFileOverlay keeps in memory.
+DEFAULT_MAX_CACHED_FILES = 256
+
+def hg_bytes(value):
+    """ INTERNAL: Return a str path or version as the bytes mercurial
+        expects. """
+    if isinstance(value, str):
+        return os.fsencode(value)
+    return value
 
-# ATTRIBUTION: Pillaged from commands.cat() in the hg source.
 def get_hg_file(repo, file_name, rev, tmp_file_name, dump_to_file = False):
     """ INTERNAL: read a file from the hg repo.
         If dump_to_file, the data is written into tmp_file_name.
-        Otherwise, the data is returned and tmp_file_name is deleted.
+        Otherwise, the data is returned.
     """
-    #print "get_hg_file -- ", file_name, rev
-
-    file_name = os.path.join(repo.root, file_name)
-    ctx = repo[rev]
-    bytes = None
-    err = True
-    matches = cmdutil.match(repo, (file_name,))
-    for abs_ in ctx.walk(matches):
-        assert err # Wacky. Why are we looping again?
-        # REDFLAG: ripped out decode code. Will I need that on windows?
-        file_ptr = None # Hmmmm starting to look like crappy Java code :-(
-        in_file = None
-        try:
-            file_ptr = cmdutil.make_file(repo, tmp_file_name, ctx.node(),
-                                         pathname=abs_)
-            file_ptr.write(ctx[abs_].data())
-            file_ptr.close()
-            file_ptr = None
-            if not dump_to_file:
-                in_file = open(tmp_file_name)
-                bytes = in_file.read()
-        finally:
-            if file_ptr:
-                file_ptr.close()
-            if in_file:
-                in_file.close()
-            if not dump_to_file and os.path.exists(tmp_file_name):
-                os.remove(tmp_file_name)
-
-        err = False
-    if err:
+    try:
+        bytes = repo[hg_bytes(rev)][hg_bytes(file_name)].data()
+    except KeyError:
         raise KeyError("File: %s doesn't exist in version: %s" \
                        % (file_name, rev))
     if dump_to_file:
+        out_file = open(tmp_file_name, 'wb')
+        try:
+            out_file.write(bytes)
+        finally:
+            out_file.close()
         return "The data was written into: %s" % tmp_file_name
 
     return bytes
 
+class PinnedVersion:
+    """ INTERNAL: Everything HgFileOverlay looks up for one changeset. """
+    def __init__(self, version, ctx):
+        self.version = version
+        self.node = ctx.node()
+        self.ctx = ctx
+        self.manifest = ctx.manifest()
+        # repo dir -> tuple of the page names in it
+        self.pages = {}
+        # path -> (overlay stamp, fork index)
+        self.forks = {}
 
 class HgFileOverlay(OverlayedFiles):
     """ An IFileOverlay that reads files from a mercurial revision."""
     def __init__(self, ui_, repo, base_dir, tmp_file):
-        OverlayedFiles.__init__(self, os.path.join(repo.root, base_dir))
+        self.root = os.fsdecode(repo.root)
+        OverlayedFiles.__init__(self, os.path.join(self.root, base_dir))
         self.base_dir = base_dir # i.e. root wrt repo
         self.ui_ = ui_
         self.repo = repo
+        self.pinned = None
         self.version = 'tip'
+        # Unused. Files are read straight out of the repo.
         self.tmp_file = tmp_file
+        # file node -> data, for every version.
+        self.file_data = OrderedDict()
+        self.max_cached_files = DEFAULT_MAX_CACHED_FILES
+
+    def get_version(self):
+        """ Return the version files are read from. """
+        return self._version
+
+    def set_version(self, version):
+        """ Set the version files are read from. """
+        self._version = version
+        if not self.pinned is None and self.pinned.version != version:
+            self.pinned = None
+
+    version = property(get_version, set_version)
+
+    def pinned_version(self):
+        """ INTERNAL: Return the PinnedVersion for self.version.
+
+            Full 40 digit hex versions are only looked up once.
+            Anything else, e.g. 'tip', is looked up every time, but the
+            manifest is only reread when it points to a new changeset. """
+        pinned = self.pinned
+        if (not pinned is None and len(pinned.version) == 40 and
+            pinned.version == self.version):
+            return pinned
+        ctx = self.repo[hg_bytes(self.version)]
+        if pinned is None or pinned.node != ctx.node():
+            pinned = PinnedVersion(self.version, ctx)
+            self.pinned = pinned
+        return pinned
 
     def repo_path(self, path):
         """ Return path w.r.t. the repository root. """
         path = os.path.abspath(path)
         assert path.startswith(self.base_path)
-        assert path.startswith(self.repo.root)
+        assert path.startswith(self.root)
 
-        rest = path[len(self.repo.root):]
+        rest = path[len(self.root):]
         if rest.startswith(os.sep):
             rest = rest[len(os.sep):]
 
@@ -101,43 +133,60 @@ class HgFileOverlay(OverlayedFiles):
             raise ValueError("Dunno how to enumerate wikitext pages from: %s"
                              % path)
         wikitext_dir = self.repo_path(path)
-        # Hmmmm... won't work for files in root. use -1?
-        return tuple([os.path.split(name)[1] for name in
-                      list(self.repo.changectx(self.version).
-                      manifest().keys()) if name.startswith(wikitext_dir)])
+        pinned = self.pinned_version()
+        pages = pinned.pages.get(wikitext_dir)
+        if pages is None:
+            # Hmmmm... won't work for files in root. use -1?
+            prefix = hg_bytes(wikitext_dir) + b'/'
+            pages = tuple([os.fsdecode(name[len(prefix):]) for name in
+                           pinned.manifest.keys()
+                           if name.startswith(prefix) and
+                           name.find(b'/', len(prefix)) == -1])
+            pinned.pages[wikitext_dir] = pages
+        return pages
 
     def exists_in_repo(self, path):
         """ INTERNAL: Return True if the file exists in the repo,
             False otherwise. """
-        return (self.repo_path(path) in
-                self.repo.changectx(self.version).manifest())
+        return hg_bytes(self.repo_path(path)) in self.pinned_version().manifest
+
+    def read_repo(self, path):
+        """ INTERNAL: Return the decoded contents of a file in the repo. """
+        pinned = self.pinned_version()
+        repo_path = hg_bytes(self.repo_path(path))
+        try:
+            file_node = pinned.manifest[repo_path]
+        except KeyError:
+            raise KeyError("File: %s doesn't exist in version: %s" \
+                           % (repo_path, self.version))
+        data = self.file_data.get(file_node)
+        if data is None:
+            data = pinned.ctx[repo_path].data()
+            self.file_data[file_node] = data
+            while len(self.file_data) > self.max_cached_files:
+                self.file_data.popitem(False)
+        else:
+            self.file_data.move_to_end(file_node)
+        return str(data, WIKITEXT_ENCODING)
 
     def read(self, path, mode='rb', non_overlayed=False):
         """ Read a file. """
         if non_overlayed:
-            return str(
-                get_hg_file(self.repo, self.repo_path(path),
-                            self.version, self.tmp_file),
-                WIKITEXT_ENCODING)
-        overlayed = self.overlay_path(path)
-        if os.path.exists(overlayed):
-            return DirectFiles.read(self, overlayed, mode)
-
-        return str(get_hg_file(self.repo, self.repo_path(path),
-                                   self.version, self.tmp_file),
-                       WIKITEXT_ENCODING)
+            return self.read_repo(path)
+
+        if not self.overlay_size(path) is None:
+            return DirectFiles.read(self, self.overlay_path(path), mode)
+
+        return self.read_repo(path)
 
     def exists(self, path, non_overlayed=False):
         """ Return True if the file exists, False otherwise. """
         if non_overlayed:
             return self.exists_in_repo(path)
 
-        overlay = self.overlay_path(path)
-        if os.path.exists(overlay):
-            if os.path.getsize(overlay) == 0:
-                return False
-            else:
-                return True
+        size = self.overlay_size(path)
+        if not size is None:
+            return size > 0
 
         return self.exists_in_repo(path)
 
@@ -145,27 +194,30 @@ class HgFileOverlay(OverlayedFiles):
         """ Return the modtime for the file."""
         if non_overlayed:
             # Hmmm commit time for changeset, not file. Good enough.
-            return int(self.repo.changectx(self.version).date()[0])
+            return int(self.pinned_version().ctx.date()[0])
 
-        overlay = self.overlay_path(path)
-        if os.path.exists(overlay) and os.path.getsize(overlay) > 0:
-            return DirectFiles.modtime(self, overlay)
+        if self.overlay_size(path):
+            return DirectFiles.modtime(self, self.overlay_path(path))
 
-        return int(self.repo.changectx(self.version).date()[0])
+        return int(self.pinned_version().ctx.date()[0])
 
     def list_pages(self, path, non_overlayed=False):
         """ IFileFunctions implementation. """
         if non_overlayed:
-            return self.repo_pages()
+            return list(self.repo_pages(path))
 
-        overlay_pages = set([])
-        overlay = self.overlay_path(path)
-        if os.path.exists(overlay):
-            overlay_pages = set(DirectFiles.list_pages(self, overlay))
+        overlay = self.snapshot(self.overlay_path(path), True)
+        deleted = set([name for name in overlay.pages
+                       if overlay.sizes.get(name) == 0])
 
-        deleted = set([])
-        for name in overlay_pages:
-            if os.path.getsize(os.path.join(overlay, name)) == 0:
-                deleted.add(name)
+        return list(overlay.pages.union(set(self.repo_pages(path)) - deleted))
 
-        return list(overlay_pages.union(set(self.repo_pages(path)) - deleted))
+    def fork_index(self, path):
+        """ IFileFunctions implementation. """
+        pinned = self.pinned_version()
+        stamp = self.snapshot(self.overlay_path(path), True).stamp
+        cached = pinned.forks.get(path)
+        if cached is None or cached[0] != stamp or stamp is None:
+            cached = (stamp, make_fork_index(self.list_pages(path)))
+            pinned.forks[path] = cached
+        return cached[1]
@@ -37,6 +37,8 @@ from .fcpconnection import FCPConnection, PolledSocket, CONNECTION_STATES, \
 from .fcpmessage import PUT_FILE_DEF
 
 from .requestqueue import RequestRunner
+from .latencymodel import LatencyModel, LATENCY_FILE_NAME
+from .requestmetrics import RequestMetrics, METRICS_FILE_NAME
 
 from .graph import UpdateGraph, get_heads, has_version
 from .bundlecache import BundleCache, is_writable, make_temp_file
@@ -48,6 +50,7 @@ from .updatesm import UpdateStateMachine, QUIESCENT, FINISHING, REQUESTING_URI,
      RUNNING_SINGLE_REQUEST, UpdateContext
 
 from .archivesm import ArchiveStateMachine, ArchiveUpdateContext
+from .usktracker import USKTracker
 
 from .statemachine import StatefulRequest
 
@@ -68,6 +71,8 @@ DEFAULT_PARAMS = {
     # Non-FCP stuff
     'N_CONCURRENT':8, # Maximum number of concurrent FCP requests.
     'CANCEL_TIME_SECS': 120 * 60, # Bound request time.
+    # Upper bound for timeouts set from observed latency.
+    'MAX_CANCEL_TIME_SECS': 6 * 60 * 60,
     'POLL_SECS':1.00, # Time to sleep in the polling loop.
 
     # Testing HACKs
@@ -101,6 +106,8 @@ class UICallbacks:
     def __init__(self, ui_):
         self.ui_ = ui_
         self.verbosity = 0
+        # Optional requestmetrics.RequestMetrics to time states in.
+        self.metrics = None
 
     def connection_state(self, dummy, state):
         """ FCPConnection.state_callback function which writes to a ui. """
@@ -116,6 +123,9 @@ class UICallbacks:
 
     def transition_callback(self, from_state, to_state):
         """ StateMachine transition callback that writes to a ui."""
+        if not self.metrics is None:
+            self.metrics.state_changed(from_state.name, to_state.name,
+                                       from_state.parent)
         if self.verbosity < 1:
             return
         if self.verbosity > 2:
@@ -300,20 +310,7 @@ def setup(ui_, repo, params, stored_cfg):
         # BUG:? shouldn't this be reading TMP_DIR from stored_cfg
         cache = BundleCache(repo, ui_, params['TMP_DIR'])
 
-    try:
-        async_socket = PolledSocket(params['FCP_HOST'], params['FCP_PORT'])
-        connection = FCPConnection(async_socket, True,
-                                   callbacks.connection_state)
-    except socket.error as err: # Not an IOError until 2.6.
-        ui_.warn("Connection to FCP server [%s:%i] failed.\n"
-                % (params['FCP_HOST'], params['FCP_PORT']))
-        raise err
-    except IOError as err:
-        ui_.warn("Connection to FCP server [%s:%i] failed.\n"
-                % (params['FCP_HOST'], params['FCP_PORT']))
-        raise err
-
-    runner = RequestRunner(connection, params['N_CONCURRENT'])
+    runner = make_runner(ui_, params, stored_cfg, callbacks)
 
     if repo is None:
         # For incremental archives.
@@ -325,8 +322,11 @@ def setup(ui_, repo, params, stored_cfg):
         ctx.repo = repo
         ctx.ui_ = ui_
         ctx.bundle_cache = cache
+        ctx.usk_tracker = USKTracker(runner.connection, stored_cfg)
+        track_request_uri(ctx.usk_tracker, params)
         update_sm = UpdateStateMachine(runner, ctx)
 
+    ctx.latency_model = runner.latency_model
 
     update_sm.params = params.copy()
     update_sm.transition_callback = callbacks.transition_callback
@@ -337,6 +337,41 @@ def setup(ui_, repo, params, stored_cfg):
 
     return update_sm
 
+def track_request_uri(usk_tracker, params):
+    """ INTERNAL: Subscribe to params['REQUEST_URI'] if it is a USK
+        that may be searched, so the node keeps its edition current. """
+    request_uri = params.get('REQUEST_URI')
+    if (not request_uri is None and is_usk(request_uri)
+        and not params.get('NO_SEARCH', False)):
+        usk_tracker.subscribe(request_uri)
+
+def make_runner(ui_, params, stored_cfg, callbacks):
+    """ INTERNAL: Connect to the FCP server and return a RequestRunner
+        for the connection. """
+    try:
+        async_socket = PolledSocket(params['FCP_HOST'], params['FCP_PORT'])
+        connection = FCPConnection(async_socket, True,
+                                   callbacks.connection_state)
+    except socket.error as err: # Not an IOError until 2.6.
+        ui_.warn("Connection to FCP server [%s:%i] failed.\n"
+                % (params['FCP_HOST'], params['FCP_PORT']))
+        raise err
+    except IOError as err:
+        ui_.warn("Connection to FCP server [%s:%i] failed.\n"
+                % (params['FCP_HOST'], params['FCP_PORT']))
+        raise err
+
+    runner = RequestRunner(connection, params['N_CONCURRENT'])
+    # Shared by all commands so timeouts improve from run to run.
+    tmp_dir = os.fsdecode(os.path.expanduser(stored_cfg.defaults['TMP_DIR']))
+    runner.latency_model = LatencyModel.from_file(
+        os.path.join(tmp_dir, LATENCY_FILE_NAME))
+    # Look here to see where the time went.
+    runner.metrics = RequestMetrics(
+        params.get('METRICS_FILE', os.path.join(tmp_dir, METRICS_FILE_NAME)))
+    callbacks.metrics = runner.metrics
+    return runner
+
 def run_until_quiescent(update_sm, poll_secs, close_socket=True):
     """ Run the state machine until it reaches the QUIESCENT state. """
     runner = update_sm.runner
@@ -368,6 +403,9 @@ def run_until_quiescent(update_sm, poll_secs, close_socket=True):
         raised = False
     finally:
         if raised or close_socket:
+            if not update_sm.ctx.usk_tracker is None:
+                # Unsubscribe while the socket is still open.
+                update_sm.ctx.usk_tracker.close()
             update_sm.runner.connection.close()
 
 def cleanup(update_sm):
@@ -376,11 +414,27 @@ def cleanup(update_sm):
         return
 
     if not update_sm.runner is None:
-        update_sm.runner.connection.close()
+        cleanup_runner(update_sm.runner, update_sm.ctx.usk_tracker)
 
     if not update_sm.ctx.bundle_cache is None:
         update_sm.ctx.bundle_cache.remove_files()
 
+def cleanup_runner(runner, usk_tracker=None):
+    """ INTERNAL: Stop any USK subscriptions, close the connection
+        and save what the runner learned. """
+    if not usk_tracker is None:
+        usk_tracker.close()
+    runner.connection.close()
+    # Not worth failing the command over.
+    try:
+        if not runner.metrics is None:
+            runner.update_counters()
+            runner.metrics.write()
+        if not runner.latency_model is None:
+            runner.latency_model.save()
+    except (IOError, OSError):
+        pass
+
 # This function needs cleanup.
 # REDFLAG: better name. 0) inverts 1) updates indices from cached state.
 # 2) key substitutions.
@@ -652,7 +706,7 @@ def execute_push(ui_, repo, params, stored_cfg):
         else:
             extra = b''
             try_inserting = False
-            if update_sm.ctx.get('UP_TO_DATE', False):
+            if update_sm.ctx.get(b'UP_TO_DATE', False):
                 extra = b'. Local changes already in Freenet'
             else:
                 try_inserting = True
@@ -680,25 +734,29 @@ def execute_push(ui_, repo, params, stored_cfg):
 
     return inserted_to
 
+def update_request_index(ui_, params, stored_cfg):
+    """ INTERNAL: Update the index of params['REQUEST_URI'] to the
+        latest known value from the stored config. """
+    assert not params['REQUEST_URI'] is None
+    if not params['NO_SEARCH'] and is_usk_file(params['REQUEST_URI']):
+        index = stored_cfg.get_index(params['REQUEST_URI'])
+        if not index is None:
+            if index >= get_version(params['REQUEST_URI']):
+                # Update index to the latest known value
+                # for the --uri case.
+                params['REQUEST_URI'] = get_usk_for_usk_version(
+                    params['REQUEST_URI'], index)
+            else:
+                ui_.status(("Cached index [%i] < index in USK [%i].  "
+                            + "Using the index from the USK.\n"
+                            + "You're sure that index exists, right?\n") %
+                           (index, get_version(params['REQUEST_URI'])))
+
 def execute_pull(ui_, repo, params, stored_cfg):
     """ Run the pull command. """
     update_sm = None
     try:
-        assert not params['REQUEST_URI'] is None
-        if not params['NO_SEARCH'] and is_usk_file(params['REQUEST_URI']):
-            index = stored_cfg.get_index(params['REQUEST_URI'])
-            if not index is None:
-                if index >= get_version(params['REQUEST_URI']):
-                    # Update index to the latest known value
-                    # for the --uri case.
-                    params['REQUEST_URI'] = get_usk_for_usk_version(
-                        params['REQUEST_URI'], index)
-                else:
-                    ui_.status(("Cached index [%i] < index in USK [%i].  "
-                                + "Using the index from the USK.\n"
-                                + "You're sure that index exists, right?\n") %
-                               (index, get_version(params['REQUEST_URI'])))
-
+        update_request_index(ui_, params, stored_cfg)
         update_sm = setup(ui_, repo, params, stored_cfg)
         ui_.status(b"%sRequest URI:\n%s\n" % (is_redundant(params[
             'REQUEST_URI']),
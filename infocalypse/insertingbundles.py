@@ -22,10 +22,12 @@
 
 from .graph import UpToDate, INSERT_SALTED_METADATA, INSERT_HUGE, \
      FREENET_BLOCK_LEN, build_version_table, get_heads, \
-     PENDING_INSERT1
+     PENDING_INSERT1, hex_version
 from .graphutil import graph_to_string, find_redundant_edges, \
      find_alternate_edges, get_huge_top_key_edges
 from .bundlecache import BundleException
+from .insertjournal import graph_key
+from .latencymodel import CHK_ONLY
 
 from .statemachine import RequestQueueState
 
@@ -35,6 +37,9 @@ FAILING = b'FAILING'
 CANCELING = b'CANCELING'
 QUIESCENT = b'QUIESCENT'
 
+# First element of the tags of GetCHKOnly requests.
+CHK_ONLY_TAG = b'CHK_ONLY'
+
 # Hmmmm... hard coded exit states.
 class InsertingBundles(RequestQueueState):
     """ A state to insert hg bundles corresponding to the edges in an
@@ -46,6 +51,8 @@ class InsertingBundles(RequestQueueState):
         self.pending = {}
         self.new_edges = []
         self.required_edges = []
+        # Edges whose CHKs must be checked before re-inserting.
+        self.unverified_edges = []
         # HACK:
         # edge -> (x,y, 0) Freenet metadata bytes
         self.salting_cache = {}
@@ -75,6 +82,15 @@ class InsertingBundles(RequestQueueState):
         self.parent.ctx.ui_.status(b"Latest heads(s) in Freenet: %b\n"
                                  % b' '.join([ver[:12] for ver in latest_revs]))
 
+        journal = self.parent.ctx.insert_journal
+        if not journal is None:
+            # Edge indices depend on the graph we started from.
+            if journal.bind(graph_key(graph_to_string(graph),
+                                      self._target_versions(),
+                                      self.parent.ctx.get(b'REINSERT', 0))):
+                self.parent.ctx.ui_.status(b"Resuming an interrupted "
+                                           + b"insert.\n")
+
         if self.parent.ctx.get('REINSERT', 0) == 1:
             self.parent.ctx.ui_.status(b"No bundles to reinsert.\n")
             # REDFLAG: Think this through. Crappy code, but expedient.
@@ -100,6 +116,8 @@ class InsertingBundles(RequestQueueState):
             # REDFLAG: rework UpToDate exception to include versions, stuff
             #      versions in  ctx?
             self.parent.ctx[b'UP_TO_DATE'] = True
+            if not journal is None:
+                journal.remove()
             self.parent.ctx.ui_.warn(str(err).encode("utf-8") + b'\n') # Hmmm
             self.parent.transition(FAILING) # Hmmm... hard coded state name
             return
@@ -121,6 +139,8 @@ class InsertingBundles(RequestQueueState):
 
         self._check_new_edges("Up to date")
 
+        self._replay_journal(graph)
+
         self.parent.ctx.graph = graph
 
         # Edge CHKs required to do metadata salting.
@@ -136,6 +156,24 @@ class InsertingBundles(RequestQueueState):
             # Will be re-added when the required metadata arrives.
             self.new_edges.remove((edge[0], edge[1], 1))
 
+        self.unverified_edges = []
+        if self.parent.ctx.get(b'REINSERT', 0) > 0:
+            # Have the node compute the CHKs so that we fail before
+            # uploading anything if the bundles don't match.
+            self.unverified_edges = [edge for edge in self.new_edges
+                                     if graph.get_chk(edge) != PENDING_INSERT1]
+
+        # i.e. Everything was inserted before we were interrupted.
+        self._check_done()
+
+    def _target_versions(self):
+        """ INTERNAL: Return the target versions as 40 digit hex ids.
+
+            Symbolic names like 'tip' would make the journal key stay
+            the same when the changesets they name change. """
+        return [hex_version(self.parent.ctx.repo, version) for version
+                in (self.parent.ctx.get(b'TARGET_VERSIONS') or ())]
+
     # REDFLAG: no longer needed?
     def leave(self, dummy):
         """ Implementation of State virtual. """
@@ -147,11 +185,20 @@ class InsertingBundles(RequestQueueState):
         """ Implementation of State virtual. """
         self.new_edges = []
         self.required_edges = []
+        self.unverified_edges = []
         self.salting_cache = {}
         RequestQueueState.reset(self)
 
     def next_runnable(self):
         """ Implementation of RequestQueueState virtual. """
+        if len(self.unverified_edges) > 0:
+            edge = self.unverified_edges.pop()
+            request = self._make_insert_request(edge, (CHK_ONLY_TAG, edge))
+            if not request is None:
+                request.in_params.fcp_params[b'GetCHKOnly'] = True
+                self.parent.ctx.set_cancel_time(request, CHK_ONLY)
+            return request
+
         for edge in self.required_edges:
             if edge in self.pending:
                 # Already running.
@@ -174,15 +221,28 @@ class InsertingBundles(RequestQueueState):
             self.pending[edge] = request
             return request
 
-        if len(self.new_edges) == 0:
+        if len(self.new_edges) == 0 or self._verifying():
             return None
 
+        return self._make_insert_request(self.new_edges.pop(), None)
+
+    def _verifying(self):
+        """ INTERNAL: Return True if GetCHKOnly requests are running. """
+        for tag in self.pending:
+            if tag[0] == CHK_ONLY_TAG:
+                return True
+        return False
+
+    def _make_insert_request(self, edge, tag):
+        """ INTERNAL: Make a request to insert the bundle for an edge,
+            or return None on failure. """
+        if tag is None:
+            tag = edge
         request = None
         try:
-            edge = self.new_edges.pop()
-            request = self.parent.ctx.make_edge_insert_request(edge, edge,
+            request = self.parent.ctx.make_edge_insert_request(edge, tag,
                                                            self.salting_cache)
-            self.pending[edge] = request
+            self.pending[tag] = request
         except BundleException:
             if self.parent.ctx.get('REINSERT', 0) > 0:
                 self.parent.ctx.ui_.warn("Couldn't create an identical "
@@ -205,6 +265,9 @@ class InsertingBundles(RequestQueueState):
         assert client.tag in self.pending
         edge = client.tag
         del self.pending[edge]
+        if edge[0] == CHK_ONLY_TAG:
+            self._verify_chk(edge[1], msg)
+            return
         # print("request_done, msg:", msg)
         if msg[0] == b'AllData':
             self.salting_cache[client.tag] = msg[2]
@@ -218,21 +281,8 @@ class InsertingBundles(RequestQueueState):
                                            % str((edge[0], edge[1], 1)).encode("utf-8"))
                 self.new_edges.append((edge[0], edge[1], 1))
         elif msg[0] == b'PutSuccessful':
-            chk1 = msg[1][b'URI']
+            chk1 = self._fixup_chk(edge, msg[1][b'URI'])
             graph = self.parent.ctx.graph
-            if edge[2] == 1 and graph.insert_length(edge) > FREENET_BLOCK_LEN:
-                # HACK HACK HACK
-                # TRICKY:
-                # Scrape the control bytes from the full request
-                # to enable metadata handling.
-                # REDFLAG: Do better?
-                chk0 = graph.get_chk((edge[0], edge[1], 0))
-                chk0_fields = chk0.split(b',')
-                chk1_fields = chk1.split(b',')
-                #print "FIELDS: ", chk0_fields, chk1_fields
-                # Hmmm... also no file names.
-                assert len(chk0_fields) == len(chk1_fields)
-                chk1 = b','.join(chk1_fields[:-1] + chk0_fields[-1:])
             if self.parent.ctx.get(b'REINSERT', 0) < 1:
                 graph.set_chk(edge[:2], edge[2],
                               graph.get_length(edge),
@@ -244,14 +294,11 @@ class InsertingBundles(RequestQueueState):
                     graph.set_chk(edge[:2], edge[2],
                               graph.get_length(edge),
                               chk1)
-                if chk1 != graph.get_chk(edge):
-                    self.parent.ctx.ui_.status(b"Bad CHK: %s %b\n" %
-                                               (str(edge).encode("utf-8"), chk1))
-                    self.parent.ctx.ui_.warn(
-                        b"CHK for reinserted edge doesn't "
-                        + b"match!\nPossibly inserted with a different version of Mercurial.\n")
-                    self.parent.transition(FAILING)
+                if not self._check_chk(edge, chk1):
                     return
+            if not self.parent.ctx.insert_journal is None:
+                self.parent.ctx.insert_journal.record_edge(
+                    edge, graph.get_length(edge), chk1)
 
         else:
             # REDFLAG: retrying?
@@ -261,15 +308,84 @@ class InsertingBundles(RequestQueueState):
             self.parent.transition(FAILING)
             return
 
+        self._check_done()
+
+    def _fixup_chk(self, edge, chk1):
+        """ INTERNAL: Return the CHK to use in the graph for an edge
+            given the URI from the node. """
+        graph = self.parent.ctx.graph
+        if edge[2] == 1 and graph.insert_length(edge) > FREENET_BLOCK_LEN:
+            # HACK HACK HACK
+            # TRICKY:
+            # Scrape the control bytes from the full request
+            # to enable metadata handling.
+            # REDFLAG: Do better?
+            chk0 = graph.get_chk((edge[0], edge[1], 0))
+            chk0_fields = chk0.split(b',')
+            chk1_fields = chk1.split(b',')
+            #print "FIELDS: ", chk0_fields, chk1_fields
+            # Hmmm... also no file names.
+            assert len(chk0_fields) == len(chk1_fields)
+            chk1 = b','.join(chk1_fields[:-1] + chk0_fields[-1:])
+        return chk1
+
+    def _check_chk(self, edge, chk1):
+        """ INTERNAL: Fail if chk1 isn't the CHK in the graph for a
+            reinserted edge. """
+        if chk1 == self.parent.ctx.graph.get_chk(edge):
+            return True
+        self.parent.ctx.ui_.status(b"Bad CHK: %s %b\n" %
+                                   (str(edge).encode("utf-8"), chk1))
+        self.parent.ctx.ui_.warn(
+            b"CHK for reinserted edge doesn't "
+            + b"match!\nPossibly inserted with a different version of Mercurial.\n")
+        self.parent.transition(FAILING)
+        return False
+
+    def _verify_chk(self, edge, msg):
+        """ INTERNAL: Handle the result of a GetCHKOnly request. """
+        if msg[0] != b'PutSuccessful':
+            # Not worth failing over. The real insert will check it.
+            self.parent.ctx.ui_.status(b"Couldn't precompute CHK for: %b\n"
+                                       % str(edge).encode("utf-8"))
+            return
+        self._check_chk(edge, self._fixup_chk(edge, msg[1][b'URI']))
+
+    def _check_done(self):
+        """ INTERNAL: Start inserting the graph when all the bundles
+            are inserted. """
         if (len(self.pending) == 0 and
             len(self.new_edges) == 0 and
             len(self.required_edges) == 0):
             self.parent.transition(INSERTING_GRAPH)
 
+    def _replay_journal(self, graph):
+        """ INTERNAL: Remove edges which were inserted by an earlier,
+            interrupted run from the list of new edges. """
+        journal = self.parent.ctx.insert_journal
+        if journal is None:
+            return
+        reinserting = self.parent.ctx.get(b'REINSERT', 0) > 0
+        count = 0
+        for edge in self.new_edges[:]: # Deep copy!
+            chk = journal.get_edge_chk(edge, graph.get_length(edge))
+            if chk is None:
+                continue
+            if not reinserting or graph.get_chk(edge) == PENDING_INSERT1:
+                graph.set_chk(edge[:2], edge[2], graph.get_length(edge), chk)
+            elif chk != graph.get_chk(edge):
+                continue # Hmmmm... graph changed under us? Insert it again.
+            self.new_edges.remove(edge)
+            count += 1
+        if count > 0:
+            self.parent.ctx.ui_.status(b"Skipping %i edge(s) inserted "
+                                       % count
+                                       + b"before the interruption.\n")
+
     def _check_new_edges(self, msg):
         """ INTERNAL: Helper function to raise if new_edges is empty. """
         if len(self.new_edges) == 0:
-            self.parent.ctx['UP_TO_DATE'] = True
+            self.parent.ctx[b'UP_TO_DATE'] = True
             raise UpToDate(msg)
 
     def set_new_edges(self, graph):
@@ -0,0 +1,160 @@
+""" A journal of completed inserts which allows interrupted pushes
+    to be resumed.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# The journal is an append only text file with one b'<key> <value>'
+# line per completed insert. The first line identifies the graph the
+# inserts were started from. Entries are only trusted if the graph
+# matches, because edge indices are only meaningful relative to it.
+
+import os
+from hashlib import sha1
+
+from .fcpclient import is_usk, get_usk_for_usk_version
+
+JOURNAL_PREFIX = b'insert_journal_'
+GRAPH_KEY = b'graph'
+
+def journal_file_name(base_dir, repo_root, target_uri):
+    """ Return the journal file name for inserting from the repository
+        at repo_root to target_uri. """
+    if is_usk(target_uri):
+        # Same journal for all editions of a USK.
+        target_uri = get_usk_for_usk_version(target_uri, 0)
+    digest = sha1(repo_root + b'\0' + target_uri).hexdigest()[:16]
+    return os.path.join(base_dir, JOURNAL_PREFIX
+                        + digest.encode('utf8') + b'.log')
+
+def graph_key(graph_bytes, target_versions, level=0):
+    """ Return a key which identifies the starting point of an insert. """
+    digest = sha1(graph_bytes)
+    for version in target_versions:
+        digest.update(version)
+    digest.update(b'%i' % level)
+    return digest.hexdigest().encode('utf8')
+
+def data_key(prefix, raw_data):
+    """ INTERNAL: Return a journal key for inserting raw_data. """
+    return prefix + b':' + sha1(raw_data).hexdigest().encode('utf8')
+
+class InsertJournal:
+    """ A class to record completed edge, graph and top key inserts
+        on disk as they finish so that they can be skipped when
+        an interrupted insert is restarted. """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # key -> value for the current graph. None until bind() is called.
+        self.entries = None
+
+    def bind(self, key):
+        """ Load the entries recorded for the graph identified by key.
+
+            Entries recorded for any other graph are discarded.
+            Returns the number of loaded entries. """
+        self.entries = self.read_entries(key)
+        if self.entries is None:
+            self.entries = {}
+        # Rewrite so that a partial last line can't corrupt the next
+        # entry.
+        self.write_lines([(GRAPH_KEY, key)]
+                         + sorted(self.entries.items()), 'wb')
+        return len(self.entries)
+
+    def read_entries(self, key):
+        """ INTERNAL: Return the entries in the journal file if it was
+            written for key, None otherwise. """
+        if not os.path.exists(self.file_name):
+            return None
+        in_file = open(self.file_name, 'rb')
+        try:
+            lines = in_file.readlines()
+        finally:
+            in_file.close()
+
+        entries = {}
+        for index, line in enumerate(lines):
+            if not line.endswith(b'\n'):
+                break # Partially written when the process died.
+            fields = line.strip().split(b' ')
+            if len(fields) != 2:
+                break # Corrupt. Keep what we have.
+            if index == 0:
+                if fields != [GRAPH_KEY, key]:
+                    return None
+                continue
+            entries[fields[0]] = fields[1]
+        if len(lines) == 0:
+            return None
+        return entries
+
+    def write_lines(self, lines, mode='ab'):
+        """ INTERNAL: Write (key, value) lines, making sure they hit
+            the disk before returning. """
+        out_file = open(self.file_name, mode)
+        try:
+            for key, value in lines:
+                assert not b' ' in key and not b' ' in value
+                assert not b'\n' in key and not b'\n' in value
+                out_file.write(b'%b %b\n' % (key, value))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        finally:
+            out_file.close()
+
+    def lookup(self, key):
+        """ INTERNAL: Return the recorded value for key or None. """
+        if self.entries is None:
+            return None
+        return self.entries.get(key)
+
+    def record(self, key, value):
+        """ INTERNAL: Record a value for key. """
+        if self.entries is None:
+            return # Not bound.
+        if self.entries.get(key) == value:
+            return
+        self.entries[key] = value
+        self.write_lines([(key, value), ])
+
+    def get_edge_chk(self, edge, length):
+        """ Return the recorded CHK for an edge, or None. """
+        return self.lookup(b'edge:%i:%i:%i:%i' % (edge[0], edge[1], edge[2],
+                                                  length))
+
+    def record_edge(self, edge, length, chk):
+        """ Record the CHK of an inserted edge. """
+        self.record(b'edge:%i:%i:%i:%i' % (edge[0], edge[1], edge[2], length),
+                    chk)
+
+    def get_data_uri(self, prefix, raw_data):
+        """ Return the recorded URI for a graph or top key insert of
+            raw_data, or None. """
+        return self.lookup(data_key(prefix, raw_data))
+
+    def record_data(self, prefix, raw_data, uri):
+        """ Record the URI of a graph or top key insert of raw_data. """
+        self.record(data_key(prefix, raw_data), uri)
+
+    def remove(self):
+        """ Delete the journal file. Called after the insert finished. """
+        self.entries = None
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
@@ -0,0 +1,227 @@
+""" Classes to set request timeouts and retry delays from observed
+    request latency.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+import json
+import os
+import random
+
+from .fcpconnection import is_fatal_error
+from .fcpmessage import is_chk_only
+
+# Request classes.
+TOP_KEY = 'TOP_KEY'
+GRAPH = 'GRAPH'
+BUNDLE = 'BUNDLE' # Fits in a single block.
+SPLITFILE = 'SPLITFILE'
+INSERT = 'INSERT'
+CHK_ONLY = 'CHK_ONLY' # Encoded locally by the node. No network traffic.
+
+# Same as graph.FREENET_BLOCK_LEN.
+BLOCK_LEN = 32 * 1024
+
+LATENCY_FILE_NAME = 'latency_model.json'
+
+# Weight of the newest sample in the moving averages.
+EWMA_ALPHA = 0.125
+# Use the fixed timeout until there are at least this many samples.
+MIN_LATENCY_SAMPLES = 8
+MAX_LATENCY_SAMPLES = 128
+# Time out requests that take this much longer than almost all
+# previous requests of the same class.
+TIMEOUT_PERCENTILE = 0.95
+TIMEOUT_FACTOR = 3.0
+MIN_TIMEOUT_SECS = 60.0
+
+MIN_RETRY_DELAY_SECS = 1.0
+MAX_RETRY_DELAY_SECS = 5 * 60.0
+
+def request_class(request, length=None):
+    """ Guess the request class of a QueueableRequest which hasn't
+        been started yet. """
+    definition = request.in_params.definition
+    params = request.in_params.fcp_params
+    if not definition is None and definition[0] != b'ClientGet':
+        if is_chk_only(params):
+            return CHK_ONLY
+        return INSERT
+    uri = params.get(b'URI', params.get('URI', b''))
+    if isinstance(uri, str):
+        uri = uri.encode('utf8')
+    if not uri.startswith(b'CHK@'):
+        return TOP_KEY
+    if not length is None and length > BLOCK_LEN:
+        return SPLITFILE
+    return BUNDLE
+
+def block_count(length):
+    """ INTERNAL: Return the number of blocks needed for length bytes. """
+    if length is None:
+        return 1
+    return max(1, (length + BLOCK_LEN - 1) // BLOCK_LEN)
+
+class RequestStats:
+    """ Latency statistics for a single request class.
+
+        Latencies for multiple block requests are kept per block. """
+    def __init__(self):
+        self.average = None
+        self.deviation = 0.0
+        self.samples = []
+        self.successes = 0
+        self.failures = 0
+
+    def record(self, secs):
+        """ Record the latency of a successful request. """
+        self.successes += 1
+        if self.average is None:
+            self.average = secs
+            self.deviation = secs / 2.0
+        else:
+            error = secs - self.average
+            self.average += EWMA_ALPHA * error
+            self.deviation += EWMA_ALPHA * (abs(error) - self.deviation)
+        self.samples.append(secs)
+        if len(self.samples) > MAX_LATENCY_SAMPLES:
+            self.samples = self.samples[-MAX_LATENCY_SAMPLES:]
+
+    def percentile(self, fraction):
+        """ Return the latency below which fraction of the samples
+            fall, or None if there aren't enough samples. """
+        if len(self.samples) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def to_dict(self):
+        """ INTERNAL: Return a dict for the JSON file. """
+        return {'average':self.average, 'deviation':self.deviation,
+                'samples':self.samples, 'successes':self.successes,
+                'failures':self.failures}
+
+    @classmethod
+    def from_dict(cls, values):
+        """ INTERNAL: Make an instance from to_dict() output. """
+        ret = RequestStats()
+        ret.average = values.get('average')
+        ret.deviation = float(values.get('deviation', 0.0))
+        ret.samples = [float(value) for value in
+                       values.get('samples', [])][-MAX_LATENCY_SAMPLES:]
+        ret.successes = int(values.get('successes', 0))
+        ret.failures = int(values.get('failures', 0))
+        return ret
+
+class LatencyModel:
+    """ Latency statistics for each request class, used to set
+        request timeouts and retry delays. """
+    def __init__(self, file_name=None):
+        # Where save() writes to.
+        self.file_name = file_name
+        # request class -> RequestStats
+        self.stats = {}
+        self.random = random.Random()
+
+    def get_stats(self, request_class):
+        """ Return the RequestStats for a request class. """
+        stats = self.stats.get(request_class)
+        if stats is None:
+            stats = RequestStats()
+            self.stats[request_class] = stats
+        return stats
+
+    def record(self, request_class, secs, succeeded, length=None):
+        """ Record the outcome of a finished request. """
+        stats = self.get_stats(request_class)
+        if not succeeded:
+            stats.failures += 1
+            return
+        stats.record(secs / block_count(length))
+
+    def timeout_secs(self, request_class, default_secs, max_secs,
+                     length=None):
+        """ Return how long to let a request run before giving up on it.
+
+            Returns default_secs until there are enough samples. """
+        stats = self.get_stats(request_class)
+        slow = stats.percentile(TIMEOUT_PERCENTILE)
+        if slow is None:
+            return default_secs
+        # Hmmmm... deviation can be big right after a long stall.
+        slow = max(slow, stats.average + 4 * stats.deviation)
+        return min(max(MIN_TIMEOUT_SECS,
+                       TIMEOUT_FACTOR * slow * block_count(length)),
+                   max_secs)
+
+    def retry_delay_secs(self, request_class, tries):
+        """ Return how long to wait before the next try of a request
+            which has failed tries times.
+
+            Exponential backoff from a fraction of the median latency,
+            with +/- 50% jitter so that retries don't all line up. """
+        base = self.get_stats(request_class).percentile(0.5)
+        if base is None:
+            base = 2 * MIN_RETRY_DELAY_SECS
+        base = max(MIN_RETRY_DELAY_SECS, base / 4.0)
+        delay = min(MAX_RETRY_DELAY_SECS,
+                    base * (2 ** max(0, min(tries - 1, 16))))
+        return delay * self.random.uniform(0.5, 1.5)
+
+    def save(self):
+        """ Write the model to file_name, if it's set. """
+        if self.file_name is None:
+            return
+        values = dict([(name, stats.to_dict()) for name, stats
+                       in list(self.stats.items())])
+        tmp_name = self.file_name + '.tmp'
+        out_file = open(tmp_name, 'w')
+        try:
+            json.dump(values, out_file, indent=1, sort_keys=True)
+        finally:
+            out_file.close()
+        os.rename(tmp_name, self.file_name)
+
+    @classmethod
+    def from_file(cls, file_name):
+        """ Read a model saved with save().
+
+            Returns an empty model if the file is missing or bad. """
+        ret = LatencyModel(file_name)
+        if not os.path.exists(file_name):
+            return ret
+        try:
+            in_file = open(file_name, 'r')
+            try:
+                values = json.load(in_file)
+            finally:
+                in_file.close()
+            for name in values:
+                ret.stats[name] = RequestStats.from_dict(values[name])
+        except (IOError, ValueError, TypeError, AttributeError):
+            # Just start over.
+            ret.stats = {}
+        return ret
+
+def should_retry(msg, tries, max_retries):
+    """ Return True if a failed request which has been tried tries
+        times is worth retrying. """
+    if tries > max_retries:
+        return False
+    return not is_fatal_error(msg)
@@ -36,6 +36,7 @@ from .choose import get_update_edges, dump_update_edges, SaltingState
 from .statemachine import RetryingRequestList, CandidateRequest
 
 from .chk import clear_control_bytes
+from .latencymodel import GRAPH, BUNDLE, SPLITFILE, should_retry
 
 def fixup(edges, candidate_list):
     """ INTERNAL : Helper used by _set_graph to fix up CHKs->edges. """
@@ -133,7 +134,8 @@ class RequestingBundles(RetryingRequestList):
         request.in_params.fcp_params['RealTimeFlag'] = True
         request.in_params.file_name = (
             make_temp_file(self.parent.ctx.bundle_cache.base_dir))
-        self.parent.ctx.set_cancel_time(request)
+        self.parent.ctx.set_cancel_time(request,
+                                        *self._request_class(candidate))
 
         # Set tag
         if not candidate[3] is None:
@@ -426,6 +428,22 @@ class RequestingBundles(RetryingRequestList):
         self.parent.ctx.ui_.status(b"Got graph. Latest graph index: %i\n" %
                                    graph.latest_index)
 
+    def _request_class(self, candidate):
+        """ INTERNAL: Return the (request class, expected length) of the
+            request for a candidate. See latencymodel. """
+        if candidate[6]:
+            return (GRAPH, None)
+        if candidate[2]:
+            return (BUNDLE, None) # Only the first block.
+        graph = self.parent.ctx.graph
+        if not graph is None and not candidate[3] is None:
+            length = graph.insert_length(candidate[3])
+        else:
+            length = candidate[4][0]
+        if self._multiple_block(candidate):
+            return (SPLITFILE, length)
+        return (BUNDLE, length)
+
     def _handle_graph_failure(self, candidate):
         """ INTERNAL: Handle failed FCP requests for the graph. """
         assert candidate[6]
@@ -435,6 +453,9 @@ class RequestingBundles(RetryingRequestList):
             #return False
             # Append retries immediately. Hmmmm...
             self.current_candidates.append(candidate)
+            self.delay_candidate(candidate,
+                                 self.parent.ctx.retry_delay_secs(
+                                     GRAPH, candidate[1]))
             return
 
         self.finished_candidates.append(candidate)
@@ -637,15 +658,23 @@ class RequestingBundles(RetryingRequestList):
         #print "_reevaluate -- exited"
 
     # REDFLAG: move
-    def _should_retry(self, candidate):
+    def _should_retry(self, candidate, msg=None):
         """ Return True if the FCP request for the candidate should
-            be retried, False otherwise. """
+            be retried, False otherwise.
+
+            Sets a backoff delay on the candidate as a side effect. """
         max_retries = self.parent.params.get('MAX_RETRIES', 0)
         if candidate[1] - 1 >= max_retries:
             #print "_should_retry -- returned False"
             return False
+        if not msg is None and not should_retry(msg, 0, max_retries):
+            return False # Fatal error.
         if not self._needs_bundle(candidate) and not candidate[6]:
             return False
+        self.delay_candidate(candidate,
+                             self.parent.ctx.retry_delay_secs(
+                                 self._request_class(candidate)[0],
+                                 candidate[1]))
         return True
 
     def _queued_redundant_edge(self, candidate):
@@ -684,7 +713,7 @@ class RequestingBundles(RetryingRequestList):
             self.finished_candidates.append(candidate)
             return
         #print "_handle_failure -- ", candidate
-        if self._should_retry(candidate):
+        if self._should_retry(candidate, msg):
             #print "_handle_failure -- retrying..."
             # Order important.  Allow should_retry to see previous msg.
             candidate[5] = msg
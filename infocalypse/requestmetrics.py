@@ -0,0 +1,271 @@
+""" Classes to collect per request metrics from a RequestRunner and
+    write them to a file.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# Times are in seconds.
+#
+# queue_wait  -- from the creation of the request to sending it to the node.
+#                i.e. time lost in our scheduler.
+# first_msg   -- from sending the request to the first message back from
+#                the node.
+# latency     -- from sending the request to the terminal message.
+# state       -- time spent in each state machine state. Time in states
+#                which don't make requests is mostly hg.
+
+import json
+import os
+import time
+
+METRICS_FILE_NAME = 'request_metrics.json'
+
+# Write the file at most this often.
+METRICS_WRITE_SECS = 60
+
+# Upper bounds of the histogram buckets.
+SECS_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+                600.0, 1800.0, 3600.0)
+
+HISTOGRAMS = ('queue_wait', 'first_msg', 'latency')
+
+# Counter values which can go down.
+GAUGES = ('running_requests', )
+
+def key_type(uri):
+    """ Return the key type of a URI, e.g. b'CHK', or b'NONE'. """
+    if isinstance(uri, str):
+        uri = uri.encode('utf8')
+    if not uri or uri.find(b'@') == -1:
+        return b'NONE'
+    return uri.split(b'@')[0].upper()
+
+def outcome(msg):
+    """ Return the outcome label for the terminal message of a request.
+
+        e.g. b'AllData', b'GetFailed:28'. """
+    code = msg[1].get(b'Code')
+    if code is None:
+        return msg[0]
+    return msg[0] + b':' + code
+
+def as_text(value):
+    """ INTERNAL: Return a label value as a str. """
+    if isinstance(value, bytes):
+        return value.decode('utf8', 'replace')
+    return str(value)
+
+class Histogram:
+    """ A cumulative histogram with fixed buckets, like Prometheus uses. """
+    def __init__(self, bounds=SECS_BUCKETS):
+        self.bounds = bounds
+        # The last entry is for values larger than all the bounds.
+        self.counts = [0, ] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Add a value to the histogram. """
+        self.total += value
+        self.count += 1
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    def cumulative(self):
+        """ Return a list of (upper bound string, count <= bound) tuples. """
+        ret = []
+        running = 0
+        for index, bound in enumerate(self.bounds):
+            running += self.counts[index]
+            ret.append((repr(bound), running))
+        ret.append(('+Inf', self.count))
+        return ret
+
+    def to_dict(self):
+        """ Return a dict for the JSON file. """
+        return {'buckets':dict(self.cumulative()), 'sum':self.total,
+                'count':self.count}
+
+class RequestStats:
+    """ Aggregated metrics for requests with the same labels. """
+    def __init__(self):
+        self.histograms = dict([(name, Histogram()) for name in HISTOGRAMS])
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+        # outcome -> count
+        self.outcomes = {}
+
+    def to_dict(self):
+        """ Return a dict for the JSON file. """
+        ret = dict([(name, histogram.to_dict()) for name, histogram
+                    in self.histograms.items()])
+        ret.update({'bytes_in':self.bytes_in, 'bytes_out':self.bytes_out,
+                    'retries':self.retries,
+                    'outcomes':dict([(as_text(name), count) for name, count
+                                     in self.outcomes.items()])})
+        return ret
+
+class RequestMetrics:
+    """ Collects request metrics and periodically writes them to
+        a JSON file, or a Prometheus text file if the file name
+        ends in '.prom'. """
+    def __init__(self, file_name=None, write_secs=METRICS_WRITE_SECS):
+        self.file_name = file_name
+        self.write_secs = write_secs
+        self.next_write = time.time() + write_secs
+        self.started = time.time()
+        # (state name, key type) -> RequestStats
+        self.requests = {}
+        # state name -> Histogram
+        self.states = {}
+        # queue -> (current state name, time it was entered)
+        self.current_states = {}
+        # name -> value, set from the RequestRunner and FCPConnection.
+        self.counters = {}
+
+    def record_request(self, state_name, uri_key_type, values):
+        """ Record the metrics for a finished request.
+
+            values is a dict with the HISTOGRAMS names, 'bytes_in',
+            'bytes_out', 'retries' and 'outcome' as keys. Missing
+            times aren't recorded. """
+        labels = (state_name, uri_key_type)
+        stats = self.requests.get(labels)
+        if stats is None:
+            stats = RequestStats()
+            self.requests[labels] = stats
+        for name in HISTOGRAMS:
+            if not values.get(name) is None:
+                stats.histograms[name].observe(values[name])
+        stats.bytes_in += values.get('bytes_in', 0)
+        stats.bytes_out += values.get('bytes_out', 0)
+        stats.retries += values.get('retries', 0)
+        name = values.get('outcome', b'unknown')
+        stats.outcomes[name] = stats.outcomes.get(name, 0) + 1
+
+    def state_changed(self, from_name, to_name, queue=None):
+        """ Record the time spent in the state from_name.
+
+            queue is the state machine that changed state. Each one
+            is timed separately, so several can share the metrics.
+            Nothing is recorded for a queue's first change, since
+            it's unknown when it entered from_name. """
+        now = time.time()
+        current = self.current_states.get(queue)
+        self.current_states[queue] = (to_name, now)
+        if current is None or current[0] != from_name:
+            return
+        histogram = self.states.get(from_name)
+        if histogram is None:
+            histogram = Histogram()
+            self.states[from_name] = histogram
+        histogram.observe(now - current[1])
+
+    def set_counter(self, name, value):
+        """ Set the value of a running total, e.g. bytes sent. """
+        self.counters[name] = value
+
+    def to_dict(self):
+        """ Return all the metrics as a dict. """
+        return {'time':time.time(),
+                'uptime':time.time() - self.started,
+                'counters':self.counters.copy(),
+                'states':dict([(as_text(name), histogram.to_dict())
+                               for name, histogram in self.states.items()]),
+                'requests':[dict(list(stats.to_dict().items())
+                                 + [('state', as_text(labels[0])),
+                                    ('key_type', as_text(labels[1]))])
+                            for labels, stats in self.requests.items()]}
+
+    def to_prometheus(self):
+        """ Return all the metrics in the Prometheus text format. """
+        lines = []
+        def histogram_lines(name, labels, histogram):
+            """ INTERNAL: Add the lines for a histogram. """
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{%sle="%s"} %i'
+                             % (name, labels, bound, count))
+            lines.append('%s_sum{%s} %f' % (name, labels.rstrip(','),
+                                            histogram.total))
+            lines.append('%s_count{%s} %i' % (name, labels.rstrip(','),
+                                              histogram.count))
+
+        for name in sorted(self.counters):
+            lines.append('# TYPE infocalypse_%s %s'
+                         % (name, ('gauge' if name in GAUGES else 'counter')))
+            lines.append('infocalypse_%s %s' % (name, self.counters[name]))
+
+        lines.append('# TYPE infocalypse_state_seconds histogram')
+        for name, histogram in sorted(self.states.items()):
+            histogram_lines('infocalypse_state_seconds',
+                            'state="%s",' % as_text(name), histogram)
+
+        for name in HISTOGRAMS:
+            metric = 'infocalypse_request_%s_seconds' % name
+            lines.append('# TYPE %s histogram' % metric)
+            for labels, stats in sorted(self.requests.items()):
+                histogram_lines(metric, 'state="%s",key_type="%s",'
+                                % (as_text(labels[0]), as_text(labels[1])),
+                                stats.histograms[name])
+
+        for name in ('bytes_in', 'bytes_out', 'retries'):
+            lines.append('# TYPE infocalypse_request_%s counter' % name)
+            for labels, stats in sorted(self.requests.items()):
+                lines.append('infocalypse_request_%s{state="%s",'
+                             'key_type="%s"} %i'
+                             % (name, as_text(labels[0]),
+                                as_text(labels[1]), getattr(stats, name)))
+
+        lines.append('# TYPE infocalypse_requests counter')
+        for labels, stats in sorted(self.requests.items()):
+            for result, count in sorted(stats.outcomes.items()):
+                lines.append('infocalypse_requests{state="%s",key_type="%s",'
+                             'outcome="%s"} %i'
+                             % (as_text(labels[0]), as_text(labels[1]),
+                                as_text(result), count))
+        return '\n'.join(lines) + '\n'
+
+    def maybe_write(self):
+        """ Write the file if write_secs have passed since the last
+            write. Call this often. """
+        if time.time() < self.next_write:
+            return
+        self.write()
+
+    def write(self):
+        """ Write the metrics to file_name, if it's set. """
+        self.next_write = time.time() + self.write_secs
+        if self.file_name is None:
+            return
+        if self.file_name.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=1, sort_keys=True)
+        # Readers never see a partial file.
+        tmp_name = self.file_name + '.tmp'
+        out_file = open(tmp_name, 'w')
+        try:
+            out_file.write(text)
+        finally:
+            out_file.close()
+        os.rename(tmp_name, self.file_name)
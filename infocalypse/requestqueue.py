@@ -21,9 +21,21 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
+import os
+import shutil
 import time
 
-from .fcpconnection import MinimalClient
+from .fcpconnection import MinimalClient, make_id, is_code, SUCCESS_MSGS
+from .requestmetrics import key_type, outcome
+
+# Finished GET results are reused for this long.
+RESULT_CACHE_SECS = 30
+# Don't keep results larger than this around.
+MAX_CACHED_RESULT_BYTES = 1024 * 1024
+MAX_RESULT_CACHE_BYTES = 16 * 1024 * 1024
+
+# FetchException code the node uses for removed requests.
+CANCELLED_CODE = 25
 
 class QueueableRequest(MinimalClient):
     """ A request which can be queued in a RequestQueue and run
@@ -36,9 +48,51 @@ class QueueableRequest(MinimalClient):
         # The time after which this request should be canceled.
         self.cancel_time_secs = None # RequestQueue.next_request() MUST set this
         self.custom_data_source = None
+        # Used to record latency. See latencymodel.request_class().
+        self.request_class = None
+        self.expected_length = None
+        # Used to measure time spent waiting to run.
+        self.created_time = time.time()
+
+def get_param(client, name):
+    """ INTERNAL: Return the value of an FCP param for a client
+        that hasn't been started, or None. """
+    for params in (client.in_params.fcp_params,
+                   client.in_params.default_fcp_params):
+        for key in (name, name.decode('utf8')):
+            if key in params:
+                value = params[key]
+                if isinstance(value, str):
+                    value = value.encode('utf8')
+                return value
+    return None
+
+def coalescing_key(client):
+    """ Return a key identifying the data a ClientGet request
+        returns, or None if the request can't share its result.
+
+        Only CHKs and SSKs are shared. USK requests can redirect
+        to different editions. """
+    if (client.in_params.definition is None
+        or client.in_params.definition[0] != b'ClientGet'
+        or client.in_params.send_data
+        or getattr(client, 'custom_data_source', None)):
+        return None
+    uri = get_param(client, b'URI')
+    if uri is None:
+        return None
+    if uri.startswith(b'freenet:'):
+        uri = uri[len(b'freenet:'):]
+    if not uri.startswith(b'CHK@') and not uri.startswith(b'SSK@'):
+        return None
+    return (uri.rstrip(b'/'), get_param(client, b'ReturnType'),
+            get_param(client, b'MaxSize'))
 
 class RequestRunner:
-    """ Class to run requests scheduled on one or more RequestQueues. """
+    """ Class to run requests scheduled on one or more RequestQueues.
+
+        ClientGet requests for the same CHK or SSK share a single
+        FCP request. See coalescing_key(). """
     def __init__(self, connection, concurrent):
         self.connection = connection
         self.concurrent = concurrent
@@ -47,6 +101,35 @@ class RequestRunner:
         self.request_queues = []
         self.index = 0
 
+        # Set False to send every request to the node.
+        self.coalescing = True
+        # Number of requests which didn't need their own FCP request.
+        self.coalesced = 0
+        # coalescing key -> running client
+        self.in_flight = {}
+        # request id -> coalescing key, for running clients
+        self.leader_keys = {}
+        # coalescing key -> [client, ...] waiting on the running client
+        self.waiting = {}
+        # (client, msg) tuples, delivered on the next kick()
+        self.finished = []
+        # Waiting clients which have to be started after all.
+        self.restart = []
+        # coalescing key -> (expire time, msg, data)
+        self.results = {}
+
+        # Optional latencymodel.LatencyModel to record latencies in.
+        self.latency_model = None
+        # request id -> time the request was sent to the node
+        self.start_times = {}
+
+        # Optional requestmetrics.RequestMetrics to record requests in.
+        self.metrics = None
+        # request id -> (state name, key type, queue wait secs)
+        self.request_labels = {}
+        # request id -> time of the first message from the node
+        self.first_msg_times = {}
+
     def add_queue(self, request_queue):
         """ Add a queue to the scheduler. """
         if not request_queue in self.request_queues:
@@ -66,6 +149,12 @@ class RequestRunner:
         if type(client) == type(1):
             raise Exception("Hack added to find bug: REDFLAG")
 
+        if self.cancel_waiting(client):
+            return
+        for entry in self.finished:
+            if entry[0] is client:
+                return # Will be delivered on the next kick().
+
         self.connection.remove_request(client.request_id())
         # REDFLAG: BUG: fix to set cancel time in the past.
         #               fix kick to check cancel time before starting?
@@ -75,6 +164,8 @@ class RequestRunner:
             You MUST call this frequently.
         """
 
+        self.deliver_finished()
+
         if self.connection.is_uploading():
             # REDFLAG: Test this code path!
             #print "kick -- bailed out, still UPLOADING..."
@@ -87,6 +178,14 @@ class RequestRunner:
             assert client.cancel_time_secs
             if client.cancel_time_secs < now:
                 self.connection.remove_request(client.request_id())
+        for clients in list(self.waiting.values()):
+            for client in clients[:]:
+                if client.cancel_time_secs < now:
+                    self.cancel_waiting(client)
+
+        while (self.restart and len(self.running) < self.concurrent
+               and not self.connection.is_uploading()):
+            self.start_request(self.restart.pop(0))
 
         # REDFLAG: test this code with multiple queues!!!
         # Round robin schedule requests from queues
@@ -110,19 +209,187 @@ class RequestRunner:
 #                 if 'URI' in client.in_params.fcp_params:
 #                     print ("   ", client.in_params.fcp_params['URI'])
                 assert client.queue == self.request_queues[self.index]
-                client.in_params._async = True
-                client.message_callback = self.msg_callback
-                request_id = self.connection.start_request(
-                    client, client.custom_data_source)
-                # print(request_id)
-                self.running[request_id] = client
+                self.start_request(client)
             else:
                 idle_queues += 1
             self.index = (self.index + 1) % len(self.request_queues)
 
+        self.deliver_finished()
+
+        if not self.metrics is None:
+            self.update_counters()
+            self.metrics.maybe_write()
+
+    def update_counters(self):
+        """ Copy running totals into the metrics. """
+        self.metrics.set_counter('running_requests', len(self.running))
+        self.metrics.set_counter('coalesced_requests', self.coalesced)
+        self.metrics.set_counter('fcp_bytes_sent',
+                                 getattr(self.connection, 'bytes_sent', 0))
+        self.metrics.set_counter('fcp_bytes_received',
+                                 getattr(self.connection, 'bytes_received', 0))
+
+    def start_request(self, client):
+        """ INTERNAL: Start a request, or attach it to a running
+            request for the same data. """
+        client.in_params._async = True
+        client.message_callback = self.msg_callback
+        key = None
+        if self.coalescing:
+            key = coalescing_key(client)
+        if not key is None:
+            if self.cached_result(client, key):
+                self.coalesced += 1
+                return
+            if key in self.in_flight:
+                self.waiting[key].append(client)
+                self.coalesced += 1
+                return
+
+        request_id = self.connection.start_request(
+            client, client.custom_data_source)
+        # print(request_id)
+        self.running[request_id] = client
+        self.start_times[request_id] = time.time()
+        if not self.metrics is None:
+            state = getattr(client.queue, 'current_state', None)
+            self.request_labels[request_id] = (
+                getattr(state, 'name', b'NONE'),
+                key_type(client.in_params.fcp_params.get(b'URI')),
+                self.start_times[request_id] - client.created_time)
+        if not key is None:
+            self.in_flight[key] = client
+            self.leader_keys[request_id] = key
+            self.waiting[key] = []
+
+    def cancel_waiting(self, client):
+        """ INTERNAL: Cancel a client waiting on another request.
+
+            Returns False if the client isn't waiting. """
+        for clients in self.waiting.values():
+            if client in clients:
+                clients.remove(client)
+                self.finished.append((client, make_failure(CANCELLED_CODE,
+                                                           b'Cancelled')))
+                return True
+        if client in self.restart:
+            self.restart.remove(client)
+            self.finished.append((client, make_failure(CANCELLED_CODE,
+                                                       b'Cancelled')))
+            return True
+        return False
+
+    def deliver_finished(self):
+        """ INTERNAL: Deliver results to clients which didn't have
+            their own FCP request. """
+        while self.finished:
+            client, msg = self.finished.pop(0)
+            client.response = msg
+            client.queue.request_done(client, msg)
+
+    def cached_result(self, client, key):
+        """ INTERNAL: Queue a recent result for key for the client.
+
+            Returns False if there is no recent result. """
+        now = time.time()
+        for old_key in list(self.results.keys()):
+            if self.results[old_key][0] < now:
+                del self.results[old_key]
+        if not key in self.results:
+            return False
+        dummy, msg, data = self.results[key]
+        self.finished.append((client, share_result(client, msg, None, data)))
+        return True
+
+    def cache_result(self, key, msg, data):
+        """ INTERNAL: Keep a successful result around for a while. """
+        if data is None or len(data) > MAX_CACHED_RESULT_BYTES:
+            return
+        self.results[key] = (time.time() + RESULT_CACHE_SECS,
+                             (msg[0], msg[1].copy()), data)
+        total = sum([len(entry[2]) for entry in self.results.values()])
+        for old_key in sorted(self.results, key=lambda k: self.results[k][0]):
+            if total <= MAX_RESULT_CACHE_BYTES:
+                break
+            total -= len(self.results[old_key][2])
+            del self.results[old_key]
+
+    def leader_done(self, client, msg, key):
+        """ INTERNAL: Share the result of a finished request with the
+            clients waiting on it.
+
+            MUST be called before the client's queue sees the result,
+            since it may move or delete the data file. """
+        del self.leader_keys[client.request_id()]
+        del self.in_flight[key]
+        waiting = self.waiting.pop(key)
+        if msg[0] == b'GetFailed' and is_code(msg, CANCELLED_CODE):
+            # Only the request that was cancelled gives up.
+            self.restart += waiting
+            return
+
+        file_name = None
+        data = None
+        if msg[0] == b'AllData':
+            if len(msg) > 2 and isinstance(msg[2], bytes):
+                data = msg[2]
+            elif not client.in_params.file_name is None:
+                file_name = client.in_params.file_name
+                if os.path.getsize(file_name) <= MAX_CACHED_RESULT_BYTES:
+                    data = read_file(file_name)
+            self.cache_result(key, msg, data)
+
+        for other in waiting:
+            self.finished.append((other, share_result(other, msg,
+                                                      file_name, data)))
+
+    def record_latency(self, client, msg):
+        """ INTERNAL: Record how long a finished request took. """
+        started = self.start_times.pop(client.request_id(), None)
+        if (self.latency_model is None or started is None
+            or getattr(client, 'request_class', None) is None):
+            return
+        self.latency_model.record(client.request_class,
+                                  time.time() - started,
+                                  msg[0] in SUCCESS_MSGS,
+                                  client.expected_length)
+
+    def record_metrics(self, client, msg):
+        """ INTERNAL: Record metrics for a finished request. """
+        request_id = client.request_id()
+        first_msg = self.first_msg_times.pop(request_id, None)
+        labels = self.request_labels.pop(request_id, None)
+        started = self.start_times.get(request_id)
+        if self.metrics is None or labels is None or started is None:
+            return
+        if not first_msg is None:
+            first_msg -= started
+        retries = 0
+        candidate = getattr(client, 'candidate', None)
+        if isinstance(candidate, list) and isinstance(candidate[1], int):
+            retries = max(0, candidate[1] - 1)
+        self.metrics.record_request(
+            labels[0], labels[1],
+            {'queue_wait':labels[2],
+             'first_msg':first_msg,
+             'latency':time.time() - started,
+             'bytes_in':int(msg[1].get(b'DataLength', 0)),
+             'bytes_out':int(client.in_params.fcp_params.get(b'DataLength',
+                                                             0)),
+             'retries':retries,
+             'outcome':outcome(msg)})
+
     def msg_callback(self, client, msg):
         """ Route incoming FCP messages to the appropriate queues. """
+        key = self.leader_keys.get(client.request_id())
+        if (not self.metrics is None
+            and not client.request_id() in self.first_msg_times):
+            self.first_msg_times[client.request_id()] = time.time()
         if client.is_finished():
+            self.record_metrics(client, msg)
+            self.record_latency(client, msg)
+            if not key is None:
+                self.leader_done(client, msg, key)
             client.queue.request_done(client, msg)
             #print "RUNNING:"
             #print self.running
@@ -134,6 +401,52 @@ class RequestRunner:
             self.kick() # haha
         else:
             client.queue.request_progress(client, msg)
+            if not key is None:
+                for other in self.waiting[key]:
+                    other.queue.request_progress(other, msg)
+
+def read_file(file_name):
+    """ INTERNAL: Return the contents of a file. """
+    in_file = open(file_name, 'rb')
+    try:
+        return in_file.read()
+    finally:
+        in_file.close()
+
+def make_failure(code, description):
+    """ INTERNAL: Make a GetFailed message for a request which never
+        reached the node. """
+    return (b'GetFailed', {b'Identifier':make_id(), b'Code':b'%i' % code,
+                           b'CodeDescription':description,
+                           b'ShortCodeDescription':description,
+                           b'Fatal':b'true'})
+
+def share_result(client, msg, file_name, data):
+    """ INTERNAL: Return a copy of the terminal message msg for another
+        client requesting the same data.
+
+        The data is copied from file_name if it isn't None, or from data
+        otherwise. """
+    fields = msg[1].copy()
+    fields[b'Identifier'] = make_id()
+    if msg[0] != b'AllData':
+        return (msg[0], fields)
+
+    if client.in_params.file_name is None:
+        if data is None:
+            data = read_file(file_name)
+        return (msg[0], fields, data)
+
+    if not file_name is None:
+        shutil.copyfile(file_name, client.in_params.file_name)
+    else:
+        out_file = open(client.in_params.file_name, 'wb')
+        try:
+            out_file.write(data)
+        finally:
+            out_file.close()
+    return (msg[0], fields,
+            "Wrote raw data to: %s" % client.in_params.file_name)
 
 
 class RequestQueue:
@@ -31,6 +31,7 @@ from configparser import ConfigParser
 from .fcpclient import FCPClient, get_usk_hash
 from .fcpconnection import FCPConnection, PolledSocket
 from .requestqueue import RequestRunner
+from .requestmetrics import RequestMetrics
 from .bundlecache import is_writable
 
 from .fmsstub import FMSStub
@@ -188,6 +189,9 @@ def get_params(base_dir):
         'FCP_POLL_SECS':0.25,
         'N_CONCURRENT':4,
         'CANCEL_TIME_SECS': 15 * 60,
+        # Use a '.prom' extension for Prometheus text format.
+        'METRICS_FILE':os.path.join(base_dir, 'request_metrics.json'),
+        'METRICS_WRITE_SECS':60,
 
         # FMSBotRunner
         'FMS_HOST':FMS_HOST,
@@ -210,6 +214,7 @@ def get_params(base_dir):
         'SITE_COALESCE_SECS':60, # Time to wait before inserting.
         'NOTIFY_COALESCE_SECS':60, # Time 2w8b4 sending fms repo update msg
         'COMMIT_COALESCE_SECS':-1, # Hack to force immediate commit
+        'APPLY_COALESCE_SECS':30, # Max wait for a batch of submissions
         'FMS_TRUST_CACHE_SECS': 1 * 60 * 60,
         'FMS_MIN_TRUST':55, # peer message trust
         'NONE_TRUST':49, # i.e. disable posting for 'None' peer msg trust
@@ -228,6 +233,9 @@ def run_wikibot(params):
     async_socket = PolledSocket(params['FCP_HOST'], params['FCP_PORT'])
     request_runner = RequestRunner(FCPConnection(async_socket, True),
                                    params['N_CONCURRENT'])
+    if params.get('METRICS_FILE'):
+        request_runner.metrics = RequestMetrics(params['METRICS_FILE'],
+                                                params['METRICS_WRITE_SECS'])
 
     # Setup FMSBotRunner to house the WikiBot.
     bot_runner = FMSBotRunner(params)
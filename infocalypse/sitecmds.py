@@ -20,13 +20,18 @@
 """
 
 
+import json
 import os
+import re
 import shutil
+import time
+from hashlib import sha1
 
 from mercurial import util
 
 from .fcpconnection import FCPError
-from .fcpclient import FCPClient, get_file_infos, set_index_file
+from .fcpclient import FCPClient, get_file_infos, set_index_file, \
+     is_usk, get_version, get_ssk_for_usk_version
 
 # HACK
 from .pathhacks import add_parallel_sys_path
@@ -53,32 +58,181 @@ def show_request_uri(ui_, params, uri):
         request_uri = uri
     ui_.status(b'RequestURI:\n%b\n' % request_uri)
 
-def dump_wiki_html(wiki_root, staging_dir, overlayed):
+def dump_wiki_html(wiki_root, staging_dir, overlayed, incremental=False):
     """ Dump the wiki as flat directory of html.
 
         wiki_root is the directory containing the wikitext and www dirs.
         staging_dir MUST contain the substring 'deletable'.
+
+        If incremental is True, the html from the last incremental dump
+        into staging_dir is updated instead of being dumped from
+        scratch. Returns the list of files which changed.
     """
 
     # i.e. so you can't delete your home directory by mistake.
-    if not staging_dir.find("deletable"):
+    if staging_dir.find("deletable") == -1:
         raise ValueError("staging dir name must contain 'deletable'")
 
-    if os.path.exists(staging_dir):
+    if not incremental and os.path.exists(staging_dir):
         shutil.rmtree(staging_dir)
-    assert not os.path.exists(staging_dir)
-
-    os.makedirs(staging_dir)
-
-    piki.dump(staging_dir, wiki_root, overlayed)
+        assert not os.path.exists(staging_dir)
+
+    if not os.path.exists(staging_dir):
+        os.makedirs(staging_dir)
+
+    return piki.dump(staging_dir, wiki_root, overlayed,
+                     incremental=incremental)
+
+# Kept between inserts. Must not start with '_tmp_', since
+# BundleCache.remove_files() deletes everything in TMP_DIR that does.
+SITE_STAGING_DIR = '_wiki_html_staging_deletable'
+
+# The manifest and piki's dump state are dot files in the staging dir.
+# They aren't inserted.
+SITE_MANIFEST_FILE = '.site_manifest'
+SITE_MANIFEST_VERSION = 2
+SITE_FILE_REGEX = re.compile(r'^[^.]')
+
+# Smaller files are always inserted directly, since a redirect
+# isn't much smaller.
+MIN_REDIRECT_LENGTH = 1024
+
+# Unchanged files are uploaded again after this many inserts, or when
+# their last upload is older than MAX_REDIRECT_AGE_SECS, so that the
+# data they redirect to doesn't fall out of the network.
+MAX_REDIRECT_INSERTS = 10
+MAX_REDIRECT_AGE_SECS = 14 * 24 * 60 * 60
+
+def fixed_edition_uri(uri):
+    """ Return an SSK for the edition of a USK freesite URI. Other
+        URIs are returned unchanged.
+
+        Redirects point at a fixed edition, not at a USK which has to
+        be looked up again. """
+    if is_usk(uri):
+        return get_ssk_for_usk_version(uri, get_version(uri))
+    return uri
+
+class SiteManifest:
+    """ Content hashes for the files in a freesite staging dir, and the
+        URIs they were last uploaded under.
+
+        Files which haven't changed since they were last uploaded can
+        be inserted as redirects to the data that is already in
+        Freenet, instead of being uploaded again. """
+    def __init__(self, site_root):
+        self.site_root = site_root
+        self.file_name = os.path.join(site_root, SITE_MANIFEST_FILE)
+        # name -> [stamp, sha1 hex digest, uri or None,
+        #          insert count when uploaded, time when uploaded]
+        self.entries = {}
+        # The number of inserts recorded with inserted().
+        self.inserts = 0
+        self.load()
+
+    def load(self):
+        """ Read the manifest file, if there is one. """
+        self.entries = {}
+        self.inserts = 0
+        if not os.path.exists(self.file_name):
+            return
+        in_file = open(self.file_name, 'rb')
+        try:
+            try:
+                manifest = json.loads(in_file.read().decode('utf8'))
+            except ValueError:
+                return # Corrupt. Everything gets uploaded.
+        finally:
+            in_file.close()
+        if manifest.get('version') == SITE_MANIFEST_VERSION:
+            self.entries = manifest['files']
+            self.inserts = manifest['inserts']
+
+    def save(self):
+        """ Write the manifest file. """
+        tmp_name = self.file_name + '.tmp'
+        out_file = open(tmp_name, 'wb')
+        try:
+            out_file.write(json.dumps({'version':SITE_MANIFEST_VERSION,
+                                       'inserts':self.inserts,
+                                       'files':self.entries}).encode('utf8'))
+        finally:
+            out_file.close()
+        os.rename(tmp_name, self.file_name)
+
+    def update(self):
+        """ Hash the files that changed since the last update and save
+            the manifest.
+
+            Returns file infos for all the files in the site. """
+        infos = get_file_infos(self.site_root, None, SITE_FILE_REGEX)
+        entries = {}
+        for info in infos:
+            stat = os.stat(info[3])
+            stamp = '%i:%i' % (stat.st_mtime_ns, stat.st_size)
+            old = self.entries.get(info[0])
+            if not old is None and old[0] == stamp:
+                entries[info[0]] = old
+                continue
+            digest = file_sha1(info[3])
+            if not old is None and old[1] == digest:
+                entries[info[0]] = [stamp, digest] + old[2:]
+            else:
+                entries[info[0]] = [stamp, digest, None, 0, 0]
+        self.entries = entries
+        self.save()
+        return infos
+
+    def get_redirects(self, infos, now=None):
+        """ Return a name -> target URI dict for the files in infos
+            which can be inserted as redirects.
+
+            infos[0], the default file, is always inserted directly. """
+        if now is None:
+            now = time.time()
+        ret = {}
+        for info in infos[1:]:
+            uri, insert, uploaded = self.entries[info[0]][2:]
+            if (uri is None or info[1] < MIN_REDIRECT_LENGTH or
+                self.inserts - insert >= MAX_REDIRECT_INSERTS or
+                now - uploaded >= MAX_REDIRECT_AGE_SECS):
+                continue
+            ret[info[0]] = uri
+        return ret
+
+    def inserted(self, request_uri, redirects, now=None):
+        """ Record that the site was inserted under request_uri, with
+            the files in redirects inserted as redirects. """
+        if now is None:
+            now = time.time()
+        if not isinstance(request_uri, bytes):
+            request_uri = request_uri.encode('utf8')
+        base = fixed_edition_uri(request_uri).decode('utf8')
+        base = base.rstrip('/') + '/'
+        for name, entry in list(self.entries.items()):
+            if not name in redirects:
+                # Point at the data, not at another redirect.
+                entry[2:] = [base + name, self.inserts, now]
+        self.inserts += 1
+        self.save()
+
+def file_sha1(full_path):
+    """ INTERNAL: Return the SHA1 hex digest of a file. """
+    digest = sha1()
+    in_file = open(full_path, 'rb')
+    try:
+        while True:
+            data = in_file.read(64 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        in_file.close()
+    return digest.hexdigest()
 
-TMP_DUMP_DIR = '_tmp_wiki_html_deletable'
 # Hmmmm... broken out to appease pylint
 def do_freenet_insert(ui_, repo, params, insert_uri, progress_func):
-    """ INTERNAL: Helper does the actual insert.
-
-                  Caller must delete TMP_DUMP_DIR!
-    """
+    """ INTERNAL: Helper does the actual insert. """
     default_mime_type = "text/plain" # put_complex_dir() default. Hmmmm.
     if not params['ISWIKI']:
         site_root = os.path.join(repo.root, params['SITE_DIR'])
@@ -87,26 +241,40 @@ def do_freenet_insert(ui_, repo, params, insert_uri, progress_func):
         default_mime_type = 'text/html'
 
         ui_.status("Dumping wiki as HTML...\n")
-        site_root = os.path.join(params['TMP_DIR'], TMP_DUMP_DIR)
-        dump_wiki_html(os.path.join(repo.root, params['WIKI_ROOT']),
-                       site_root,
-                       params['OVERLAYED'])
+        site_root = os.path.join(params['TMP_DIR'], SITE_STAGING_DIR)
+        changed = dump_wiki_html(os.path.join(repo.root, params['WIKI_ROOT']),
+                                 site_root,
+                                 params['OVERLAYED'],
+                                 True)
+        ui_.status(b'%i files changed since the last dump.\n' % len(changed))
 
     ui_.status('Default file: %s\n' % params['SITE_DEFAULT_FILE'])
     ui_.status('Reading files from:\n%s\n' % site_root)
 
-    infos = get_file_infos(site_root)
+    manifest = None
+    if params['ISWIKI']:
+        manifest = SiteManifest(site_root)
+        infos = manifest.update()
+    else:
+        infos = get_file_infos(site_root)
 
     try:
         set_index_file(infos, params['SITE_DEFAULT_FILE'])
     except ValueError:
         raise util.Abort("Couldn't read %s" % params['SITE_DEFAULT_FILE'])
 
+    redirects = {}
+    if not manifest is None:
+        redirects = manifest.get_redirects(infos)
+
     ui_.status('--- files ---\n')
 
     for info in infos:
         ui_.status('%s %s\n' % (info[0], info[1]))
     ui_.status('---\n')
+    if len(redirects) > 0:
+        ui_.status(b'Inserting %i unchanged files as redirects.\n'
+                   % len(redirects))
 
     if params['DRYRUN']:
         ui_.status('Would have inserted to:\n%s\n' % insert_uri)
@@ -121,8 +289,11 @@ def do_freenet_insert(ui_, repo, params, insert_uri, progress_func):
         ui_.status('Inserting to:\n%s\n' % insert_uri)
         try:
             request_uri = client.put_complex_dir(insert_uri, infos,
-                                                 default_mime_type)[1]['URI']
+                                                 default_mime_type,
+                                                 redirects)[1][b'URI']
             show_request_uri(ui_, params, request_uri)
+            if not manifest is None:
+                manifest.inserted(request_uri, redirects)
         except FCPError as err:
             if err.is_code(9): # magick number for collision
                 ui_.warn('An update was already inserted on that index.\n'
@@ -153,16 +324,13 @@ def execute_putsite(ui_, repo, params):
 
     # Remove trailing /
     params['SITE_KEY'] = params['SITE_KEY'].split('/')[0].strip()
-    try:
-        do_freenet_insert(ui_, repo, params,
-                          get_insert_uri(params),
-                          progress)
-    finally:
-        tmp_dump = os.path.join(params['TMP_DIR'], TMP_DUMP_DIR)
-        if os.path.exists(tmp_dump):
-            # REDFLAG: DCI, failure here is horrible.
-            # i.e. untrusted unencrypted data on your disk
-            shutil.rmtree(tmp_dump)
+    # The SITE_STAGING_DIR staging dir is kept so that the next insert
+    # only has to dump and upload what changed.
+    # REDFLAG: It's html dumped from the local repo, but it is
+    #          unencrypted data on your disk.
+    do_freenet_insert(ui_, repo, params,
+                      get_insert_uri(params),
+                      progress)
 
 MSG_FMT = b"""InsertURI:
 %s
@@ -24,6 +24,7 @@
 # REDFLAG: move this into requestqueue?
 
 import os
+import time
 
 from .fcpconnection import SUCCESS_MSGS
 from .requestqueue import QueueableRequest
@@ -275,6 +276,67 @@ class CandidateRequest(StatefulRequest):
         StatefulRequest.__init__(self, queue)
         self.candidate = None
 
+# Hedge requests that take longer than this fraction of recent requests.
+HEDGE_PERCENTILE = 0.9
+# Use the default delay until there are at least this many samples.
+MIN_HEDGE_SAMPLES = 8
+MAX_HEDGE_SAMPLES = 256
+
+class HedgingPolicy:
+    """ Decides when a slow request should be raced against a request
+        for a redundant key, and keeps track of which redundant key
+        usually wins the race. """
+    def __init__(self, default_delay_secs, min_delay_secs=5.0,
+                 percentile=HEDGE_PERCENTILE, request_class=None):
+        self.default_delay_secs = default_delay_secs
+        self.min_delay_secs = min_delay_secs
+        self.percentile = percentile
+        # latencymodel request class to fall back to. See delay_secs().
+        self.request_class = request_class
+        # Latencies of recent successful requests.
+        self.latencies = []
+        # redundancy ordinal -> races won
+        self.wins = {}
+
+    def record_latency(self, secs):
+        """ Record the latency of a successful request. """
+        self.latencies.append(secs)
+        if len(self.latencies) > MAX_HEDGE_SAMPLES:
+            self.latencies = self.latencies[-MAX_HEDGE_SAMPLES:]
+
+    def delay_secs(self, latency_model=None):
+        """ Return how long to wait before hedging a request.
+
+            Until there are enough samples of its own, the policy
+            uses the latency_model's samples for request_class, which
+            last from run to run. """
+        if len(self.latencies) < MIN_HEDGE_SAMPLES:
+            delay = None
+            if not latency_model is None and not self.request_class is None:
+                delay = latency_model.get_stats(
+                    self.request_class).percentile(self.percentile)
+            if delay is None:
+                return self.default_delay_secs
+            return max(self.min_delay_secs, delay)
+        ordered = sorted(self.latencies)
+        index = int(self.percentile * (len(ordered) - 1))
+        return max(self.min_delay_secs, ordered[index])
+
+    def record_win(self, ordinal):
+        """ Record that the request for the ordinal'th redundant key
+            finished first. """
+        self.wins[ordinal] = self.wins.get(ordinal, 0) + 1
+
+    def preferred_ordinal(self, ordinals):
+        """ Return the ordinal that has won the most races or None if
+            none of them have won more than the others. """
+        counts = sorted([(self.wins.get(ordinal, 0), ordinal)
+                         for ordinal in ordinals])
+        if len(counts) == 0 or (len(counts) > 1 and
+                                counts[-1][0] == counts[-2][0]):
+            return None
+        return counts[-1][1]
+
 # This is not as well thought out as the other stuff in this file.
 # REDFLAG: better name?
 class RetryingRequestList(RequestQueueState):
@@ -289,22 +351,59 @@ class RetryingRequestList(RequestQueueState):
         self.current_candidates = []
         self.next_candidates = []
         self.finished_candidates = []
+        # Set to a HedgingPolicy to race slow requests against
+        # requests for redundant keys. See hedge_candidate().
+        self.hedging = None
+        # tag -> time the request was started
+        self.started = {}
+        # Tags of requests which were hedged or are hedges.
+        self.hedged = set([])
+        # id(candidate) -> (time, candidate) for retries which
+        # shouldn't run before time. See delay_candidate().
+        self.retry_times = {}
 
     def reset(self):
         """ Implementation of State virtual. """
         self.current_candidates = []
         self.next_candidates = []
         self.finished_candidates = []
+        self.started = {}
+        self.hedged = set([])
+        self.retry_times = {}
         RequestQueueState.reset(self)
 
+    def delay_candidate(self, candidate, delay_secs):
+        """ Don't run a request for candidate for delay_secs.
+
+            The candidate stays wherever the subclass puts it.
+            get_candidate() just skips it until then. """
+        if delay_secs <= 0:
+            self.retry_times.pop(id(candidate), None)
+            return
+        self.retry_times[id(candidate)] = (time.time() + delay_secs,
+                                           candidate)
+
+    def is_delayed(self, candidate):
+        """ INTERNAL: Return True if candidate can't be run yet. """
+        entry = self.retry_times.get(id(candidate))
+        if entry is None:
+            return False
+        if entry[1] is candidate and entry[0] > time.time():
+            return True
+        del self.retry_times[id(candidate)]
+        return False
+
     def next_runnable(self):
         """ Implementation of RequestQueueState virtual. """
-        candidate = self.get_candidate()
-        if candidate is None:
-            return None
+        request = self.next_hedge()
+        if request is None:
+            candidate = self.get_candidate()
+            if candidate is None:
+                return None
+            request = self.make_request(candidate)
 
-        request = self.make_request(candidate)
         self.pending[request.tag] = request
+        self.started[request.tag] = time.time()
         return request
 
     def request_done(self, client, msg):
@@ -312,8 +411,83 @@ class RetryingRequestList(RequestQueueState):
         candidate = client.candidate
         assert not candidate is None
         del self.pending[client.tag]
+        started = self.started.pop(client.tag, None)
+        self.hedged.discard(client.tag)
+        losers = ()
+        if not self.hedging is None and msg[0] in SUCCESS_MSGS:
+            if not started is None:
+                self.hedging.record_latency(time.time() - started)
+            losers = self.cancel_losers(candidate)
         # REDFLAG: fix signature? to get rid of candidate
         self.candidate_done(client, msg, candidate)
+        for loser in losers:
+            self.hedge_lost(loser)
+
+    ############################################################
+    # Hedging
+    def next_hedge(self):
+        """ INTERNAL: Return a request for a redundant key for the first
+            pending request that has run for too long, or None. """
+        if self.hedging is None:
+            return None
+        delay = self.hedging.delay_secs(self.parent.ctx.latency_model)
+        now = time.time()
+        for tag, request in list(self.pending.items()):
+            if tag in self.hedged or now - self.started.get(tag, now) < delay:
+                continue
+            self.hedged.add(tag) # Only try once.
+            candidate = self.hedge_candidate(request.candidate)
+            if candidate is None:
+                continue
+            hedge = self.make_request(candidate)
+            self.hedged.add(hedge.tag) # Don't hedge the hedge.
+            return hedge
+        return None
+
+    def cancel_losers(self, winner):
+        """ INTERNAL: Cancel the pending requests racing the candidate
+            that just succeeded and return their candidates. """
+        group = self.hedge_group(winner)
+        if group is None:
+            return ()
+        tags = [tag for tag, request in list(self.pending.items())
+                if self.hedge_group(request.candidate) == group]
+        if len(tags) == 0:
+            return ()
+
+        self.hedging.record_win(self.hedge_ordinal(winner))
+        runner = self.parent.runner
+        losers = []
+        for tag in tags:
+            request = self.pending[tag]
+            losers.append(request.candidate)
+            self.started.pop(tag, None)
+            self.hedged.discard(tag)
+            # Can't cancel while uploading. Just let it finish.
+            if not runner.connection.is_uploading():
+                runner.cancel_request(request)
+            # The orphan handling code discards the final message.
+            self.parent.ctx.orphan_request(self, tag)
+        return losers
+
+    def hedge_candidate(self, dummy_candidate):
+        """ Return a candidate for a redundant key which can be run
+            in parallel with the slow candidate, or None. """
+        return None
+
+    def hedge_group(self, dummy_candidate):
+        """ Return a value which is the same for all candidates that
+            race each other, or None if the candidate doesn't race. """
+        return None
+
+    def hedge_ordinal(self, dummy_candidate):
+        """ Return the redundancy ordinal of the candidate. """
+        return 0
+
+    def hedge_lost(self, dummy_candidate):
+        """ Called when a request for the candidate was canceled
+            because another request in its group won. """
+        pass
 
     ############################################################
     def is_stalled(self):
@@ -355,9 +529,11 @@ class RetryingRequestList(RequestQueueState):
         #print "NEXT:"
         #print self.next_candidates
 
-        candidate = self.current_candidates.pop()
-
-        return candidate
+        # Skip candidates waiting to be retried.
+        for index in range(len(self.current_candidates) - 1, -1, -1):
+            if not self.is_delayed(self.current_candidates[index]):
+                return self.current_candidates.pop(index)
+        return None
 
     ############################################################
     def candidate_done(self, client, msg, candidate):
@@ -21,12 +21,14 @@
 """
 
 
+import errno
 import os
 import time
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 from mercurial import mdiff
-from mercurial import commands
+from mercurial import commands, hg
 from zipfile import ZipFile
 from binascii import hexlify
 
@@ -43,7 +45,8 @@ from deltacoder import compress, decompress
 
 add_parallel_sys_path('fniki')
 from fileoverlay import DirectFiles
-from piki import versioned_page_re as WIKINAME_REGEX
+from piki import versioned_page_re as WIKINAME_REGEX, reversed_lines
+from searchindex import update_wiki_index
 
 # Reasons submission were rejected.
 REJECT_UNKNOWN = 0 # Dunno why submission failed.
@@ -58,6 +61,10 @@ SENTINEL_VER = '000000000000'
 
 MAX_INFO_LEN = 1024 # Arbitrary, reasonable bound.
 
+# Number of threads ForkingSubmissionHandler.apply_submissions() checks
+# submissions on.
+DEFAULT_WORKERS = 4
+
 #----------------------------------------------------------#
 CRLF = '\x0d\x0a'
 EMPTY_FILE_SHA_HEX = new_sha(b'').hexdigest()
@@ -361,7 +368,7 @@ def handle_conflict(head, full_path, name, bytes, updated_sha):
         # starting from a different base rev.
         return 3, name # Already applied
 
-    versioned_name = "%s_%s" % (name, hexlify(updated_sha))
+    versioned_name = "%s_%s" % (name, hexlify(updated_sha).decode('ascii'))
     # REDFLAG: LATER: explict hg copy to minimize repo size? 
     head.write(os.path.join(os.path.split(full_path)[0],
                             versioned_name),
@@ -471,7 +478,7 @@ def forking_extract_wikitext(arch, overlay, head, name):
         # HACK. len == 0 => delete
         ret = 2
         if not head.is_overlayed():
-            os.remove(full_path)
+            head.remove(full_path)
             return ret, name
 
     head.write(full_path, raw_file, 'wb')
@@ -565,6 +572,10 @@ def unbundle_wikitext(overlay, in_stream,
                                   name, True)
             action = extract_wikitext(arch, overlay, name)
             op_lut[action].add(name)
+
+        # Keep piki's full text search index current, if there is one.
+        update_wiki_index(overlay.base_path, overlay.is_overlayed(),
+                          op_lut[0].union(op_lut[1]).union(op_lut[2]))
         return op_lut
     finally:
         arch.close()
@@ -681,15 +692,68 @@ def check_merges(submitted_pages, all_pages, hexdigest_func):
                 raise SubmitError("Not deleted!: %s" % versioned_name,
                                   True)
 
-def merge_wikitext(ui_, repo, base_dir, tmp_file, in_stream):
-    """ Merge changes from a submission zip file into the
-        repository. """
+class PendingFiles(DirectFiles):
+    """ A DirectFiles which keeps writes and removals in memory until
+        flush() is called.
+
+        It also records the names of the files which were looked at,
+        so that submissions which don't depend on each other can be
+        found. """
+    def __init__(self, base_path):
+        DirectFiles.__init__(self, base_path)
+        # full path -> text, None for removed files
+        self.pending = {}
+        # Names of the files read, written or checked for.
+        self.used = set([])
+
+    def write(self, path, bytes, mode='wb'):
+        """ IFileFunctions implementation. """
+        self.used.add(os.path.split(path)[1])
+        self.pending[path] = bytes
+
+    def remove(self, path):
+        """ Remove a file. """
+        self.used.add(os.path.split(path)[1])
+        self.pending[path] = None
+
+    def read(self, path, mode='rb', dummy_non_overlayed=False):
+        """ IFileFunctions implementation. """
+        self.used.add(os.path.split(path)[1])
+        if path in self.pending:
+            if self.pending[path] is None:
+                raise IOError(errno.ENOENT, "Removed", path)
+            return self.pending[path]
+        return DirectFiles.read(self, path, mode)
+
+    def exists(self, path, dummy_non_overlayed=False):
+        """ IFileFunctions implementation. """
+        self.used.add(os.path.split(path)[1])
+        if path in self.pending:
+            return not self.pending[path] is None
+        return DirectFiles.exists(self, path)
+
+    def flush(self):
+        """ Write the pending changes into the file system. """
+        for path in sorted(self.pending):
+            if self.pending[path] is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                DirectFiles.write(self, path, self.pending[path], 'wb')
+        self.pending = {}
+
+def prepare_wikitext(ui_, repo, base_dir, in_stream):
+    """ Check a submission zip file and work out the changes it makes
+        to the repository, without writing anything.
+
+        Returns an (op_lut, PendingFiles) tuple. """
 
     # HgFileOverlay to read bundle files with.
-    prev_overlay = HgFileOverlay(ui_, repo, base_dir, tmp_file)
+    prev_overlay = HgFileOverlay(ui_, repo, base_dir, None)
 
-    # Direct overlay to write updates into the repo.
-    head_overlay = DirectFiles(os.path.join(repo.root, base_dir))
+    # Overlay which holds the updates to the repo.
+    head_overlay = PendingFiles(os.path.join(os.fsdecode(repo.root),
+                                             base_dir))
 
     arch = ZipFile(in_stream, 'r')
     try:
@@ -732,10 +796,36 @@ def merge_wikitext(ui_, repo, base_dir, tmp_file, in_stream):
                                                               head_overlay,
                                                               name)
             op_lut[action].add(versioned_name)
-        return op_lut
+        return op_lut, head_overlay
     finally:
         arch.close()
 
+def merge_wikitext(ui_, repo, base_dir, dummy_tmp_file, in_stream):
+    """ Merge changes from a submission zip file into the
+        repository. """
+    op_lut, head_overlay = prepare_wikitext(ui_, repo, base_dir, in_stream)
+    head_overlay.flush()
+    return op_lut
+
+def check_changes(results):
+    """ INTERNAL: Raise NoChangesError if merge_wikitext() results don't
+        change anything. """
+    if len(results[3]) > 0 and sum([len(results[index]) for index in
+                                    (0, 1, 2, 4)]) == 0: #HACK, fix order!
+        raise NoChangesError()
+
+    assert sum([len(results[index]) for index in (0, 1, 2, 4)]) > 0
+
+def prepare_submission(ui_, repo_root, base_dir, raw_zip_bytes):
+    """ INTERNAL: Run prepare_wikitext() on a worker thread.
+
+        Mercurial repository objects aren't thread safe, so it reads
+        from its own. """
+    results = prepare_wikitext(ui_, hg.repository(ui_, repo_root), base_dir,
+                               io.BytesIO(raw_zip_bytes))
+    check_changes(results[0])
+    return results
+
 
 class ForkingSubmissionHandler:
     """ Class which applies submissions to wikitext in an hg repo, creating
@@ -747,49 +837,130 @@ class ForkingSubmissionHandler:
         self.base_dir = None # relative wrt self.repo.root
         self.notify_needs_commit = lambda :None
         self.notify_committed = lambda succeeded:None
+        # Called with the msg_ids of submissions once they have been
+        # committed or rejected.
+        self.notify_finished = lambda msg_ids:None
 
     def full_base_path(self):
         """ INTERNAL: Returns the full path to the dir which contains the
             wikitext dir. """
-        return os.path.join(self.repo.root, self.base_dir)
+        return os.path.join(os.fsdecode(self.repo.root), self.base_dir)
 
     def apply_submission(self, msg_id, submission_tuple, raw_zip_bytes,
                          tmp_file):
         """ Apply a submission zip bundle. """
-        # REJECT_CONFLICT isn't used anymore. We just fork.
-        code = REJECT_ILLEGAL
         try:
-            self.commit_results(msg_id, submission_tuple,
-                                merge_wikitext(self.ui_,
-                                               self.repo,
-                                               self.base_dir,
-                                               tmp_file,
-                                               io.StringIO(
-                                                   raw_zip_bytes)))
-            return True
-
-        except NoChangesError as err:
+            results = merge_wikitext(self.ui_, self.repo, self.base_dir,
+                                     tmp_file, io.BytesIO(raw_zip_bytes))
+            check_changes(results)
+        except SubmitError as err:
+            self.reject(msg_id, submission_tuple, err)
+            self.notify_finished((msg_id, ))
+            return False
+        except Exception as err:
+            self.reject_unexpected(msg_id, submission_tuple, err)
+            self.notify_finished((msg_id, ))
+            return False
+
+        self.commit_results(msg_id, submission_tuple, results)
+        self.notify_finished((msg_id, ))
+        return True
+
+    def apply_submissions(self, submissions, workers=DEFAULT_WORKERS):
+        """ Apply a list of (msg_id, submission_tuple, raw_zip_bytes)
+            submissions, in order.
+
+            The submissions are checked and patched on a pool of worker
+            threads. The ones which don't touch any of the pages used
+            by submissions before them are committed together. The rest
+            are applied one by one with apply_submission() afterwards,
+            so the end result is the same as applying them in order.
+
+            Returns the number of submissions which were applied. """
+        if len(submissions) == 1:
+            msg_id, submission_tuple, raw_zip_bytes = submissions[0]
+            return int(self.apply_submission(msg_id, submission_tuple,
+                                             raw_zip_bytes, None))
+
+        batch = []
+        serial = []
+        # Names of the pages used by the submissions so far.
+        used = set([])
+        pool = ThreadPoolExecutor(workers)
+        try:
+            futures = [pool.submit(prepare_submission, self.ui_,
+                                   self.repo.root, self.base_dir,
+                                   submission[2])
+                       for submission in submissions]
+            # Wait for all of them. The workers read the head files.
+            for submission, future in zip(submissions, futures):
+                msg_id, submission_tuple = submission[:2]
+                try:
+                    results, head = future.result()
+                except SubmitError as err:
+                    # Doesn't depend on the other submissions.
+                    self.reject(msg_id, submission_tuple, err)
+                    self.notify_finished((msg_id, ))
+                    continue
+                except Exception as err:
+                    self.reject_unexpected(msg_id, submission_tuple, err)
+                    self.notify_finished((msg_id, ))
+                    continue
+
+                if head.used.isdisjoint(used):
+                    batch.append((msg_id, submission_tuple, results, head))
+                else:
+                    serial.append(submission)
+                used.update(head.used)
+        finally:
+            pool.shutdown()
+
+        self.logger.debug("apply_submissions -- %i submissions, "
+                          % len(submissions) +
+                          "%i batched, %i serial" % (len(batch),
+                                                     len(serial)))
+        if len(batch) > 0:
+            for entry in batch:
+                entry[3].flush()
+            self.commit_batch([entry[:3] for entry in batch])
+            self.notify_finished([entry[0] for entry in batch])
+
+        applied = len(batch)
+        for msg_id, submission_tuple, raw_zip_bytes in serial:
+            if self.apply_submission(msg_id, submission_tuple,
+                                     raw_zip_bytes, None):
+                applied += 1
+        return applied
+
+    def reject(self, msg_id, submission_tuple, err):
+        """ INTERNAL: Log a submission which raised a SubmitError
+            into rejected.txt. """
+        code = REJECT_ILLEGAL
+        if isinstance(err, NoChangesError):
             self.logger.debug("apply_submission -- no changes, illegal: %s" %
                               str(err.illegal))
             if not err.illegal:
                 # i.e. zip contained legal changes that were already applied.
                 code = REJECT_APPLIED
-
-        except SubmitError as err:
+        else:
             self.logger.debug("apply_submission --  err: %s" % str(err))
 
+            # REJECT_CONFLICT isn't used anymore. We just fork.
             if err.illegal:
                 self.logger.warn("apply_submission -- ILLEGAL .zip: %s" %
                                  str(submission_tuple))
                 code = REJECT_ILLEGAL
 
-        except Exception as err:
-            self.logger.warn("apply_submission -- ILLEGAL .zip(1): %s" %
-                              str(submission_tuple))
-            raise # DCI
         self.update_change_log(msg_id, submission_tuple,
                                code, False)
-        return False
+
+    def reject_unexpected(self, msg_id, submission_tuple, err):
+        """ INTERNAL: Reject a submission which raised something other
+            than a SubmitError, e.g. because the .zip is corrupt. """
+        self.logger.debug("apply_submission -- unexpected error: %s [%s]" %
+                          (str(submission_tuple), repr(err)))
+        self.reject(msg_id, submission_tuple,
+                    SubmitError("Unexpected error: %s" % repr(err), True))
 
     # Sets needs commit on failure, but not success. Hmmm...
     # Update <wiki_root>/submitted.txt
@@ -807,10 +978,11 @@ class ForkingSubmissionHandler:
             full_path = os.path.join(full_path, 'accepted.txt')
             out_file = open(full_path, 'ab')
             try:
-                out_file.write("%s:%i:%s:%s\n" % ( SENTINEL_VER,
-                                                   time.time(),
-                                                   submission_tuple[0],
-                                                   submission_tuple[3]))
+                out_file.write(("%s:%i:%s:%s\n" % ( SENTINEL_VER,
+                                                    time.time(),
+                                                    submission_tuple[0],
+                                                    submission_tuple[3])).
+                               encode('utf8'))
                 # Created, modified, removed, skipped, forked
                 op_lut = ('C', 'M', 'R', '*', 'F')
                 for index, values in enumerate(result):
@@ -819,8 +991,9 @@ class ForkingSubmissionHandler:
                     if len(values):
                         values = list(values)
                         values.sort()
-                        out_file.write("%s:%s\n" % (op_lut[index],
-                                                    ':'.join(values)))
+                        out_file.write(("%s:%s\n" % (op_lut[index],
+                                                     ':'.join(values))).
+                                       encode('utf8'))
             finally:
                 out_file.close()
             # Caller is resposible for commiting or setting "needs commit".
@@ -832,11 +1005,12 @@ class ForkingSubmissionHandler:
             result = REJECT_UNKNOWN # ??? just assert?
         out_file = open(full_path, 'ab')
         try:
-            out_file.write("%s:%i:%s:%s:%i\n" % (hex_version(self.repo)[:12],
-                                                 time.time(),
-                                                 submission_tuple[0],
-                                                 submission_tuple[3],
-                                                 int(result)))
+            out_file.write(("%s:%i:%s:%s:%i\n" % (
+                hex_version(self.repo, b'tip')[:12].decode('ascii'),
+                time.time(),
+                submission_tuple[0],
+                submission_tuple[3],
+                int(result))).encode('utf8'))
         finally:
             out_file.close()
 
@@ -850,33 +1024,33 @@ class ForkingSubmissionHandler:
     # i.e. because we have to write the log entry *before* we know the version.
     def fixup_accepted_log(self):
         """ INTERNAL: Hack to fix the hg version int the accepted.txt log. """
-        version = hex_version(self.repo)[:12] # The new tip.
+        version = hex_version(self.repo, b'tip')[:12] # The new tip.
         self.logger.debug("fixup_accept_log -- fixing up: %s" % version)
         assert len(version) == len(SENTINEL_VER)
 
+        # The entries are at the end of the log, so only read back to
+        # the last entry which was already fixed up, and overwrite the
+        # versions in place.
         full_path = os.path.join(self.full_base_path(), 'accepted.txt')
-        in_file = open(full_path, 'rb')
+        sentinel = SENTINEL_VER.encode('ascii')
+        out_file = open(full_path, 'r+b')
         try:
-            lines = in_file.readlines()
-            in_file.close()
-            pos = len(lines) -1
-            while pos >= 0:
-                if not lines[pos].startswith(SENTINEL_VER):
-                    pos -= 1
+            positions = []
+            pos = out_file.seek(0, os.SEEK_END)
+            for line in reversed_lines(out_file):
+                pos -= len(line)
+                if line[:2] in (b'C:', b'M:', b'R:', b'F:'):
                     continue
-                lines[pos] = version + lines[pos][len(version):]
-                break
-
-            assert pos >= 0
-            # Replace existing file.
-            os.remove(full_path)
-            try:
-                out_file = open(full_path, 'wb')
-                out_file.write("".join(lines))
-            finally:
-                out_file.close()
+                if not line.startswith(sentinel):
+                    break
+                positions.append(pos)
+
+            assert len(positions) > 0
+            for pos in positions:
+                out_file.seek(pos)
+                out_file.write(version)
         finally:
-            in_file.close()
+            out_file.close()
 
 
     # DCI: need code to scrub non vcd files?
@@ -887,11 +1061,13 @@ class ForkingSubmissionHandler:
         """ INTERNAL: Commit the results of a submission to the local repo. """
 
         print("RESULTS: ", results)
-        if len(results[3]) > 0 and sum([len(results[index]) for index in
-                                        (0, 1, 2, 4)]) == 0: #HACK, fix order!
-            raise NoChangesError()
+        check_changes(results)
+        self.commit_batch(((msg_id, submission_tuple, results), ))
 
-        assert sum([len(results[index]) for index in (0, 1, 2, 4)]) > 0
+    def commit_batch(self, entries):
+        """ INTERNAL: Commit the results of a list of
+            (msg_id, submission_tuple, results) submissions to the local
+            repo in a single changeset. """
 
         wikitext_dir = os.path.join(self.full_base_path(), 'wikitext')
         raised = True
@@ -899,40 +1075,44 @@ class ForkingSubmissionHandler:
         #pylint: disable-msg=E1101
         self.ui_.pushbuffer()
         try:
-            # hg add new files.
-            for name in results[0]:
-                full_path = os.path.join(wikitext_dir, name)
-                commands.add(self.ui_, self.repo, full_path)
-
-            # hg add fork files
-            for name in results[4]:
-                full_path = os.path.join(wikitext_dir, name)
-                commands.add(self.ui_, self.repo, full_path)
+            # hg add new and fork files.
+            added = []
+            removed = []
+            for dummy, dummy, results in entries:
+                added += [os.fsencode(os.path.join(wikitext_dir, name))
+                          for name in results[0].union(results[4])]
+                removed += [os.fsencode(os.path.join(wikitext_dir, name))
+                            for name in results[2]]
+            if len(added) > 0:
+                commands.add(self.ui_, self.repo, *added)
 
             # hg remove removed files.
-            for name in results[2]:
-                full_path = os.path.join(wikitext_dir, name)
-                commands.remove(self.ui_, self.repo, full_path)
+            if len(removed) > 0:
+                commands.remove(self.ui_, self.repo, *removed)
 
             # Writes to/prunes special file used to generate RemoteChanges.
-            self.update_change_log(msg_id, submission_tuple, results, True)
+            for msg_id, submission_tuple, results in entries:
+                self.update_change_log(msg_id, submission_tuple, results,
+                                       True)
 
             # REDFLAG: LATER, STAKING? later allow third field for staker.
-            # fms_id|chk
-            commit_msg = "%s|%s" % (submission_tuple[0],
-                                    submission_tuple[3])
+            # fms_id|chk, one line per submission.
+            commit_msg = '\n'.join(["%s|%s" % (submission_tuple[0],
+                                               submission_tuple[3])
+                                    for dummy, submission_tuple, dummy
+                                    in entries])
             # hg commit
             commands.commit(self.ui_, self.repo,
                             logfile=None, addremove=None, user=None,
                             date=None,
-                            message=commit_msg)
+                            message=commit_msg.encode('utf8'))
             self.fixup_accepted_log() # Fix version in accepted.txt
             self.notify_committed(True)
             raised = False
         finally:
             text = self.ui_.popbuffer()
             if raised:
-                self.logger.debug("commit_results -- popped log:\n%s" % text)
+                self.logger.debug("commit_batch -- popped log:\n%s" % text)
 
 
     def force_commit(self, msg='F', notify=True): # F -> Failed
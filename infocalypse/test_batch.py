@@ -0,0 +1,204 @@
+""" Tests for pulling many repositories over one FCP connection.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mercurial import hg, ui, commands, error
+
+from .batchcmds import BatchJob, PULL, PUSH, read_batch_file, execute_batch
+from .config import Config
+from .fcpclient import FCPClient, get_usk_for_usk_version
+from .fcpsim import SimulatedNode, SimServer, make_sim_connection
+from .graph import hex_version
+from .infcmds import DEFAULT_PARAMS
+from .requestmetrics import METRICS_FILE_NAME
+from .topkey import top_key_tuple_to_bytes
+from .updatesm import REQUESTING_URI, REQUESTING_BUNDLES, FAILING, \
+     FINISHING
+
+FAKE_CHK = (b'CHK@badroutingkey155JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+
+def make_top_key(heads):
+    """ Return top key bytes with the full head list. """
+    return top_key_tuple_to_bytes(((FAKE_CHK,),
+                                   ((10, (b'0' * 40,), heads, (FAKE_CHK,),
+                                     True, True),)))
+
+class ReadBatchFileTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_batch')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def read(self, text):
+        file_name = os.path.join(self.test_dir, 'batch.txt')
+        out_file = open(file_name, 'wb')
+        try:
+            out_file.write(text)
+        finally:
+            out_file.close()
+        return read_batch_file(file_name)
+
+    def test_read(self):
+        jobs = self.read(b'# A comment\n'
+                         + b'\n'
+                         + b'pull /tmp/one\n'
+                         + b'  push /tmp/two  \n'
+                         + b'pull /tmp/three USK@abc,def,AQACAAE/repo\n')
+        self.assertEqual([(job.command, job.repo_dir, job.uri)
+                          for job in jobs],
+                         [(PULL, b'/tmp/one', None),
+                          (PUSH, b'/tmp/two', None),
+                          (PULL, b'/tmp/three',
+                           b'USK@abc,def,AQACAAE/repo/0')])
+        self.assertEqual(jobs[2].name(), b'three')
+        self.assertFalse(jobs[0].is_done())
+
+    def test_bad_lines(self):
+        self.assertRaises(error.Abort, self.read, b'clone /tmp/one\n')
+        self.assertRaises(error.Abort, self.read, b'pull\n')
+        self.assertRaises(error.Abort, self.read,
+                          b'pull /tmp/one USK@abc,def,AQACAAE/repo extra\n')
+
+class ExecuteBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_batch')
+        self.ui_ = ui.ui()
+        self.ui_.setconfig(b'ui', b'quiet', b'true')
+
+        self.node = SimulatedNode({'LATENCY_SECS':0.0, 'JITTER_SECS':0.0})
+        self.server = SimServer(self.node, port=0)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+        self.cfg = Config()
+        self.cfg.file_name = os.path.join(self.test_dir, 'infocalypse.cfg')
+        self.cfg.defaults['DEFAULT_PRIVATE_KEY'] = b''
+        self.cfg.defaults['TMP_DIR'] = os.path.join(self.test_dir,
+                                                    'tmp').encode('utf8')
+        os.makedirs(self.cfg.defaults['TMP_DIR'])
+
+        self.params = DEFAULT_PARAMS.copy()
+        self.params.update({'FCP_HOST':'127.0.0.1',
+                            'FCP_PORT':self.server.listener.getsockname()[1],
+                            'TMP_DIR':self.cfg.defaults['TMP_DIR'],
+                            'VERBOSITY':1,
+                            'NO_SEARCH':False,
+                            'POLL_SECS':0.05,
+                            'MAX_ACTIVE_REPOS':2})
+
+    def tearDown(self):
+        self.stopped = True
+        self.thread.join()
+        self.server.listener.close()
+        shutil.rmtree(self.test_dir)
+
+    def serve(self):
+        while not self.stopped:
+            self.server.serve_once(0.05)
+
+    def make_repo(self, name):
+        repo_dir = os.path.join(self.test_dir, name).encode('utf8')
+        repo = hg.repository(self.ui_, repo_dir, True)
+        out_file = open(os.path.join(repo_dir, b'a'), 'wb')
+        try:
+            out_file.write(b'a\n')
+        finally:
+            out_file.close()
+        commands.add(self.ui_, repo, os.path.join(repo_dir, b'a'))
+        commands.commit(self.ui_, repo, message=b'a', user=b'test')
+        return repo
+
+    def test_failure_isolation(self):
+        repo = self.make_repo('one')
+        clone_dir = os.path.join(self.test_dir, 'two').encode('utf8')
+        hg.clone(self.ui_, {}, repo.root, clone_dir, update=False)
+
+        # Insert a top key for a repository which has the same
+        # head as the local ones, so pulling needs no bundles.
+        client = FCPClient(make_sim_connection(self.node))
+        client.message_callback = lambda client, msg: None
+        keys = client.generate_ssk()[1]
+        insert_uri = keys[b'InsertURI'].replace(b'SSK@', b'USK@') + b'repo/0'
+        request_uri = (keys[b'RequestURI'].replace(b'SSK@', b'USK@')
+                       + b'repo/0')
+        for index in range(0, 2):
+            client.put(get_usk_for_usk_version(insert_uri, index),
+                       make_top_key((hex_version(repo, b'tip'),)))
+        missing_uri = request_uri.replace(b'/repo/', b'/missing/')
+
+        jobs = [BatchJob(PULL, repo.root, request_uri),
+                # Not a repository.
+                BatchJob(PULL, os.path.join(self.test_dir,
+                                            'none').encode('utf8'),
+                         request_uri),
+                # No URI.
+                BatchJob(PULL, self.make_repo('three').root),
+                # Nothing at the URI.
+                BatchJob(PULL, self.make_repo('four').root, missing_uri),
+                BatchJob(PULL, clone_dir, request_uri)]
+
+        self.assertEqual(execute_batch(self.ui_, jobs, self.params,
+                                       self.cfg), 3)
+        self.assertEqual([job.succeeded for job in jobs],
+                         [True, False, False, False, True])
+        for job in jobs:
+            self.assertTrue(job.is_done())
+            self.assertTrue(job.update_sm is None)
+        for index in (0, 4):
+            self.assertEqual(jobs[index].result_uris,
+                             (get_usk_for_usk_version(request_uri, 1), ))
+        self.assertTrue(jobs[1].error.find(b'not found') != -1)
+        self.assertTrue(jobs[2].error.startswith(b'No stored request URI'))
+        self.assertEqual(self.cfg.get_index(request_uri), 1)
+
+        # No more than MAX_ACTIVE_REPOS at once.
+        for job in jobs:
+            overlapping = [other for other in jobs
+                           if other.start_time <= job.start_time
+                           and other.end_time > job.start_time]
+            self.assertTrue(len(overlapping) <= 2)
+
+        # State times from every job end up in the shared metrics.
+        metrics = json.load(open(os.path.join(
+            self.cfg.defaults['TMP_DIR'].decode('utf8'), METRICS_FILE_NAME)))
+        counts = dict([(name, metrics['states'][name]['count'])
+                       for name in metrics['states']])
+        self.assertEqual(counts[REQUESTING_URI.decode('utf8')], 3)
+        self.assertEqual(counts[REQUESTING_BUNDLES.decode('utf8')], 2)
+        self.assertEqual(counts[FINISHING.decode('utf8')], 2)
+        self.assertEqual(counts[FAILING.decode('utf8')], 1)
+
+if __name__ == '__main__':
+    unittest.main()
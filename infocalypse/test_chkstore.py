@@ -0,0 +1,113 @@
+""" Unit tests for the shared CHK store.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from .chkstore import ChkStore, chk_file_name, append_to
+
+def fake_chk(index):
+    """ Return a CHK string which is only used as a name. """
+    return b'CHK@fake%i,AAAA,AAIC--8' % index
+
+class ChkStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_chkstore')
+        self.store = ChkStore(os.path.join(self.test_dir, 'store'), 3000)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def add_block(self, index, length=1000, age=0):
+        """ Add a block to the store, age seconds old. """
+        file_name = os.path.join(self.test_dir, 'block%i' % index)
+        out_file = open(file_name, 'wb')
+        try:
+            out_file.write(b'%i' % index * length)
+        finally:
+            out_file.close()
+        full_path = self.store.add(fake_chk(index), file_name, length)
+        then = time.time() - age
+        os.utime(full_path, (then, then))
+        return full_path
+
+    def stored(self):
+        return set([entry[2] for entry in self.store.entries()])
+
+    def test_link_out(self):
+        self.add_block(0)
+        dest = os.path.join(self.test_dir, 'out')
+        self.store.link_out(fake_chk(0), dest, 1000)
+        self.assertEqual(os.path.getsize(dest), 1000)
+        self.assertRaises(IOError, self.store.link_out, fake_chk(0), dest, 999)
+        self.assertRaises(IOError, self.store.link_out, fake_chk(1), dest)
+
+    def test_append_to_link(self):
+        full_path = self.add_block(0, 10)
+        dest = os.path.join(self.test_dir, 'out')
+        self.store.link_out(fake_chk(0), dest)
+        # Padding a linked out block doesn't change the stored one.
+        append_to(os.fsencode(dest), b'\xff')
+        self.assertEqual(os.path.getsize(dest), 11)
+        self.assertEqual(os.path.getsize(full_path), 10)
+        self.assertEqual(os.stat(full_path).st_nlink, 1)
+        self.assertEqual(sorted(os.listdir(self.test_dir)),
+                         ['out', 'store'])
+        append_to(dest, b'\xff')
+        self.assertEqual(os.path.getsize(dest), 12)
+
+    def test_collect_garbage(self):
+        for index in range(0, 5):
+            self.add_block(index, age=1000 - index * 100)
+
+        # Using a block makes it the most recently used.
+        self.store.link_out(fake_chk(0), os.path.join(self.test_dir, 'out'))
+        # So does adding a block which is already stored.
+        file_name = os.path.join(self.test_dir, 'again')
+        shutil.copyfile(self.store.full_path(fake_chk(1)), file_name)
+        self.store.add(fake_chk(1), file_name, 1000)
+
+        # The least recently used go first, but referenced blocks are
+        # never removed.
+        removed = self.store.collect_garbage([fake_chk(2)])
+        self.assertEqual(removed, [chk_file_name(fake_chk(3)),
+                                   chk_file_name(fake_chk(4))])
+        self.assertEqual(self.store.total_bytes(), 3000)
+
+        # Over budget, but everything left is referenced.
+        self.assertEqual(self.store.collect_garbage(
+            [fake_chk(0), fake_chk(1), fake_chk(2)], 0), [])
+
+        removed = self.store.collect_garbage([fake_chk(2)], 1000)
+        self.assertEqual(set(removed), set([chk_file_name(fake_chk(0)),
+                                            chk_file_name(fake_chk(1))]))
+        self.assertEqual(self.stored(), set([chk_file_name(fake_chk(2))]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+""" Smoke tests for the FCP node simulator and the code which runs
+    against it.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mercurial import ui, hg, commands
+# Registers the revset predicates bundling uses outside of hg itself.
+from mercurial import dispatch # pylint: disable-msg=W0611
+
+from .bundlecache import BundleCache
+from .fcpsim import SimulatedNode, make_sim_connection, PUT_ROUTE_NOT_FOUND
+from .fcpclient import FCPClient, prefetch_usk, get_usk_for_usk_version, \
+     is_negative_usk, make_search_uris
+from .fcpconnection import FCPError, POLL_TIME_SECS
+from .fcpmessage import GET_DEF, PUT_FILE_DEF
+from .graph import UpdateGraph
+from .latencymodel import LatencyModel, MIN_LATENCY_SAMPLES, \
+     TOP_KEY as TOP_KEY_CLASS
+from .requestqueue import RequestRunner, RequestQueue
+from .statemachine import StatefulRequest
+from .topkey import top_key_tuple_to_bytes
+from .updatesm import UpdateStateMachine, UpdateContext, QUIESCENT, \
+     FINISHING, INSERTING_URI
+from .usktracker import USKTracker
+
+# No latency so the tests run quickly.
+SIM_PARAMS = {'LATENCY_SECS':0.0, 'JITTER_SECS':0.0}
+
+MAX_WAIT_SECS = 10.0
+
+FAKE_CHK = (b'CHK@badroutingkey155JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+
+# Has the full head list, so requesting heads doesn't need the graph.
+TOP_KEY = ((FAKE_CHK,),
+           ((10, (b'0' * 40,), (b'a' * 40,), (FAKE_CHK,), True, True),))
+
+UPDATE_SM_PARAMS = {'NO_SEARCH':False, 'AGGRESSIVE_SEARCH':True,
+                    'CANCEL_TIME_SECS':MAX_WAIT_SECS}
+
+def record_messages(node):
+    """ Make node record the FCP messages it handles.
+
+        Returns the list they are appended to. """
+    msgs = []
+    handlers = {}
+    for name, handler in node.HANDLERS.items():
+        def recording(node_, session, msg, handler=handler):
+            msgs.append(msg)
+            handler(node_, session, msg)
+        handlers[name] = recording
+    node.HANDLERS = handlers
+    return msgs
+
+def get_uris(msgs):
+    """ Return the URIs of the ClientGet messages in msgs. """
+    return [msg[1][b'URI'] for msg in msgs if msg[0] == b'ClientGet']
+
+def poll_until(connection, done, kick=None):
+    """ Poll connection until done() returns True. """
+    end_time = time.time() + MAX_WAIT_SECS
+    while not done():
+        if time.time() > end_time:
+            raise Exception("Timed out")
+        connection.socket.poll()
+        if not kick is None:
+            kick()
+        time.sleep(POLL_TIME_SECS)
+
+class QuietUI:
+    """ Just enough of a mercurial ui to run an UpdateStateMachine. """
+    def __init__(self):
+        self.out = []
+
+    def status(self, msg):
+        self.out.append(msg)
+
+    warn = status
+    debug = status
+
+class ListQueue(RequestQueue):
+    """ A RequestQueue which runs a fixed list of requests. """
+    def __init__(self, runner):
+        RequestQueue.__init__(self, runner)
+        self.requests = []
+        # tag -> terminal message
+        self.results = {}
+
+    def next_runnable(self):
+        if len(self.requests) == 0:
+            return None
+        return self.requests.pop(0)
+
+    def request_done(self, client, msg):
+        self.results[client.tag] = msg
+
+    def add_get(self, tag, uri):
+        request = StatefulRequest(self)
+        request.tag = tag
+        request.in_params.definition = GET_DEF
+        request.in_params.fcp_params = {b'URI':uri}
+        request.cancel_time_secs = time.time() + MAX_WAIT_SECS
+        self.requests.append(request)
+        return request
+
+    def add_put(self, tag, raw_data, chk_only=False):
+        request = StatefulRequest(self)
+        request.tag = tag
+        request.in_params.definition = PUT_FILE_DEF
+        request.in_params.fcp_params = {b'URI':b'CHK@'}
+        if chk_only:
+            request.in_params.fcp_params[b'GetCHKOnly'] = True
+        request.in_params.send_data = raw_data
+        request.cancel_time_secs = time.time() + MAX_WAIT_SECS
+        self.requests.append(request)
+        return request
+
+class SimTestCase(unittest.TestCase):
+    def setUp(self):
+        self.node = SimulatedNode(SIM_PARAMS)
+        self.msgs = record_messages(self.node)
+        self.connection = make_sim_connection(self.node)
+        self.client = FCPClient(self.connection)
+        self.client.message_callback = lambda client, msg: None
+
+    def tearDown(self):
+        self.connection.close()
+
+    def make_usk(self, name):
+        """ Return an (insert_uri, request_uri) tuple for a new USK. """
+        msg = self.client.generate_ssk()
+        return (msg[1][b'InsertURI'].replace(b'SSK@', b'USK@')
+                + name + b'/0',
+                msg[1][b'RequestURI'].replace(b'SSK@', b'USK@')
+                + name + b'/0')
+
+    def run_queue(self, queue, concurrent=4):
+        """ Run all the requests in queue and return the results. """
+        runner = RequestRunner(self.connection, concurrent)
+        runner.add_queue(queue)
+        count = len(queue.requests)
+        poll_until(self.connection,
+                   lambda: len(queue.results) == count, runner.kick)
+        return runner
+
+class SmokeTests(SimTestCase):
+    def test_generate_ssk(self):
+        msg = self.client.generate_ssk()
+        self.assertEqual(msg[0], b'SSKKeypair')
+        self.assertTrue(msg[1][b'InsertURI'].startswith(b'SSK@'))
+        self.assertTrue(msg[1][b'RequestURI'].startswith(b'SSK@'))
+        self.assertNotEqual(msg[1][b'InsertURI'], msg[1][b'RequestURI'])
+
+    def test_chk_round_trip(self):
+        msg = self.client.put(b'CHK@', b'hello world')
+        self.assertEqual(msg[0], b'PutSuccessful')
+        chk = msg[1][b'URI']
+        self.assertTrue(chk.startswith(b'CHK@'))
+        # Same data, same CHK.
+        self.assertEqual(self.client.put(b'CHK@', b'hello world')[1][b'URI'],
+                         chk)
+        msg = self.client.get(chk)
+        self.assertEqual(msg[0], b'AllData')
+        self.assertEqual(msg[2], b'hello world')
+
+        missing = chk.replace(b'CHK@', b'CHK@X', 1)
+        self.assertRaises(FCPError, self.client.get, missing)
+
+    def test_usk_edition_update(self):
+        insert_uri, request_uri = self.make_usk(b'test')
+        for index in range(0, 3):
+            msg = self.client.put(get_usk_for_usk_version(insert_uri, index),
+                                  b'edition %i' % index)
+            self.assertEqual(msg[0], b'PutSuccessful')
+        self.assertEqual(prefetch_usk(self.client, request_uri), 2)
+        self.assertEqual(self.client.get(
+            get_usk_for_usk_version(request_uri, 2))[2], b'edition 2')
+
+        # Subscribers hear about later editions.
+        tracker = USKTracker(self.connection)
+        try:
+            self.assertTrue(tracker.wait_until_current((request_uri,),
+                                                       MAX_WAIT_SECS))
+            self.assertTrue(tracker.is_current(request_uri))
+            self.assertEqual(tracker.latest_edition(request_uri), 2)
+            self.client.put(get_usk_for_usk_version(insert_uri, 3),
+                            b'edition 3')
+            poll_until(self.connection,
+                       lambda: tracker.latest_edition(request_uri) == 3)
+            self.assertEqual(tracker.latest_uri(request_uri),
+                             get_usk_for_usk_version(request_uri, 3))
+        finally:
+            tracker.close()
+        self.assertEqual(len(self.node.sessions[0].subscriptions), 0)
+
+class RequestRunnerTests(SimTestCase):
+    def test_coalescing(self):
+        chk = self.client.put(b'CHK@', b'shared data')[1][b'URI']
+        gets = len(get_uris(self.msgs))
+        queue = ListQueue(None)
+        for index in range(0, 3):
+            queue.add_get(index, chk)
+        runner = self.run_queue(queue)
+        for index in range(0, 3):
+            self.assertEqual(queue.results[index][0], b'AllData')
+            self.assertEqual(queue.results[index][2], b'shared data')
+        # Only one request went to the node.
+        self.assertEqual(len(get_uris(self.msgs)) - gets, 1)
+        self.assertEqual(runner.coalesced, 2)
+
+        # A recent result is reused.
+        queue = ListQueue(None)
+        queue.add_get(3, chk)
+        runner.add_queue(queue)
+        poll_until(self.connection, lambda: len(queue.results) == 1,
+                   runner.kick)
+        self.assertEqual(queue.results[3][2], b'shared data')
+        self.assertEqual(len(get_uris(self.msgs)) - gets, 1)
+
+    def test_no_coalescing(self):
+        chk = self.client.put(b'CHK@', b'shared data')[1][b'URI']
+        gets = len(get_uris(self.msgs))
+        queue = ListQueue(None)
+        for index in range(0, 3):
+            queue.add_get(index, chk)
+        runner = RequestRunner(self.connection, 4)
+        runner.coalescing = False
+        runner.add_queue(queue)
+        poll_until(self.connection, lambda: len(queue.results) == 3,
+                   runner.kick)
+        self.assertEqual(len(get_uris(self.msgs)) - gets, 3)
+
+    def test_chk_only(self):
+        queue = ListQueue(None)
+        queue.add_put(b'only', b'bundle bytes', True)
+        self.run_queue(queue)
+        msg = queue.results[b'only']
+        self.assertEqual(msg[0], b'PutSuccessful')
+        chk = msg[1][b'URI']
+
+        # Nothing was inserted.
+        self.assertRaises(FCPError, self.client.get, chk)
+
+        # But the real insert gets the same CHK.
+        queue = ListQueue(None)
+        queue.add_put(b'real', b'bundle bytes')
+        self.run_queue(queue)
+        self.assertEqual(queue.results[b'real'][1][b'URI'], chk)
+        self.assertEqual(self.client.get(chk)[2], b'bundle bytes')
+
+class USKSearchTests(SimTestCase):
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.insert_uri, self.request_uri = self.make_usk(b'repo.R1')
+        for insert_uri in make_search_uris(self.insert_uri):
+            for index in range(0, 3):
+                self.client.put(get_usk_for_usk_version(insert_uri, index),
+                                top_key_tuple_to_bytes(TOP_KEY))
+        self.tracker = USKTracker(self.connection)
+
+    def tearDown(self):
+        self.tracker.close()
+        SimTestCase.tearDown(self)
+
+    def request_heads(self, latency_model=None):
+        """ Run a top key request and return the ClientGet URIs it
+            sent. """
+        first = len(self.msgs)
+        ctx = UpdateContext(None)
+        ctx.ui_ = QuietUI()
+        ctx.usk_tracker = self.tracker
+        ctx.latency_model = latency_model
+        update_sm = UpdateStateMachine(RequestRunner(self.connection, 4),
+                                       ctx)
+        update_sm.params = UPDATE_SM_PARAMS.copy()
+        update_sm.start_requesting_heads(self.request_uri)
+        poll_until(self.connection,
+                   lambda: update_sm.current_state.name == QUIESCENT,
+                   update_sm.runner.kick)
+        self.assertTrue(update_sm.get_state(QUIESCENT).
+                        arrived_from((FINISHING,)))
+        return get_uris(self.msgs[first:])
+
+    def test_search_without_subscription(self):
+        uris = self.request_heads()
+        self.assertTrue(is_negative_usk(uris[0]))
+
+        # It subscribed, so the next request can skip the search.
+        poll_until(self.connection,
+                   lambda: self.tracker.is_current(self.request_uri))
+        self.assertEqual(self.tracker.latest_edition(self.request_uri), 2)
+        self.assertFalse(is_negative_usk(self.request_heads()[0]))
+
+    def test_no_search_when_current(self):
+        self.assertTrue(self.tracker.wait_until_current((self.request_uri,),
+                                                        MAX_WAIT_SECS))
+        uris = self.request_heads()
+        self.assertEqual(set(uris),
+                         set([get_usk_for_usk_version(uri, 2) for uri
+                              in make_search_uris(self.request_uri)]))
+
+    def test_redundant_top_keys(self):
+        self.assertTrue(self.tracker.wait_until_current((self.request_uri,),
+                                                        MAX_WAIT_SECS))
+        # No latency samples, so both are requested at once.
+        self.assertEqual(len(self.request_heads()), 2)
+
+        # The redundant key is held back while the first one is
+        # faster than usual.
+        model = LatencyModel()
+        for dummy in range(0, MIN_LATENCY_SAMPLES):
+            model.record(TOP_KEY_CLASS, MAX_WAIT_SECS, True)
+        self.assertEqual(len(self.request_heads(model)), 1)
+
+class InterruptedPushTests(SimTestCase):
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.test_dir = tempfile.mkdtemp(prefix='test_fcpsim')
+        self.ui_ = ui.ui()
+        self.ui_.setconfig(b'ui', b'username', b'test')
+        self.ui_.setconfig(b'ui', b'quiet', b'true')
+        repo_dir = os.path.join(self.test_dir, 'repo')
+        self.repo = hg.repository(self.ui_, os.fsencode(repo_dir), True)
+        for name in ('one', 'two'):
+            out_file = open(os.path.join(repo_dir, name), 'wb')
+            try:
+                out_file.write(b'%s\n' % name.encode('utf8') * 100)
+            finally:
+                out_file.close()
+            commands.add(self.ui_, self.repo,
+                         os.fsencode(os.path.join(repo_dir, name)))
+            commands.commit(self.ui_, self.repo,
+                            message=name.encode('utf8'))
+        self.cache_dir = os.fsencode(os.path.join(self.test_dir, 'cache'))
+        os.makedirs(self.cache_dir)
+        self.insert_uri = self.make_usk(b'repo')[0]
+
+    def tearDown(self):
+        SimTestCase.tearDown(self)
+        shutil.rmtree(self.test_dir)
+
+    def fail_usk_puts(self):
+        """ Make the node fail top key inserts, interrupting the push
+            after the bundles and graph are inserted.
+
+            Returns a function which undoes it. """
+        handler = self.node.HANDLERS[b'ClientPut']
+        def failing(node_, session, msg):
+            if msg[1].get(b'URI', b'CHK@').startswith(b'CHK@'):
+                handler(node_, session, msg)
+                return
+            session.send_failure(b'PutFailed', msg[1][b'Identifier'],
+                                 PUT_ROUTE_NOT_FOUND)
+        self.node.HANDLERS = self.node.HANDLERS.copy()
+        self.node.HANDLERS[b'ClientPut'] = failing
+        def undo():
+            self.node.HANDLERS[b'ClientPut'] = handler
+        return undo
+
+    def push(self):
+        """ Insert the repo with a new UpdateStateMachine, like a fresh
+            hg fn-create. Returns (succeeded, ClientPut messages). """
+        first = len(self.msgs)
+        ctx = UpdateContext(None)
+        ctx.repo = self.repo
+        ctx.ui_ = QuietUI()
+        ctx.bundle_cache = BundleCache(self.repo, self.ui_, self.cache_dir)
+        update_sm = UpdateStateMachine(RequestRunner(self.connection, 4),
+                                       ctx)
+        update_sm.params = UPDATE_SM_PARAMS.copy()
+        update_sm.start_inserting(UpdateGraph(), (b'tip', ), self.insert_uri)
+        poll_until(self.connection,
+                   lambda: update_sm.current_state.name == QUIESCENT,
+                   update_sm.runner.kick)
+        succeeded = update_sm.get_state(QUIESCENT).arrived_from((FINISHING,))
+        if succeeded:
+            self.assertEqual(update_sm.get_state(INSERTING_URI).
+                             get_request_uris()[0].split(b'/')[1], b'repo')
+        return (succeeded, [msg for msg in self.msgs[first:]
+                            if msg[0] == b'ClientPut'])
+
+    def journal_files(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.startswith(b'insert_journal_')]
+
+    def test_restart(self):
+        undo = self.fail_usk_puts()
+        succeeded, puts = self.push()
+        self.assertFalse(succeeded)
+        chk_puts = [msg for msg in puts if msg[1][b'URI'] == b'CHK@']
+        # The bundles and the two copies of the graph.
+        self.assertTrue(len(chk_puts) > 2)
+        self.assertEqual(len(self.journal_files()), 1)
+
+        # Only the top keys are inserted again.
+        undo()
+        succeeded, puts = self.push()
+        self.assertTrue(succeeded)
+        self.assertTrue(len(puts) > 0)
+        self.assertEqual([msg for msg in puts if msg[1][b'URI'] == b'CHK@'],
+                         [])
+        # Nothing left to resume.
+        self.assertEqual(self.journal_files(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+""" Unit tests for racing slow requests against redundant ones.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import unittest
+
+from .latencymodel import LatencyModel, TOP_KEY
+from .statemachine import HedgingPolicy, RetryingRequestList, \
+     CandidateRequest, MIN_HEDGE_SAMPLES
+from .updatesm import UpdateContextBase
+
+class FakeConnection:
+    def __init__(self):
+        self.uploading = False
+
+    def is_uploading(self):
+        return self.uploading
+
+class FakeRunner:
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.cancelled = []
+
+    def cancel_request(self, client):
+        self.cancelled.append(client)
+
+class FakeParent:
+    def __init__(self):
+        self.runner = FakeRunner()
+        self.ctx = UpdateContextBase(self)
+
+class RacingList(RetryingRequestList):
+    """ Candidates are [key, group, ordinal] lists. Requests for
+        candidates in the same group race each other. """
+    def __init__(self, parent):
+        RetryingRequestList.__init__(self, parent, b'RACING')
+        self.hedging = HedgingPolicy(10.0, 1.0)
+        self.spare = {}
+        self.done = []
+        self.lost = []
+
+    def make_request(self, candidate):
+        request = CandidateRequest(self.parent)
+        request.tag = candidate[0]
+        request.candidate = candidate
+        return request
+
+    def hedge_candidate(self, candidate):
+        spare = self.spare.get(candidate[1], [])
+        if len(spare) == 0:
+            return None
+        return spare.pop(0)
+
+    def hedge_group(self, candidate):
+        return candidate[1]
+
+    def hedge_ordinal(self, candidate):
+        return candidate[2]
+
+    def candidate_done(self, client, msg, candidate):
+        self.done.append((candidate, msg[0]))
+
+    def hedge_lost(self, candidate):
+        self.lost.append(candidate)
+
+    def add(self, key, group, ordinal):
+        candidate = [key, group, ordinal]
+        if ordinal == 0:
+            self.current_candidates.append(candidate)
+        else:
+            self.spare.setdefault(group, []).append(candidate)
+        return candidate
+
+    def age(self, tag, secs):
+        """ Pretend the request for tag started secs ago. """
+        self.started[tag] -= secs
+
+class HedgingPolicyTests(unittest.TestCase):
+    def test_delay_secs(self):
+        policy = HedgingPolicy(45.0, 2.0, request_class=TOP_KEY)
+        self.assertEqual(policy.delay_secs(), 45.0)
+
+        # Falls back to the latency model.
+        model = LatencyModel()
+        self.assertEqual(policy.delay_secs(model), 45.0)
+        for secs in range(1, 11):
+            model.record(TOP_KEY, float(secs), True)
+        self.assertEqual(policy.delay_secs(model), 10.0)
+        for dummy in range(0, 100):
+            model.record(TOP_KEY, 0.1, True)
+        # Never less than the floor.
+        self.assertEqual(policy.delay_secs(model), 2.0)
+
+        # Its own samples win once there are enough.
+        for secs in range(0, MIN_HEDGE_SAMPLES):
+            policy.record_latency(5.0 + secs)
+        self.assertEqual(policy.delay_secs(model), 11.0)
+        self.assertEqual(policy.delay_secs(), 11.0)
+
+    def test_preferred_ordinal(self):
+        policy = HedgingPolicy(45.0)
+        self.assertEqual(policy.preferred_ordinal([0, 1]), None)
+        policy.record_win(1)
+        self.assertEqual(policy.preferred_ordinal([0, 1]), 1)
+        policy.record_win(0)
+        self.assertEqual(policy.preferred_ordinal([0, 1]), None)
+        self.assertEqual(policy.preferred_ordinal([0]), 0)
+        self.assertEqual(policy.preferred_ordinal([]), None)
+
+class RetryingRequestListTests(unittest.TestCase):
+    def setUp(self):
+        self.parent = FakeParent()
+        self.state = RacingList(self.parent)
+
+    def test_next_hedge(self):
+        state = self.state
+        state.add(b'a0', b'a', 0)
+        a1 = state.add(b'a1', b'a', 1)
+        state.add(b'b0', b'b', 0)
+
+        first = state.next_runnable()
+        second = state.next_runnable()
+        self.assertEqual(set([first.tag, second.tag]), set([b'a0', b'b0']))
+        # Not slow yet.
+        self.assertEqual(state.next_runnable(), None)
+
+        state.age(b'a0', 11.0)
+        hedge = state.next_runnable()
+        self.assertTrue(hedge.candidate is a1)
+        self.assertTrue(b'a1' in state.pending)
+        # Only hedged once, and hedges aren't hedged.
+        state.age(b'a1', 11.0)
+        self.assertEqual(state.next_runnable(), None)
+
+        # No redundant key for b.
+        state.age(b'b0', 11.0)
+        self.assertEqual(state.next_runnable(), None)
+
+    def test_cancel_losers(self):
+        state = self.state
+        state.add(b'a0', b'a', 0)
+        state.add(b'a1', b'a', 1)
+        state.add(b'b0', b'b', 0)
+        for dummy in range(0, 2):
+            state.next_runnable()
+        state.age(b'a0', 11.0)
+        hedge = state.next_runnable()
+
+        # The hedge wins.
+        state.request_done(hedge, (b'AllData', {}, b''))
+        self.assertEqual(state.done, [(hedge.candidate, b'AllData')])
+        self.assertEqual([candidate[0] for candidate in state.lost],
+                         [b'a0', ])
+        self.assertEqual([client.tag for client
+                          in self.parent.runner.cancelled],
+                         ['orphaned_%s_%s' % (b'a0', b'RACING')])
+        self.assertEqual(list(state.pending.keys()), [b'b0', ])
+        self.assertEqual(self.parent.ctx.orphaned.keys(),
+                         set(['orphaned_%s_%s' % (b'a0', b'RACING')]))
+        self.assertEqual(state.hedging.wins, {1:1})
+        self.assertEqual(len(state.hedging.latencies), 1)
+
+        # Nothing races b0.
+        state.request_done(state.pending[b'b0'], (b'AllData', {}, b''))
+        self.assertEqual(len(state.lost), 1)
+        self.assertEqual(state.hedging.wins, {1:1})
+
+    def test_no_cancel_while_uploading(self):
+        state = self.state
+        state.add(b'a0', b'a', 0)
+        state.add(b'a1', b'a', 1)
+        first = state.next_runnable()
+        state.age(b'a0', 11.0)
+        state.next_runnable()
+
+        self.parent.runner.connection.uploading = True
+        state.request_done(first, (b'AllData', {}, b''))
+        # Orphaned, but left to finish.
+        self.assertEqual(self.parent.runner.cancelled, [])
+        self.assertEqual(len(state.pending), 0)
+        self.assertEqual(state.hedging.wins, {0:1})
+
+    def test_failure_doesnt_cancel(self):
+        state = self.state
+        state.add(b'a0', b'a', 0)
+        state.add(b'a1', b'a', 1)
+        first = state.next_runnable()
+        state.age(b'a0', 11.0)
+        state.next_runnable()
+        state.request_done(first, (b'GetFailed', {}))
+        self.assertEqual(self.parent.runner.cancelled, [])
+        self.assertEqual(list(state.pending.keys()), [b'a1', ])
+        self.assertEqual(state.hedging.wins, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+""" Unit tests for the insert journal used to resume interrupted inserts.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .graph import UpdateGraph, PENDING_INSERT, PENDING_INSERT1
+from .insertingbundles import InsertingBundles
+from .insertjournal import InsertJournal, journal_file_name, graph_key
+
+REPO_ROOT = b'/tmp/repo'
+USK = b'USK@abc,def,AQECAAE/repo/%i'
+
+class QuietUI:
+    def __init__(self):
+        self.out = []
+
+    def status(self, msg):
+        self.out.append(msg)
+
+class FakeContext(dict):
+    def __init__(self, journal):
+        dict.__init__(self)
+        self.insert_journal = journal
+        self.ui_ = QuietUI()
+
+class FakeParent:
+    def __init__(self, journal):
+        self.ctx = FakeContext(journal)
+        self.params = {}
+
+class InsertJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_insertjournal')
+        self.file_name = journal_file_name(os.fsencode(self.test_dir),
+                                           REPO_ROOT, USK % 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def read_lines(self):
+        in_file = open(self.file_name, 'rb')
+        try:
+            return in_file.read().split(b'\n')
+        finally:
+            in_file.close()
+
+    def append(self, raw_bytes):
+        out_file = open(self.file_name, 'ab')
+        try:
+            out_file.write(raw_bytes)
+        finally:
+            out_file.close()
+
+    def test_file_name(self):
+        # All editions of a USK share a journal.
+        self.assertEqual(journal_file_name(os.fsencode(self.test_dir),
+                                           REPO_ROOT, USK % 7),
+                         self.file_name)
+        self.assertNotEqual(journal_file_name(os.fsencode(self.test_dir),
+                                              b'/tmp/other', USK % 3),
+                            self.file_name)
+        self.assertNotEqual(graph_key(b'graph', (b'a' * 40, )),
+                            graph_key(b'graph', (b'a' * 40, ), 2))
+
+    def test_record_and_lookup(self):
+        journal = InsertJournal(self.file_name)
+        # Ignored until bound.
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+        self.assertTrue(journal.get_edge_chk((-1, 0, 0), 100) is None)
+        self.assertFalse(os.path.exists(self.file_name))
+
+        self.assertEqual(journal.bind(b'one'), 0)
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+        journal.record_edge((-1, 0, 1), 100, b'CHK@one')
+        journal.record_data(b'graph', b'graph bytes', b'CHK@graph')
+        journal.record_data(b'top:' + USK % 3, b'top key', USK % 3)
+        # Recording the same value again doesn't grow the file.
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+        self.assertEqual(len(self.read_lines()), 6)
+
+        journal = InsertJournal(self.file_name)
+        self.assertEqual(journal.bind(b'one'), 4)
+        self.assertEqual(journal.get_edge_chk((-1, 0, 0), 100), b'CHK@zero')
+        self.assertEqual(journal.get_edge_chk((-1, 0, 1), 100), b'CHK@one')
+        # The length is part of the key.
+        self.assertTrue(journal.get_edge_chk((-1, 0, 0), 101) is None)
+        self.assertEqual(journal.get_data_uri(b'graph', b'graph bytes'),
+                         b'CHK@graph')
+        self.assertTrue(journal.get_data_uri(b'graph', b'other') is None)
+        self.assertEqual(journal.get_data_uri(b'top:' + USK % 3, b'top key'),
+                         USK % 3)
+        self.assertTrue(journal.get_data_uri(b'top:' + USK % 4, b'top key')
+                        is None)
+
+        journal.remove()
+        self.assertFalse(os.path.exists(self.file_name))
+        self.assertTrue(journal.get_edge_chk((-1, 0, 0), 100) is None)
+
+    def test_bind_other_graph(self):
+        journal = InsertJournal(self.file_name)
+        journal.bind(b'one')
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+
+        journal = InsertJournal(self.file_name)
+        self.assertEqual(journal.bind(b'two'), 0)
+        self.assertTrue(journal.get_edge_chk((-1, 0, 0), 100) is None)
+        self.assertEqual(self.read_lines(), [b'graph two', b''])
+
+        # Discarded, not just hidden.
+        journal = InsertJournal(self.file_name)
+        self.assertEqual(journal.bind(b'one'), 0)
+
+    def test_partial_last_line(self):
+        journal = InsertJournal(self.file_name)
+        journal.bind(b'one')
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+        # The process died while writing.
+        self.append(b'edge:-1:0:1:100 CHK@o')
+
+        journal = InsertJournal(self.file_name)
+        self.assertEqual(journal.bind(b'one'), 1)
+        self.assertTrue(journal.get_edge_chk((-1, 0, 1), 100) is None)
+        # Rewritten without the partial line, so the next entry is ok.
+        journal.record_edge((-1, 0, 1), 100, b'CHK@one')
+        journal = InsertJournal(self.file_name)
+        self.assertEqual(journal.bind(b'one'), 2)
+        self.assertEqual(journal.get_edge_chk((-1, 0, 1), 100), b'CHK@one')
+
+        # A partial first line.
+        journal.remove()
+        self.append(b'graph on')
+        self.assertEqual(InsertJournal(self.file_name).bind(b'one'), 0)
+
+    def make_state(self, journal, reinsert=0):
+        graph = UpdateGraph()
+        graph.add_edge((-1, 0), (100, PENDING_INSERT))
+        graph.add_edge((-1, 0), (100, PENDING_INSERT1))
+        graph.add_edge((0, 1), (200, PENDING_INSERT))
+        state = InsertingBundles(FakeParent(journal), b'INSERTING_BUNDLES')
+        state.parent.ctx[b'REINSERT'] = reinsert
+        state.new_edges = [(-1, 0, 0), (-1, 0, 1), (0, 1, 0)]
+        return state, graph
+
+    def test_skip_journaled_edges(self):
+        journal = InsertJournal(self.file_name)
+        journal.bind(b'one')
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+        # Different length, so not the same bundle.
+        journal.record_edge((0, 1, 0), 201, b'CHK@two')
+
+        # Restarted.
+        journal = InsertJournal(self.file_name)
+        journal.bind(b'one')
+        state, graph = self.make_state(journal)
+        state._replay_journal(graph)
+        self.assertEqual(state.new_edges, [(-1, 0, 1), (0, 1, 0)])
+        self.assertEqual(graph.get_chk((-1, 0, 0)), b'CHK@zero')
+        self.assertEqual(graph.get_chk((0, 1, 0)), PENDING_INSERT)
+        self.assertEqual(state.parent.ctx.ui_.out,
+                         [b"Skipping 1 edge(s) inserted before the "
+                          + b"interruption.\n"])
+
+        # Nothing to skip without a journal.
+        state, graph = self.make_state(None)
+        state._replay_journal(graph)
+        self.assertEqual(len(state.new_edges), 3)
+
+    def test_skip_reinserted_edges(self):
+        journal = InsertJournal(self.file_name)
+        journal.bind(b'one')
+        journal.record_edge((-1, 0, 0), 100, b'CHK@zero')
+        journal.record_edge((0, 1, 0), 200, b'CHK@changed')
+        state, graph = self.make_state(journal, 2)
+        graph.set_chk((-1, 0), 0, 100, b'CHK@zero')
+        graph.set_chk((0, 1), 0, 200, b'CHK@two')
+        state._replay_journal(graph)
+        # The graph's CHK wins if they don't match.
+        self.assertEqual(state.new_edges, [(-1, 0, 1), (0, 1, 0)])
+        self.assertEqual(graph.get_chk((0, 1, 0)), b'CHK@two')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+""" Unit tests for the request metrics.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from .requestmetrics import Histogram, RequestMetrics, key_type, outcome
+
+class HistogramTests(unittest.TestCase):
+    def test_cumulative(self):
+        histogram = Histogram((1.0, 5.0))
+        self.assertEqual(histogram.cumulative(),
+                         [('1.0', 0), ('5.0', 0), ('+Inf', 0)])
+        for value in (0.5, 1.0, 3.0, 10.0, 20.0):
+            histogram.observe(value)
+        # Bounds are inclusive.
+        self.assertEqual(histogram.cumulative(),
+                         [('1.0', 2), ('5.0', 3), ('+Inf', 5)])
+        self.assertEqual(histogram.counts, [2, 1, 2])
+        self.assertEqual(histogram.total, 34.5)
+        self.assertEqual(histogram.to_dict(),
+                         {'buckets':{'1.0':2, '5.0':3, '+Inf':5},
+                          'sum':34.5, 'count':5})
+
+    def test_labels(self):
+        self.assertEqual(key_type(b'CHK@abc,def,AAIC--8'), b'CHK')
+        self.assertEqual(key_type('usk@abc/name/1'), b'USK')
+        self.assertEqual(key_type(None), b'NONE')
+        self.assertEqual(outcome((b'AllData', {})), b'AllData')
+        self.assertEqual(outcome((b'GetFailed', {b'Code':b'28'})),
+                         b'GetFailed:28')
+
+class RequestMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_requestmetrics')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def age_state(self, metrics, queue, secs):
+        """ Pretend queue entered its current state secs ago. """
+        name, entered = metrics.current_states[queue]
+        metrics.current_states[queue] = (name, entered - secs)
+
+    def test_state_changed(self):
+        metrics = RequestMetrics()
+        # Unknown entry time.
+        metrics.state_changed(b'A', b'B', 'one')
+        self.assertEqual(metrics.states, {})
+
+        metrics.state_changed(b'A', b'B', 'two')
+        self.age_state(metrics, 'one', 3.0)
+        self.age_state(metrics, 'two', 0.3)
+        # Interleaved changes from two queues don't mix up their times.
+        metrics.state_changed(b'B', b'C', 'two')
+        metrics.state_changed(b'B', b'C', 'one')
+        self.assertEqual(metrics.states[b'B'].cumulative()[:3],
+                         [('0.1', 0), ('0.5', 1), ('1.0', 1)])
+        self.assertEqual(metrics.states[b'B'].count, 2)
+        self.assertTrue(metrics.states[b'B'].total >= 3.3)
+
+        # Out of sync from_name isn't recorded.
+        metrics.state_changed(b'X', b'D', 'one')
+        self.assertFalse(b'X' in metrics.states)
+        self.assertFalse(b'C' in metrics.states)
+
+    def make_metrics(self, file_name=None):
+        metrics = RequestMetrics(file_name)
+        metrics.record_request(b'REQUESTING_URI', b'USK',
+                               {'queue_wait':0.05, 'first_msg':0.2,
+                                'latency':2.0, 'bytes_in':10,
+                                'bytes_out':20, 'retries':1,
+                                'outcome':b'GetFailed:28'})
+        metrics.record_request(b'REQUESTING_URI', b'USK',
+                               {'latency':7.0, 'outcome':b'AllData'})
+        metrics.state_changed(b'A', b'B', None)
+        self.age_state(metrics, None, 1.5)
+        metrics.state_changed(b'B', b'C', None)
+        metrics.set_counter('bytes_sent', 1000)
+        metrics.set_counter('running_requests', 3)
+        return metrics
+
+    def test_to_prometheus(self):
+        lines = self.make_metrics().to_prometheus().splitlines()
+        for line in (
+            '# TYPE infocalypse_bytes_sent counter',
+            'infocalypse_bytes_sent 1000',
+            '# TYPE infocalypse_running_requests gauge',
+            'infocalypse_running_requests 3',
+            '# TYPE infocalypse_state_seconds histogram',
+            'infocalypse_state_seconds_bucket{state="B",le="1.0"} 0',
+            'infocalypse_state_seconds_bucket{state="B",le="2.5"} 1',
+            'infocalypse_state_seconds_bucket{state="B",le="+Inf"} 1',
+            'infocalypse_state_seconds_count{state="B"} 1',
+            '# TYPE infocalypse_request_latency_seconds histogram',
+            'infocalypse_request_latency_seconds_bucket'
+            + '{state="REQUESTING_URI",key_type="USK",le="5.0"} 1',
+            'infocalypse_request_latency_seconds_bucket'
+            + '{state="REQUESTING_URI",key_type="USK",le="+Inf"} 2',
+            'infocalypse_request_latency_seconds_sum'
+            + '{state="REQUESTING_URI",key_type="USK"} 9.000000',
+            'infocalypse_request_latency_seconds_count'
+            + '{state="REQUESTING_URI",key_type="USK"} 2',
+            # Missing times aren't recorded.
+            'infocalypse_request_first_msg_seconds_count'
+            + '{state="REQUESTING_URI",key_type="USK"} 1',
+            '# TYPE infocalypse_request_retries counter',
+            'infocalypse_request_retries'
+            + '{state="REQUESTING_URI",key_type="USK"} 1',
+            'infocalypse_request_bytes_out'
+            + '{state="REQUESTING_URI",key_type="USK"} 20',
+            '# TYPE infocalypse_requests counter',
+            'infocalypse_requests{state="REQUESTING_URI",key_type="USK",'
+            + 'outcome="AllData"} 1',
+            'infocalypse_requests{state="REQUESTING_URI",key_type="USK",'
+            + 'outcome="GetFailed:28"} 1'):
+            self.assertTrue(line in lines, line)
+        # One TYPE line per metric.
+        types = [line.split()[2] for line in lines if line.startswith('#')]
+        self.assertEqual(len(types), len(set(types)))
+
+    def test_write(self):
+        file_name = os.path.join(self.test_dir, 'metrics.json')
+        metrics = self.make_metrics(file_name)
+        metrics.maybe_write()
+        # Not time to write yet.
+        self.assertFalse(os.path.exists(file_name))
+        metrics.next_write = time.time() - 1
+        metrics.maybe_write()
+        values = json.load(open(file_name))
+        self.assertEqual(values['counters']['bytes_sent'], 1000)
+        self.assertEqual(values['states']['B']['count'], 1)
+        self.assertEqual(values['requests'][0]['outcomes'],
+                         {'AllData':1, 'GetFailed:28':1})
+        # Written to a tmp file and renamed.
+        self.assertEqual(os.listdir(self.test_dir), ['metrics.json'])
+
+        prom_name = os.path.join(self.test_dir, 'metrics.prom')
+        metrics.file_name = prom_name
+        metrics.write()
+        self.assertEqual(open(prom_name).read(), metrics.to_prometheus())
+        self.assertEqual(sorted(os.listdir(self.test_dir)),
+                         ['metrics.json', 'metrics.prom'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+""" Unit tests for inserting unchanged freesite files as redirects.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .fcpclient import set_index_file
+from .sitecmds import SiteManifest, fixed_edition_uri, \
+     MAX_REDIRECT_INSERTS, MAX_REDIRECT_AGE_SECS
+
+KEY = b'SSK@abc,def,AQACAAE'
+NOW = 1000000000.0
+
+class SiteManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.site_root = tempfile.mkdtemp(prefix='test_sitecmds')
+        for name in ('index.html', 'Big', 'Small'):
+            self.write_file(name, b'x' * 2048)
+        self.write_file('Small', b'small')
+
+    def tearDown(self):
+        shutil.rmtree(self.site_root)
+
+    def write_file(self, name, data):
+        out_file = open(os.path.join(self.site_root, name), 'wb')
+        try:
+            out_file.write(data)
+        finally:
+            out_file.close()
+
+    def redirects(self, manifest, now=NOW):
+        infos = manifest.update()
+        set_index_file(infos, 'index.html')
+        return manifest.get_redirects(infos, now)
+
+    def test_fixed_edition_uri(self):
+        self.assertEqual(fixed_edition_uri(b'USK@abc,def,AQACAAE/site/7/'),
+                         b'SSK@abc,def,AQACAAE/site-7/')
+        self.assertEqual(fixed_edition_uri(b'SSK@abc,def,AQACAAE/site-7/'),
+                         b'SSK@abc,def,AQACAAE/site-7/')
+
+    def test_redirects(self):
+        manifest = SiteManifest(self.site_root)
+        self.assertEqual(self.redirects(manifest), {})
+        manifest.inserted(b'USK@abc,def,AQACAAE/site/1/', {}, NOW)
+
+        # Survives reloading.
+        manifest = SiteManifest(self.site_root)
+        # The default file and small files are always uploaded.
+        self.assertEqual(self.redirects(manifest),
+                         {'Big':'SSK@abc,def,AQACAAE/site-1/Big'})
+        manifest.inserted(KEY + b'/site-2', {'Big':None}, NOW)
+        self.assertEqual(manifest.entries['Small'][2],
+                         'SSK@abc,def,AQACAAE/site-2/Small')
+        # Still points at the edition with the data.
+        self.assertEqual(self.redirects(manifest),
+                         {'Big':'SSK@abc,def,AQACAAE/site-1/Big'})
+
+        # Changed files are uploaded.
+        self.write_file('Big', b'y' * 2048)
+        self.assertEqual(self.redirects(manifest), {})
+
+    def test_reupload(self):
+        manifest = SiteManifest(self.site_root)
+        self.redirects(manifest)
+        manifest.inserted(KEY + b'/site-0/', {}, NOW)
+        for index in range(1, MAX_REDIRECT_INSERTS):
+            redirects = self.redirects(manifest)
+            self.assertEqual(list(redirects.keys()), ['Big', ])
+            manifest.inserted(KEY + b'/site-%i/' % index, redirects, NOW)
+        # Too many inserts since it was uploaded.
+        self.assertEqual(self.redirects(manifest), {})
+        manifest.inserted(KEY + b'/site-%i/' % MAX_REDIRECT_INSERTS, {}, NOW)
+        self.assertEqual(self.redirects(manifest),
+                         {'Big':'SSK@abc,def,AQACAAE/site-%i/Big'
+                          % MAX_REDIRECT_INSERTS})
+
+        # Too old.
+        self.assertEqual(self.redirects(manifest,
+                                        NOW + MAX_REDIRECT_AGE_SECS), {})
+
+if __name__ == '__main__':
+    unittest.main()
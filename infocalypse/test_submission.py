@@ -0,0 +1,172 @@
+""" Unit tests for applying batches of wiki submissions.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+from mercurial import ui, hg, commands
+
+from .graph import hex_version
+from .submission import ForkingSubmissionHandler, pack_info, utf8_sha, \
+     unicode_make_patch, REJECT_ILLEGAL
+
+PAGES = ('FrontPage', 'PageOne', 'PageTwo')
+
+class Logging:
+    def __init__(self):
+        self.warnings = []
+    def trace(self, msg):
+        pass
+    def debug(self, msg):
+        pass
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+class SubmissionTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_submission')
+        self.ui_ = ui.ui()
+        self.ui_.setconfig(b'ui', b'username', b'test')
+        self.ui_.setconfig(b'ui', b'quiet', b'true')
+        self.repo = hg.repository(self.ui_, os.fsencode(self.test_dir), True)
+        self.wiki_root = os.path.join(self.test_dir, 'wiki_root')
+        os.makedirs(os.path.join(self.wiki_root, 'wikitext'))
+        for name in PAGES:
+            self.write_file(os.path.join('wikitext', name), 'page %s\n' % name)
+        for name in [os.path.join('wikitext', name) for name in PAGES] + [
+            'accepted.txt', 'rejected.txt']:
+            if not os.path.exists(os.path.join(self.wiki_root, name)):
+                self.write_file(name, '')
+            commands.add(self.ui_, self.repo,
+                         os.fsencode(os.path.join(self.wiki_root, name)))
+        commands.commit(self.ui_, self.repo, message=b'base')
+        self.base = hex_version(self.repo, b'tip').decode('ascii')
+
+        self.finished = []
+        self.handler = ForkingSubmissionHandler()
+        self.handler.ui_ = self.ui_
+        self.handler.repo = self.repo
+        self.handler.logger = Logging()
+        self.handler.base_dir = 'wiki_root'
+        self.handler.notify_finished = lambda msg_ids: self.finished.append(
+            list(msg_ids))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, name, text):
+        out_file = open(os.path.join(self.wiki_root, name), 'wb')
+        try:
+            out_file.write(text.encode('utf8'))
+        finally:
+            out_file.close()
+
+    def read_file(self, name):
+        in_file = open(os.path.join(self.wiki_root, name), 'rb')
+        try:
+            return in_file.read().decode('utf8')
+        finally:
+            in_file.close()
+
+    def make_submission(self, msg_id, name, new_text):
+        """ Return a submission which changes a page from the base
+            version. """
+        buf = io.BytesIO()
+        arch = ZipFile(buf, 'w')
+        arch.writestr('__INFO__', pack_info(self.base, 'submitter'))
+        old_text = 'page %s\n' % name
+        arch.writestr(name, utf8_sha(old_text).digest()
+                      + utf8_sha(new_text).digest()
+                      + unicode_make_patch(old_text, new_text))
+        arch.close()
+        return (msg_id, ('fms_' + msg_id, 'hash', self.base[:12],
+                         'CHK@' + msg_id, 0), buf.getvalue())
+
+    def corrupt_submission(self, msg_id):
+        return (msg_id, ('fms_' + msg_id, 'hash', self.base[:12],
+                         'CHK@' + msg_id, 0), b'Not a zip file.')
+
+    def commit_count(self):
+        return len(self.repo.unfiltered().changelog)
+
+    def test_apply_submissions(self):
+        submissions = [self.make_submission('one', 'PageOne', 'One.\n'),
+                       self.make_submission('two', 'PageTwo', 'Two.\n'),
+                       # Conflict with the first two.
+                       self.make_submission('three', 'PageOne', 'Three.\n'),
+                       self.make_submission('four', 'PageTwo', 'Four.\n'),
+                       self.corrupt_submission('five')]
+        self.assertEqual(self.handler.apply_submissions(submissions), 4)
+
+        # The corrupt one is rejected while the others are checked, the
+        # independent ones are committed together, then the rest one
+        # at a time.
+        self.assertEqual(self.finished, [['five'], ['one', 'two'],
+                                         ['three'], ['four']])
+        self.assertEqual(self.commit_count(), 4)
+        self.assertEqual(self.read_file('wikitext/PageOne'), 'One.\n')
+        self.assertEqual(self.read_file('wikitext/PageTwo'), 'Two.\n')
+        forks = sorted([name for name in os.listdir(
+            os.path.join(self.wiki_root, 'wikitext')) if name.find('_') != -1])
+        self.assertEqual([name.split('_')[0] for name in forks],
+                         ['PageOne', 'PageTwo'])
+        self.assertEqual(self.read_file('wikitext/' + forks[0]), 'Three.\n')
+        self.assertEqual(forks[0].split('_')[1],
+                         utf8_sha('Three.\n').hexdigest())
+
+        rejected = self.read_file('rejected.txt').splitlines()
+        self.assertEqual(len(rejected), 1)
+        self.assertTrue(rejected[0].endswith(':CHK@five:%i' % REJECT_ILLEGAL))
+        accepted = self.read_file('accepted.txt')
+        for msg_id in ('one', 'two', 'three', 'four'):
+            self.assertTrue(accepted.find('CHK@' + msg_id) != -1)
+
+    def test_apply_corrupt_submission(self):
+        self.assertFalse(self.handler.apply_submission(
+            *(self.corrupt_submission('one') + (None, ))))
+        self.assertEqual(self.finished, [['one']])
+        self.assertEqual(len(self.handler.logger.warnings), 1)
+        self.assertTrue(self.read_file('rejected.txt').endswith(
+            ':CHK@one:%i\n' % REJECT_ILLEGAL))
+
+    def test_not_finished_before_commit(self):
+        def commit_batch(dummy_entries):
+            raise IOError("Commit failed.")
+        self.handler.commit_batch = commit_batch
+        submissions = [self.make_submission('one', 'PageOne', 'One.\n'),
+                       self.make_submission('two', 'PageTwo', 'Two.\n'),
+                       self.corrupt_submission('three')]
+        self.assertRaises(IOError, self.handler.apply_submissions,
+                          submissions)
+        # The others are still running, so they are retried.
+        self.assertEqual(self.finished, [['three']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+""" Unit tests for the wikibot's persistent sqlite store.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# OK to be a little sloppy for test code.
+# pylint: disable-msg=C0111
+# For setUp() and tearDown()
+# pylint: disable-msg=C0103
+
+import os
+import shelve
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from .wikibotctx import WikiBotContext, open_store, STORE_FILE, \
+     STORE_VERSION
+
+USK_HASH = 'abcdef012345'
+
+def submission(msg_id):
+    return ('fms_' + msg_id, 'hash', 'abcdef012345', 'CHK@' + msg_id, 0)
+
+class FakeRunner:
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def get_path(self, bot, fname):
+        return os.path.join(self.base_dir, bot.name + '_' + fname)
+
+class FakeBot:
+    def __init__(self, base_dir):
+        self.name = 'wikibot'
+        self.parent = FakeRunner(base_dir)
+        self.params = {}
+        self.debugs = []
+
+    def trace(self, msg):
+        pass
+
+    def debug(self, msg):
+        self.debugs.append(msg)
+
+class WikiBotContextTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='test_wikibotctx')
+        self.bot = FakeBot(self.test_dir)
+        self.ctx = None
+
+    def tearDown(self):
+        if not self.ctx is None:
+            self.ctx.close_dbs()
+        shutil.rmtree(self.test_dir)
+
+    def open_ctx(self):
+        """ Open a new context on the store, like a restarted bot. """
+        if not self.ctx is None:
+            self.ctx.close_dbs()
+        self.ctx = WikiBotContext(self.bot)
+        self.ctx.setup_dbs({'USK_HASH':USK_HASH, 'LATEST_INDEX':3,
+                            'INSERT_URI':None, 'REQUEST_URI':None})
+        return self.ctx
+
+    def write_shelve(self, name, values):
+        store = shelve.open(self.bot.parent.get_path(self.bot, name), 'c')
+        try:
+            for key, value in values.items():
+                store[key] = value
+        finally:
+            store.close()
+
+    def pop_all(self, ctx):
+        msg_ids = []
+        while True:
+            msg_id = ctx.pop_msg_id()
+            if msg_id is None:
+                return msg_ids
+            msg_ids.append(msg_id)
+
+    def test_import_shelves(self):
+        self.write_shelve('store_handled_ids', {'one':'', 'two':''})
+        self.write_shelve('store_applied_requests', {'CHK@one':''})
+        self.write_shelve('store_info', {'USK_HASH':USK_HASH,
+                                         'LATEST_INDEX':7})
+        running = {'running':['two', 'three'], 'queued':['four', 'five']}
+        for msg_id in ('two', 'three', 'four', 'five'):
+            running[msg_id] = submission(msg_id)
+        self.write_shelve('store_running_requests', running)
+
+        ctx = self.open_ctx()
+        self.assertTrue('one' in ctx.store_handled_ids)
+        self.assertTrue('two' in ctx.store_handled_ids)
+        self.assertEqual(len(ctx.store_handled_ids), 2)
+        self.assertTrue('CHK@one' in ctx.store_applied_requests)
+        self.assertFalse('CHK@two' in ctx.store_applied_requests)
+        # Kept because it is newer than the param.
+        self.assertEqual(ctx.store_info['LATEST_INDEX'], 7)
+
+        # Running requests were requeued ahead of the queued ones.
+        self.assertEqual(ctx.running_count(), 0)
+        self.assertEqual(ctx.queued_count(), 4)
+        self.assertEqual(ctx.get_submission('three'), submission('three'))
+        self.assertEqual(self.pop_all(ctx), ['two', 'three', 'four', 'five'])
+
+        # Only imported into a newly created store.
+        self.write_shelve('store_handled_ids', {'six':''})
+        ctx = self.open_ctx()
+        self.assertFalse('six' in ctx.store_handled_ids)
+
+    def test_fifo_across_crash(self):
+        ctx = self.open_ctx()
+        self.assertFalse(ctx.has_submissions())
+        for msg_id in ('one', 'two', 'three', 'four'):
+            ctx.queue_submission(msg_id, submission(msg_id))
+        self.assertEqual(ctx.pop_msg_id(), 'one')
+        self.assertEqual(ctx.pop_msg_id(), 'two')
+        self.assertEqual(ctx.finish_submissions(('one', )),
+                         [submission('one'), ])
+
+        # Crash with 'two' running.
+        ctx = self.open_ctx()
+        self.assertEqual(ctx.running_count(), 0)
+        self.assertEqual(ctx.queued_count(), 3)
+        ctx.queue_submission('five', submission('five'))
+        self.assertEqual(self.pop_all(ctx), ['two', 'three', 'four', 'five'])
+        self.assertEqual(ctx.running_count(), 4)
+
+        self.assertEqual(ctx.finish_submissions(('three', 'two')),
+                         [submission('three'), submission('two')])
+        self.assertEqual(ctx.finish_submission('five'), submission('five'))
+        self.assertRaises(KeyError, ctx.get_submission, 'five')
+        self.assertTrue(ctx.has_submissions())
+        ctx.finish_submission('four')
+        self.assertFalse(ctx.has_submissions())
+
+    def test_duplicate_msg_id(self):
+        ctx = self.open_ctx()
+        ctx.queue_submission('one', submission('one'))
+        self.assertRaises(sqlite3.IntegrityError, ctx.queue_submission,
+                          'one', submission('one'))
+        # Still a duplicate while it is running.
+        self.assertEqual(ctx.pop_msg_id(), 'one')
+        self.assertRaises(sqlite3.IntegrityError, ctx.queue_submission,
+                          'one', submission('one'))
+        self.assertEqual(ctx.running_count(), 1)
+        self.assertEqual(ctx.queued_count(), 0)
+
+    def test_wrong_version(self):
+        file_name = os.path.join(self.test_dir, STORE_FILE)
+        conn, created = open_store(file_name)
+        self.assertTrue(created)
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'version'",
+                     (STORE_VERSION + '0', ))
+        conn.commit()
+        conn.close()
+        self.assertRaises(IOError, open_store, file_name)
+
+        conn = sqlite3.connect(file_name)
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'version'",
+                     (STORE_VERSION, ))
+        conn.commit()
+        conn.close()
+        conn, created = open_store(file_name)
+        self.assertFalse(created)
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
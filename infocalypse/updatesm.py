@@ -34,7 +34,11 @@ from .fcpmessage import GET_DEF, PUT_FILE_DEF, GET_REQUEST_URI_DEF
 from .requestqueue import RequestQueue
 
 from .chk import clear_control_bytes
+from .latencymodel import request_class as guess_request_class, \
+     should_retry, INSERT, TOP_KEY
 from .bundlecache import make_temp_file, BundleException
+from .chkstore import append_to
+from .insertjournal import InsertJournal, journal_file_name
 from .graph import INSERT_NORMAL, INSERT_PADDED, INSERT_SALTED_METADATA, \
      INSERT_HUGE, FREENET_BLOCK_LEN, has_version, \
      pull_bundle, hex_version
@@ -43,7 +47,8 @@ from .choose import get_top_key_updates
 
 from .statemachine import StatefulRequest, RequestQueueState, StateMachine, \
      Quiescent, Canceling, RetryingRequestList, CandidateRequest, \
-     DecisionState, RunningSingleRequest, require_state, delete_client_file
+     DecisionState, RunningSingleRequest, require_state, delete_client_file, \
+     HedgingPolicy
 
 from .insertingbundles import InsertingBundles
 from .requestingbundles import RequestingBundles
@@ -58,6 +63,13 @@ PAD_BYTE = b'\xff'
 
 MAX_SSK_LEN = 1024
 
+# Time to wait before racing a slow top key request against a request
+# for the redundant top key, when there are no latency samples to go
+# on. i.e. Request both at once.
+URI_HEDGE_DELAY_SECS = 0
+# Never wait less than this once there are samples.
+URI_HEDGE_MIN_DELAY_SECS = 2.0
+
 class UpdateContextBase(dict):
     """ A class to hold inter-state data used while the state machine is
         running. """
@@ -72,6 +84,12 @@ class UpdateContextBase(dict):
         self.ui_ = None
         self.repo = None
         self.bundle_cache = None
+        # Optional usktracker.USKTracker with the latest known editions.
+        self.usk_tracker = None
+        # Optional latencymodel.LatencyModel used to set timeouts.
+        self.latency_model = None
+        # Optional insertjournal.InsertJournal of completed inserts.
+        self.insert_journal = None
 
         # Orphaned request handling hmmm...
         self.orphaned = {}
@@ -83,22 +101,48 @@ class UpdateContextBase(dict):
         self[b'INSERT_URI'] = b'CHK@'
         self[b'REQUEST_URI'] = None
 
-    def set_cancel_time(self, request):
-        """ Sets the timeout on a QueueableRequest. """
-        request.cancel_time_secs = time.time() \
-                                   + self.parent.params['CANCEL_TIME_SECS']
+    def set_cancel_time(self, request, request_class=None, length=None):
+        """ Sets the timeout on a QueueableRequest.
+
+            The timeout comes from the latency model if there is one.
+            request_class and length are guessed if they aren't set.
+            See latencymodel.request_class(). """
+        timeout = self.parent.params['CANCEL_TIME_SECS']
+        if not self.latency_model is None:
+            if not length is None:
+                request.expected_length = length
+            if not request_class is None:
+                request.request_class = request_class
+            elif request.request_class is None:
+                request.request_class = guess_request_class(
+                    request, request.expected_length)
+            timeout = self.latency_model.timeout_secs(
+                request.request_class, timeout,
+                self.parent.params.get('MAX_CANCEL_TIME_SECS', timeout),
+                request.expected_length)
+        request.cancel_time_secs = time.time() + timeout
+
+    def retry_delay_secs(self, request_class, tries):
+        """ Return how long to wait before retrying a request. """
+        if self.latency_model is None:
+            return 0
+        return self.latency_model.retry_delay_secs(request_class, tries)
 
     def orphan_requests(self, from_state):
         """ Give away requests that should be allowed to keep running. """
         if not hasattr(from_state, 'pending') or len(from_state.pending) == 0:
             return
 
-        for tag in from_state.pending:
-            request = from_state.pending[tag]
-            request.tag = "orphaned_%s_%s" % (str(request.tag), from_state.name)
-            assert not request.tag in self.orphaned
-            self.orphaned[request.tag] = request
-        from_state.pending.clear()
+        for tag in list(from_state.pending.keys()):
+            self.orphan_request(from_state, tag)
+        assert len(from_state.pending) == 0
+
+    def orphan_request(self, from_state, tag):
+        """ Give away a single pending request from from_state. """
+        request = from_state.pending.pop(tag)
+        request.tag = "orphaned_%s_%s" % (str(request.tag), from_state.name)
+        assert not request.tag in self.orphaned
+        self.orphaned[request.tag] = request
 
 
 class UpdateContext(UpdateContextBase):
@@ -195,7 +239,7 @@ class UpdateContext(UpdateContextBase):
         request.in_params.send_data = True
         if not mime_type is None:
             request.in_params.fcp_params[b'Metadata.ContentType'] = mime_type
-        self.set_cancel_time(request)
+        self.set_cancel_time(request, INSERT, self.graph.insert_length(edge))
         return request
 
     def _get_bundle(self, edge, pad):
@@ -220,12 +264,8 @@ class UpdateContext(UpdateContextBase):
                                       % (original_len, bundle[0]))
             assert bundle[0] == original_len
             if pad:
-                out_file = open(tmp_file, 'ab')
-                try:
-                    out_file.seek(0, os.SEEK_END)
-                    out_file.write(PAD_BYTE)
-                finally:
-                    out_file.close()
+                # tmp_file can be a hard link into the bundle cache.
+                append_to(tmp_file, PAD_BYTE)
 
             assert expected_len == os.path.getsize(tmp_file)
             raised = False
@@ -296,13 +336,45 @@ class StaticRequestList(RetryingRequestList):
         self.current_candidates.insert(0, candidate)
         self.ordered.append(candidate)
 
-    def should_retry(self, dummy_client, dummy_msg, candidate):
+    def replay_insert(self, candidate, uri):
+        """ Add an insert candidate which already finished in an
+            earlier run. See insertjournal. """
+        assert candidate[2]
+        candidate[5] = (b'PutSuccessful', {b'URI':uri})
+        self.ordered.append(candidate)
+        self.finished_candidates.append(candidate)
+        self.required_successes -= 1
+
+    def queue_insert(self, candidate, journal_key):
+        """ Queue an insert candidate unless the insert journal says
+            it already finished. """
+        journal = self.parent.ctx.insert_journal
+        if not journal is None:
+            uri = journal.get_data_uri(journal_key, candidate[3])
+            if not uri is None:
+                self.replay_insert(candidate, uri)
+                return
+        self.queue(candidate)
+
+    def record_insert(self, msg, candidate, journal_key):
+        """ Record a finished insert in the insert journal. """
+        journal = self.parent.ctx.insert_journal
+        if (not journal is None and candidate[2]
+            and msg[0] == b'PutSuccessful'):
+            journal.record_data(journal_key, candidate[3], msg[1][b'URI'])
+
+    def should_retry(self, client, msg, candidate):
         """ Returns True if the request candidate should be retried,
             False otherwise. """
         # REDFLAG: rationalize parameter names
         # ATL == Above the Line
         max_retries = self.parent.params.get('MAX_ATL_RETRIES', 0)
-        return candidate[1] > max_retries + 1
+        if not should_retry(msg, candidate[1], max_retries):
+            return False
+        self.delay_candidate(candidate,
+                             self.parent.ctx.retry_delay_secs(
+                                 client.request_class, candidate[1]))
+        return True
 
     # Override to provide better tags.
     # tags MUST uniquely map to candidates.
@@ -410,9 +482,19 @@ class InsertingGraph(StaticRequestList):
         assert len(graph_bytes) <= 31 * 1024
 
         # Insert the graph twice for redundancy
-        self.queue([b'CHK@', 0, True, b'#A\n' + graph_bytes, None, None])
-        self.queue([b'CHK@', 0, True, b'#B\n' + graph_bytes, None, None])
         self.required_successes = 2
+        self.queue_insert([b'CHK@', 0, True, b'#A\n' + graph_bytes,
+                           None, None], b'graph')
+        self.queue_insert([b'CHK@', 0, True, b'#B\n' + graph_bytes,
+                           None, None], b'graph')
+        if self.required_successes <= 0:
+            self.parent.ctx.ui_.status(b"Graph already inserted.\n")
+            self.parent.transition(self.success_state)
+
+    def candidate_done(self, client, msg, candidate):
+        """ Implementation of RetryingRequestList virtual. """
+        self.record_insert(msg, candidate, b'graph')
+        StaticRequestList.candidate_done(self, client, msg, candidate)
 
     def leave(self, to_state):
         """ Implementation of State virtual.
@@ -517,18 +599,29 @@ class InsertingUri(StaticRequestList):
         insert_uris = make_frozen_uris(self.parent.ctx[b'INSERT_URI'],
                                        should_increment(self))
         assert len(insert_uris) < 3
+        self.required_successes = len(insert_uris)
         for index, uri in enumerate(insert_uris):
             if self.parent.params.get('DUMP_URIS', False):
                 self.parent.ctx.ui_.status(b"INSERT_URI: %s\n" % uri)
-            self.queue([uri, 0, True,
-                        self.topkey_funcs.top_key_tuple_to_bytes(top_key_tuple,
-                                                                 salt[index]),
-                        None, None])
-        self.required_successes = len(insert_uris)
+            self.queue_insert([uri, 0, True,
+                               self.topkey_funcs.top_key_tuple_to_bytes(
+                                   top_key_tuple, salt[index]),
+                               None, None], b'top:' + uri)
+        if self.required_successes <= 0:
+            self.parent.ctx.ui_.status(b"Top key already inserted.\n")
+            self.parent.transition(self.success_state)
+
+    def candidate_done(self, client, msg, candidate):
+        """ Implementation of RetryingRequestList virtual. """
+        self.record_insert(msg, candidate, b'top:' + candidate[0])
+        StaticRequestList.candidate_done(self, client, msg, candidate)
 
     def leave(self, to_state):
         """ Implementation of State virtual. """
         if to_state.name == self.success_state:
+            if not self.parent.ctx.insert_journal is None:
+                # Nothing left to resume.
+                self.parent.ctx.insert_journal.remove()
             # Hmmm... what about chks?
             # Update the index in the insert_uri on success
             if (should_increment(self) and
@@ -568,6 +661,18 @@ class RequestingUri(StaticRequestList):
         # Git'r done for now.
         self.topkey_funcs = topkey
 
+        self.hedging = HedgingPolicy(URI_HEDGE_DELAY_SECS,
+                                     URI_HEDGE_MIN_DELAY_SECS,
+                                     request_class=TOP_KEY)
+        # Redundant URI candidates which are only run if the first
+        # one is slow or fails.
+        self.hedge_reserve = []
+
+    def reset(self):
+        """ Implementation of State virtual. """
+        StaticRequestList.reset(self)
+        self.hedge_reserve = []
+
     def enter(self, dummy):
         """ Implementation of State virtual. """
         #require_state(from_state, QUIESCENT)
@@ -575,7 +680,19 @@ class RequestingUri(StaticRequestList):
         #print self.parent.ctx[b'REQUEST_URI']
 
         request_uri = self.parent.ctx[b'REQUEST_URI']
-        if (is_usk(request_uri) and
+        tracker = self.parent.ctx.usk_tracker
+        is_current = False
+        if (is_usk(request_uri) and not tracker is None and
+            not self.parent.params['NO_SEARCH']):
+            # A NOP if setup() already subscribed. Otherwise it keeps
+            # the edition current for later requests on the connection.
+            tracker.subscribe(request_uri)
+            # Start from the latest edition we know about.
+            request_uri = tracker.latest_uri(request_uri)
+            # No point in making the node search again.
+            is_current = tracker.is_current(request_uri)
+
+        if (is_usk(request_uri) and not is_current and
             self.parent.params.get('AGGRESSIVE_SEARCH', False)):
             request_uri = get_negative_usk(request_uri)
 
@@ -597,6 +714,45 @@ class RequestingUri(StaticRequestList):
         # So we don't implictly favor one by requesting it first.
         random.shuffle(self.current_candidates)
 
+        if (len(self.current_candidates) > 1 and
+            self.hedging.delay_secs(self.parent.ctx.latency_model) > 0):
+            # Run one now and hold the others back. They're run if it
+            # is slow or fails.
+            preferred = self.hedging.preferred_ordinal(
+                list(range(0, len(self.ordered))))
+            if not preferred is None:
+                first = self.ordered[preferred]
+            else:
+                first = self.current_candidates[-1] # i.e. popped next.
+            self.hedge_reserve = [candidate for candidate
+                                  in self.current_candidates
+                                  if not candidate is first]
+            self.current_candidates = [first, ]
+
+    def hedge_candidate(self, dummy_candidate):
+        """ Implementation of RetryingRequestList virtual. """
+        if len(self.hedge_reserve) == 0:
+            return None
+        return self.hedge_reserve.pop()
+
+    def hedge_group(self, candidate):
+        """ Implementation of RetryingRequestList virtual. """
+        if candidate[2]:
+            return None
+        return 0 # All the request URIs race each other.
+
+    def hedge_ordinal(self, candidate):
+        """ Implementation of RetryingRequestList virtual. """
+        return self.ordered.index(candidate)
+
+    def candidate_done(self, client, msg, candidate):
+        """ Implementation of RetryingRequestList virtual. """
+        if not msg[0] in SUCCESS_MSGS and len(self.hedge_reserve) > 0:
+            # Don't wait for the hedge delay.
+            self.current_candidates += self.hedge_reserve
+            self.hedge_reserve = []
+        StaticRequestList.candidate_done(self, client, msg, candidate)
+
     def leave(self, to_state):
         """ Implementation of State virtual. """
         if to_state.name == self.success_state:
@@ -605,6 +761,10 @@ class RequestingUri(StaticRequestList):
                 self.parent.ctx.ui_.status(b"Current USK version: %i\n" %
                                        get_version(self.parent
                                                    .ctx[b'REQUEST_URI']))
+                if not self.parent.ctx.usk_tracker is None:
+                    self.parent.ctx.usk_tracker.update(
+                        self.parent.ctx[b'REQUEST_URI'],
+                        get_version(self.parent.ctx[b'REQUEST_URI']))
 
             if (self.parent.ctx[b'IS_KEYPAIR'] and
                 is_usk(self.parent.ctx[b'REQUEST_URI']) and # lose usk checks?
@@ -950,17 +1110,31 @@ class UpdateStateMachine(RequestQueue, StateMachine):
         ctx.repo = self.ctx.repo
         ctx.ui_ = self.ctx.ui_
         ctx.bundle_cache = self.ctx.bundle_cache
+        ctx.usk_tracker = self.ctx.usk_tracker
+        ctx.latency_model = self.ctx.latency_model
         if len(self.ctx.orphaned) > 0:
             print("BUG?: Abandoning orphaned requests.")
             self.ctx.orphaned.clear()
 
         self.ctx = ctx
 
+    def open_insert_journal(self, target_uri):
+        """ INTERNAL: Set up the insert journal used to resume inserts to
+            target_uri. It is bound to a graph by InsertingBundles. """
+        if (self.ctx.repo is None or self.ctx.bundle_cache is None
+            or target_uri is None or self.params.get('NO_INSERT_JOURNAL')):
+            return
+        self.ctx.insert_journal = InsertJournal(
+            journal_file_name(self.ctx.bundle_cache.base_dir,
+                              self.ctx.repo.root, target_uri))
+
     def start_inserting(self, graph, to_versions, insert_uri=b'CHK@'):
         """ Start and insert of the graph and any required new edge CHKs
             to the insert URI. """
         self.require_state(QUIESCENT)
         self.reset()
+        if insert_uri != b'CHK@':
+            self.open_insert_journal(insert_uri)
         self.ctx.graph = graph
         self.ctx[b'TARGET_VERSIONS'] = to_versions
         self.ctx[b'INSERT_URI'] = insert_uri
@@ -976,6 +1150,7 @@ class UpdateStateMachine(RequestQueue, StateMachine):
 
         self.require_state(QUIESCENT)
         self.reset()
+        self.open_insert_journal(insert_uri)
         self.ctx.graph = None
         self.ctx[b'INSERT_URI'] = insert_uri
         self.ctx[b'REQUEST_URI'] = request_uri
@@ -1050,6 +1225,7 @@ class UpdateStateMachine(RequestQueue, StateMachine):
         """ Start reinserting the repository"""
         self.require_state(QUIESCENT)
         self.reset()
+        self.open_insert_journal(request_uri)
         self.ctx[b'REQUEST_URI'] = request_uri
         self.ctx[b'INSERT_URI'] = insert_uri
         self.ctx[b'IS_KEYPAIR'] = is_keypair
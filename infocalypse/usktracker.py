@@ -0,0 +1,159 @@
+""" Classes to keep track of the latest editions of many USKs.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# INTENT: Let the node do the USK searching. One SubscribeUSK request
+# per USK, all multiplexed over a single FCPConnection, instead of
+# repeatedly fetching negative USKs until the edition "settles".
+
+import time
+
+from .fcpconnection import MinimalClient, POLL_TIME_SECS, FAILURE_MSGS
+from .fcpmessage import SUBSCRIBE_USK_DEF
+from .fcpclient import get_usk_hash, get_version, get_usk_for_usk_version
+
+class USKSubscription(MinimalClient):
+    """ A long running SubscribeUSK request for a single USK. """
+    def __init__(self, usk):
+        MinimalClient.__init__(self)
+        self.usk = usk
+        self.edition = None
+        # Number of SubscribedUSKRoundFinished messages seen.
+        self.rounds = 0
+        self.failed = False
+        self.in_params._async = True
+
+    def start(self, connection, edition):
+        """ Start the subscription from edition. """
+        self.reset()
+        self.in_params.definition = SUBSCRIBE_USK_DEF
+        self.in_params.fcp_params = {
+            b'URI':get_usk_for_usk_version(self.usk, max(edition, 0)),
+            b'RealTimeFlag':True,
+            }
+        connection.start_request(self)
+
+class USKTracker:
+    """ A live table of the latest known editions of USKs.
+
+        The last known editions are read from and written back to a
+        Config instance, if one is passed in. The caller is responsible
+        for saving it with Config.to_file().
+    """
+    def __init__(self, connection, stored_cfg=None):
+        self.connection = connection
+        self.stored_cfg = stored_cfg
+        # usk hash -> USKSubscription
+        self.subscriptions = {}
+        # usk hash -> latest known edition
+        self.editions = {}
+        # Functions called with (usk, edition) when an edition is found.
+        self.listeners = []
+
+    def latest_edition(self, usk):
+        """ Return the latest known edition of usk, or None if unknown. """
+        usk_hash = get_usk_hash(usk)
+        edition = self.editions.get(usk_hash)
+        if not self.stored_cfg is None:
+            stored = self.stored_cfg.get_index(usk_hash)
+            if edition is None or (not stored is None and stored > edition):
+                edition = stored
+        return edition
+
+    def latest_uri(self, usk):
+        """ Return usk with its version set to the latest known
+            edition. """
+        edition = self.latest_edition(usk)
+        if edition is None or edition <= abs(get_version(usk)):
+            return usk
+        return get_usk_for_usk_version(usk, edition)
+
+    def is_current(self, usk):
+        """ Return True if the node has finished at least one search
+            for later editions of usk since it was subscribed. """
+        subscription = self.subscriptions.get(get_usk_hash(usk))
+        return (not subscription is None and not subscription.failed
+                and subscription.rounds > 0)
+
+    def update(self, usk, edition):
+        """ Record that edition of usk exists. """
+        usk_hash = get_usk_hash(usk)
+        edition = abs(edition)
+        prev = self.editions.get(usk_hash)
+        if not prev is None and edition <= prev:
+            return
+        self.editions[usk_hash] = edition
+        if not self.stored_cfg is None:
+            self.stored_cfg.update_index(usk_hash, edition)
+        for listener in self.listeners:
+            listener(usk, edition)
+
+    def subscribe(self, usk):
+        """ Start tracking usk. A NOP if it's already tracked. """
+        usk_hash = get_usk_hash(usk)
+        subscription = self.subscriptions.get(usk_hash)
+        if not subscription is None and not subscription.failed:
+            return subscription
+
+        self.update(usk, get_version(usk))
+        subscription = USKSubscription(usk)
+        subscription.message_callback = self.handle_message
+        self.subscriptions[usk_hash] = subscription
+        subscription.start(self.connection, self.latest_edition(usk))
+        return subscription
+
+    def unsubscribe(self, usk):
+        """ Stop tracking usk. """
+        subscription = self.subscriptions.pop(get_usk_hash(usk), None)
+        if not subscription is None:
+            self.connection.unsubscribe_usk(subscription)
+
+    def close(self):
+        """ Stop all subscriptions. """
+        for subscription in list(self.subscriptions.values()):
+            self.connection.unsubscribe_usk(subscription)
+        self.subscriptions.clear()
+
+    def handle_message(self, client, msg):
+        """ INTERNAL: FCP message callback for all subscriptions. """
+        if msg[0] == b'SubscribedUSKUpdate':
+            edition = int(msg[1][b'Edition'])
+            client.edition = max(edition, client.edition or 0)
+            self.update(client.usk, edition)
+        elif msg[0] == b'SubscribedUSKRoundFinished':
+            client.rounds += 1
+        elif msg[0] in FAILURE_MSGS:
+            client.failed = True
+
+    def wait_until_current(self, usks, timeout_secs):
+        """ Poll the connection until every USK in usks has finished
+            a search round, failed, or timeout_secs elapses.
+
+            Returns True if all the USKs are current. """
+        subscriptions = [self.subscribe(usk) for usk in usks]
+        end_time = time.time() + timeout_secs
+        while time.time() < end_time:
+            if min([subscription.failed or subscription.rounds > 0
+                    for subscription in subscriptions] + [True, ]):
+                break
+            if not self.connection.socket.poll():
+                break
+            time.sleep(POLL_TIME_SECS)
+        return min([self.is_current(usk) for usk in usks] + [True, ])
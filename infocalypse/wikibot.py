@@ -21,14 +21,12 @@
 
 # DCI: fix debugging param values. e.g.: short timeouts that cause 10, 25 errors
 import os
-import shutil
 import time
 
 from mercurial import ui, hg, commands
 
 from .fcpmessage import GET_DEF, PUT_COMPLEX_DIR_DEF
-from .fcpclient import parse_progress, get_file_infos, \
-     set_index_file, dir_data_source
+from .fcpclient import parse_progress, set_index_file, dir_data_source
 
 from .requestqueue import QueueableRequest, RequestQueue
 
@@ -39,13 +37,13 @@ from .fmsbot import FMSBot
 from .submission import ForkingSubmissionHandler, \
      REJECT_NOTRUST, REJECT_FCPFAIL, REJECT_APPLIED
 
-from .bundlecache import BundleCache, is_writable, make_temp_file
+from .bundlecache import BundleCache, is_writable
 from .updatesm import UpdateContext, UpdateStateMachine, QUIESCENT, FINISHING
 from .infcmds import UICallbacks, set_debug_vars
 
 # freesite insert stuff
 from .statemachine import StatefulRequest
-from .sitecmds import dump_wiki_html
+from .sitecmds import dump_wiki_html, SiteManifest
 
 from .wikibotctx import WikiBotContext, context_to_str
 
@@ -54,6 +52,12 @@ add_parallel_sys_path('fniki')
 
 HTML_DUMP_DIR = '__html_dump_deletable__'
 
+# Maximum number of submissions fetched and applied together.
+# Fetched submissions are applied when there are this many, when
+# nothing else is in flight, or APPLY_COALESCE_SECS after the first
+# one arrived, whichever comes first.
+SUBMISSION_BATCH_SIZE = 100
+
 # Parameters used by WikiBot.
 REQUIRED_PARAMS = frozenset([
     'FCP_HOST', 'FCP_PORT', 'FCP_POLL_SECS', 'N_CONCURRENT',
@@ -63,6 +67,7 @@ REQUIRED_PARAMS = frozenset([
     'SITE_DEFAULT_FILE', 'INSERT_URI', 'REQUEST_URI','VERBOSITY',
     'TMP_DIR', 'NO_SEARCH', 'USK_HASH', 'FNPUSH_COALESCE_SECS',
     'SITE_COALESCE_SECS', 'NOTIFY_COALESCE_SECS', 'COMMIT_COALESCE_SECS',
+    'APPLY_COALESCE_SECS',
     'FMS_GROUP', 'FMS_ID', 'FMS_TRUST_CACHE_SECS', 'FMS_MIN_TRUST',
     'NONE_TRUST',
     'REPO_DIR', 'WIKI_ROOT',])
@@ -126,6 +131,13 @@ class WikiBot(FMSBot, RequestQueue):
 
         self.trust = None
         self.update_sm = None
+        # (request, SiteManifest, redirects) for the running freesite
+        # insert.
+        self.site_insert = None
+        # (msg_id, submission_tuple, raw_zip_bytes) for fetched
+        # submissions which haven't been applied yet. They stay in the
+        # ctx's running list until they are.
+        self.fetched = []
         # Why doesn't the base class ctr do this?
         request_runner.add_queue(self)
 
@@ -191,6 +203,9 @@ class WikiBot(FMSBot, RequestQueue):
         self.applier.notify_needs_commit = (
             lambda: self.ctx.set_timeout('COMMIT_COALESCE_SECS'))
         self.applier.notify_committed = self.ctx.committed
+        # Submissions stay running in the store until they are
+        # committed or rejected, so they are retried after a crash.
+        self.applier.notify_finished = self.ctx.finish_submissions
         self._send_status_notification('STARTED')
 
     def on_shutdown(self, why):
@@ -258,6 +273,11 @@ class WikiBot(FMSBot, RequestQueue):
             # Wait until fn-push or freesite insert finishes.
             return
 
+        if self.ctx.timed_out('APPLY_COALESCE_SECS'):
+            # Don't wait for slow requests.
+            self.trace("Applying fetched submissions.")
+            self._handle_submissions()
+
         # DCI: Is this working as expected?
         if self.ctx.has_submissions():
             return
@@ -326,13 +346,6 @@ class WikiBot(FMSBot, RequestQueue):
     #----------------------------------------------------------#
     def _cleanup_temp_files(self):
         """ Helper to clean up temp files. """
-        site_root = os.path.join(self.params['TMP_DIR'], HTML_DUMP_DIR)
-        if os.path.exists(site_root):
-            if not site_root.find("deletable"):
-                raise ValueError("staging dir name must contain 'deletable'")
-            shutil.rmtree(site_root)
-            assert not os.path.exists(site_root)
-
         # Order is import. remove_files() errors if there are dirs.
         if (not self.update_sm is None and
             not self.update_sm.ctx.bundle_cache is None):
@@ -406,13 +419,20 @@ class WikiBot(FMSBot, RequestQueue):
 
         # DCI: try block, with file cleanup
         # DCI: need to check that there are no uncommited files!
+        # The staging dir is kept between inserts so only changed pages
+        # are dumped and uploaded.
         site_root = os.path.join(self.params['TMP_DIR'], HTML_DUMP_DIR)
-        dump_wiki_html(os.path.join(self.repo.root, self.params['WIKI_ROOT']),
-                       site_root, False)
+        changed = dump_wiki_html(os.path.join(self.repo.root,
+                                              self.params['WIKI_ROOT']),
+                                 site_root, False, True)
 
-        infos = get_file_infos(site_root)
+        manifest = SiteManifest(site_root)
+        infos = manifest.update()
         set_index_file(infos, self.params['SITE_DEFAULT_FILE'])
-        self.debug('start_freesite_insert -- dumped %i files' % len(infos))
+        redirects = manifest.get_redirects(infos)
+        self.debug('start_freesite_insert -- dumped %i files, %i changed, '
+                   % (len(infos), len(changed))
+                   + '%i redirects' % len(redirects))
         self.trace('--- files ---')
         for info in infos:
             self.trace('%s %s' % (info[0], info[1]))
@@ -431,7 +451,9 @@ class WikiBot(FMSBot, RequestQueue):
 
         # Sets up in_params for ClientPutComplexDir as a side effect.
         request.custom_data_source = (
-            dir_data_source(infos, request.in_params, 'text/html'))
+            dir_data_source(infos, request.in_params, 'text/html',
+                            redirects))
+        self.site_insert = (request, manifest, redirects)
 
         request.cancel_time_secs = (time.time() +
                                     self.params['CANCEL_TIME_SECS'])
@@ -489,6 +511,8 @@ class WikiBot(FMSBot, RequestQueue):
             # Success
             self.ctx.clear_timeout('SITE_COALESCE_SECS')
             self.debug("freesite_transition -- freesite insertion finished.")
+            request, manifest, redirects = self.site_insert
+            manifest.inserted(request.response[1][b'URI'], redirects)
             tag_site_index(self.ui_, self.repo)
         else:
             # Failure
@@ -499,6 +523,7 @@ class WikiBot(FMSBot, RequestQueue):
         # Cleanup
         self._cleanup_temp_files()
         self.update_sm = None
+        self.site_insert = None
 
     #----------------------------------------------------------#
     # RequestQueue implementation.
@@ -507,13 +532,16 @@ class WikiBot(FMSBot, RequestQueue):
         if not self.update_sm is None:
             return None # Don't run CHK request while fn-pushing repo.
 
+        if self.ctx.running_count() >= SUBMISSION_BATCH_SIZE:
+            return None # Wait until the batch is applied.
+
         msg_id = self.ctx.pop_msg_id()
         if msg_id is None:
             return None
 
         self.trace("next_runnable -- popped: %s" % msg_id)
 
-        chk = self.ctx.store_running_requests[msg_id][3] # hmmm why not 0 or 1?
+        chk = self.ctx.get_submission(msg_id)[3] # hmmm why not 0 or 1?
 
         self.trace("next_runnable -- chk: %s" % chk)
         request = SubmissionRequest(self, msg_id)
@@ -525,8 +553,7 @@ class WikiBot(FMSBot, RequestQueue):
         request.cancel_time_secs = (time.time() +
                                     self.params['CANCEL_TIME_SECS'])
         # DCI: Retrying ?
-        self.ctx.mark_running(msg_id)
-
+        # pop_msg_id() already marked it running.
         return request
 
     def request_progress(self, dummy_client, msg):
@@ -541,28 +568,38 @@ class WikiBot(FMSBot, RequestQueue):
         """ RequestQueue implementation. """
         msg_id = client.msg_id
         self.debug("request_done -- : %s" % msg_id)
-        self.ctx.mark_finished(msg_id)
-
-        # DCI: Retrying ???
-        submission_tuple = self.ctx.remove_submission(msg_id)
 
         if msg[0] == b'AllData': # Success
-            self._handle_submission(msg_id, submission_tuple, msg)
+            self.fetched.append((msg_id,
+                                 self.ctx.get_submission(msg_id),
+                                 msg[2]))
+            if len(self.fetched) == 1:
+                self.ctx.set_timeout('APPLY_COALESCE_SECS')
         else:
+            # DCI: Retrying ???
+            submission_tuple = self.ctx.finish_submission(msg_id)
             self._handle_fcp_failure(msg_id, submission_tuple, msg)
 
+        if (len(self.fetched) >= SUBMISSION_BATCH_SIZE or
+            self.ctx.running_count() == len(self.fetched)):
+            # Full batch, or nothing left in flight.
+            self._handle_submissions()
+
+    def _handle_submissions(self):
+        """ INTERNAL: Apply the fetched submission bundles."""
+        self.ctx.clear_timeout('APPLY_COALESCE_SECS')
+        submissions = []
+        for msg_id, submission_tuple, raw_zip_bytes in self.fetched:
+            self.trace("handle_submissions --  %s" % str(submission_tuple))
+            submissions.append((msg_id, submission_tuple, raw_zip_bytes))
+        self.fetched = []
+        if len(submissions) == 0:
+            return
 
-    def _handle_submission(self, msg_id, submission_tuple, msg):
-        """ INTERNAL: Handle incoming submission bundles."""
-        self.debug("handle_submission --  %s" % msg_id)
-        self.trace("handle_submission --  %s" % str(submission_tuple))
-        tmp_file = make_temp_file(self.params['TMP_DIR'])
-        try:
-            self.applier.apply_submission(msg_id, submission_tuple,
-                                          msg[2], tmp_file)
-        finally:
-            if os.path.exists(tmp_file):
-                os.remove(tmp_file)
+        self.debug("handle_submissions --  %i submissions"
+                   % len(submissions))
+        applied = self.applier.apply_submissions(submissions)
+        self.debug("handle_submissions --  applied %i" % applied)
 
     def _handle_fcp_failure(self, msg_id, submission_tuple, msg):
         """ INTERNAL: Handle FCP request failure when requesting CHK
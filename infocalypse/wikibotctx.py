@@ -19,11 +19,142 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
+# All the persistent state lives in one sqlite file, STORE_FILE in the
+# bot's storage dir. Submissions are rows in a single table with a
+# state column, so queueing, popping and finishing a submission each
+# touch one row in one transaction no matter how many messages have
+# been handled. Only the bot instance writes the store.
+
+import dbm
+import json
 import shelve
+import sqlite3
 import time
 
 from .fcpclient import get_version, get_usk_for_usk_version
 
+STORE_FILE = 'store.db'
+
+# Bump this when the schema changes.
+STORE_VERSION = '1'
+
+# Submission states.
+QUEUED = 0
+RUNNING = 1
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS handled (key TEXT PRIMARY KEY) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS applied (key TEXT PRIMARY KEY) WITHOUT ROWID",
+    # seq orders the FIFO.
+    "CREATE TABLE IF NOT EXISTS submissions (seq INTEGER PRIMARY KEY "
+    + "AUTOINCREMENT, msg_id TEXT UNIQUE NOT NULL, submission TEXT NOT NULL, "
+    + "state INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS submissions_by_state "
+    + "ON submissions (state, seq)",
+)
+
+# The shelve dbs used before STORE_FILE.
+OLD_SHELVES = ('store_handled_ids', 'store_running_requests',
+               'store_applied_requests', 'store_info')
+
+class KeyTable:
+    """ A persistent set of strings kept in a single column table.
+
+        Supports enough of the dict interface to be used like the
+        shelve dbs it replaced, i.e. table[key] = '' and key in table.
+    """
+    def __init__(self, conn, table):
+        self.conn = conn
+        self.table = table
+
+    def __contains__(self, key):
+        return not self.conn.execute("SELECT 1 FROM %s WHERE key = ?"
+                                     % self.table, (key, )).fetchone() is None
+
+    def __setitem__(self, key, dummy):
+        self.add(key)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM %s"
+                                 % self.table).fetchone()[0]
+
+    def add(self, key):
+        """ Add key to the set. """
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO %s VALUES (?)"
+                              % self.table, (key, ))
+
+class InfoTable:
+    """ A persistent key -> value map, values are stored as json. """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, key, default=None):
+        """ Return the value for key or default. """
+        row = self.conn.execute("SELECT value FROM info WHERE key = ?",
+                                (key, )).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        return not self.conn.execute("SELECT 1 FROM info WHERE key = ?",
+                                     (key, )).fetchone() is None
+
+    def __getitem__(self, key):
+        row = self.conn.execute("SELECT value FROM info WHERE key = ?",
+                                (key, )).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO info VALUES (?, ?)",
+                              (key, json.dumps(value)))
+
+def open_store(file_name):
+    """ Open the sqlite store, creating it if necessary.
+
+        Returns a (connection, created) tuple. created is True if the
+        file didn't have a schema yet. """
+    conn = sqlite3.connect(file_name, timeout=30)
+    try:
+        # WAL so status readers don't block the bot and commits
+        # don't have to fsync the whole db.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            row = conn.execute("SELECT value FROM meta WHERE key = 'version'"
+                               ).fetchone()
+            created = row is None
+            if created:
+                conn.execute("INSERT INTO meta VALUES ('version', ?)",
+                             (STORE_VERSION, ))
+            elif row[0] != STORE_VERSION:
+                raise IOError("Unsupported wikibot store version: %s"
+                              % row[0])
+    except:
+        conn.close()
+        raise
+    return (conn, created)
+
+def read_shelve(file_name):
+    """ INTERNAL: Return the contents of a shelve db as a dict, or None
+        if it can't be read. """
+    try:
+        store = shelve.open(file_name, 'r')
+    except dbm.error:
+        return None
+    try:
+        return dict(store.items())
+    finally:
+        store.close()
+
 def pretty_timeout(future_time):
     """ Return a human readable string for a timeout. """
     if future_time is None:
@@ -39,8 +170,8 @@ def context_to_str(ctx):
     """ Return human readable info about a WikiBotContext in a string."""
     return (("running: %i, queued: %i, " +
              "commit: %s, fnpush: %s, freesite: %s") %
-            (len(ctx.store_running_requests['running']),
-             len(ctx.store_running_requests['queued']),
+            (ctx.running_count(),
+             ctx.queued_count(),
              # DCI: clean list comprehension?
              pretty_timeout(ctx.timeouts.get('COMMIT_COALESCE_SECS',
                                               None)),
@@ -55,11 +186,14 @@ class WikiBotContext:
     # DCI: not exactly, better doc
     """ Class to hold the runtime state of a WikiBot instance. """
     def __init__(self, parent):
-        # shelve storage
+        # sqlite storage
         self.parent = parent
+        self.conn = None
+        # Set of handled msg_ids
         self.store_handled_ids = None
-        self.store_running_requests = None
+        # Set of CHKs which were already applied.
         self.store_applied_requests = None
+        # 'USK_HASH', 'LATEST_INDEX'
         self.store_info = None
 
         self.timeouts = {}
@@ -86,40 +220,24 @@ class WikiBotContext:
 
     def synch_dbs(self):
         """ Force write of databases to disk. """
-        if not self.store_handled_ids is None:
-            self.store_handled_ids.sync()
-        if not self.store_running_requests is None:
-            self.store_running_requests.sync()
-        if not self.store_applied_requests is None:
-            self.store_applied_requests.sync()
+        # Every change is committed as it is made. This just keeps
+        # the WAL file from growing without bound.
+        if not self.conn is None:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
 
     def setup_dbs(self, params):
         """ Initialize the databases used for persistent storage. """
-        # Load shelves.
-        # Set of handled msg_ids
         assert not self.parent is None
         assert not self.parent.parent is None
 
-        self.store_handled_ids = shelve.open(
-            self.parent.parent.get_path(self.parent, 'store_handled_ids'))
-        # msg_id -> submission_tuple map
-        # 'running' -> list of currently running request msg_ids
-        # 'queued' -> FIFO of msg_ids for enqueued requests
-        self.store_running_requests = shelve.open(
-            self.parent.parent.get_path(self.parent,
-                                        'store_running_requests'))
-        self.store_applied_requests = shelve.open(
-            self.parent.parent.get_path(self.parent,
-                                        'store_applied_requests'))
-        self.store_info = shelve.open(
-            self.parent.parent.get_path(self.parent,
-                                        'store_info'))
-
-        self.parent.trace("Opened shelve dbs.")
-        if not 'running' in self.store_running_requests:
-            self.store_running_requests['running'] = []
-        if not 'queued' in self.store_running_requests:
-            self.store_running_requests['queued'] = []
+        self.conn, created = open_store(
+            self.parent.parent.get_path(self.parent, STORE_FILE))
+        self.store_handled_ids = KeyTable(self.conn, 'handled')
+        self.store_applied_requests = KeyTable(self.conn, 'applied')
+        self.store_info = InfoTable(self.conn)
+        self.parent.trace("Opened sqlite store.")
+        if created:
+            self.import_shelves()
 
         if self.store_info.get('USK_HASH', '') != params['USK_HASH']:
             # Reset if the repos usk changed. hmmmm possible?
@@ -134,67 +252,125 @@ class WikiBotContext:
 
         del params['LATEST_INDEX'] # DCI: debugging hack!
 
-        running = self.store_running_requests['running']
-        queued = self.store_running_requests['queued']
+        running = [row[0] for row in self.conn.execute(
+            "SELECT msg_id FROM submissions WHERE state = ? ORDER BY seq",
+            (RUNNING, ))]
         if len(running) > 0:
             # DCI: Test
             self.parent.debug("Cleaning up crashed requests:\n%s" %
                               '\n'.join(running))
             # Hmmmm... what if a running request caused the crash?
-            # Reset after crash.
-            self.store_running_requests['queued'] = running + queued
-            self.store_running_requests['running'] = []
+            # Reset after crash. They keep their place at the head of
+            # the FIFO because it is ordered by seq.
+            with self.conn:
+                self.conn.execute("UPDATE submissions SET state = ? "
+                                  + "WHERE state = ?", (QUEUED, RUNNING))
+
+    def import_shelves(self):
+        """ INTERNAL: Copy the state from the shelve dbs used by older
+            versions into a newly created store. """
+        stores = {}
+        for name in OLD_SHELVES:
+            stores[name] = read_shelve(
+                self.parent.parent.get_path(self.parent, name))
+        if not [store for store in stores.values() if not store is None]:
+            return
+
+        self.parent.debug("Importing shelve dbs.")
+        with self.conn:
+            if not stores['store_handled_ids'] is None:
+                self.conn.executemany("INSERT OR IGNORE INTO handled "
+                                      + "VALUES (?)",
+                                      [(key, ) for key
+                                       in stores['store_handled_ids']])
+            if not stores['store_applied_requests'] is None:
+                self.conn.executemany("INSERT OR IGNORE INTO applied "
+                                      + "VALUES (?)",
+                                      [(key, ) for key
+                                       in stores['store_applied_requests']])
+            if not stores['store_info'] is None:
+                self.conn.executemany("INSERT OR REPLACE INTO info "
+                                      + "VALUES (?, ?)",
+                                      [(key, json.dumps(value)) for key, value
+                                       in stores['store_info'].items()])
+            running = stores['store_running_requests']
+            if not running is None:
+                # Running requests go back on the head of the queue,
+                # the same as after a crash.
+                for msg_id in (running.get('running', [])
+                               + running.get('queued', [])):
+                    if msg_id in running:
+                        self.conn.execute(
+                            "INSERT OR IGNORE INTO submissions "
+                            + "(msg_id, submission, state) VALUES (?, ?, ?)",
+                            (msg_id, json.dumps(running[msg_id]), QUEUED))
 
     def close_dbs(self):
         """ Close the databases used for persistent storage. """
-        if not self.store_handled_ids is None:
-            self.store_handled_ids.close()
-        if not self.store_running_requests is None:
-            self.store_running_requests.close()
-        if not self.store_applied_requests is None:
-            self.store_applied_requests.close()
-        if not self.store_info is None:
-            self.store_info.close()
+        if not self.conn is None:
+            self.conn.close()
+            self.conn = None
 
     def queue_submission(self, msg_id, submission):
         """ Add a submission to the submission FIFO. """
-        assert not msg_id in self.store_running_requests
-        queued = self.store_running_requests['queued']
-        assert not msg_id in queued
-        assert not msg_id in self.store_running_requests['running']
-
-        self.store_running_requests[msg_id] = submission
-        queued.append(msg_id)
-        self.store_running_requests['queued'] = queued
+        with self.conn:
+            # Raises sqlite3.IntegrityError if msg_id is already queued.
+            self.conn.execute("INSERT INTO submissions "
+                              + "(msg_id, submission, state) VALUES (?, ?, ?)",
+                              (msg_id, json.dumps(submission), QUEUED))
 
     # can return None
     def pop_msg_id(self):
-        """ Remove the oldest submission from the FIFO and return it. """
-        queued = self.store_running_requests['queued']
-        if len(queued) == 0:
-            return None
-
-        msg_id = queued.pop(0)
-        self.store_running_requests['queued'] = queued # force sync.
-
-        #self.trace("next_runnable -- popped: %s" % msg_id)
-        running = self.store_running_requests['running']
-        assert not msg_id in running
-        return msg_id
-
-    def mark_running(self, msg_id):
-        """ Persistently mark the submission as running. """
-        running = self.store_running_requests['running']
-        assert not msg_id in running
-        running.append(msg_id)
-        self.store_running_requests['running'] = running # force sync.
-
-    def mark_finished(self, msg_id):
-        """ Persistently mark the submission as not running. """
-        running = self.store_running_requests['running']
-        assert msg_id in running
-        running.remove(msg_id)
-        self.store_running_requests['running'] = running # force sync.
+        """ Remove the oldest submission from the FIFO, persistently mark
+            it as running and return its msg_id. """
+        with self.conn:
+            row = self.conn.execute("SELECT seq, msg_id FROM submissions "
+                                    + "WHERE state = ? ORDER BY seq LIMIT 1",
+                                    (QUEUED, )).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE submissions SET state = ? WHERE seq = ?",
+                              (RUNNING, row[0]))
+        return row[1]
+
+    def get_submission(self, msg_id):
+        """ Return the submission tuple for a queued or running
+            submission. """
+        row = self.conn.execute("SELECT submission FROM submissions "
+                                + "WHERE msg_id = ?", (msg_id, )).fetchone()
+        if row is None:
+            raise KeyError(msg_id)
+        return tuple(json.loads(row[0]))
+
+    def finish_submissions(self, msg_ids):
+        """ Persistently remove running submissions in a single
+            transaction and return their submission tuples. """
+        ret = []
+        with self.conn:
+            for msg_id in msg_ids:
+                row = self.conn.execute("SELECT submission, state "
+                                        + "FROM submissions WHERE msg_id = ?",
+                                        (msg_id, )).fetchone()
+                assert not row is None and row[1] == RUNNING
+                self.conn.execute("DELETE FROM submissions WHERE msg_id = ?",
+                                  (msg_id, ))
+                ret.append(tuple(json.loads(row[0])))
+        return ret
+
+    def finish_submission(self, msg_id):
+        """ Persistently remove a running submission and return its
+            submission tuple. """
+        return self.finish_submissions((msg_id, ))[0]
+
+    def running_count(self):
+        """ Return the number of running submissions. """
+        return self.conn.execute("SELECT COUNT(*) FROM submissions "
+                                 + "WHERE state = ?", (RUNNING, )).fetchone()[0]
+
+    def queued_count(self):
+        """ Return the number of submissions waiting to run. """
+        return self.conn.execute("SELECT COUNT(*) FROM submissions "
+                                 + "WHERE state = ?", (QUEUED, )).fetchone()[0]
 
     def update_latest_index(self, uri):
         """ Update the latest known version of the stored repo usk. """
@@ -204,12 +380,6 @@ class WikiBotContext:
         if version > self.store_info['LATEST_INDEX']:
             self.store_info['LATEST_INDEX'] = version
 
-    def remove_submission(self, msg_id):
-        """ Remove stored the stored information for the submission. """
-        ret = self.store_running_requests[msg_id]
-        del self.store_running_requests[msg_id]
-        return ret
-
     def request_uri(self):
         """ Return the repository request URI. """
         return get_usk_for_usk_version(self.parent.params['REQUEST_URI'],
@@ -248,8 +418,8 @@ class WikiBotContext:
     def has_submissions(self):
         """ Return True if there are subissions which are running or need
             to be run, False otherwise. """
-        return (len(self.store_running_requests['running']) > 0 or
-                len(self.store_running_requests['queued']) > 0)
+        return not self.conn.execute("SELECT 1 FROM submissions LIMIT 1"
+                                     ).fetchone() is None
 
 # REDFLAG: revisit during code cleanup
 # pylint error about too many public methods. grrrr...
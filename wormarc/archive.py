@@ -21,19 +21,48 @@
 """
 
 import os
-from binaryrep import NULL_SHA, write_raw_link, check_shas #, str_sha
+from binaryrep import NULL_SHA, LINK_HEADER_LEN, write_raw_link, \
+     check_shas, link_sha #, str_sha
 from blocknames import BLOCK_SUFFIX, ReadWriteNames
+from chunking import iter_chunks, AVG_CHUNK_LEN
+from deltacoder import CHUNK_LIST_PREFIX, is_chunk_list, chunk_list_shas
+from shafunc import new_sha
 
 # Just happens to be Freenet block size ;-)
 MIN_BLOCK_LEN = 32 * 1024
 
 MAX_HISTORY_LEN = 16
 
+# Exponent for the free block slot term in plan_compress()'s cost model.
+# Larger values favor leaving free slots over rewriting fewer bytes now.
+SLACK_EXPONENT = 3
+
+# Above this many partitions plan_compress() falls back to compress().
+MAX_PLANNED_PARTITIONS = 16
+
 # 1 effectively causes a full reinsert when history chains are shortened.
 # Larger values favor smaller incremental deltas at the expense of
 # a longer history chain and larger total history size.
 COALESCE_FACTOR = 1.5
 
+# Files smaller than this are never split into chunks.
+MIN_CHUNKED_FILE_LEN = 16 * 1024
+
+# Chunks are stored if that costs less than this times a full insert.
+# > 1 so that the chunks are there to share with later files.
+CHUNK_COST_FACTOR = 1.25
+
+# Chunk links always have this age. Chunks are looked up by the SHA1
+# of their raw bytes, not by link hash, so that the chunks written by
+# coders with different codecs are still shared.
+#
+# Chunk links don't have a parent. The parent field holds the SHA1 of
+# the raw bytes instead, so the lookup index can be built from the
+# link headers the LinkMap already read, without reading any chunks.
+# Chunks written with a NULL_SHA parent by older versions are still
+# read and hashed.
+CHUNK_AGE = 0
+
 #----------------------------------------------------------#
 
 def is_ordered(partitions):
@@ -117,6 +146,79 @@ def compress(partitions, max_len, multiple=2):
     assert is_ordered(partitions)
     return partitions
 
+def contiguous_groupings(count, max_len):
+    """ INTERNAL: Generate all the ways to split range(count) into
+        at most max_len contiguous (start, end + 1) groups. """
+    if count == 0:
+        yield []
+        return
+    for end in range(1, count + 1):
+        if end == count:
+            yield [(0, count), ]
+            continue
+        if max_len < 2:
+            continue
+        for rest in contiguous_groupings(count - end, max_len - 1):
+            yield [(0, end), ] + [(start + end, stop + end)
+                                  for start, stop in rest]
+
+def rewrite_cost(layout):
+    """ Return the number of bytes which must be written (and re-inserted)
+        to create the partitions in layout.
+
+        Partitions which are a single existing block are free. """
+    return sum([partition[2] for partition in layout
+                if partition[0] != partition[1]])
+
+# Every block we rewrite is a block which must be re-inserted into
+# Freenet, so plan for the fewest rewritten bytes, not the neatest sizes.
+#
+# A cheap merge which leaves no free slots just forces an expensive
+# one on the next update, so the raw cost is discounted by the number of
+# free slots left afterwards. Exhaustive search is fine because
+# the number of partitions is max_blocks + 1 in practice.
+def plan_compress(partitions, max_len, multiple=2):
+    """ Reduce the length of the partitions to <= max_len while
+        minimizing the number of bytes rewritten.
+
+        Like compress(), drops zero length partitions and enforces
+        len(partition[n]) * multiple < len(partition[n + 1]) in
+        the result. """
+
+    partitions = [partition for partition in partitions
+                  if  partition[2] > 0]
+
+    if len(partitions) <= max_len:
+        return partitions
+
+    if len(partitions) > MAX_PLANNED_PARTITIONS:
+        return compress(partitions, max_len, multiple)
+
+    assert max_len > 1
+    best = None
+    for groups in contiguous_groupings(len(partitions), max_len):
+        layout = [(partitions[start][0], partitions[end - 1][1],
+                   sum([partition[2] for partition
+                        in partitions[start:end]]))
+                  for start, end in groups]
+
+        if [True for index in range(0, len(layout) - 1)
+            if layout[index][2] * multiple >= layout[index + 1][2]]:
+            continue
+
+        # Hmmm... ties go to the layout with more blocks.
+        score = (rewrite_cost(layout) /
+                 float((max_len - len(layout) + 1) ** SLACK_EXPONENT),
+                 -len(layout))
+        if best is None or score < best[0]:
+            best = (score, layout)
+
+    # Merging everything into one partition always qualifies.
+    assert not best is None
+    assert is_ordered(best[1])
+    assert is_contiguous(best[1])
+    return best[1]
+
 #----------------------------------------------------------#
 
 class WORMBlockArchive:
@@ -161,6 +263,12 @@ class WORMBlockArchive:
         It was written to implement incrementally updateable file
         archives on top of Freenet.
 
+        Files of MIN_CHUNKED_FILE_LEN or more can also be stored as
+        a list of content defined chunks, each in its own history
+        link, so that data shared between files or versions is only
+        stored once. write_new_delta() does this when it is cheaper
+        than writing a delta.
+
     """
     def __init__(self, delta_coder, blocks):
         self.delta_coder = delta_coder
@@ -169,11 +277,19 @@ class WORMBlockArchive:
         self.max_blocks = 4
         # Hmmm...
         self.age = 0
+        self.chunking = True
+        # history link sha -> chunk link shas, () if not a chunk list.
+        self.chunk_refs = {}
+        # raw chunk sha -> chunk link sha, built on first use.
+        self.chunk_index = None
+        # Same for the chunks written since start_update().
+        self.pending_chunks = {}
 
     def create(self, block_dir, base_name, overwrite=False ):
         """ Create a new archive. """
         names = ReadWriteNames(block_dir, base_name, BLOCK_SUFFIX)
         self.age = self.blocks.create(names, self.max_blocks, overwrite)
+        self.chunk_index = None
 
     # Updateable.
     # LATER: read only???
@@ -181,6 +297,7 @@ class WORMBlockArchive:
         """ Load an existing archive. """
         names = ReadWriteNames(block_dir, base_name, BLOCK_SUFFIX)
         self.age = self.blocks.load(names, self.max_blocks, tags)
+        self.chunk_index = None
 
     # MUST call this if you called load() or create()
     def close(self):
@@ -288,6 +405,13 @@ class WORMBlockArchive:
                                                      tmp_file)
                 blob_file = tmp_file
 
+            if self.chunking:
+                max_len = os.path.getsize(blob_file) + LINK_HEADER_LEN
+                if parent == NULL_SHA:
+                    max_len *= CHUNK_COST_FACTOR
+                link = self.write_chunks(new_file, max_len)
+                if not link is None:
+                    return link
 
             self.blocks.update_links.append(
                 write_raw_link(self.blocks.update_stream,
@@ -299,6 +423,122 @@ class WORMBlockArchive:
             self.blocks.tmps.remove_temp_file(oldest_delta)
             self.blocks.tmps.remove_temp_file(tmp_file)
 
+    def write_chunks(self, new_file, max_len):
+        """ INTERNAL: Write new_file as a list of chunks.
+
+            Returns the chunk list link or None if it would take
+            max_len bytes or more to write the missing chunks and the
+            chunk list. """
+        # The chunk list alone costs about this much.
+        list_cost = LINK_HEADER_LEN + len(CHUNK_LIST_PREFIX)
+        if (list_cost + len(NULL_SHA) * (os.path.getsize(new_file)
+                                         // AVG_CHUNK_LEN) >= max_len):
+            return None # The delta is already small.
+
+        in_file = open(new_file, 'rb')
+        try:
+            raw = in_file.read()
+        finally:
+            in_file.close()
+        if len(raw) < MIN_CHUNKED_FILE_LEN:
+            return None
+
+        chunk_shas = []
+        # raw chunk sha -> (chunk link sha, blob), in file order so the
+        # chunks for a file are close together.
+        new_chunks = {}
+        cost = list_cost
+        for chunk in iter_chunks(raw):
+            raw_sha = new_sha(chunk).digest()
+            if raw_sha in new_chunks:
+                chunk_sha = new_chunks[raw_sha][0]
+            else:
+                chunk_sha = self.find_chunk(raw_sha)
+            if chunk_sha is None:
+                # Only compress the chunks which aren't stored yet.
+                blob = self.delta_coder.make_chunk_blob(chunk)
+                chunk_sha = link_sha(CHUNK_AGE, raw_sha, blob)
+                new_chunks[raw_sha] = (chunk_sha, blob)
+                cost += len(blob) + LINK_HEADER_LEN
+            chunk_shas.append(chunk_sha)
+            cost += len(chunk_sha)
+            if cost >= max_len:
+                return None
+        raw = None
+
+        list_blob = self.delta_coder.make_chunk_list_blob(chunk_shas)
+        tmp_file = self.blocks.tmps.make_temp_file()
+        try:
+            for raw_sha, value in new_chunks.items():
+                self.write_blob(tmp_file, value[1])
+                self.blocks.update_links.append(
+                    write_raw_link(self.blocks.update_stream,
+                                   CHUNK_AGE, raw_sha, tmp_file, 0))
+                assert self.blocks.update_links[-1][0] == value[0]
+                self.pending_chunks[raw_sha] = value[0]
+
+            self.write_blob(tmp_file, list_blob)
+            link = write_raw_link(self.blocks.update_stream,
+                                  self.age + 1, NULL_SHA, tmp_file, 0)
+            self.blocks.update_links.append(link)
+            self.chunk_refs[link[0]] = tuple(chunk_shas)
+            return link
+        finally:
+            self.blocks.tmps.remove_temp_file(tmp_file)
+
+    def find_chunk(self, raw_sha):
+        """ INTERNAL: Return the link sha of a stored chunk with raw
+            bytes that hash to raw_sha, or None if there isn't one. """
+        if raw_sha in self.pending_chunks:
+            return self.pending_chunks[raw_sha]
+        if self.chunk_index is None:
+            self.index_chunks()
+        chunk_sha = self.chunk_index.get(raw_sha)
+        if chunk_sha is None or not chunk_sha in self.blocks.link_map:
+            return None # Never stored or dropped by compress().
+        return chunk_sha
+
+    def index_chunks(self):
+        """ INTERNAL: Build the raw chunk sha -> chunk link sha index
+            from the link headers. See CHUNK_AGE. """
+        self.chunk_index = {}
+        for links in self.blocks.link_map.values():
+            link = links[0]
+            if link[1] != CHUNK_AGE:
+                continue
+            raw_sha = link[2]
+            if raw_sha == NULL_SHA:
+                # Written before the parent field held the raw sha.
+                raw_sha = new_sha(self.delta_coder.decode_blob(
+                    self.get_data(link[0]))[1]).digest()
+            self.chunk_index[raw_sha] = link[0]
+
+    # pylint: disable-msg=R0201
+    def write_blob(self, file_name, blob):
+        """ INTERNAL: Write blob bytes into a file. """
+        out_file = open(file_name, 'wb')
+        try:
+            out_file.write(blob)
+        finally:
+            out_file.close()
+
+    def chunks_for(self, history_sha):
+        """ Return the SHA1 hashes of the chunk links referenced by a
+            history link, or () if it isn't a chunk list. """
+        if history_sha in self.chunk_refs:
+            return self.chunk_refs[history_sha]
+
+        ret = ()
+        link = self.blocks.link_map.get_link(history_sha)
+        # Only full inserts can be chunk lists. Peek at the codec
+        # prefix to avoid reading the whole blob.
+        if (link[2] == NULL_SHA and
+            is_chunk_list(self.blocks.link_map.read_prefix(
+                history_sha, len(CHUNK_LIST_PREFIX)))):
+            ret = chunk_list_shas(self.get_data(history_sha))
+        self.chunk_refs[history_sha] = ret
+        return ret
+
     def require_blocks(self):
         """ INTERNAL: Raises if the BlockStorage delegate isn't initialized."""
         if self.blocks is None:
@@ -308,12 +548,14 @@ class WORMBlockArchive:
         """ Create temporary storage required to update the archive. """
         self.require_blocks()
         self.blocks.start_update()
+        self.pending_chunks = {}
 
     def abandon_update(self):
         """ Abandon all changes made to the archive since
             start_update() and free temporary storage. """
         if not self.blocks is None: # Hmmmm...
             self.blocks.abandon_update()
+        self.pending_chunks = {}
 
     # Allowed to drop history not in the referenced shas
     # list.
@@ -325,7 +567,20 @@ class WORMBlockArchive:
         self.require_blocks()
         if referenced_shas is None:
             referenced_shas = set([])
+
+        # BlockStorage adds the history for the updates, but it can't
+        # know about the chunks that history references.
+        for link in self.blocks.update_links:
+            referenced_shas.update(self.chunk_refs.get(link[0], ()))
+            if link[1] == CHUNK_AGE:
+                continue # No history.
+            for child in self.blocks.get_history(link[2]):
+                referenced_shas.update(self.chunks_for(child[0]))
+
         self.age = self.blocks.commit_update(referenced_shas)
+        if not self.chunk_index is None:
+            self.chunk_index.update(self.pending_chunks)
+        self.pending_chunks = {}
         self.compress(referenced_shas)
 
 
@@ -348,19 +603,17 @@ class WORMBlockArchive:
 
         #count = self.blocks.nonzero_blocks()
 
-        # Compute the "real" size of each block without unreferenced links
-        real_lens = [0 for dummy in range(0, len(self.blocks.tags))]
-
-        for links in list(self.blocks.link_map.values()):
-            for link in links:
-                if not link[0] in referenced_shas:
-                    continue
-                real_lens[link[5]] += link[6]
+        # Compute the "real" size of each block without unreferenced links.
+        # The LinkMap keeps running counts, so this only visits the links
+        # which were referenced or dropped since the last call.
+        self.blocks.link_map.set_referenced(referenced_shas)
+        real_lens = self.blocks.link_map.referenced_lengths(
+            len(self.blocks.tags))
 
         uncompressed = [[index, index, real_lens[index]]
                         for index in range(0, len(self.blocks.tags))]
 
-        compressed = compress(uncompressed, self.max_blocks)
+        compressed = plan_compress(uncompressed, self.max_blocks)
         # Can't put lists in a set.
         compressed = [tuple(value) for value in compressed]
         uncompressed = [tuple(value) for value in uncompressed]
@@ -382,6 +635,7 @@ class WORMBlockArchive:
         for head_sha in head_sha_list:
             for link in self.blocks.get_history(head_sha):
                 ret.add(link[0])
+                ret.update(self.chunks_for(link[0]))
         if include_updates:
             ret = ret.union(self.uncommited_shas())
 
@@ -0,0 +1,419 @@
+""" Offline throughput and memory benchmarks for the archive code.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# Usage:
+# python benchmark.py [results.json [workload ...]]
+#
+# Runs every workload by default. Peak RSS is for the whole process, so
+# run one workload per invocation if you care about the memory numbers.
+#
+# Results are written as JSON so runs from different commits can
+# be diffed.
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None # Windows
+
+from binaryrep import NULL_SHA, manifest_to_file
+from blocks import BlockStorage, ITempFileManager
+from linkmap import LinkMap
+from archive import WORMBlockArchive
+from deltacoder import DeltaCoder
+
+FORMAT_VERSION = 1
+
+# Tags for blocks which existed before an update. Blocks that are
+# re-written get new tags. See arclocal.provisional_top_key().
+OLD_TAG = 'old'
+
+class HandleTemps(ITempFileManager):
+    """ Delegate to handle temp file creation and deletion. """
+    def __init__(self, base_dir):
+        ITempFileManager.__init__(self)
+        self.base_dir = base_dir
+
+    def make_temp_file(self):
+        """ Return a new unique temp file name including full path. """
+        return os.path.join(self.base_dir, "__TMP__%s" %
+                            str(random.random())[2:])
+
+    def remove_temp_file(self, full_path):
+        """ Remove and existing temp file. """
+        if full_path and os.path.exists(full_path):
+            os.remove(full_path)
+
+#----------------------------------------------------------#
+class Timers:
+    """ Accumulate time spent in selected methods by wrapping them. """
+    def __init__(self):
+        self.totals = {}
+        self.originals = []
+
+    def wrap(self, cls, method_name, label):
+        """ Start timing calls to cls.method_name under label. """
+        original = getattr(cls, method_name)
+        self.totals[label] = 0.0
+
+        def timed(*args, **kwargs):
+            """ INTERNAL: Timing wrapper. """
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.totals[label] += time.time() - start
+
+        self.originals.append((cls, method_name, original))
+        setattr(cls, method_name, timed)
+
+    def reset(self):
+        """ Zero the accumulated times. """
+        for label in self.totals:
+            self.totals[label] = 0.0
+
+    def unwrap(self):
+        """ Restore the original methods. """
+        for cls, method_name, original in self.originals:
+            setattr(cls, method_name, original)
+        self.originals = []
+
+def peak_rss_kb():
+    """ Return the peak resident set size of the process in kB
+        or None if it isn't available. """
+    if resource is None:
+        return None
+    value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        value /= 1024 # bytes on OS X
+    return value
+
+def git_revision():
+    """ Return the current git revision or None. """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).strip().decode('utf8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#----------------------------------------------------------#
+# Workloads
+#
+# A workload is a function(rand, files, update_index) which changes the
+# files dict (name -> bytes) in place and returns nothing. The initial
+# contents come from the matching *_setup function.
+
+def random_text(rand, line_count):
+    """ Return line_count lines of random wordish text. """
+    words = (b'the', b'archive', b'block', b'freenet', b'insert', b'chk',
+             b'update', b'wiki', b'page', b'link', b'history', b'delta')
+    return b''.join([b' '.join([rand.choice(words) for dummy
+                                in range(0, rand.randrange(4, 12))]) + b'\n'
+                     for dummy in range(0, line_count)])
+
+def random_binary(rand, length):
+    """ Return length random bytes. """
+    return bytes(bytearray(rand.getrandbits(8) for dummy
+                           in range(0, length)))
+
+def text_setup(rand):
+    """ Many small text files. """
+    return dict([(b'src/file_%03i.txt' % index,
+                  random_text(rand, rand.randrange(50, 400)))
+                 for index in range(0, 100)])
+
+def text_edits(rand, files, dummy):
+    """ Edit a few lines in one to three files. """
+    for name in rand.sample(sorted(files.keys()), rand.randrange(1, 4)):
+        lines = files[name].splitlines(True)
+        for dummy in range(0, rand.randrange(1, 4)):
+            lines[rand.randrange(0, len(lines))] = random_text(rand, 1)
+        files[name] = b''.join(lines)
+
+def binary_setup(rand):
+    """ A few big binary files. """
+    return dict([(b'img/blob_%02i.bin' % index,
+                  random_binary(rand, rand.randrange(32, 128) * 1024))
+                 for index in range(0, 8)])
+
+def binary_churn(rand, files, update_index):
+    """ Overwrite a region of a binary file, sometimes add a new one. """
+    name = rand.choice(sorted(files.keys()))
+    raw = files[name]
+    start = rand.randrange(0, len(raw))
+    length = rand.randrange(1, 8 * 1024)
+    files[name] = raw[:start] + random_binary(rand, length) + \
+                  raw[start + length:]
+    if update_index % 10 == 9:
+        files[b'img/new_%03i.bin' % update_index] = random_binary(
+            rand, rand.randrange(16, 64) * 1024)
+
+def wiki_setup(rand):
+    """ A wiki with a couple hundred pages. """
+    return dict([(b'wikitext/Page%03i' % index,
+                  random_text(rand, rand.randrange(5, 60)))
+                 for index in range(0, 200)])
+
+def wiki_trace(rand, files, update_index):
+    """ Mostly appends to pages, some new pages, a few renames. """
+    names = sorted(files.keys())
+    choice = rand.random()
+    if choice < 0.7:
+        name = rand.choice(names)
+        files[name] = files[name] + random_text(rand,
+                                                rand.randrange(1, 6))
+    elif choice < 0.9:
+        files[b'wikitext/NewPage%04i' % update_index] = \
+                random_text(rand, rand.randrange(3, 30))
+    else:
+        name = rand.choice(names)
+        files[b'wikitext/Renamed%04i' % update_index] = \
+                files.pop(name) + random_text(rand, 1)
+
+WORKLOADS = {
+    'small_text_edits':(text_setup, text_edits, 200),
+    'binary_churn':(binary_setup, binary_churn, 60),
+    'wiki_trace':(wiki_setup, wiki_trace, 200),
+    }
+
+#----------------------------------------------------------#
+class BenchmarkArchive:
+    """ A minimal name -> history head manifest on top of an archive,
+        like FileManifest, but with byte string names. """
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.tmps = HandleTemps(base_dir)
+        self.archive = WORMBlockArchive(DeltaCoder(),
+                                        BlockStorage(self.tmps))
+        self.archive.create(base_dir, 'block')
+        self.heads = {} # name -> (contents, head sha)
+        self.manifest_sha = NULL_SHA
+
+    def write_file(self, raw):
+        """ INTERNAL: Write raw into a new temp file. """
+        name = self.tmps.make_temp_file()
+        out_file = open(name, 'wb')
+        try:
+            out_file.write(raw)
+        finally:
+            out_file.close()
+        return name
+
+    def update(self, files):
+        """ Write the changes in files into the archive.
+
+            Returns (bytes_written, blocks_rewritten). """
+        archive = self.archive
+        archive.blocks.tags = [OLD_TAG for dummy in archive.blocks.tags]
+        archive.start_update()
+        raised = True
+        try:
+            unchanged = set([])
+            new_heads = {}
+            for name in files:
+                prev = self.heads.get(name)
+                if not prev is None and prev[0] == files[name]:
+                    new_heads[name] = prev
+                    unchanged.add(prev[1])
+                    continue
+                tmp = self.write_file(files[name])
+                try:
+                    link = archive.write_new_delta(
+                        NULL_SHA if prev is None else prev[1], tmp)
+                finally:
+                    self.tmps.remove_temp_file(tmp)
+                new_heads[name] = (files[name], link[0])
+
+            tmp = self.tmps.make_temp_file()
+            try:
+                manifest_to_file(tmp, dict([(name, (NULL_SHA, value[1]))
+                                            for name, value
+                                            in new_heads.items()]))
+                manifest_sha = archive.write_new_delta(self.manifest_sha,
+                                                       tmp)[0]
+            finally:
+                self.tmps.remove_temp_file(tmp)
+
+            archive.commit_update(archive.referenced_shas(unchanged))
+            self.heads = new_heads
+            self.manifest_sha = manifest_sha
+            raised = False
+        finally:
+            if raised:
+                archive.abandon_update()
+
+        bytes_written = 0
+        blocks_rewritten = 0
+        for index, tag in enumerate(archive.blocks.tags):
+            if tag == OLD_TAG:
+                continue
+            length = os.path.getsize(archive.blocks.full_path(index))
+            if length == 0:
+                continue
+            bytes_written += length
+            blocks_rewritten += 1
+        return bytes_written, blocks_rewritten
+
+    def verify(self):
+        """ Check that every file reads back correctly. """
+        tmp = self.tmps.make_temp_file()
+        try:
+            for name, value in self.heads.items():
+                self.archive.get_file(value[1], tmp)
+                in_file = open(tmp, 'rb')
+                try:
+                    if in_file.read() != value[0]:
+                        raise IOError("Bad read back: %s" % repr(name))
+                finally:
+                    in_file.close()
+        finally:
+            self.tmps.remove_temp_file(tmp)
+
+    def archive_bytes(self):
+        """ Return the total size of the block files. """
+        return sum([os.path.getsize(self.archive.blocks.full_path(index))
+                    for index in range(0, len(self.archive.blocks.tags))])
+
+    def reload(self):
+        """ Close and reload the archive from the block files. """
+        self.archive.close()
+        self.archive = WORMBlockArchive(DeltaCoder(),
+                                        BlockStorage(self.tmps))
+        self.archive.load(self.base_dir, 'block')
+
+    def close(self):
+        """ Close the archive. """
+        self.archive.close()
+
+def run_workload(name, timers, updates=None, seed=0x5eed):
+    """ Run a single workload and return a dict of results. """
+    setup, change, default_updates = WORKLOADS[name]
+    if updates is None:
+        updates = default_updates
+    rand = random.Random(seed)
+    files = setup(rand)
+
+    base_dir = tempfile.mkdtemp(prefix='wormarc_bench_')
+    bench = BenchmarkArchive(base_dir)
+    timers.reset()
+    try:
+        bytes_written = 0
+        blocks_rewritten = 0
+        start = time.time()
+        bench.update(files) # Initial insert isn't counted.
+        initial_secs = time.time() - start
+
+        start = time.time()
+        for index in range(0, updates):
+            change(rand, files, index)
+            written, rewritten = bench.update(files)
+            bytes_written += written
+            blocks_rewritten += rewritten
+        update_secs = time.time() - start
+
+        # Time a cold load, then read everything back.
+        start = time.time()
+        bench.reload()
+        bench.verify()
+        read_secs = time.time() - start
+
+        return {'updates':updates,
+                'initial_insert_secs':initial_secs,
+                'update_secs':update_secs,
+                'updates_per_sec':updates / max(update_secs, 1e-9),
+                'bytes_written':bytes_written,
+                'bytes_per_update':bytes_written / float(updates),
+                'blocks_rewritten':blocks_rewritten,
+                'blocks_rewritten_per_update':
+                blocks_rewritten / float(updates),
+                'archive_bytes':bench.archive_bytes(),
+                'files':len(files),
+                'reload_and_verify_secs':read_secs,
+                'peak_rss_kb':peak_rss_kb(),
+                'timers':dict(timers.totals),
+                }
+    finally:
+        bench.close()
+        shutil.rmtree(base_dir)
+
+def run_benchmarks(names=None, updates=None):
+    """ Run workloads and return a JSON serializable results dict. """
+    if not names:
+        names = sorted(WORKLOADS.keys())
+    timers = Timers()
+    timers.wrap(LinkMap, 'read', 'LinkMap.read')
+    timers.wrap(DeltaCoder, 'apply_deltas', 'DeltaCoder.apply_deltas')
+    timers.wrap(BlockStorage, 'merge_blocks', 'BlockStorage.merge_blocks')
+    try:
+        results = {}
+        for name in names:
+            results[name] = run_workload(name, timers, updates)
+    finally:
+        timers.unwrap()
+
+    return {'format_version':FORMAT_VERSION,
+            'git_revision':git_revision(),
+            'python':sys.version.split()[0],
+            'time':time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'workloads':results}
+
+def main():
+    """ Command line entry point. """
+    out_file_name = 'wormarc_benchmark.json'
+    if len(sys.argv) > 1:
+        out_file_name = sys.argv[1]
+    names = sys.argv[2:]
+    for name in names:
+        if not name in WORKLOADS:
+            print("Unknown workload: %s. Known: %s" %
+                  (name, ', '.join(sorted(WORKLOADS.keys()))))
+            sys.exit(1)
+
+    results = run_benchmarks(names)
+    for name in sorted(results['workloads']):
+        values = results['workloads'][name]
+        print("%s: %.1f updates/sec, %i bytes/update, "
+              "%.2f blocks rewritten/update, peak RSS %s kB" %
+              (name, values['updates_per_sec'], values['bytes_per_update'],
+               values['blocks_rewritten_per_update'],
+               values['peak_rss_kb']))
+        for label in sorted(values['timers']):
+            print("   %s: %.3f secs" % (label, values['timers'][label]))
+
+    out_file = open(out_file_name, 'w')
+    try:
+        json.dump(results, out_file, indent=1, sort_keys=True)
+    finally:
+        out_file.close()
+    print("Wrote: %s" % out_file_name)
+
+if __name__ == "__main__":
+    main()
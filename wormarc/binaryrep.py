@@ -27,7 +27,7 @@ import struct
 from binascii import hexlify
 from hashlib import sha1
 
-NULL_SHA = '\x00' * 20
+NULL_SHA = b'\x00' * 20
 
 LINK_HEADER_FMT = '!LL20s'
 LINK_HEADER_LEN = struct.calcsize(LINK_HEADER_FMT)
@@ -69,12 +69,19 @@ def checked_read(in_stream, length, allow_eof=False):
     """
 
     bytes = in_stream.read(length)
-    if allow_eof and bytes == '':
+    if allow_eof and bytes == b'':
         return bytes
     if len(bytes) != length:
         raise IOError(MSG_INCOMPLETE_READ)
     return bytes
 
+def link_sha(age, parent, raw):
+    """ Return the raw SHA1 hash of a history link. """
+    sha_value = sha1(str(age).encode('utf8'))
+    sha_value.update(parent)
+    sha_value.update(raw)
+    return sha_value.digest()
+
 # Wire rep:
 # <total length><age><parent><blob data>
 #
@@ -89,7 +96,7 @@ def read_link(in_stream, keep_data=True, pos=None, stream_index=None):
     """ Read a single history link from an open stream. """
 
     bytes = checked_read(in_stream, LINK_HEADER_LEN, True)
-    if bytes == '':
+    if bytes == b'':
         return None # Clean EOF
 
     length, age, parent = struct.unpack(LINK_HEADER_FMT, bytes)
@@ -97,14 +104,12 @@ def read_link(in_stream, keep_data=True, pos=None, stream_index=None):
     raw = checked_read(in_stream, payload_len)
 
     # READFLAG: incrementally read / hash
-    sha_value = sha1(str(age))
-    sha_value.update(parent)
-    sha_value.update(raw)
+    sha_value = link_sha(age, parent, raw)
 
     if not keep_data:
         raw = None
 
-    return (sha_value.digest(), age, parent, raw,
+    return (sha_value, age, parent, raw,
             pos, stream_index, payload_len)
 
 
@@ -115,14 +120,11 @@ def copy_raw_links(in_stream, out_stream, allowed_shas, copied_shas):
     count = 0
     while True:
         hdr = checked_read(in_stream, LINK_HEADER_LEN, True)
-        if hdr == '':
+        if hdr == b'':
             return count # Clean EOF
         length, age, parent = struct.unpack(LINK_HEADER_FMT, hdr)
-        sha_value = sha1(str(age))
-        sha_value.update(parent)
         rest = checked_read(in_stream, length - LINK_HEADER_LEN)
-        sha_value.update(rest)
-        value = sha_value.digest()
+        value = link_sha(age, parent, rest)
         if value in copied_shas:
             continue # Only copy once.
 
@@ -150,16 +152,13 @@ def write_raw_link(out_stream, age, parent, raw_file, stream_index):
                                      age,
                                      parent))
 
-        sha_value = sha1(str(age))
-        sha_value.update(parent)
-
         out_stream.write(raw)
         # REDFLAG: read / hash incrementally
-        sha_value.update(raw)
+        sha_value = link_sha(age, parent, raw)
     finally:
         in_file.close()
 
-    return (sha_value.digest(), age, parent, None,
+    return (sha_value, age, parent, None,
             pos, stream_index, len(raw) + LINK_HEADER_LEN)
 
 def write_file_manifest(name_map, out_stream):
@@ -220,7 +219,7 @@ def get_file_sha(full_path):
         sha_value = sha1()
         while True:
             bytes = in_file.read(READ_CHUNK_LEN)
-            if bytes == "":
+            if bytes == b"":
                 break
             sha_value.update(bytes)
         return sha_value.digest()
@@ -0,0 +1,157 @@
+""" A simple rolling hash binary delta for files that aren't line oriented.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# Same idea as rsync. Index fixed size blocks of the old file by a weak
+# rolling checksum, slide a window over the new file looking for
+# matches, and emit copy / insert operations.
+#
+# Wire rep:
+# <new length>[<op>...]
+# op is one of:
+# 'C'<old offset><length>
+# 'I'<length><literal bytes>
+
+import struct
+
+BLOCK_LEN = 32
+
+# Don't bother indexing more than this many offsets per checksum.
+MAX_CANDIDATES = 8
+
+DELTA_HDR_FMT = '!L'
+DELTA_HDR_LEN = struct.calcsize(DELTA_HDR_FMT)
+COPY_FMT = '!LL'
+COPY_LEN = struct.calcsize(COPY_FMT)
+INSERT_FMT = '!L'
+INSERT_LEN = struct.calcsize(INSERT_FMT)
+
+OP_COPY = b'C'
+OP_INSERT = b'I'
+
+def weak_checksum(data):
+    """ Return the (a, b) rsync style weak checksum for data. """
+    a_sum = 0
+    b_sum = 0
+    length = len(data)
+    for index, value in enumerate(bytearray(data)):
+        a_sum += value
+        b_sum += (length - index) * value
+    return a_sum & 0xffff, b_sum & 0xffff
+
+def index_blocks(old, block_len=BLOCK_LEN):
+    """ INTERNAL: Return a weak checksum -> [offset, ...] map for the
+        non-overlapping blocks in old. """
+    table = {}
+    for offset in range(0, len(old) - block_len + 1, block_len):
+        a_sum, b_sum = weak_checksum(old[offset:offset + block_len])
+        offsets = table.setdefault((b_sum << 16) | a_sum, [])
+        if len(offsets) < MAX_CANDIDATES:
+            offsets.append(offset)
+    return table
+
+def find_match(table, old, new, pos, weak, block_len):
+    """ INTERNAL: Return the (old_offset, length) of the longest verified
+        match for the window at pos, or None. """
+    best = None
+    window = new[pos:pos + block_len]
+    for offset in table.get(weak, ()):
+        if old[offset:offset + block_len] != window:
+            continue # Weak checksum collision.
+        length = block_len
+        while (offset + length < len(old) and pos + length < len(new) and
+               old[offset + length] == new[pos + length]):
+            length += 1
+        if best is None or length > best[1]:
+            best = (offset, length)
+    return best
+
+def make_delta(old, new, block_len=BLOCK_LEN):
+    """ Return binary delta bytes which turn old into new. """
+    old = bytes(old)
+    new = bytes(new)
+    ops = [struct.pack(DELTA_HDR_FMT, len(new)), ]
+
+    def flush_literal(start, end):
+        """ INTERNAL: Emit an insert op for new[start:end]. """
+        if end > start:
+            ops.append(OP_INSERT + struct.pack(INSERT_FMT, end - start))
+            ops.append(new[start:end])
+
+    table = index_blocks(old, block_len)
+    literal_start = 0
+    pos = 0
+    a_sum = b_sum = None
+    while pos + block_len <= len(new):
+        if a_sum is None:
+            a_sum, b_sum = weak_checksum(new[pos:pos + block_len])
+
+        match = find_match(table, old, new, pos,
+                           (b_sum << 16) | a_sum, block_len)
+        if not match is None:
+            flush_literal(literal_start, pos)
+            ops.append(OP_COPY + struct.pack(COPY_FMT, match[0], match[1]))
+            pos += match[1]
+            literal_start = pos
+            a_sum = None # Restart the rolling checksum.
+            continue
+
+        if pos + block_len >= len(new):
+            break
+
+        # Roll the window forward by one byte.
+        out_value = new[pos]
+        in_value = new[pos + block_len]
+        a_sum = (a_sum - out_value + in_value) & 0xffff
+        b_sum = (b_sum - block_len * out_value + a_sum) & 0xffff
+        pos += 1
+
+    flush_literal(literal_start, len(new))
+    return b''.join(ops)
+
+def apply_delta(old, delta):
+    """ Return the bytes made by applying a delta from make_delta()
+        to old. """
+    length = struct.unpack(DELTA_HDR_FMT, delta[:DELTA_HDR_LEN])[0]
+    parts = []
+    pos = DELTA_HDR_LEN
+    while pos < len(delta):
+        op_code = delta[pos:pos + 1]
+        pos += 1
+        if op_code == OP_COPY:
+            offset, count = struct.unpack(COPY_FMT,
+                                          delta[pos:pos + COPY_LEN])
+            pos += COPY_LEN
+            if offset + count > len(old):
+                raise ValueError("Copy past end of old data.")
+            parts.append(old[offset:offset + count])
+        elif op_code == OP_INSERT:
+            count = struct.unpack(INSERT_FMT,
+                                  delta[pos:pos + INSERT_LEN])[0]
+            pos += INSERT_LEN
+            parts.append(delta[pos:pos + count])
+            pos += count
+        else:
+            raise ValueError("Unknown delta op: %r" % op_code)
+
+    ret = b''.join(parts)
+    if len(ret) != length:
+        raise ValueError("Delta produced the wrong length.")
+    return ret
@@ -23,7 +23,7 @@
 
 import os
 
-from archive import MIN_BLOCK_LEN, UpToDateException
+from archive import MIN_BLOCK_LEN, CHUNK_AGE, UpToDateException
 from linkmap import LinkMap
 from binaryrep import NULL_SHA, copy_raw_links
 
@@ -137,6 +137,8 @@ class BlockStorage:
             age = max(age, link[1])
             # New link
             referenced_shas.add(link[0])
+            if link[1] == CHUNK_AGE:
+                continue # The parent field isn't a parent.
             # Previous history
             # TRICKY: You can't call get_history on the new link itself
             #         because it isn't commited yet.
@@ -181,6 +183,8 @@ class BlockStorage:
                                   self.full_path(ordinal, False))
 
         for ordinal in range(0, num_blocks):
+            if os.path.exists(self.full_path(ordinal, False)):
+                os.remove(self.full_path(ordinal, False)) # Might be a link.
             out_file = open(self.full_path(ordinal, False), 'wb')
             out_file.close()
 
@@ -452,6 +456,10 @@ class BlockStorage:
 
             # Add trailing zero length blocks.
             for index in range(self.nonzero_blocks(), min_blocks):
+                # Block files may be hard links to cached blocks.
+                # Never truncate one in place.
+                if os.path.exists(self.full_path(index, False)):
+                    os.remove(self.full_path(index, False))
                 out_file = open(self.full_path(index, False), 'wb')
                 out_file.close()
         finally:
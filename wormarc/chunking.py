@@ -0,0 +1,123 @@
+""" Content defined chunking used to share data between files in an
+    archive.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+# This is FastCDC (Xia et al., USENIX ATC '16): a gear hash with
+# normalized chunking. Chunk boundaries depend only on nearby content,
+# so an insertion only changes the chunks around it, and identical
+# runs of data in different files end up in identical chunks.
+
+from hashlib import sha1
+
+MIN_CHUNK_LEN = 2 * 1024
+AVG_CHUNK_LEN = 8 * 1024
+MAX_CHUNK_LEN = 64 * 1024
+
+# Spread mask bits out over the 32 bit hash as suggested in the paper.
+def spread_mask(bits):
+    """ INTERNAL: Return a 32 bit mask with bits one bits spread out over
+        the high end of the word. """
+    mask = 0
+    position = 31
+    step = max(1, 32 // max(bits, 1) - 1)
+    while bits > 0 and position >= 0:
+        mask |= 1 << position
+        position -= step
+        bits -= 1
+    return mask
+
+def make_gear_table():
+    """ INTERNAL: Return 256 pseudo random 32 bit values.
+
+        MUST NEVER CHANGE. Chunk boundaries depend on it. """
+    table = []
+    for index in range(0, 256):
+        table.append(int.from_bytes(sha1(b'gear%i' % index).digest()[:4],
+                                    'big'))
+    return tuple(table)
+
+GEAR = make_gear_table()
+
+def log2(value):
+    """ INTERNAL: Integer log base 2. """
+    ret = 0
+    while value > 1:
+        value >>= 1
+        ret += 1
+    return ret
+
+def iter_boundaries(data, min_len=MIN_CHUNK_LEN, avg_len=AVG_CHUNK_LEN,
+                    max_len=MAX_CHUNK_LEN):
+    """ Generate the end offsets of the content defined chunks in data.
+
+        Callers can stop early without hashing the rest of data. """
+    assert min_len <= avg_len <= max_len
+    bits = log2(avg_len)
+    # Harder to cut before avg_len, easier after.
+    mask_small = spread_mask(bits + 1)
+    mask_large = spread_mask(bits - 1)
+    gear = GEAR
+    length = len(data)
+    data = bytearray(data)
+    start = 0
+    while start < length:
+        if length - start <= min_len:
+            yield length
+            break
+        end = min(start + max_len, length)
+        normal = min(start + avg_len, end)
+        pos = start + min_len
+        value = 0
+        cut = end
+        while pos < normal:
+            value = ((value << 1) + gear[data[pos]]) & 0xffffffff
+            if not value & mask_small:
+                cut = pos + 1
+                break
+            pos += 1
+        else:
+            while pos < end:
+                value = ((value << 1) + gear[data[pos]]) & 0xffffffff
+                if not value & mask_large:
+                    cut = pos + 1
+                    break
+                pos += 1
+        yield cut
+        start = cut
+
+def chunk_boundaries(data, min_len=MIN_CHUNK_LEN, avg_len=AVG_CHUNK_LEN,
+                     max_len=MAX_CHUNK_LEN):
+    """ Return a list of the end offsets of the content defined chunks
+        in data. """
+    return list(iter_boundaries(data, min_len, avg_len, max_len))
+
+def iter_chunks(data, min_len=MIN_CHUNK_LEN, avg_len=AVG_CHUNK_LEN,
+                max_len=MAX_CHUNK_LEN):
+    """ Generate the content defined chunks in data. """
+    start = 0
+    for end in iter_boundaries(data, min_len, avg_len, max_len):
+        yield data[start:end]
+        start = end
+
+def chunk_data(data, min_len=MIN_CHUNK_LEN, avg_len=AVG_CHUNK_LEN,
+               max_len=MAX_CHUNK_LEN):
+    """ Return a list of the content defined chunks in data. """
+    return list(iter_chunks(data, min_len, avg_len, max_len))
@@ -27,8 +27,15 @@
 import zlib
 from mercurial import mdiff
 
+try:
+    #raise ImportError("fake") # To test the fallback code path.
+    import zstandard
+except ImportError:
+    # zstd is optional. Archives written without it still decode.
+    zstandard = None
 
 from binaryrep import NULL_SHA
+import bindelta
 ############################################################
 # ATTRIBUTION: Pillaged from Mercurial revlog.py by Matt Mackall
 #              Then hacked, so bugs are mine.
@@ -38,7 +45,7 @@ _decompress = zlib.decompress
 def compress(text):
     """ generate a possibly-compressed representation of text """
     if not text:
-        return ("", text)
+        return (b"", text)
     l = len(text)
     bin = None
     if l < 44: # Is this Mercurial specific or a zlib overhead thing?
@@ -55,25 +62,25 @@ def compress(text):
             pos = pos2
         p.append(z.flush())
         if sum(map(len, p)) < l:
-            bin = "".join(p)
+            bin = b"".join(p)
     else:
         bin = _compress(text)
     if bin is None or len(bin) > l:
-        if text[0] == '\0':
-            return ("", text)
-        return ('u', text)
-    return ("", bin)
+        if text[0:1] == b'\0':
+            return (b"", text)
+        return (b'u', text)
+    return (b"", bin)
 
 def decompress(bin):
     """ decompress the given input """
     if not bin:
         return bin
-    t = bin[0]
-    if t == '\0':
+    t = bin[0:1]
+    if t == b'\0':
         return bin
-    if t == 'x':
+    if t == b'x':
         return _decompress(bin)
-    if t == 'u':
+    if t == b'u':
         return bin[1:]
 
     raise Exception("unknown compression type %r" % t)
@@ -83,6 +90,214 @@ def decompress(bin):
 
 ############################################################
 
+############################################################
+# Codecs
+#
+# Blobs written by older versions are the raw output of compress()
+# above, so their first byte is always '\0', 'x' or 'u'.  Newer blobs
+# start with CODEC_MARKER followed by a one byte codec id, so the codec
+# is recorded in every link without changing the link wire format.
+#
+# Wire rep:
+# [CODEC_MARKER<codec id>]<codec payload>
+
+CODEC_MARKER = b'c'
+
+# Ids for the codecs built into this module.
+CODEC_ZSTD = 1
+CODEC_BINARY = 2
+CODEC_CHUNK_LIST = 3
+# Ids >= this are for codecs registered by the application, e.g.
+# zstd with a trained dictionary.
+FIRST_USER_CODEC = 16
+
+# Bytes sniffed by looks_binary().
+SNIFF_LEN = 8 * 1024
+
+ZSTD_LEVEL = 19
+
+# Magic numbers for formats which are already compressed.
+COMPRESSED_MAGIC = (b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'PK\x03\x04',
+                    b'\x1f\x8b', b'BZh', b'\xfd7zXZ', b'(\xb5/\xfd',
+                    b'OggS', b'ID3')
+
+def looks_binary(raw):
+    """ Return True if raw doesn't look like line oriented text. """
+    return raw[:SNIFF_LEN].find(b'\0') != -1 or looks_compressed(raw)
+
+def looks_compressed(raw):
+    """ Return True if raw starts with the magic number of a compressed
+        file format. """
+    for magic in COMPRESSED_MAGIC:
+        if raw.startswith(magic):
+            return True
+    return False
+
+class DeltaCodec:
+    """ ABC for a pluggable delta and compression algorithm.
+
+        codec_id is written into every blob the codec encodes.
+        None means write the old untagged format.
+    """
+    def __init__(self, codec_id):
+        self.codec_id = codec_id
+
+    def encode(self, raw):
+        """ Return the compressed representation of raw. """
+        raise NotImplementedError()
+
+    def decode(self, payload):
+        """ Return the raw bytes for a payload written by encode(). """
+        raise NotImplementedError()
+
+    def make_patch(self, old, new):
+        """ Return patch bytes which transform old into new. """
+        raise NotImplementedError()
+
+    # Default implementation applies one patch at a time.
+    def apply_patches(self, text, patches):
+        """ Apply a list of patches, oldest first, to text. """
+        for patch in patches:
+            text = self.apply_patch(text, patch)
+        return text
+
+    def apply_patch(self, text, patch):
+        """ Apply a single patch to text. """
+        raise NotImplementedError()
+
+class MercurialCodec(DeltaCodec):
+    """ The original codec, mdiff.textdiff() patches + zlib, written
+        in the untagged format so older versions can read it. """
+    def __init__(self):
+        DeltaCodec.__init__(self, None)
+
+    def encode(self, raw):
+        """ Return the compressed representation of raw. """
+        return b''.join(compress(raw))
+
+    def decode(self, payload):
+        """ Return the raw bytes for a payload written by encode(). """
+        return decompress(payload)
+
+    def make_patch(self, old, new):
+        """ Return patch bytes which transform old into new. """
+        return mdiff.textdiff(old, new)
+
+    def apply_patches(self, text, patches):
+        """ Apply a list of patches, oldest first, to text. """
+        return mdiff.patches(text, patches)
+
+    def apply_patch(self, text, patch):
+        """ Apply a single patch to text. """
+        return mdiff.patches(text, [patch, ])
+
+class ZstdCodec(MercurialCodec):
+    """ mdiff.textdiff() patches compressed with zstd, optionally using
+        a trained dictionary.
+
+        The dictionary isn't stored in the archive. The same
+        dictionary MUST be registered under the same codec_id
+        to read blobs written with it.
+    """
+    def __init__(self, codec_id=CODEC_ZSTD, dict_data=None,
+                 level=ZSTD_LEVEL):
+        MercurialCodec.__init__(self)
+        if zstandard is None:
+            raise ImportError("The zstandard module isn't installed.")
+        self.codec_id = codec_id
+        self.dictionary = None
+        if not dict_data is None:
+            self.dictionary = zstandard.ZstdCompressionDict(dict_data)
+        self.level = level
+
+    def encode(self, raw):
+        """ Return the compressed representation of raw. """
+        return zstandard.ZstdCompressor(level=self.level,
+                                        dict_data=self.dictionary,
+                                        write_content_size=True).compress(raw)
+
+    def decode(self, payload):
+        """ Return the raw bytes for a payload written by encode(). """
+        return zstandard.ZstdDecompressor(
+            dict_data=self.dictionary).decompress(payload)
+
+def train_zstd_dictionary(samples, dict_size=16 * 1024):
+    """ Return the bytes of a zstd dictionary trained on a list of
+        sample file contents. """
+    if zstandard is None:
+        raise ImportError("The zstandard module isn't installed.")
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+class BinaryCodec(DeltaCodec):
+    """ Rolling hash copy / insert deltas from bindelta.py for files
+        which mdiff would treat as one giant line. """
+    def __init__(self, codec_id=CODEC_BINARY):
+        DeltaCodec.__init__(self, codec_id)
+
+    def encode(self, raw):
+        """ Return the compressed representation of raw. """
+        if looks_compressed(raw):
+            # Don't waste time trying to compress a .png or .zip.
+            return b'u' + raw
+        return b''.join(compress(raw))
+
+    def decode(self, payload):
+        """ Return the raw bytes for a payload written by encode(). """
+        return decompress(payload)
+
+    def make_patch(self, old, new):
+        """ Return patch bytes which transform old into new. """
+        return bindelta.make_delta(old, new)
+
+    def apply_patch(self, text, patch):
+        """ Apply a single patch to text. """
+        return bindelta.apply_delta(text, patch)
+
+class ChunkListCodec(DeltaCodec):
+    """ A full file stored as a list of the SHA1 hashes of the history
+        links which hold its chunks.
+
+        DeltaCoder.decode_blob() does the expansion, since only it
+        can read other links. """
+    def __init__(self):
+        DeltaCodec.__init__(self, CODEC_CHUNK_LIST)
+
+    def encode(self, raw):
+        """ Return the compressed representation of raw. """
+        assert len(raw) % 20 == 0
+        return raw
+
+    def decode(self, payload):
+        """ Return the raw bytes for a payload written by encode(). """
+        if len(payload) % 20 != 0:
+            raise Exception("Bad chunk list length: %i" % len(payload))
+        return payload
+
+    def make_patch(self, old, new):
+        """ Chunk lists are always written as full inserts. """
+        raise NotImplementedError()
+
+    def apply_patch(self, text, patch):
+        """ Chunk lists are always written as full inserts. """
+        raise NotImplementedError()
+
+CHUNK_LIST_PREFIX = CODEC_MARKER + bytes([CODEC_CHUNK_LIST])
+
+def is_chunk_list(blob_prefix):
+    """ Return True if a blob starting with blob_prefix is a
+        chunk list. """
+    return blob_prefix[:len(CHUNK_LIST_PREFIX)] == CHUNK_LIST_PREFIX
+
+def chunk_list_shas(blob):
+    """ Return the tuple of chunk link SHA1 hashes in a chunk
+        list blob. """
+    assert is_chunk_list(blob)
+    payload = blob[len(CHUNK_LIST_PREFIX):]
+    return tuple([payload[pos:pos + 20]
+                  for pos in range(0, len(payload), 20)])
+
+############################################################
+
 # REDFLAG: wants_stream ENOTIMPL, who closes stream?
 # Returns raw patch data if if it's not set
 # returns a readable stream if wants_stream is True, otherwise the raw data
@@ -90,14 +305,82 @@ def decompress(bin):
 #    pass
 
 class DeltaCoder:
-    """ Wrapper around the delta compression/decompression implementation
-        used by the Mercurial Revlog.
+    """ Wrapper around a registry of delta compression/decompression
+        codecs.
+
+        The default text codec is the one used by the Mercurial
+        Revlog, binary files use BinaryCodec. Pass use_zstd=True to
+        write text with zstd instead. Only do that if everyone who reads
+        the archive has zstandard installed.
 
         See revlog.py, mdiff.py, mpatch.c, bdiff.c in Mercurial codebase.
     """
-    def __init__(self):
+    def __init__(self, use_zstd=False):
         self.get_data_func = lambda x:None
         self.tmp_file_mgr = None
+        self.codecs = {}
+        self.legacy_codec = MercurialCodec()
+        self.register_codec(BinaryCodec())
+        self.register_codec(ChunkListCodec())
+        self.binary_codec = self.codecs[CODEC_BINARY]
+        self.text_codec = self.legacy_codec
+        if not zstandard is None:
+            # Can read zstd blobs, but doesn't write them unless asked.
+            # Peers without zstandard couldn't read them.
+            self.register_codec(ZstdCodec())
+        if use_zstd:
+            if zstandard is None:
+                raise ImportError("use_zstd requires the zstandard module.")
+            self.text_codec = self.codecs[CODEC_ZSTD]
+
+    def register_codec(self, codec):
+        """ Add a codec so blobs written with its id can be decoded. """
+        if codec.codec_id is None or codec.codec_id < 0 or \
+               codec.codec_id > 255:
+            raise ValueError("Bad codec id: %s" % str(codec.codec_id))
+        if (codec.codec_id in self.codecs and
+            not self.codecs[codec.codec_id] is codec):
+            raise ValueError("Codec id already registered: %i" %
+                             codec.codec_id)
+        self.codecs[codec.codec_id] = codec
+
+    # Subclasses can override to select codecs by some other policy.
+    def choose_codec(self, raw_new):
+        """ Return the codec to use to write a new version of a file. """
+        if looks_binary(raw_new):
+            return self.binary_codec
+        return self.text_codec
+
+    def encode_blob(self, codec, raw):
+        """ INTERNAL: Return the tagged blob bytes for raw. """
+        if codec.codec_id is None:
+            return codec.encode(raw)
+        return CODEC_MARKER + bytes([codec.codec_id]) + codec.encode(raw)
+
+    def decode_blob(self, blob):
+        """ INTERNAL: Return a (codec, raw bytes) tuple for a blob. """
+        if blob[0:1] != CODEC_MARKER:
+            return (self.legacy_codec, decompress(blob))
+        codec = self.codecs.get(blob[1])
+        if codec is None:
+            raise Exception("Unknown codec id: %i" % blob[1])
+        if codec.codec_id == CODEC_CHUNK_LIST:
+            chunks = [self.decode_blob(self.get_data_func(sha_value))[1]
+                      for sha_value in chunk_list_shas(blob)]
+            return (codec, b''.join(chunks))
+        return (codec, codec.decode(blob[2:]))
+
+    def make_chunk_blob(self, chunk):
+        """ Return the blob bytes to store a single chunk.
+
+            The same chunk bytes MUST always make the same blob or
+            chunks won't be shared. """
+        return self.encode_blob(self.choose_codec(chunk), chunk)
+
+    def make_chunk_list_blob(self, chunk_shas):
+        """ Return the blob bytes for a list of chunk link hashes. """
+        return self.encode_blob(self.codecs[CODEC_CHUNK_LIST],
+                                b''.join(chunk_shas))
 
     # Define an ABC? What would the runtime overhead be?
     # Subclass might need tmp_file_mgr or get_data_func.
@@ -114,15 +397,13 @@ class DeltaCoder:
             in_file.close()
 
         if disable_compression:
-            values = ('u', raw_new)
+            blob = b'u' + raw_new
         else:
-            values = compress(raw_new)
+            blob = self.encode_blob(self.choose_codec(raw_new), raw_new)
 
         out_file = open(out_file_name, 'wb')
         try:
-            if values[0]:
-                out_file.write(values[0])
-            out_file.write(values[1])
+            out_file.write(blob)
         finally:
             out_file.close()
 
@@ -151,13 +432,12 @@ class DeltaCoder:
         in_old = open(old_file, 'rb')
         try:
             raw_old = in_old.read()
-            values = compress(mdiff.textdiff(raw_old, raw_new))
+            codec = self.choose_codec(raw_new)
+            blob = self.encode_blob(codec, codec.make_patch(raw_old, raw_new))
             parent = history_chain[0][0]
             out_file = open(out_file_name, 'wb')
             try:
-                if values[0]:
-                    out_file.write(values[0])
-                out_file.write(values[1])
+                out_file.write(blob)
             finally:
                 out_file.close()
         finally:
@@ -191,16 +471,24 @@ class DeltaCoder:
             index += 1
 
         assert not text is None
-        text = decompress(text)
-        if len(deltas) == 0:
-            raw = text
-        else:
-            for index in range(0, len(deltas)):
-                deltas[index] = decompress(deltas[index])
-            deltas.reverse() # iterate in reverse?
-            raw = mdiff.patches(text, deltas)
-
+        raw = self.decode_blob(text)[1]
         text = None
+        deltas.reverse() # Oldest first.
+
+        # Apply runs of patches written by the same codec together
+        # so mdiff.patches() can still fold them.
+        run = []
+        for delta in deltas:
+            codec, patch = self.decode_blob(delta)
+            if len(run) > 0 and not run[0] is codec:
+                raw = run[0].apply_patches(raw, run[1:])
+                run = []
+            if len(run) == 0:
+                run.append(codec)
+            run.append(patch)
+        if len(run) > 0:
+            raw = run[0].apply_patches(raw, run[1:])
+
         out_file = open(out_file_name, "wb")
         try:
             out_file.write(raw)
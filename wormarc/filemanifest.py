@@ -24,6 +24,8 @@
 
 import os
 import shutil
+import time
+from binascii import hexlify, unhexlify
 
 from binaryrep import NULL_SHA, manifest_from_file, \
      manifest_to_file, get_file_sha, check_shas, str_sha
@@ -146,8 +148,9 @@ class FileManifest:
                         # Renamed
                         new_name_map[name] = file_sha_map[file_sha]
                     else:
-                        # REDFLAG: We lose history for files which are renamed
-                        #          and modified.
+                        # We lose history for files which are renamed
+                        # and modified, but write_new_delta() can still
+                        # share chunks with the old version.
                         # Created (or renamed and modified)
                         link = archive.write_new_delta(NULL_SHA, full_path)
                         new_name_map[name] = (file_sha, link[0])
@@ -375,6 +378,114 @@ def read_local_dir(manifest, target_dir, dirs, ignore_regex):
 
     return (overwrite, remove, local_dirs, extant)
 
+#----------------------------------------------------------#
+
+# Files modified less than this many seconds before they were
+# recorded aren't trusted. A later write in the same mtime tick
+# wouldn't change the stat info.
+RACY_SECS = 2
+
+def stat_info(full_path):
+    """ INTERNAL: Return an (mtime_ns, size, inode) tuple for a file,
+        or None if it doesn't exist. """
+    try:
+        values = os.stat(full_path)
+    except OSError:
+        return None
+    return (values.st_mtime_ns, values.st_size, values.st_ino)
+
+def name_key(name):
+    """ INTERNAL: Names are stored as bytes. """
+    if isinstance(name, bytes):
+        return name
+    return name.encode('utf8')
+
+class StatCache:
+    """ A persistent map of local file stat info to the SHA1 hashes of
+        the file and the history link it was extracted from.
+
+        Used by manifest_to_dir() to skip files which are already up
+        to date without rehashing them.
+    """
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+        # name -> (mtime_ns, size, inode, file_sha, history_sha)
+        self.entries = {}
+
+    # Wire rep, one line per file, all hex except the ints:
+    # <history sha> <file sha> <mtime_ns> <size> <inode> <name>
+    @classmethod
+    def from_file(cls, file_name):
+        """ Load a StatCache. A missing or corrupt file gives an
+            empty cache. """
+        cache = StatCache(file_name)
+        if not os.path.exists(file_name):
+            return cache
+        in_file = open(file_name, 'rb')
+        try:
+            try:
+                for line in in_file:
+                    fields = line.split()
+                    cache.entries[unhexlify(fields[5])] = (
+                        int(fields[2]), int(fields[3]), int(fields[4]),
+                        unhexlify(fields[1]), unhexlify(fields[0]))
+            except (ValueError, IndexError, TypeError):
+                # Cheap to rebuild.
+                cache.entries = {}
+        finally:
+            in_file.close()
+        return cache
+
+    def save(self):
+        """ Write the cache to its file. """
+        tmp_name = self.file_name + '.tmp'
+        out_file = open(tmp_name, 'wb')
+        try:
+            for name in sorted(self.entries):
+                mtime, size, inode, file_sha, history_sha = \
+                       self.entries[name]
+                out_file.write(b' '.join((hexlify(history_sha),
+                                          hexlify(file_sha),
+                                          b'%i' % mtime, b'%i' % size,
+                                          b'%i' % inode,
+                                          hexlify(name))) + b'\n')
+        finally:
+            out_file.close()
+        os.replace(tmp_name, self.file_name)
+
+    def record(self, name, full_path, file_sha, history_sha):
+        """ Record the state of a file which matches file_sha. """
+        info = stat_info(full_path)
+        if info is None:
+            self.forget(name)
+            return
+        if info[0] >= (time.time() - RACY_SECS) * 1e9:
+            info = (0, ) + info[1:] # Check the hash next time.
+        self.entries[name_key(name)] = info + (file_sha, history_sha)
+
+    def forget(self, name):
+        """ Remove a file from the cache. """
+        self.entries.pop(name_key(name), None)
+
+    def is_current(self, name, full_path, file_sha, history_sha):
+        """ Return True if the file at full_path has contents file_sha.
+
+            Only hashes the file if the stat info doesn't match. """
+        info = stat_info(full_path)
+        if info is None:
+            return False
+        entry = self.entries.get(name_key(name))
+        if not entry is None and entry[:3] == info:
+            if entry[4] == history_sha or entry[3] == file_sha:
+                if entry[4] != history_sha:
+                    self.record(name, full_path, file_sha, history_sha)
+                return True
+
+        if get_file_sha(full_path) != file_sha:
+            return False
+        self.record(name, full_path, file_sha, history_sha)
+        return True
+
 # Hmmm... wackamole code.
 # REDFLAG: Other ways to make sleazy path references.
 def validate_path(base_dir, full_path):
@@ -395,10 +506,14 @@ def validate_path(base_dir, full_path):
 # No error handling or cleanup.
 # Doubt this will work on Windows, must handle backwards path sep.
 def manifest_to_dir(archive, manifest, target_dir, ignore_regex=None,
-                    dry_run=False):
+                    dry_run=False, stat_cache=None):
 
     """ Update files in a local directory by extracting files in a manifest.
 
+        If stat_cache is set, only files which don't already match
+        the manifest are extracted, and overwrite only contains them.
+        The caller is responsible for saving the cache.
+
         WARNING. NOT WELL TESTED. POTENTIALLY DANGEROUS.
         PROBABLY BROKEN ON WINDOWS. """
 
@@ -409,6 +524,18 @@ def manifest_to_dir(archive, manifest, target_dir, ignore_regex=None,
 
     remove_dirs = local_dirs - dirs
     create = set(manifest.name_map.keys()) - extant
+    if not stat_cache is None:
+        for name in remove:
+            stat_cache.forget(name)
+        names = set([name_key(name) for name in manifest.name_map])
+        for name in list(stat_cache.entries.keys()):
+            if not name in names:
+                stat_cache.forget(name)
+        overwrite = set([name for name in overwrite
+                         if not stat_cache.is_current(
+                             name, os.path.join(target_dir, name),
+                             manifest.name_map[name][0],
+                             manifest.name_map[name][1])])
     if dry_run:
         return (create, overwrite, set(remove.keys()), remove_dirs)
 
@@ -434,9 +561,16 @@ def manifest_to_dir(archive, manifest, target_dir, ignore_regex=None,
 
     # Copy files out of the archive, onto the local file system.
     for file_name in manifest.name_map:
+        if (not stat_cache is None and not file_name in create and
+            not file_name in overwrite):
+            continue # Already up to date.
         validate_path(target_dir, os.path.join(target_dir, file_name))
         archive.get_file(manifest.name_map[file_name][1],
                          os.path.join(target_dir, file_name))
+        if not stat_cache is None:
+            stat_cache.record(file_name, os.path.join(target_dir, file_name),
+                              manifest.name_map[file_name][0],
+                              manifest.name_map[file_name][1])
 
     return (create, overwrite, set(remove.keys()), remove_dirs)
 
@@ -19,7 +19,7 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
-from binaryrep import read_link, str_sha
+from binaryrep import read_link, str_sha, LINK_HEADER_LEN
 
 class LinkMap(dict):
     """ A history link hash addressable index of the history links in
@@ -27,6 +27,17 @@ class LinkMap(dict):
     def __init__(self):
         dict.__init__(self)
         self.files = []
+        # Incrementally maintained so that archive.compress() doesn't
+        # have to walk every link on every commit.
+        self.referenced = frozenset([])
+        self.referenced_lens = {} # block ordinal -> referenced bytes
+
+    def _count_link(self, link, sign=1):
+        """ INTERNAL: Update the referenced byte counters for a link. """
+        if not link[0] in self.referenced:
+            return
+        self.referenced_lens[link[5]] = (self.referenced_lens.get(link[5], 0)
+                                         + sign * link[6])
 
     def read(self, file_list, keep_data=False):
         """ Read the index from a collection of block files. """
@@ -64,6 +75,7 @@ class LinkMap(dict):
             link = list(link) # REDFLAG: ??? tuple -> list -> tuple
             prev.append(tuple(link))
             self[link[0]] = tuple(prev)
+            self._count_link(link)
             count += 1
 
         return age, count
@@ -73,6 +85,7 @@ class LinkMap(dict):
     # Omit from fixups == delete
     def _update_block_ordinals(self, fixups):
         """ INTERNAL: Implementation helper for update_blocks(). """
+        self.referenced_lens = {}
         for sha_hash in list(self.keys()):
             prev = self.get(sha_hash)
             updated = []
@@ -83,6 +96,7 @@ class LinkMap(dict):
                 link = list(link)
                 link[5] = fixups[link[5]]
                 updated.append(tuple(link))
+                self._count_link(link)
             if len(updated) > 0:
                 self[sha_hash] = tuple(updated)
             else:
@@ -117,6 +131,27 @@ class LinkMap(dict):
             if raised:
                 self.close()
 
+    def set_referenced(self, referenced_shas):
+        """ Set the history link hashes which count as referenced.
+
+            Only the difference from the previous set is visited. """
+        referenced_shas = frozenset(referenced_shas)
+        dropped = self.referenced - referenced_shas
+        added = referenced_shas - self.referenced
+        for sha_hash in dropped:
+            for link in self.get(sha_hash, ()):
+                self._count_link(link, -1)
+        self.referenced = referenced_shas
+        for sha_hash in added:
+            for link in self.get(sha_hash, ()):
+                self._count_link(link)
+
+    def referenced_lengths(self, count):
+        """ Return a list of the referenced bytes in the first count
+            blocks. """
+        return [self.referenced_lens.get(index, 0)
+                for index in range(0, count)]
+
     def close(self):
         """ Close the index. """
         for in_file in self.files:
@@ -150,6 +185,17 @@ class LinkMap(dict):
         assert ret[0] ==  link_sha
         return ret
 
+    def read_prefix(self, link_sha, length):
+        """ Read at most length bytes from the start of a link's blob
+            data without reading the rest of it. """
+        link = self.get_link(link_sha)
+        if not link[3] is None:
+            return link[3][:length]
+
+        in_stream = self.files[link[5]]
+        in_stream.seek(link[4] + LINK_HEADER_LEN)
+        return in_stream.read(min(length, link[6]))
+
 def raw_block_read(link_map, ordinal):
     """ Read a single block file. """
     table = {}
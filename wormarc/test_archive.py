@@ -44,15 +44,20 @@ from binaryrep import NULL_SHA, get_file_sha, str_sha
 from blocks import BlockStorage, ITempFileManager
 from linkmap import verify_link_map
 from filemanifest import FileManifest, entries_from_dir, entries_from_seq, \
-     manifest_to_dir, verify_manifest, validate_path
+     manifest_to_dir, verify_manifest, validate_path, StatCache
 
 from archive import WORMBlockArchive, is_ordered, is_contiguous, \
-     repartition, compress
+     repartition, compress, plan_compress
 
-from deltacoder import DeltaCoder
+from chunking import chunk_boundaries
+from deltacoder import DeltaCoder, BinaryCodec, ZstdCodec, \
+     train_zstd_dictionary, zstandard, FIRST_USER_CODEC, CODEC_MARKER, \
+     CODEC_BINARY, CODEC_ZSTD
 
 from hghelper import export_hg_repo
 
+from benchmark import run_benchmarks, WORKLOADS
+
 # False causes test dir to be cleaned up automatically
 # after every run.
 LEAVE_TEST_DIR = False
@@ -572,7 +577,7 @@ class SmokeTests(ArchiveTestCase):
             self.assertTrue(is_contiguous(repartioned))
 
 
-    def updateFunc(self, blocks, change_len, max_len):
+    def updateFunc(self, blocks, change_len, max_len, compress_func=compress):
         assert len(blocks) > 0
         blocks = blocks[:]
         if blocks[0][2] + change_len < 32 * 1024:
@@ -580,7 +585,7 @@ class SmokeTests(ArchiveTestCase):
             return blocks
         # Add and compress
         blocks.insert(0, (-1, -1, change_len))
-        return compress(blocks, max_len)
+        return compress_func(blocks, max_len)
 
     def histogram(self, values, bin_width):
         table = {}
@@ -642,6 +647,379 @@ class SmokeTests(ArchiveTestCase):
             print("%i %i %i" % (percent, point, point/(32*1024 + 1)))
 
 
+    # Returns the total number of bytes written into new blocks.
+    def simulate_bytes_written(self, compress_func, max_blocks,
+                               iterations, change_size):
+        blocks = [(index, index, 0) for index in range(0, max_blocks)]
+        written = 0
+        for dummy in range(0, iterations):
+            old_blocks = blocks[:]
+            blocks = self.updateFunc(blocks, change_size, max_blocks,
+                                     compress_func)
+            self.assertTrue(is_ordered(blocks) or
+                            (is_ordered(blocks[1:]) and
+                             blocks[0][2] < 32 * 1024))
+            self.assertTrue(len(blocks) <= max_blocks)
+
+            # Unchanged blocks keep their old (index, index, length) tuple.
+            written += sum([value[2] for value in
+                            set(blocks) - set(old_blocks)])
+
+            # Fix ordinals. Shouldn't matter.
+            blocks = [(index, index, blocks[index][2]) for index
+                      in range(0, len(blocks))]
+        return written
+
+    def test_contiguous_groupings(self):
+        for length in range(1, 8):
+            for max_len in range(2, length + 2):
+                blocks = [(index, index, 1)
+                          for index in range(0, length)]
+                planned = plan_compress(blocks, max_len, 0)
+                self.assertTrue(len(planned) <= max_len)
+                self.assertTrue(is_contiguous(planned))
+                self.assertTrue(sum([value[2] for value in planned])
+                                == length)
+
+    def test_plan_compress(self):
+        for dummy in range(0, 1000):
+            length = random.randrange(1, 8)
+            max_len = random.randrange(2, 6)
+            blocks = [(index, index, random.randrange(0, 10))
+                      for index in range(0, length)]
+            original_blocks = blocks[:]
+            planned = plan_compress(blocks, max_len)
+            self.assertTrue(blocks == original_blocks)
+            self.assertTrue(len(planned) <= max_len)
+            self.assertTrue(is_contiguous(planned) or
+                            0 in [value[2] for value in blocks])
+            if len(planned) < len([value for value in blocks
+                                   if value[2] > 0]):
+                self.assertTrue(is_ordered(planned))
+
+    # Compare bytes re-written by the planner against the
+    # greedy compress().
+    def test_simulate_planner(self):
+        iterations = 4000
+        for max_blocks, change_size in ((4, 1024), (4, 2 * 1024),
+                                        (4, 12000), (6, 4 * 1024)):
+            greedy = self.simulate_bytes_written(compress, max_blocks,
+                                                 iterations, change_size)
+            planned = self.simulate_bytes_written(plan_compress, max_blocks,
+                                                  iterations, change_size)
+            print("blocks: %i change: %i greedy: %i planned: %i (%.3f)" %
+                  (max_blocks, change_size, greedy, planned,
+                   planned / float(greedy)))
+            self.assertTrue(planned <= greedy)
+
+    # Returns a history chain, head first, for the versions in raw_list.
+    def make_chain(self, coder, raw_list):
+        chain = []
+        for index, raw in enumerate(raw_list):
+            new_file = self.write_file(raw)
+            blob_file = self.tmps.make_temp_file()
+            if index == 0:
+                parent = coder.make_full_insert(new_file, blob_file)
+            else:
+                old_file = self.write_file(raw_list[index - 1])
+                parent = coder.make_delta(chain, old_file, new_file,
+                                          blob_file)
+                self.tmps.remove_temp_file(old_file)
+            self.tmps.remove_temp_file(new_file)
+            blob = self.read_file(blob_file)
+            chain.insert(0, (sha1(str(index).encode('utf8')).digest(),
+                             index, parent, blob, None, None, len(blob)))
+        return chain
+
+    def check_chain(self, coder, chain, raw_list):
+        for index in range(0, len(chain)):
+            out_file = self.tmps.make_temp_file()
+            coder.apply_deltas(chain[index:], out_file)
+            self.assertTrue(self.read_file(out_file) ==
+                            raw_list[len(chain) - 1 - index])
+
+    def test_delta_codecs(self):
+        text = [b''.join([b'line %i\n' % line for line in range(0, 500)]), ]
+        text.append(text[-1].replace(b'line 7\n', b'line seven\n'))
+        text.append(text[-1] + b'more\n')
+
+        binary = [bytes(bytearray(random.randrange(0, 256)
+                                  for dummy in range(0, 8192))), ]
+        binary.append(binary[-1][:1000] + b'\0\1\2' + binary[-1][1200:])
+        binary.append(binary[-1][:4000] + binary[-1][4100:])
+
+        coder = DeltaCoder()
+        for raw_list in (text, binary):
+            chain = self.make_chain(coder, raw_list)
+            self.check_chain(coder, chain, raw_list)
+
+        # Binary deltas are tagged and much smaller than the file.
+        chain = self.make_chain(coder, binary)
+        self.assertTrue(chain[0][3][0:2] == CODEC_MARKER +
+                        bytes([CODEC_BINARY]))
+        self.assertTrue(chain[0][6] < 1024)
+
+        # Text is written in the format every peer can read.
+        chain = self.make_chain(coder, text)
+        self.assertTrue(chain[0][3][0:1] != CODEC_MARKER)
+
+        # Blobs written by the old coder still decode.
+        old_coder = DeltaCoder()
+        old_coder.text_codec = old_coder.legacy_codec
+        old_coder.binary_codec = old_coder.legacy_codec
+        for raw_list in (text, binary):
+            chain = self.make_chain(old_coder, raw_list)
+            self.assertTrue(chain[0][3][0:1] != CODEC_MARKER)
+            self.check_chain(coder, chain, raw_list)
+
+        # Mixed chains decode.
+        chain = self.make_chain(old_coder, binary[:2])
+        old_file = self.write_file(binary[1])
+        new_file = self.write_file(binary[2])
+        blob_file = self.tmps.make_temp_file()
+        parent = coder.make_delta(chain, old_file, new_file, blob_file)
+        self.tmps.remove_temp_file(old_file)
+        self.tmps.remove_temp_file(new_file)
+        blob = self.read_file(blob_file)
+        chain.insert(0, (sha1(b'mixed').digest(), 2, parent, blob,
+                         None, None, len(blob)))
+        self.check_chain(coder, chain, binary)
+
+        self.assertRaises(ValueError, coder.register_codec,
+                          BinaryCodec(None))
+        self.assertRaises(ValueError, coder.register_codec,
+                          BinaryCodec())
+
+    def test_zstd_dictionary_codec(self):
+        if zstandard is None:
+            print("zstandard isn't installed.")
+            return
+        samples = [b''.join([b'<p>Page %i, paragraph %i</p>\n' %
+                             (page, para) for para in range(0, 20)])
+                   for page in range(0, 200)]
+        dict_data = train_zstd_dictionary(samples, 4096)
+
+        # zstd is only written when asked for.
+        coder = DeltaCoder(True)
+        chain = self.make_chain(coder, samples[:2])
+        self.assertTrue(chain[0][3][0:2] == CODEC_MARKER +
+                        bytes([CODEC_ZSTD]))
+        self.check_chain(DeltaCoder(), chain, samples[:2])
+
+        coder = DeltaCoder()
+        coder.register_codec(ZstdCodec(FIRST_USER_CODEC, dict_data))
+        coder.text_codec = coder.codecs[FIRST_USER_CODEC]
+        raw_list = [samples[0], samples[1]]
+        chain = self.make_chain(coder, raw_list)
+        self.check_chain(coder, chain, raw_list)
+
+        # Can't read without the dictionary.
+        out_file = self.tmps.make_temp_file()
+        self.assertRaises(Exception, DeltaCoder().apply_deltas,
+                          chain, out_file)
+        self.tmps.remove_temp_file(out_file)
+
+    def test_chunk_boundaries(self):
+        raw = bytes(bytearray(random.randrange(0, 256)
+                              for dummy in range(0, 256 * 1024)))
+        ends = chunk_boundaries(raw, 1024, 4096, 16384)
+        self.assertTrue(ends[-1] == len(raw))
+        starts = [0, ] + ends[:-1]
+        for start, end in zip(starts[:-1], ends[:-1]):
+            self.assertTrue(end - start >= 1024 and end - start <= 16384)
+
+        # An insertion only changes the chunks around it.
+        edited = raw[:100000] + b'INSERTED' + raw[100000:]
+        old_chunks = set([raw[start:end] for start, end
+                          in zip(starts, ends)])
+        new_ends = chunk_boundaries(edited, 1024, 4096, 16384)
+        new_chunks = [edited[start:end] for start, end
+                      in zip([0, ] + new_ends[:-1], new_ends)]
+        missing = [chunk for chunk in new_chunks
+                   if not chunk in old_chunks]
+        self.assertTrue(len(missing) <= 2)
+
+    def test_chunk_dedup(self):
+        raw = bytes(bytearray(random.randrange(0, 256)
+                              for dummy in range(0, 128 * 1024)))
+        versions = (raw,
+                    # Renamed and modified.
+                    raw[:60000] + b'A small edit' + raw[60000:],
+                    # Unrelated.
+                    bytes(bytearray(random.randrange(0, 256)
+                                    for dummy in range(0, 20 * 1024))))
+
+        a = self.make_empty_archive('A')
+        heads = []
+        written = []
+        for raw_file in versions:
+            name = self.write_file(raw_file)
+            try:
+                a.start_update()
+                heads.append(a.write_new_delta(NULL_SHA, name)[0])
+                written.append(os.path.getsize(a.blocks.update_file))
+                a.commit_update(a.referenced_shas(heads[:-1]))
+            finally:
+                self.tmps.remove_temp_file(name)
+
+        self.assertTrue(len(a.chunks_for(heads[0])) > 0)
+        self.assertTrue(len(a.chunks_for(heads[1])) > 0)
+        # Only the chunks around the edit were written.
+        self.assertTrue(written[1] < written[0] / 4)
+
+        a.close()
+        b = self.load_archive('A')
+        try:
+            verify_link_map(b.blocks.link_map)
+            # The chunk index is built without reading any chunks.
+            get_data = b.get_data
+            b.get_data = None
+            b.index_chunks()
+            b.get_data = get_data
+            chunk_shas = set([])
+            for head in heads:
+                chunk_shas.update(b.chunks_for(head))
+            self.assertEqual(set(b.chunk_index.values()), chunk_shas)
+            for raw_sha, chunk_sha in b.chunk_index.items():
+                self.assertEqual(sha1(b.delta_coder.decode_blob(
+                    b.get_data(chunk_sha))[1]).digest(), raw_sha)
+
+            # Loaded archives find chunk lists without the cache.
+            self.assertTrue(len(b.chunks_for(heads[1])) > 0)
+            for head, raw_file in zip(heads, versions):
+                out_file = self.tmps.make_temp_file()
+                b.get_file(head, out_file)
+                self.assertTrue(self.read_file(out_file) == raw_file)
+
+            # Dropping the first version keeps the shared chunks.
+            b.start_update()
+            name = self.write_file(versions[2][::-1])
+            try:
+                b.write_new_delta(heads[2], name)
+            finally:
+                self.tmps.remove_temp_file(name)
+            b.commit_update(b.referenced_shas(heads[1:2]))
+            out_file = self.tmps.make_temp_file()
+            b.get_file(heads[1], out_file)
+            self.assertTrue(self.read_file(out_file) == versions[1])
+        finally:
+            b.close()
+
+    def test_chunk_lookup(self):
+        # Compressible, so the chunk blobs depend on the codec.
+        raw = b''.join([b'%i %i\n' % (index, random.randrange(0, 1000000))
+                        for index in range(0, 12000)])
+        edited = raw[:50000] + b'A small edit' + raw[50000:]
+
+        coder = DeltaCoder()
+        if not zstandard is None:
+            coder = DeltaCoder(True)
+        a = WORMBlockArchive(coder, BlockStorage(self.tmps))
+        a.create(self.test_dir, 'A')
+        name = self.write_file(raw)
+        try:
+            a.start_update()
+            head0 = a.write_new_delta(NULL_SHA, name)[0]
+            a.commit_update()
+        finally:
+            self.tmps.remove_temp_file(name)
+            a.close()
+
+        # Chunks are found by their raw bytes, even if they were
+        # written with another codec.
+        b = self.load_archive('A')
+        try:
+            name = self.write_file(edited)
+            try:
+                b.start_update()
+                head1 = b.write_new_delta(NULL_SHA, name)[0]
+                written = os.path.getsize(b.blocks.update_file)
+                b.commit_update(b.referenced_shas([head0]))
+            finally:
+                self.tmps.remove_temp_file(name)
+            self.assertTrue(written < len(raw) / 8)
+            self.assertTrue(len(set(b.chunks_for(head0)) &
+                                set(b.chunks_for(head1))) > 0)
+
+            # Small deltas aren't chunked.
+            name = self.write_file(edited.replace(b'A small edit',
+                                                  b'A smaller edit'))
+            try:
+                b.start_update()
+                link = b.write_new_delta(head1, name)
+                self.assertTrue(link[2] == head1)
+                self.assertTrue(len(b.pending_chunks) == 0)
+                b.commit_update(b.referenced_shas([head0, head1]))
+            finally:
+                self.tmps.remove_temp_file(name)
+            out_file = self.tmps.make_temp_file()
+            b.get_file(link[0], out_file)
+            self.assertTrue(self.read_file(out_file) ==
+                            edited.replace(b'A small edit', b'A smaller edit'))
+        finally:
+            b.close()
+
+    def test_stat_cache(self):
+        cache_file = os.path.join(self.test_dir, 'stat_cache.txt')
+        cache = StatCache.from_file(cache_file)
+        self.assertTrue(len(cache.entries) == 0)
+
+        names = []
+        for index in range(0, 3):
+            full_path = os.path.join(self.test_dir, 'file_%i' % index)
+            out_file = open(full_path, 'wb')
+            out_file.write(b'contents %i' % index)
+            out_file.close()
+            # Not racy.
+            os.utime(full_path, (time.time() - 60, time.time() - 60))
+            names.append(full_path)
+
+        file_shas = [get_file_sha(name) for name in names]
+        history_shas = [sha1(name.encode('utf8')).digest() for name in names]
+        # Unknown files are hashed.
+        self.assertTrue(cache.is_current('file_0', names[0],
+                                         file_shas[0], history_shas[0]))
+        self.assertFalse(cache.is_current('file_1', names[1],
+                                          file_shas[0], history_shas[0]))
+        cache.record('file_1', names[1], file_shas[1], history_shas[1])
+        cache.record('file_2', names[2], file_shas[2], history_shas[2])
+        cache.save()
+
+        cache = StatCache.from_file(cache_file)
+        self.assertTrue(len(cache.entries) == 3)
+
+        # Same stat info, so the changed contents aren't noticed. i.e.
+        # the file wasn't rehashed.
+        stat = os.stat(names[0])
+        out_file = open(names[0], 'wb')
+        out_file.write(b'CONTENTS 0')
+        out_file.close()
+        os.utime(names[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertTrue(cache.is_current('file_0', names[0],
+                                         file_shas[0], history_shas[0]))
+
+        # A new mtime forces a rehash.
+        os.utime(names[0], (time.time() - 30, time.time() - 30))
+        self.assertFalse(cache.is_current('file_0', names[0],
+                                          file_shas[0], history_shas[0]))
+
+        # Files which were just written aren't trusted.
+        os.utime(names[2], None)
+        cache.record('file_2', names[2], file_shas[2], history_shas[2])
+        self.assertTrue(cache.entries[b'file_2'][0] == 0)
+
+        cache.forget('file_1')
+        self.assertFalse(b'file_1' in cache.entries)
+
+    def test_benchmark_smoke(self):
+        results = run_benchmarks(None, 3)
+        self.assertTrue(sorted(results['workloads'].keys()) ==
+                        sorted(WORKLOADS.keys()))
+        for values in list(results['workloads'].values()):
+            self.assertTrue(values['updates'] == 3)
+            self.assertTrue(values['bytes_written'] > 0)
+            self.assertTrue('LinkMap.read' in values['timers'])
+
     def test_hg_repo_torture_test(self):
         if HG_REPO_DIR == '':
             print("Set HG_REPO_DIR!")